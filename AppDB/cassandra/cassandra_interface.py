@@ -24,6 +24,7 @@ from dbinterface_batch import *
 from pycassa.system_manager import *
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../lib/"))
+import appscale_info
 import constants
 import file_io
 
@@ -41,22 +42,107 @@ KEYSPACE = "Keyspace1"
 # The standard column family used for tables
 STANDARD_COL_FAM = "Standard1"
 
+# The number of pooled connections kept open to each database node.
+CONNECTIONS_PER_NODE = 2
+
+# The number of times a failed call is retried on another connection.
+MAX_RETRIES = 5
+
+# Seconds a connection waits on a database node before failing over.
+CONNECTION_TIMEOUT = 5
+
+# The number of rows fetched by a single multiget call.
+MAX_GET_KEYS = 500
+
+# The number of row mutations sent in a single batch_mutate call.
+MAX_MUTATIONS = 500
+
+# The consistency level of reads and writes to tables not listed below.
+DEFAULT_READ_CONSISTENCY = CONSISTENCY_QUORUM
+DEFAULT_WRITE_CONSISTENCY = CONSISTENCY_ONE
+
+# Rows read from these tables only point at entities, which the datastore
+# reads again and validates, so a single replica is enough.
+READ_CONSISTENCY = {
+  APP_KIND_TABLE: CONSISTENCY_ONE,
+  ASC_PROPERTY_TABLE: CONSISTENCY_ONE,
+  DSC_PROPERTY_TABLE: CONSISTENCY_ONE,
+  COMPOSITE_TABLE: CONSISTENCY_ONE,
+}
+
+# Write consistency levels of tables which differ from the default.
+WRITE_CONSISTENCY = {}
+
 class DatastoreProxy(AppDBInterface):
   """ 
     Cassandra implementation of the AppDBInterface
   """
-  def __init__(self):
+  def __init__(self, read_consistency=None, write_consistency=None):
     """
     Constructor.
+
+    Args:
+      read_consistency: A dict of table names to the consistency level used
+        to read them, overriding READ_CONSISTENCY.
+      write_consistency: A dict of table names to the consistency level used
+        to write them, overriding WRITE_CONSISTENCY.
     """
 
     self.host = file_io.read(constants.APPSCALE_HOME + \
                 '/.appscale/my_private_ip')
     self.port = CASS_DEFAULT_PORT
+    self.read_consistency = dict(READ_CONSISTENCY)
+    self.read_consistency.update(read_consistency or {})
+    self.write_consistency = dict(WRITE_CONSISTENCY)
+    self.write_consistency.update(write_consistency or {})
+
+    # The pool spreads connections over all database nodes, and retries
+    # failed calls on a connection to another node. Connections are opened
+    # on first use, so the datastore can start while a node is down.
+    server_list = ["{0}:{1}".format(ip, self.port)
+                   for ip in self.get_db_ips()]
     self.pool = pycassa.ConnectionPool(keyspace=KEYSPACE,
-                          server_list=[self.host+":"+str(self.port)], 
+                          server_list=server_list,
+                          pool_size=CONNECTIONS_PER_NODE * len(server_list),
+                          max_retries=MAX_RETRIES,
+                          timeout=CONNECTION_TIMEOUT,
                           prefill=False)
 
+    # ColumnFamily handles keyed by table name. Creating one looks up the
+    # table's schema, so they are kept for the life of the pool.
+    self.column_families = {}
+
+  def get_db_ips(self):
+    """ Gets the IPs of all database nodes from the AppScale role files,
+    falling back to this node if they can not be read.
+
+    Returns:
+      A list of IPs.
+    """
+    try:
+      ips = appscale_info.get_db_ips()
+    except IOError:
+      ips = []
+    return ips or [self.host.strip()]
+
+  def get_column_family(self, table_name):
+    """ Gets a ColumnFamily handle for a table, using the table's read and
+    write consistency levels.
+
+    Args:
+      table_name: The table to access
+    Returns:
+      A pycassa.ColumnFamily.
+    """
+    if table_name not in self.column_families:
+      self.column_families[table_name] = pycassa.ColumnFamily(self.pool,
+        table_name,
+        read_consistency_level=self.read_consistency.get(table_name,
+          DEFAULT_READ_CONSISTENCY),
+        write_consistency_level=self.write_consistency.get(table_name,
+          DEFAULT_WRITE_CONSISTENCY))
+    return self.column_families[table_name]
+
   def batch_get_entity(self, table_name, row_keys, column_names):
     """
     Takes in batches of keys and retrieves their cooresponding rows.
@@ -75,22 +161,17 @@ class DatastoreProxy(AppDBInterface):
     if not isinstance(row_keys, list): raise TypeError("Expected a list")
 
     ret_val = {}
-    client = self.pool.get()
-    path = ColumnPath(table_name)
-    slice_predicate = SlicePredicate(column_names=column_names)
-    results = client.multiget_slice(row_keys, 
-                                   path, 
-                                   slice_predicate, 
-                                   CONSISTENCY_QUORUM)
-    
+    cf = self.get_column_family(table_name)
+    # The keys are fetched MAX_GET_KEYS at a time.
+    results = cf.multiget(row_keys, columns=column_names,
+                          buffer_size=MAX_GET_KEYS)
+
+    # Rows without any of the columns are left out of the results.
     for row in row_keys:
       col_dic = {}
-      for columns in results[row]:
-        col_dic[columns.column.name] = columns.column.value
+      for column_name, value in results.get(row, {}).items():
+        col_dic[str(column_name)] = value
       ret_val[row] = col_dic
-
-    if client:
-      self.pool.return_conn(client)
     return ret_val
 
   def batch_put_entity(self, table_name, row_keys, column_names, cell_values):
@@ -113,14 +194,14 @@ class DatastoreProxy(AppDBInterface):
     if not isinstance(row_keys, list): raise TypeError("Expected a list")
     if not isinstance(cell_values, dict): raise TypeError("Expected a dic")
 
-    cf = pycassa.ColumnFamily(self.pool,table_name)
-    multi_map = {}
+    cf = self.get_column_family(table_name)
+    b = cf.batch(queue_size=MAX_MUTATIONS)
     for key in row_keys:
       cols = {}
       for cname in column_names:
         cols[cname] = cell_values[key][cname]
-      multi_map[key] = cols
-    cf.batch_insert(multi_map)
+      b.insert(key, cols)
+    b.send()
       
   def batch_delete(self, table_name, row_keys, column_names=[]):
     """
@@ -138,10 +219,9 @@ class DatastoreProxy(AppDBInterface):
     if not isinstance(table_name, str): raise TypeError("Expected a str")
     if not isinstance(row_keys, list): raise TypeError("Expected a list")
 
-    path = ColumnPath(table_name)
     try:
-      cf = pycassa.ColumnFamily(self.pool,table_name)
-      b = cf.batch()
+      cf = self.get_column_family(table_name)
+      b = cf.batch(queue_size=MAX_MUTATIONS)
       for key in row_keys:
         b.remove(key)
       b.send()
@@ -162,6 +242,7 @@ class DatastoreProxy(AppDBInterface):
 
     sysman = pycassa.system_manager.SystemManager(self.host + ":" + str(CASS_DEFAULT_PORT))
     sysman.drop_column_family(KEYSPACE, table_name)
+    self.column_families.pop(table_name, None)
 
   def create_table(self, table_name, column_names):
     """ 
@@ -235,12 +316,11 @@ class DatastoreProxy(AppDBInterface):
 
     results = []
 
-    cf = pycassa.ColumnFamily(self.pool,table_name)
+    cf = self.get_column_family(table_name)
     keyslices = cf.get_range(columns=column_names, 
                              start=start_key, 
                              finish=end_key,
-                             row_count=row_count,
-                             read_consistency_level=CONSISTENCY_QUORUM)
+                             row_count=row_count)
 
     for key in keyslices:
       if keys_only:
@@ -0,0 +1,113 @@
+# See LICENSE file
+"""
+A bounded pool of database connections shared by threads.
+"""
+import contextlib
+import logging
+import Queue
+import threading
+
+class ConnectionPool():
+  """ Hands out connections to one thread at a time. At most max_size
+      connections are open; callers wait once all of them are in use.
+      Connections which fail with a transport error are closed and replaced
+      by new ones on later use.
+  """
+
+  def __init__(self, create_connection, max_size, transport_errors=(),
+    close_connection=None):
+    """ Constructor.
+
+    Args:
+      create_connection: A function which opens and returns a connection.
+      max_size: The number of connections allowed to be open at once.
+      transport_errors: A tuple of exception types which mean a connection
+        is broken and can not be used again.
+      close_connection: A function which closes a connection.
+    """
+    self.create_connection = create_connection
+    self.max_size = max_size
+    self.transport_errors = tuple(transport_errors)
+    self.close_connection = close_connection
+    self.__idle = Queue.LifoQueue()
+    self.__slots = threading.BoundedSemaphore(max_size)
+
+  def get(self):
+    """ Takes a connection from the pool, opening one if none are idle.
+        Blocks while max_size connections are in use.
+
+    Returns:
+      A connection, which must be given back with put or discard.
+    """
+    self.__slots.acquire()
+    try:
+      return self.__idle.get_nowait()
+    except Queue.Empty:
+      pass
+    try:
+      return self.create_connection()
+    except Exception:
+      self.__slots.release()
+      raise
+
+  def put(self, connection):
+    """ Gives a working connection back to the pool.
+
+    Args:
+      connection: A connection returned by get.
+    """
+    self.__idle.put(connection)
+    self.__slots.release()
+
+  def discard(self, connection):
+    """ Closes a broken connection instead of giving it back to the pool.
+
+    Args:
+      connection: A connection returned by get.
+    """
+    try:
+      if self.close_connection:
+        self.close_connection(connection)
+    except Exception, exception:
+      logging.warning("Unable to close connection: {0}".format(exception))
+    finally:
+      self.__slots.release()
+
+  @contextlib.contextmanager
+  def connection(self):
+    """ A context manager which holds a connection for the calls in its
+        block, and gives it back or discards it when the block exits.
+
+    Yields:
+      A connection.
+    """
+    connection = self.get()
+    try:
+      yield connection
+    except self.transport_errors:
+      self.discard(connection)
+      raise
+    except Exception:
+      self.put(connection)
+      raise
+    self.put(connection)
+
+  def call(self, function, *args):
+    """ Calls a function with a pooled connection. If the connection turns
+        out to be broken, the call is made once more on a new connection,
+        so the function must be safe to repeat.
+
+    Args:
+      function: A function taking a connection followed by args.
+      args: Further arguments for the function.
+    Returns:
+      The value returned by the function.
+    """
+    try:
+      with self.connection() as connection:
+        return function(connection, *args)
+    except self.transport_errors, transport_error:
+      logging.warning("Retrying on a new connection after: {0}".format(
+        transport_error))
+    with self.connection() as connection:
+      return function(connection, *args)
@@ -0,0 +1,569 @@
+#!/usr/bin/python
+# See LICENSE file
+"""
+Benchmarks the datastore server's request path. Each workload calls the
+DatastoreDistributed methods behind a remote_api request, so locking,
+journaling and validation are measured along with the database calls. Any
+datastore backend can be used, with a ZooKeeper ensemble or an in-process
+stand-in. Results are written as JSON, so that runs can be compared.
+"""
+import getopt
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../AppServer"))
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import entity_pb
+
+import appscale_datastore_batch
+import datastore_server
+
+from datastore_server import DatastoreDistributed
+from zkappscale import zktransaction as zk
+from inprocess_zookeeper import InProcessZooKeeper
+
+# The application the benchmark stores its entities under.
+APP_ID = "benchmark"
+
+# The kind of root entities, and of the entities put into entity groups.
+KIND = "BenchmarkEntity"
+CHILD_KIND = "BenchmarkChild"
+
+# The number of times each workload runs by default.
+REQUESTS = 200
+
+# Seeds the random choices, so that runs with the same seed do the same work.
+SEED = 0
+
+# The number of entities in each batch put and get.
+BATCH_SIZE = 10
+
+# The number of entity groups which all entity group writes go to.
+ENTITY_GROUPS = 5
+
+# The number of distinct values of the indexed tag property.
+TAGS = 10
+
+# The size of the unindexed payload of each entity.
+PAYLOAD_SIZE = 100
+
+# The number of results fetched by each query, and by each batch of a query
+# read through a cursor.
+QUERY_LIMIT = 20
+
+# The number of batches read through a query cursor.
+CURSOR_BATCHES = 3
+
+# The number of IDs reserved by each allocate_ids call.
+ALLOCATE_SIZE = 100
+
+# The workloads, in the order they run. Writes come first to give the reads
+# and queries something to find.
+WORKLOADS = [
+  'put_batch',
+  'put_entity_group',
+  'transaction',
+  'get_batch',
+  'allocate_ids',
+  'query_ancestor',
+  'query_kind',
+  'query_property',
+  'query_composite',
+  'query_cursor',
+]
+
+class CallCounter():
+  """ Wraps an object and counts the calls made to its methods. """
+
+  def __init__(self, target):
+    """ Constructor.
+
+    Args:
+      target: The object whose methods are counted.
+    """
+    self.__target = target
+    self.__counts = {}
+    self.__lock = threading.Lock()
+
+  def __getattr__(self, name):
+    attribute = getattr(self.__target, name)
+    if not callable(attribute):
+      return attribute
+
+    def counted(*args, **kwargs):
+      """ Counts a call and passes it on to the target. """
+      with self.__lock:
+        self.__counts[name] = self.__counts.get(name, 0) + 1
+      return attribute(*args, **kwargs)
+    return counted
+
+  def get_counts(self):
+    """ Returns the number of calls made to each method.
+
+    Returns:
+      A dict of method names to counts.
+    """
+    with self.__lock:
+      return dict(self.__counts)
+
+class InProcessZKTransaction(zk.ZKTransaction):
+  """ A ZKTransaction whose connection is an InProcessZooKeeper. """
+
+  def __init__(self, server):
+    """ Constructor.
+
+    Args:
+      server: The InProcessZooKeeper holding the transaction metadata.
+    """
+    self.server = server
+    zk.ZKTransaction.__init__(self, host="in-process", start_gc=False)
+
+  def connect(self):
+    """ Returns the in-process server, which needs no connection.
+
+    Returns:
+      The InProcessZooKeeper.
+    """
+    self.server.start()
+    return self.server
+
+def percentile(values, fraction):
+  """ Returns the nearest-rank percentile of a sorted list.
+
+  Args:
+    values: A sorted list of numbers.
+    fraction: The percentile, as a fraction between 0 and 1.
+  Returns:
+    The value at that percentile, or 0 if there are no values.
+  """
+  if not values:
+    return 0
+  index = max(0, int(round(fraction * len(values))) - 1)
+  return values[min(index, len(values) - 1)]
+
+class DatastoreBenchmark():
+  """ Runs reproducible workloads against a DatastoreDistributed and
+      measures their throughput, latency and the calls each makes to the
+      database and to ZooKeeper.
+  """
+
+  def __init__(self, datastore_batch, zookeeper, zookeeper_server=None,
+    seed=SEED, namespace=""):
+    """ Constructor.
+
+    Args:
+      datastore_batch: The datastore backend, an AppDBInterface.
+      zookeeper: The ZKTransaction holding transaction metadata.
+      zookeeper_server: The InProcessZooKeeper behind zookeeper, if it is
+        one, to also report the ZooKeeper requests made.
+      seed: Seeds the workloads' random choices.
+      namespace: The namespace entities are stored in.
+    """
+    self.datastore_batch = CallCounter(datastore_batch)
+    self.zookeeper = CallCounter(zookeeper)
+    self.zookeeper_server = zookeeper_server
+    self.datastore = DatastoreDistributed(self.datastore_batch,
+      zookeeper=self.zookeeper)
+    self.random = random.Random(seed)
+    self.namespace = namespace
+    # Keys of the root entities stored so far, and of the entity groups.
+    self.keys = []
+    self.groups = []
+    self.next_name = 0
+
+  def run(self, requests=REQUESTS, workloads=WORKLOADS):
+    """ Runs each workload in turn.
+
+    Args:
+      requests: The number of times to run each workload.
+      workloads: The names of the workloads to run.
+    Returns:
+      A dict of workload names to their results.
+    """
+    self.setup()
+    results = {}
+    for name in workloads:
+      logging.info("Running {0} {1} times".format(name, requests))
+      results[name] = self.measure(getattr(self, name), requests)
+    return results
+
+  def stop(self):
+    """ Stops the threads the datastore started. """
+    self.datastore.write_pool.stop()
+
+  def get_counts(self):
+    """ Returns the calls made so far, keyed by where they were made. """
+    counts = {'datastore_calls': self.datastore_batch.get_counts(),
+              'zookeeper_calls': self.zookeeper.get_counts()}
+    if self.zookeeper_server:
+      counts['zookeeper_requests'] = self.zookeeper_server.get_stats()
+    return counts
+
+  def measure(self, workload, requests):
+    """ Runs a workload and measures it.
+
+    Args:
+      workload: A function running one request.
+      requests: The number of times to run it.
+    Returns:
+      A dict with the throughput, latency percentiles in milliseconds, the
+      number of failed requests and the average calls made per request.
+    """
+    before = self.get_counts()
+    latencies = []
+    errors = 0
+    start = time.time()
+    for _ in range(requests):
+      request_start = time.time()
+      try:
+        workload()
+      except Exception, exception:
+        logging.exception(exception)
+        errors += 1
+      latencies.append(time.time() - request_start)
+    elapsed = time.time() - start
+
+    latencies.sort()
+    result = {
+      'requests': requests,
+      'errors': errors,
+      'seconds': round(elapsed, 3),
+      'throughput': round(requests / elapsed, 1) if elapsed else 0,
+      'latency_ms': {
+        'p50': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99': round(percentile(latencies, 0.99) * 1000, 3),
+        'max': round(latencies[-1] * 1000, 3) if latencies else 0,
+      },
+    }
+    for source, counts in self.get_counts().items():
+      result[source] = dict((name, round(
+        float(count - before[source].get(name, 0)) / requests, 2))
+        for name, count in counts.items()
+        if count != before[source].get(name, 0))
+    return result
+
+  def setup(self):
+    """ Creates the composite index the composite query reads and the
+        entity groups, which are not measured.
+    """
+    index = entity_pb.CompositeIndex()
+    index.set_app_id(APP_ID)
+    index.set_state(entity_pb.CompositeIndex.READ_WRITE)
+    definition = index.mutable_definition()
+    definition.set_entity_type(KIND)
+    definition.set_ancestor(False)
+    for name in ['tag', 'score']:
+      prop = definition.add_property()
+      prop.set_name(name)
+      prop.set_direction(entity_pb.Index_Property.ASCENDING)
+    # There are no entities yet, so the index is usable without a backfill.
+    index_id, _ = self.datastore.allocate_ids(APP_ID + \
+      DatastoreDistributed._NAMESPACE_SEPARATOR + \
+      datastore_server.dbconstants.APP_INDEX_TABLE, 1, num_retries=3)
+    index.set_id(index_id)
+    self.datastore.put_composite_index(index)
+
+    groups = [self.new_entity(KIND) for _ in range(ENTITY_GROUPS)]
+    self.put(groups)
+    self.groups = [entity.key() for entity in groups]
+
+  def new_entity(self, kind, parent=None):
+    """ Creates an entity with a new name, an indexed tag and score, and an
+        unindexed payload.
+
+    Args:
+      kind: The kind of the entity.
+      parent: The entity_pb.Reference of its parent, or None for a root
+        entity.
+    Returns:
+      An entity_pb.EntityProto.
+    """
+    self.next_name += 1
+    entity = entity_pb.EntityProto()
+    key = entity.mutable_key()
+    key.set_app(APP_ID)
+    key.set_name_space(self.namespace)
+    if parent:
+      key.mutable_path().CopyFrom(parent.path())
+    element = key.mutable_path().add_element()
+    element.set_type(kind)
+    element.set_name("{0:010d}".format(self.next_name))
+    entity.mutable_entity_group().add_element().CopyFrom(
+      key.path().element(0))
+
+    for name, value in [('tag', self.random.randrange(TAGS)),
+                        ('score', self.random.randrange(1000000))]:
+      prop = entity.add_property()
+      prop.set_name(name)
+      prop.set_multiple(False)
+      prop.mutable_value().set_int64value(value)
+
+    payload = entity.add_raw_property()
+    payload.set_name('payload')
+    payload.set_meaning(entity_pb.Property.BLOB)
+    payload.set_multiple(False)
+    payload.mutable_value().set_stringvalue(''.join(
+      chr(self.random.randrange(256)) for _ in range(PAYLOAD_SIZE)))
+    return entity
+
+  def put(self, entities, transaction=None):
+    """ Stores entities through dynamic_put.
+
+    Args:
+      entities: A list of entity_pb.EntityProto.
+      transaction: The transaction handle to put them in, if any.
+    """
+    request = datastore_pb.PutRequest()
+    for entity in entities:
+      request.add_entity().CopyFrom(entity)
+    if transaction:
+      request.mutable_transaction().set_app(APP_ID)
+      request.mutable_transaction().set_handle(transaction)
+    self.datastore.dynamic_put(APP_ID, request, datastore_pb.PutResponse())
+
+  def get(self, keys, transaction=None):
+    """ Fetches entities through dynamic_get.
+
+    Args:
+      keys: A list of entity_pb.Reference.
+      transaction: The transaction handle to get them in, if any.
+    Returns:
+      A datastore_pb.GetResponse.
+    """
+    request = datastore_pb.GetRequest()
+    for key in keys:
+      request.add_key().CopyFrom(key)
+    if transaction:
+      request.mutable_transaction().set_app(APP_ID)
+      request.mutable_transaction().set_handle(transaction)
+    response = datastore_pb.GetResponse()
+    self.datastore.dynamic_get(APP_ID, request, response)
+    return response
+
+  def new_query(self, kind=None):
+    """ Creates a query over the benchmark's namespace.
+
+    Args:
+      kind: The kind to query, or None for a kindless query.
+    Returns:
+      A datastore_pb.Query.
+    """
+    query = datastore_pb.Query()
+    query.set_app(APP_ID)
+    query.set_name_space(self.namespace)
+    if kind:
+      query.set_kind(kind)
+    query.set_limit(QUERY_LIMIT)
+    return query
+
+  def run_query(self, query):
+    """ Runs a query through _dynamic_run_query.
+
+    Args:
+      query: A datastore_pb.Query.
+    Returns:
+      A datastore_pb.QueryResult.
+    """
+    result = datastore_pb.QueryResult()
+    self.datastore._dynamic_run_query(query, result)
+    return result
+
+  def put_batch(self):
+    """ Puts a batch of new root entities, each its own entity group. """
+    entities = [self.new_entity(KIND) for _ in range(BATCH_SIZE)]
+    self.put(entities)
+    self.keys.extend(entity.key() for entity in entities)
+
+  def put_entity_group(self):
+    """ Puts a new entity into one of a few entity groups, which all
+        writes of this workload contend for.
+    """
+    self.put([self.new_entity(CHILD_KIND, self.random.choice(self.groups))])
+
+  def transaction(self):
+    """ Reads an entity group root and puts a new entity into its group in
+        a transaction.
+    """
+    group = self.random.choice(self.groups)
+    handle = self.datastore.setup_transaction(APP_ID, False)
+    self.get([group], transaction=handle)
+    self.put([self.new_entity(CHILD_KIND, group)], transaction=handle)
+    transaction = datastore_pb.Transaction()
+    transaction.set_app(APP_ID)
+    transaction.set_handle(handle)
+    _, error, message = self.datastore.commit_transaction(APP_ID,
+      transaction.Encode())
+    if error:
+      raise zk.ZKTransactionException(message)
+
+  def get_batch(self):
+    """ Gets a batch of stored root entities. """
+    self.get(self.random.sample(self.keys, min(BATCH_SIZE, len(self.keys))))
+
+  def allocate_ids(self):
+    """ Reserves a block of IDs for the root entity kind. """
+    prefix = self.datastore.get_table_prefix(self.groups[0])
+    self.datastore.allocate_ids(prefix, ALLOCATE_SIZE)
+
+  def query_ancestor(self):
+    """ Queries the entities in an entity group. """
+    query = self.new_query(CHILD_KIND)
+    query.mutable_ancestor().CopyFrom(self.random.choice(self.groups))
+    self.run_query(query)
+
+  def query_kind(self):
+    """ Queries root entities by kind. """
+    self.run_query(self.new_query(KIND))
+
+  def query_property(self):
+    """ Queries root entities with an equality filter on one property. """
+    query = self.new_query(KIND)
+    query_filter = query.add_filter()
+    query_filter.set_op(datastore_pb.Query_Filter.EQUAL)
+    prop = query_filter.add_property()
+    prop.set_name('tag')
+    prop.set_multiple(False)
+    prop.mutable_value().set_int64value(self.random.randrange(TAGS))
+    self.run_query(query)
+
+  def query_composite(self):
+    """ Queries root entities with an equality filter on one property,
+        ordered by another, which the composite index serves.
+    """
+    query = self.new_query(KIND)
+    query_filter = query.add_filter()
+    query_filter.set_op(datastore_pb.Query_Filter.EQUAL)
+    prop = query_filter.add_property()
+    prop.set_name('tag')
+    prop.set_multiple(False)
+    prop.mutable_value().set_int64value(self.random.randrange(TAGS))
+    order = query.add_order()
+    order.set_property('score')
+    order.set_direction(datastore_pb.Query_Order.ASCENDING)
+    self.run_query(query)
+
+  def query_cursor(self):
+    """ Reads several batches of a kind query through its cursor. """
+    query = self.new_query(KIND)
+    query.clear_limit()
+    query.set_count(QUERY_LIMIT)
+    result = self.run_query(query)
+    for _ in range(CURSOR_BATCHES - 1):
+      if not result.more_results() or not result.has_cursor():
+        break
+      next_request = datastore_pb.NextRequest()
+      next_request.mutable_cursor().CopyFrom(result.cursor())
+      next_request.set_count(QUERY_LIMIT)
+      result = datastore_pb.QueryResult()
+      self.datastore._dynamic_next(APP_ID, next_request, result)
+
+def get_datastore(db_type, scratch_dir):
+  """ Creates the datastore backend. The SQLite backend is given a file in
+      scratch_dir, so that each run starts from an empty datastore.
+
+  Args:
+    db_type: The name of the datastore backend.
+    scratch_dir: A directory for files which are removed after the run.
+  Returns:
+    An AppDBInterface.
+  """
+  if db_type == "sqlite":
+    sys.path.append(os.path.join(os.path.dirname(__file__), "sqlite"))
+    import sqlite_interface
+    return sqlite_interface.DatastoreProxy(
+      os.path.join(scratch_dir, "benchmark.db"))
+  return appscale_datastore_batch.DatastoreFactory.getDatastore(db_type)
+
+def usage():
+  """ Prints the usage for this benchmark. """
+  print "AppScale Datastore Benchmark"
+  print
+  print "Options:"
+  print "\t--type=<" + ','.join(datastore_server.VALID_DATASTORES) + ">"
+  print "\t--zoo_keeper <zk nodes, or none for an in-process stand-in>"
+  print "\t--requests <number of times each workload runs>"
+  print "\t--seed <seed for the workloads' random choices>"
+  print "\t--namespace <namespace to store entities in>"
+  print "\t--output <file to write the JSON results to, or stdout>"
+
+def main(argv):
+  """ Runs the benchmark and writes its results. """
+  db_type = "sqlite"
+  zookeeper_locations = None
+  requests = REQUESTS
+  seed = SEED
+  namespace = ""
+  output = None
+
+  try:
+    opts, args = getopt.getopt(argv, "t:z:n:s:a:o:",
+                               ["type=",
+                                "zoo_keeper=",
+                                "requests=",
+                                "seed=",
+                                "namespace=",
+                                "output="])
+  except getopt.GetoptError:
+    usage()
+    sys.exit(1)
+
+  for opt, arg in opts:
+    if opt in ("-t", "--type"):
+      db_type = arg
+    elif opt in ("-z", "--zoo_keeper"):
+      zookeeper_locations = arg
+    elif opt in ("-n", "--requests"):
+      requests = int(arg)
+    elif opt in ("-s", "--seed"):
+      seed = int(arg)
+    elif opt in ("-a", "--namespace"):
+      namespace = arg
+    elif opt in ("-o", "--output"):
+      output = arg
+
+  if db_type not in datastore_server.VALID_DATASTORES:
+    usage()
+    sys.exit(1)
+
+  scratch_dir = tempfile.mkdtemp()
+  zookeeper_server = None
+  if zookeeper_locations:
+    zookeeper = zk.ZKTransaction(host=zookeeper_locations, start_gc=False)
+  else:
+    zookeeper_server = InProcessZooKeeper()
+    zookeeper = InProcessZKTransaction(zookeeper_server)
+
+  try:
+    benchmark = DatastoreBenchmark(get_datastore(db_type, scratch_dir),
+      zookeeper, zookeeper_server=zookeeper_server, seed=seed,
+      namespace=namespace)
+    try:
+      results = {
+        'datastore': db_type,
+        'zookeeper': zookeeper_locations or "in-process",
+        'requests': requests,
+        'seed': seed,
+        'workloads': benchmark.run(requests),
+      }
+    finally:
+      benchmark.stop()
+  finally:
+    zookeeper.close()
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+  encoded = json.dumps(results, indent=2, sort_keys=True)
+  if output:
+    with open(output, 'w') as output_file:
+      output_file.write(encoded + "\n")
+  else:
+    print encoded
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
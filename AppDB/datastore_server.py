@@ -8,22 +8,36 @@ requests from AppServers and responds according to the type of request its
 given (Put, Get, Delete, Query, etc).
 """
 import __builtin__
+import array
 import getopt
 import itertools
+import json
 import logging
 import md5
 import os
+import re
 import sys
 import threading
+import time
 
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
 
+# Tornado releases before 2.1, such as the 0.2 the installer builds, can not
+# share a listening socket between forked processes.
+try:
+  import tornado.netutil
+  import tornado.process
+  SHARED_SOCKETS = True
+except ImportError:
+  SHARED_SOCKETS = False
+
 import appscale_datastore_batch
 import dbconstants
 import groomer
 import helper_functions
+import worker_pool
 
 from zkappscale import zktransaction as zk
 from zkappscale.zktransaction import ZKTransactionException
@@ -45,6 +59,8 @@ from google.appengine.runtime import apiproxy_errors
 
 from google.appengine.ext.remote_api import remote_api_pb
 
+from google.net.proto import ProtocolBuffer
+
 from M2Crypto import SSL
 
 # Buffer type used for key storage in the datastore
@@ -56,11 +72,15 @@ datastore_access = None
 # ZooKeeper global variable for locking
 zookeeper = None
 
+# Runs remote requests off the IOLoop. An instance of
+# worker_pool.FairWorkerPool, or None to run them on the IOLoop.
+request_pool = None
+
 entity_pb.Reference.__hash__ = lambda self: hash(self.Encode())
 datastore_pb.Query.__hash__ = lambda self: hash(self.Encode())
 
 # The datastores supported for this version of the AppScale datastore
-VALID_DATASTORES = ['cassandra', 'hbase', 'hypertable']
+VALID_DATASTORES = ['cassandra', 'hbase', 'hypertable', 'sqlite']
 
 # Port this service binds to if using SSL
 DEFAULT_SSL_PORT = 8443
@@ -71,6 +91,29 @@ DEFAULT_PORT = 4080
 # IDs are acquired in block sizes of this
 BLOCK_SIZE = 10000
 
+# When fewer than this fraction of a block of IDs is left locally, the next
+# block is reserved.
+ID_LOW_WATERMARK = 0.1
+
+# The number of threads used to write to the different tables at once.
+WRITE_WORKERS = 8
+
+# The number of threads running remote requests. With none, requests run on
+# the IOLoop one at a time.
+REQUEST_WORKERS = 0
+
+# The number of remote requests allowed to wait or run at once. Requests
+# beyond this are turned away with a TIMEOUT error.
+MAX_PENDING_REQUESTS = 1000
+
+# The number of remote requests a single application is allowed to have
+# waiting or running at once.
+MAX_PENDING_REQUESTS_PER_APP = 500
+
+# The number of server processes sharing the listening socket. Zero starts
+# one per core.
+SERVER_PROCESSES = 1
+
 # The length of an ID string meant to make sure we have lexigraphically ordering
 ID_KEY_LENGTH = 10
 
@@ -80,7 +123,156 @@ TOMBSTONE = "APPSCALE_SOFT_DELETE"
 # Local datastore location through nginx.
 LOCAL_DATASTORE = "localhost:8888"
 
- 
+# Field numbers of the value types which can be read back from index keys.
+INDEX_VALUE_TAGS = [
+  entity_pb.PropertyValue.kint64Value,
+  entity_pb.PropertyValue.kbooleanValue,
+  entity_pb.PropertyValue.kstringValue,
+  entity_pb.PropertyValue.kdoubleValue,
+]
+
+# The number of results returned in a query batch when no count is given.
+QUERY_BATCH_SIZE = 20
+
+# Seconds a query cursor is kept after its last use.
+QUERY_CURSOR_TTL = 300
+
+# The number of index rows read at a time when counting query results.
+COUNT_BATCH_SIZE = 1000
+
+# Seconds composite index definitions are cached for. Other datastore
+# servers start maintaining a new index once their cached copy expires.
+COMPOSITE_INDEX_CACHE_TTL = 60
+
+# The number of entities read at a time when backfilling a composite index.
+BACKFILL_BATCH_SIZE = 100
+
+# Stands in for null values in composite index keys, and sorts before
+# every other encoded value.
+COMPOSITE_NULL_VALUE = '\x00'
+
+# The number of index rows read at a time for each filter of a merge join.
+MERGE_JOIN_BATCH_SIZE = 100
+
+# Inequality operators swapped when scanning a descending index property.
+REVERSED_OPERATORS = {
+  datastore_pb.Query_Filter.LESS_THAN:
+    datastore_pb.Query_Filter.GREATER_THAN,
+  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:
+    datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL,
+  datastore_pb.Query_Filter.GREATER_THAN:
+    datastore_pb.Query_Filter.LESS_THAN,
+  datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL:
+    datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL,
+}
+
+# Seconds between writes of the changes puts and deletes made to the kind
+# statistics.
+STATS_FLUSH_INTERVAL = 60
+
+# The kinds and key name of the statistics entities applications read.
+KIND_STAT_KIND = '__Stat_Kind__'
+GLOBAL_STAT_KIND = '__Stat_Total__'
+GLOBAL_STAT_NAME = 'total_entity_usage'
+
+class QueryCursor():
+  """ The position of a query whose remaining results are fetched a batch
+      at a time.
+  """
+  def __init__(self, query):
+    """ Constructor.
+
+    Args:
+      query: The datastore_pb.Query being run.
+    """
+    self.cursor_id = None
+    self.query = query
+    self.app = query.app()
+    # The last entity returned, which the next batch starts after.
+    self.last_result = None
+    # The number of results left before the query limit, if it has one.
+    self.remaining = None
+    if query.has_limit():
+      self.remaining = query.limit()
+    self.last_access = time.time()
+
+class QueryCursorRegistry():
+  """ Keeps the cursors of queries which have more results, so that Next
+      requests can continue them. Cursors unused for longer than the TTL are
+      dropped.
+  """
+  def __init__(self, ttl=QUERY_CURSOR_TTL):
+    """ Constructor.
+
+    Args:
+      ttl: Seconds a cursor is kept after its last use.
+    """
+    self.ttl = ttl
+    self.__cursors = {}
+    self.__next_id = 1
+    self.__lock = threading.Lock()
+
+  def add(self, cursor):
+    """ Registers a cursor and gives it an ID.
+
+    Args:
+      cursor: A QueryCursor.
+    Returns:
+      The ID of the cursor.
+    """
+    self.evict_idle()
+    with self.__lock:
+      cursor.cursor_id = self.__next_id
+      self.__next_id += 1
+      cursor.last_access = time.time()
+      self.__cursors[cursor.cursor_id] = cursor
+    return cursor.cursor_id
+
+  def get(self, app_id, cursor_id):
+    """ Looks up a cursor.
+
+    Args:
+      app_id: The application asking for the cursor.
+      cursor_id: The ID of the cursor.
+    Returns:
+      The QueryCursor, or None if it does not exist, has expired, or belongs
+      to another application.
+    """
+    self.evict_idle()
+    with self.__lock:
+      cursor = self.__cursors.get(cursor_id)
+      if not cursor or cursor.app != app_id:
+        return None
+      cursor.last_access = time.time()
+      return cursor
+
+  def remove(self, cursor_id):
+    """ Forgets a cursor.
+
+    Args:
+      cursor_id: The ID of the cursor.
+    """
+    with self.__lock:
+      self.__cursors.pop(cursor_id, None)
+
+  def evict_idle(self):
+    """ Drops cursors which have not been used within the TTL.
+
+    Returns:
+      The number of cursors dropped.
+    """
+    cutoff = time.time() - self.ttl
+    with self.__lock:
+      idle = [cursor_id for cursor_id, cursor in self.__cursors.items()
+              if cursor.last_access < cutoff]
+      for cursor_id in idle:
+        del self.__cursors[cursor_id]
+    return len(idle)
+
+  def __len__(self):
+    """ Returns the number of open cursors. """
+    return len(self.__cursors)
+
 class DatastoreDistributed():
   """ AppScale persistent layer for the datastore API. It is the 
       replacement for the AppServers to persist their data into 
@@ -113,13 +305,17 @@ class DatastoreDistributed():
   # The key we use to lock for allocating new IDs
   _ALLOCATE_ROOT_KEY = "__allocate__"
 
-  def __init__(self, datastore_batch, zookeeper=None):
+  def __init__(self, datastore_batch, zookeeper=None, id_block_size=BLOCK_SIZE,
+               write_workers=WRITE_WORKERS):
     """
        Constructor.
      
      Args:
        datastore_batch: a reference to the batch datastore interface .
        zookeeper: a reference to the zookeeper interface.
+       id_block_size: the number of IDs reserved at once for entities 
+         which are put without one.
+       write_workers: the number of threads writing to tables at once.
     """
     logging.basicConfig(format='%(asctime)s %(levelname)s %(filename)s:' \
       '%(lineno)s %(message)s ', level=logging.INFO)
@@ -144,6 +340,39 @@ class DatastoreDistributed():
     # zookeeper instance for accesing ZK functionality
     self.zookeeper = zookeeper
 
+    # Ranges of IDs reserved from the ID table but not yet handed out, 
+    # keyed by table prefix. Each range is a [next_id, last_id] list.
+    self.__id_blocks = {}
+    self.__id_lock = threading.RLock()
+    self.id_block_size = id_block_size
+
+    # Counters reported through get_stats.
+    self.__stats = {'id_block_size': id_block_size,
+                    'id_blocks_reserved': 0,
+                    'ids_allocated_locally': 0,
+                    'table_writes': {}}
+    self.__stats_lock = threading.Lock()
+
+    # Writes to different tables for the same request are independent, so
+    # they are sent to the database concurrently by these threads.
+    self.write_pool = worker_pool.WorkerPool(write_workers,
+                                             name="datastore-write")
+
+    # Queries with more results than fit in a batch, kept for Next requests.
+    self.query_cursors = QueryCursorRegistry()
+
+    # Composite index definitions keyed by application ID. Each entry is a
+    # tuple of the time they were read and a list of
+    # entity_pb.CompositeIndex.
+    self.__composite_indexes = {}
+
+    # Changes puts and deletes made to the number and size of the entities
+    # of each kind, keyed by application ID and kind. Each entry is a
+    # [count, bytes] list, added to the statistics entities by
+    # flush_kind_stats.
+    self.__kind_stat_deltas = {}
+    self.__kind_stat_lock = threading.Lock()
+
   @staticmethod
   def get_entity_kind(key_path):
     """ Returns the Kind of the Entity. A Kind is like a type or a 
@@ -379,26 +608,120 @@ class DatastoreDistributed():
        entities: A list of entities for which their 
                  indexes are to be deleted
     """
+    self.write_tables(self.get_index_deletes(entities))
+
+  def get_index_deletes(self, entities):
+    """ Builds the writes which remove the index entries of entities.
+
+    Args:
+       entities: A list of entities for which their 
+                 indexes are to be deleted
+    Returns:
+      A list of writes to pass to write_tables.
+    """
+    asc_rows, desc_rows = self.get_index_rows(entities)
+    return self.__index_delete_writes(asc_rows.keys(), desc_rows.keys(),
+      self.get_composite_rows(entities).keys())
+
+  def get_index_rows(self, entities):
+    """ Returns the index rows of entities for both property tables.
+
+    Args:
+      entities: A list of entities.
+    Returns:
+      A tuple of two dictionaries, for the ascending and descending tables,
+      mapping index keys to the entity key they reference.
+    """
+    entities_tuple = [(self.get_table_prefix(x), x) for x in entities]
+    asc_rows = dict((str(key), str(reference)) for key, reference in
+      self.get_index_kv_from_tuple(entities_tuple, reverse=False))
+    desc_rows = dict((str(key), str(reference)) for key, reference in
+      self.get_index_kv_from_tuple(entities_tuple, reverse=True))
+    return asc_rows, desc_rows
+
+  def __index_delete_writes(self, asc_keys, desc_keys, composite_keys=()):
+    """ Builds the writes which remove rows from the index tables.
+
+    Args:
+      asc_keys: A list of keys to remove from the ascending table.
+      desc_keys: A list of keys to remove from the descending table.
+      composite_keys: A list of keys to remove from the composite table.
+    Returns:
+      A list of writes to pass to write_tables.
+    """
+    writes = []
+    for table, schema, keys in [
+        (dbconstants.ASC_PROPERTY_TABLE, dbconstants.PROPERTY_SCHEMA, asc_keys),
+        (dbconstants.DSC_PROPERTY_TABLE, dbconstants.PROPERTY_SCHEMA,
+         desc_keys),
+        (dbconstants.COMPOSITE_TABLE, dbconstants.COMPOSITE_SCHEMA,
+         composite_keys)]:
+      if keys:
+        writes.append((table, self.datastore_batch.batch_delete,
+                       (table, sorted(keys), schema)))
+    return writes
+
+  def __index_put_writes(self, asc_rows, desc_rows, composite_rows=None):
+    """ Builds the writes which add rows to the index tables.
+
+    Args:
+      asc_rows: A dictionary of keys to entity references for the ascending
+        table.
+      desc_rows: A dictionary of keys to entity references for the descending
+        table.
+      composite_rows: A dictionary of keys to entity references for the 
+        composite table.
+    Returns:
+      A list of writes to pass to write_tables.
+    """
+    writes = []
+    for table, schema, rows in [
+        (dbconstants.ASC_PROPERTY_TABLE, dbconstants.PROPERTY_SCHEMA, asc_rows),
+        (dbconstants.DSC_PROPERTY_TABLE, dbconstants.PROPERTY_SCHEMA,
+         desc_rows),
+        (dbconstants.COMPOSITE_TABLE, dbconstants.COMPOSITE_SCHEMA,
+         composite_rows)]:
+      if rows:
+        values = dict((key, {schema[0]: reference})
+                      for key, reference in rows.items())
+        writes.append((table, self.datastore_batch.batch_put_entity,
+                       (table, sorted(rows), schema, values)))
+    return writes
+
+  def write_tables(self, writes):
+    """ Runs writes to different tables concurrently and waits for all of
+        them, so a request is only acknowledged once every table is updated.
+
+    Args:
+      writes: A list of (table_name, function, args) tuples.
+    Raises:
+      The first exception raised by any of the writes.
+    """
+    self.write_pool.map([(self.__timed_write, (table, function, args))
+                         for table, function, args in writes])
+
+  def __timed_write(self, table_name, function, args):
+    """ Runs a write and records how long it took for the table.
+
+    Args:
+      table_name: The table being written to.
+      function: The datastore_batch function doing the write.
+      args: The arguments for the function.
+    Returns:
+      The value returned by the function.
+    """
+    start = time.time()
+    try:
+      return function(*args)
+    finally:
+      elapsed = time.time() - start
+      with self.__stats_lock:
+        table_stats = self.__stats['table_writes'].setdefault(table_name,
+          {'count': 0, 'seconds': 0.0})
+        table_stats['count'] += 1
+        table_stats['seconds'] += elapsed
 
-    if len(entities) == 0: 
-      return
 
-    entities_tuple = sorted((self.get_table_prefix(x), x) for x in entities)
-    asc_index_keys = self.get_index_kv_from_tuple(entities_tuple, 
-                                                     reverse=False)
-    desc_index_keys = self.get_index_kv_from_tuple(entities_tuple, 
-                                                     reverse=True)
-    # Remove the value, just get keys
-    asc_index_keys = [x[0] for x in asc_index_keys] 
-    desc_index_keys = [x[0] for x in desc_index_keys] 
-    # TODO Consider doing these in parallel with threads
-    self.datastore_batch.batch_delete(dbconstants.ASC_PROPERTY_TABLE, 
-                                      asc_index_keys, 
-                                      column_names=dbconstants.PROPERTY_SCHEMA)
-    self.datastore_batch.batch_delete(dbconstants.DSC_PROPERTY_TABLE, 
-                                      desc_index_keys,
-                                      column_names=dbconstants.PROPERTY_SCHEMA)
-    
   def insert_entities(self, entities, txn_hash):
     """Inserts or updates entities in the DB.
 
@@ -406,6 +729,18 @@ class DatastoreDistributed():
       entities: A list of entities to store.
       txn_hash: A mapping of root keys to transaction IDs.
     """
+    self.write_tables(self.get_entity_puts(entities, txn_hash))
+
+  def get_entity_puts(self, entities, txn_hash):
+    """ Builds the writes which store entities in the entity, journal and 
+        kind tables.
+
+    Args:      
+      entities: A list of entities to store.
+      txn_hash: A mapping of root keys to transaction IDs.
+    Returns:
+      A list of writes to pass to write_tables.
+    """
 
     def row_generator(entities):
       """ Generates keys and encoded entities for a list of entities. 
@@ -466,19 +801,15 @@ class DatastoreDistributed():
           {dbconstants.APP_KIND_SCHEMA[0]:str(ii[1])}
 
 
-    # TODO do these in ||                        
-    self.datastore_batch.batch_put_entity(dbconstants.APP_ENTITY_TABLE, 
-                                          row_keys, 
-                                          dbconstants.APP_ENTITY_SCHEMA, 
-                                          row_values)    
-
-    self.update_journal(row_keys, row_values, txn_hash)
-
-    self.datastore_batch.batch_put_entity(dbconstants.APP_KIND_TABLE,
-                                          kind_row_keys,
-                                          dbconstants.APP_KIND_SCHEMA, 
-                                          kind_row_values) 
-
+    return [
+      (dbconstants.APP_ENTITY_TABLE, self.datastore_batch.batch_put_entity,
+       (dbconstants.APP_ENTITY_TABLE, row_keys, dbconstants.APP_ENTITY_SCHEMA,
+        row_values)),
+      (dbconstants.JOURNAL_TABLE, self.update_journal,
+       (row_keys, row_values, txn_hash)),
+      (dbconstants.APP_KIND_TABLE, self.datastore_batch.batch_put_entity,
+       (dbconstants.APP_KIND_TABLE, kind_row_keys, dbconstants.APP_KIND_SCHEMA,
+        kind_row_values))]
 
   def insert_index_entries(self, entities):
     """ Inserts index entries for the supplied entities.
@@ -487,36 +818,369 @@ class DatastoreDistributed():
       entities: A list of tuples of prefix and entities 
                 to create index entries for.
     """
+    self.write_tables(self.get_index_puts(entities))
 
-    entities = sorted((self.get_table_prefix(x), x) for x in entities)
- 
-    row_keys = []
-    rev_row_keys = []
-    row_values = {}
-    rev_row_values = {}
+  def get_index_puts(self, entities):
+    """ Builds the writes which insert index entries for entities.
 
-    for prefix, group in itertools.groupby(entities, lambda x: x[0]):
-      group_rows = self.get_index_kv_from_tuple(group, False)
-      row_keys = [str(ii[0]) for ii in group_rows]
-      for ii in group_rows:
-        row_values[str(ii[0])] = {'reference': str(ii[1])}
- 
-    for prefix, group in itertools.groupby(entities, lambda x: x[0]):
-      rev_group_rows = self.get_index_kv_from_tuple(group, True)
-      rev_row_keys = [str(ii[0]) for ii in rev_group_rows]
-      for ii in rev_group_rows:
-        rev_row_values[str(ii[0])] = {'reference': str(ii[1])}
-
-    # TODO  these in parallel
-    self.datastore_batch.batch_put_entity(dbconstants.ASC_PROPERTY_TABLE, 
-                          row_keys, 
-                          dbconstants.PROPERTY_SCHEMA, 
-                          row_values)
-
-    self.datastore_batch.batch_put_entity(dbconstants.DSC_PROPERTY_TABLE, 
-                          rev_row_keys,  
-                          dbconstants.PROPERTY_SCHEMA,
-                          rev_row_values)
+    Args:
+      entities: A list of entities to create index entries for.
+    Returns:
+      A list of writes to pass to write_tables.
+    """
+    asc_rows, desc_rows = self.get_index_rows(entities)
+    return self.__index_put_writes(asc_rows, desc_rows,
+      self.get_composite_rows(entities))
+
+  def get_composite_index_key(self, app_id, index_id):
+    """ Returns the key of a composite index definition in the index table.
+
+    Args:
+      app_id: The application ID.
+      index_id: The ID of the composite index.
+    Returns:
+      A row key for the APP_INDEX_TABLE.
+    """
+    return app_id + self._NAMESPACE_SEPARATOR + \
+      str(index_id).zfill(ID_KEY_LENGTH)
+
+  def get_composite_index_prefix(self, prefix, index_id):
+    """ Returns the start of the keys of a composite index's rows.
+
+    Args:
+      prefix: The table prefix (app id and namespace).
+      index_id: The ID of the composite index.
+    Returns:
+      A key prefix for the COMPOSITE_TABLE.
+    """
+    return prefix + self._NAMESPACE_SEPARATOR + \
+      str(index_id).zfill(ID_KEY_LENGTH) + self._NAMESPACE_SEPARATOR
+
+  def get_composite_indexes(self, app_id, refresh=False):
+    """ Returns the composite index definitions of an application. They
+        are read from the index table again once the cached copy is older
+        than COMPOSITE_INDEX_CACHE_TTL.
+
+    Args:
+      app_id: The application ID.
+      refresh: True to ignore the cached copy.
+    Returns:
+      A list of entity_pb.CompositeIndex.
+    """
+    cached = self.__composite_indexes.get(app_id)
+    if cached and not refresh and \
+       time.time() - cached[0] < COMPOSITE_INDEX_CACHE_TTL:
+      return cached[1]
+
+    start_key = app_id + self._NAMESPACE_SEPARATOR
+    rows = self.datastore_batch.range_query(dbconstants.APP_INDEX_TABLE,
+      dbconstants.APP_INDEX_SCHEMA, start_key, start_key + self._TERM_STRING,
+      self._MAXIMUM_RESULTS)
+    indexes = []
+    for row in rows:
+      encoded = row.values()[0].get(dbconstants.APP_INDEX_SCHEMA[0])
+      if encoded:
+        indexes.append(entity_pb.CompositeIndex(encoded))
+    self.__composite_indexes[app_id] = (time.time(), indexes)
+    return indexes
+
+  def get_composite_index(self, app_id, index_id):
+    """ Returns a composite index definition, bypassing the cache.
+
+    Args:
+      app_id: The application ID.
+      index_id: The ID of the composite index.
+    Returns:
+      An entity_pb.CompositeIndex, or None if it does not exist.
+    """
+    for index in self.get_composite_indexes(app_id, refresh=True):
+      if index.id() == index_id:
+        return index
+    return None
+
+  def put_composite_index(self, index):
+    """ Stores a composite index definition.
+
+    Args:
+      index: An entity_pb.CompositeIndex.
+    """
+    row_key = self.get_composite_index_key(index.app_id(), index.id())
+    self.datastore_batch.batch_put_entity(dbconstants.APP_INDEX_TABLE,
+      [row_key], dbconstants.APP_INDEX_SCHEMA,
+      {row_key: {dbconstants.APP_INDEX_SCHEMA[0]: index.Encode()}})
+    self.__composite_indexes.pop(index.app_id(), None)
+
+  def create_composite_index(self, app_id, index):
+    """ Stores a new composite index and starts writing rows for the
+        entities which already exist. Creating an index with the same
+        definition as an existing one returns the existing index's ID.
+
+    Args:
+      app_id: The application ID.
+      index: An entity_pb.CompositeIndex with an ID of 0.
+    Returns:
+      The ID of the index.
+    """
+    for existing in self.get_composite_indexes(app_id, refresh=True):
+      if existing.state() != entity_pb.CompositeIndex.DELETED and \
+         existing.definition().Equals(index.definition()):
+        return existing.id()
+
+    index_id, _ = self.allocate_ids(app_id + self._NAMESPACE_SEPARATOR + \
+      dbconstants.APP_INDEX_TABLE, 1, num_retries=3)
+    new_index = entity_pb.CompositeIndex()
+    new_index.CopyFrom(index)
+    new_index.set_app_id(app_id)
+    new_index.set_id(index_id)
+    new_index.set_state(entity_pb.CompositeIndex.WRITE_ONLY)
+    self.put_composite_index(new_index)
+    self.start_index_job(self.backfill_composite_index, new_index)
+    return index_id
+
+  def update_composite_index(self, app_id, index):
+    """ Changes the state of a composite index.
+
+    Args:
+      app_id: The application ID.
+      index: An entity_pb.CompositeIndex with the ID and new state.
+    Raises:
+      apiproxy_errors.ApplicationError: If the index does not exist.
+    """
+    existing = self.get_composite_index(app_id, index.id())
+    if not existing:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+        'Index {0} does not exist'.format(index.id()))
+    if index.state() == entity_pb.CompositeIndex.DELETED:
+      self.delete_composite_index(app_id, existing)
+      return
+    existing.set_state(index.state())
+    self.put_composite_index(existing)
+
+  def delete_composite_index(self, app_id, index):
+    """ Stops serving queries from a composite index and removes its rows.
+
+    Args:
+      app_id: The application ID.
+      index: An entity_pb.CompositeIndex with the ID to delete.
+    Raises:
+      apiproxy_errors.ApplicationError: If the index does not exist.
+    """
+    existing = self.get_composite_index(app_id, index.id())
+    if not existing:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+        'Index {0} does not exist'.format(index.id()))
+    existing.set_state(entity_pb.CompositeIndex.DELETED)
+    self.put_composite_index(existing)
+    self.start_index_job(self.remove_composite_index, existing)
+
+  def start_index_job(self, function, index):
+    """ Runs a long running index job in a background thread.
+
+    Args:
+      function: The job to run, taking the index as its argument.
+      index: An entity_pb.CompositeIndex.
+    """
+    thread = threading.Thread(target=function, args=(index,),
+      name="composite-index-{0}".format(index.id()))
+    thread.daemon = True
+    thread.start()
+
+  def get_app_prefixes(self, app_id):
+    """ Returns the table prefixes of all namespaces used by an application.
+
+    Args:
+      app_id: The application ID.
+    Returns:
+      A list of table prefixes.
+    """
+    start_key = app_id + self._NAMESPACE_SEPARATOR
+    return [str(key) for key in self.datastore_batch.range_query(
+      dbconstants.APP_NAMESPACE_TABLE, dbconstants.APP_NAMESPACE_SCHEMA,
+      start_key, start_key + self._TERM_STRING, self._MAXIMUM_RESULTS,
+      keys_only=True)]
+
+  def backfill_composite_index(self, index, wait=COMPOSITE_INDEX_CACHE_TTL):
+    """ Writes the composite index rows of entities stored before the index
+        was created, then lets the index serve queries. Every datastore
+        server maintains the index once its cached definitions expire, so
+        the scan waits for that first.
+
+    Args:
+      index: An entity_pb.CompositeIndex in the WRITE_ONLY state.
+      wait: Seconds to wait before scanning.
+    """
+    time.sleep(wait)
+    app_id = index.app_id()
+    kind = index.definition().entity_type()
+    start = time.time()
+    total = 0
+    for prefix in self.get_app_prefixes(app_id):
+      start_key = prefix + self._NAMESPACE_SEPARATOR + kind + ':'
+      end_key = start_key + self._TERM_STRING
+      start_inclusive = self._ENABLE_INCLUSIVITY
+      while True:
+        refs = self.datastore_batch.range_query(dbconstants.APP_KIND_TABLE,
+          dbconstants.APP_KIND_SCHEMA, start_key, end_key,
+          BACKFILL_BATCH_SIZE, start_inclusive=start_inclusive)
+        if not refs:
+          break
+        self.__backfill_rows(prefix, index, refs)
+        total += len(refs)
+        if len(refs) < BACKFILL_BATCH_SIZE:
+          break
+        start_key = str(refs[-1].keys()[0])
+        start_inclusive = self._DISABLE_INCLUSIVITY
+
+    existing = self.get_composite_index(app_id, index.id())
+    if not existing or \
+       existing.state() != entity_pb.CompositeIndex.WRITE_ONLY:
+      logging.info("Composite index {0} for {1} changed during backfill".\
+        format(index.id(), app_id))
+      return
+    existing.set_state(entity_pb.CompositeIndex.READ_WRITE)
+    self.put_composite_index(existing)
+    logging.info("Backfilled composite index {0} for {1} with {2} entities "
+      "in {3:.2f} seconds".format(index.id(), app_id, total,
+      time.time() - start))
+
+  def __backfill_rows(self, prefix, index, refs):
+    """ Writes composite index rows for a batch of entities. The entities
+        are read again afterwards, and rows for values changed by a put
+        in between are removed.
+
+    Args:
+      prefix: The table prefix of the entities.
+      index: An entity_pb.CompositeIndex.
+      refs: Rows from the kind table referencing the entities.
+    """
+    def composite_rows(encoded_entities):
+      """ Returns the rows of the index for a list of encoded entities. """
+      rows = {}
+      for encoded in encoded_entities:
+        rows.update(self.get_composite_index_rows(prefix, index,
+          entity_pb.EntityProto(encoded)))
+      return rows
+
+    rows = composite_rows(self.__fetch_entities(refs))
+    self.write_tables(self.__index_put_writes({}, {}, rows))
+    current = composite_rows(self.__fetch_entities(refs))
+    stale = [key for key in rows if key not in current]
+    self.write_tables(self.__index_delete_writes([], [], stale))
+
+  def remove_composite_index(self, index, wait=COMPOSITE_INDEX_CACHE_TTL):
+    """ Removes the rows and definition of a deleted composite index. Rows
+        are removed once no datastore server writes them anymore.
+
+    Args:
+      index: An entity_pb.CompositeIndex in the DELETED state.
+      wait: Seconds to wait before removing rows.
+    """
+    time.sleep(wait)
+    app_id = index.app_id()
+    for prefix in self.get_app_prefixes(app_id):
+      start_key = self.get_composite_index_prefix(prefix, index.id())
+      end_key = start_key + self._TERM_STRING
+      start_inclusive = self._ENABLE_INCLUSIVITY
+      while True:
+        keys = [str(key) for key in self.datastore_batch.range_query(
+          dbconstants.COMPOSITE_TABLE, dbconstants.COMPOSITE_SCHEMA,
+          start_key, end_key, BACKFILL_BATCH_SIZE,
+          start_inclusive=start_inclusive, keys_only=True)]
+        if keys:
+          self.write_tables(self.__index_delete_writes([], [], keys))
+        if len(keys) < BACKFILL_BATCH_SIZE:
+          break
+        # Rows which could not be deleted are not scanned again.
+        start_key = keys[-1]
+        start_inclusive = self._DISABLE_INCLUSIVITY
+
+    row_key = self.get_composite_index_key(app_id, index.id())
+    self.datastore_batch.batch_delete(dbconstants.APP_INDEX_TABLE, [row_key],
+      dbconstants.APP_INDEX_SCHEMA)
+    self.__composite_indexes.pop(app_id, None)
+
+  @staticmethod
+  def encode_composite_value(value, direction):
+    """ Encodes a property value for a composite index key. Encoded values
+        never start with one another, so values of different properties
+        are concatenated without separators.
+
+    Args:
+      value: A property value in the sortable encoding.
+      direction: The direction of the index property.
+    Returns:
+      A string to append to a composite index key.
+    """
+    value = str(value) or COMPOSITE_NULL_VALUE
+    if direction == entity_pb.Index_Property.DESCENDING:
+      value = helper_functions.reverse_lex(value)
+    return value
+
+  def get_composite_index_keys(self, prefix, index, values, path):
+    """ Returns the keys an entity has in a composite index.
+
+    Args:
+      prefix: The table prefix of the entity.
+      index: An entity_pb.CompositeIndex.
+      values: A dictionary mapping property names to lists of values in the
+        sortable encoding.
+      path: The encoded key path of the entity.
+    Returns:
+      A list of keys, one for each combination of values. Entities missing
+      one of the properties are not in the index.
+    """
+    value_lists = []
+    for prop in index.definition().property_list():
+      if not values.get(prop.name()):
+        return []
+      value_lists.append([self.encode_composite_value(value, prop.direction())
+                          for value in values[prop.name()]])
+
+    index_prefix = self.get_composite_index_prefix(prefix, index.id())
+    return [index_prefix + ''.join(combination) + self._NAMESPACE_SEPARATOR +
+            path for combination in itertools.product(*value_lists)]
+
+  def get_composite_index_rows(self, prefix, index, entity):
+    """ Returns the rows of an entity in a composite index.
+
+    Args:
+      prefix: The table prefix of the entity.
+      index: An entity_pb.CompositeIndex.
+      entity: An entity_pb.EntityProto.
+    Returns:
+      A dictionary mapping composite index keys to the entity key they
+      reference.
+    """
+    values = {}
+    for prop in entity.property_list():
+      values.setdefault(prop.name(), []).append(
+        str(self.__encode_index_pb(prop.value())))
+    path = str(self.__encode_index_pb(entity.key().path()))
+    reference = str(self.get_entity_key(prefix, entity.key().path()))
+    return dict((key, reference) for key in
+      self.get_composite_index_keys(prefix, index, values, path))
+
+  def get_composite_rows(self, entities):
+    """ Returns the rows of entities in the composite indexes which are
+        being maintained. Ancestor indexes are not maintained.
+
+    Args:
+      entities: A list of entities.
+    Returns:
+      A dictionary mapping composite index keys to the entity key they
+      reference.
+    """
+    rows = {}
+    for entity in entities:
+      kind = self.get_entity_kind(entity)
+      for index in self.get_composite_indexes(entity.key().app()):
+        if index.state() in [entity_pb.CompositeIndex.WRITE_ONLY,
+                             entity_pb.CompositeIndex.READ_WRITE] and \
+           not index.definition().ancestor() and \
+           index.definition().entity_type() == kind:
+          rows.update(self.get_composite_index_rows(
+            self.get_table_prefix(entity), index, entity))
+    return rows
 
   def acquire_next_id_from_db(self, prefix):
     """ Gets the next available ID for key assignment.
@@ -580,8 +1244,74 @@ class DatastoreDistributed():
     start = current_id
     end = next_id - 1
 
+    if max_id:
+      self.discard_id_blocks(prefix, max_id)
+
     return start, end
 
+  def allocate_local_ids(self, prefix, size):
+    """ Hands out IDs from blocks reserved ahead of time, so that entities 
+        put without an ID do not each need a lock and a round trip to the
+        ID table. A new block is reserved once the IDs left locally fall 
+        below the low watermark.
+
+    Args:
+      prefix: A table namespace prefix.
+      size: Number of IDs to allocate.
+    Returns:
+      A list of unique IDs.
+    Raises:
+      ZKTransactionException: If a new block could not be reserved.
+    """
+    low_watermark = int(self.id_block_size * ID_LOW_WATERMARK)
+    with self.__id_lock:
+      blocks = self.__id_blocks.setdefault(prefix, [])
+      available = sum(last - first + 1 for first, last in blocks)
+      if available - size < low_watermark:
+        needed = size + low_watermark - available
+        start, end = self.allocate_ids(prefix, max(self.id_block_size, needed),
+          num_retries=3)
+        blocks.append([start, end])
+        self.__stats['id_blocks_reserved'] += 1
+
+      ids = []
+      while len(ids) < size:
+        block = blocks[0]
+        count = min(size - len(ids), block[1] - block[0] + 1)
+        ids.extend(range(block[0], block[0] + count))
+        block[0] += count
+        if block[0] > block[1]:
+          blocks.pop(0)
+      self.__stats['ids_allocated_locally'] += size
+    return ids
+
+  def discard_id_blocks(self, prefix, max_id):
+    """ Drops locally reserved IDs which are not greater than max_id. 
+
+    Args:
+      prefix: A table namespace prefix.
+      max_id: IDs up to and including this value must no longer be used.
+    """
+    with self.__id_lock:
+      blocks = self.__id_blocks.get(prefix, [])
+      for block in blocks:
+        block[0] = max(block[0], max_id + 1)
+      self.__id_blocks[prefix] = [block for block in blocks
+                                  if block[0] <= block[1]]
+
+  def get_stats(self):
+    """ Returns counters describing the work done by this datastore.
+
+    Returns:
+      A dictionary of statistic names to values.
+    """
+    with self.__stats_lock:
+      stats = dict(self.__stats)
+      stats['table_writes'] = dict((table, dict(table_stats))
+        for table, table_stats in self.__stats['table_writes'].items())
+    stats['open_query_cursors'] = len(self.query_cursors)
+    return stats
+
   def put_entities(self, app_id, entities, txn_hash):
     """ Updates indexes of existing entities, inserts new entities and 
         indexes for them.
@@ -591,12 +1321,244 @@ class DatastoreDistributed():
        entities: List of entities.
        txn_hash: A mapping of root keys to transaction IDs.
     """
-    sorted_entities = sorted((self.get_table_prefix(x), x) for x in entities)
-    for prefix, group in itertools.groupby(sorted_entities, lambda x: x[0]):
-      keys = [e.key() for e in entities]
-      self.delete_entities(app_id, keys, txn_hash, soft_delete=False)
-      self.insert_entities(entities, txn_hash)
-      self.insert_index_entries(entities)
+    row_keys = [self.get_entity_key(self.get_table_prefix(e), e.key().path())
+                for e in entities]
+
+    # The previous versions are read once, both to register them for 
+    # rollback and to find which of their index rows are stale.
+    ret = self.datastore_batch.batch_get_entity(dbconstants.APP_ENTITY_TABLE, 
+                                                row_keys,
+                                                dbconstants.APP_ENTITY_SCHEMA)
+    self.register_old_entities(ret, txn_hash, app_id)
+
+    old_entities = self.get_existing_entities(ret)
+    old_asc, old_desc = self.get_index_rows(old_entities)
+    new_asc, new_desc = self.get_index_rows(entities)
+    old_composite = self.get_composite_rows(old_entities)
+    new_composite = self.get_composite_rows(entities)
+
+    # Index keys contain the property value and entity key, so rows for
+    # unchanged values are the same on both sides and are left alone.
+    stale_asc = [key for key in old_asc if key not in new_asc]
+    stale_desc = [key for key in old_desc if key not in new_desc]
+    stale_composite = [key for key in old_composite 
+                       if key not in new_composite]
+    added_asc = dict((key, reference) for key, reference in new_asc.items()
+                     if key not in old_asc)
+    added_desc = dict((key, reference) for key, reference in new_desc.items()
+                      if key not in old_desc)
+    added_composite = dict((key, reference) for key, reference in 
+                           new_composite.items() if key not in old_composite)
+
+    self.write_tables(self.get_entity_puts(entities, txn_hash) +
+      self.__index_delete_writes(stale_asc, stale_desc, stale_composite) +
+      self.__index_put_writes(added_asc, added_desc, added_composite))
+    self.record_kind_stats(old_entities, entities)
+
+  def record_kind_stats(self, removed, added):
+    """ Records how a put or delete changed the number and size of the
+        entities of each kind. Statistics entities and other private kinds
+        are not counted. Changes rolled back with a transaction are still
+        counted until the groomer recounts every kind.
+
+    Args:
+      removed: A list of entity_pb.EntityProto which were replaced or
+        deleted.
+      added: A list of entity_pb.EntityProto which were stored.
+    """
+    changes = [(entity, -1) for entity in removed] + \
+              [(entity, 1) for entity in added]
+    with self.__kind_stat_lock:
+      for entity, sign in changes:
+        kind = self.get_entity_kind(entity)
+        if re.match(groomer.DatastoreGroomer.PROTECTED_KINDS, kind):
+          continue
+        delta = self.__kind_stat_deltas.setdefault(entity.key().app(), {}).\
+          setdefault(kind, [0, 0])
+        delta[0] += sign
+        delta[1] += sign * entity.ByteSize()
+
+  def get_kind_stat_deltas(self):
+    """ Returns the changes to the kind statistics not flushed yet.
+
+    Returns:
+      A dict of application IDs to dicts of kinds to [count, bytes] lists.
+    """
+    with self.__kind_stat_lock:
+      return dict((app_id, dict((kind, list(delta))
+        for kind, delta in kinds.items()))
+        for app_id, kinds in self.__kind_stat_deltas.items())
+
+  def flush_kind_stats(self):
+    """ Adds the changes recorded since the last flush to the statistics
+        entities of each application. The changes of an application which
+        can not be written are kept for the next flush.
+    """
+    with self.__kind_stat_lock:
+      deltas = self.__kind_stat_deltas
+      self.__kind_stat_deltas = {}
+
+    for app_id, kinds in deltas.items():
+      kinds = dict((kind, delta) for kind, delta in kinds.items()
+                   if delta != [0, 0])
+      if not kinds:
+        continue
+      try:
+        self.apply_kind_stats(app_id, kinds)
+      except (ZKTransactionException,
+              dbconstants.AppScaleDBConnectionError), error:
+        logging.warning("Unable to update the kind statistics of {0}: {1}"\
+          .format(app_id, str(error)))
+        with self.__kind_stat_lock:
+          pending = self.__kind_stat_deltas.setdefault(app_id, {})
+          for kind, (count, size) in kinds.items():
+            delta = pending.setdefault(kind, [0, 0])
+            delta[0] += count
+            delta[1] += size
+
+  def apply_kind_stats(self, app_id, kinds):
+    """ Adds changes to the kind statistics and the global statistic of an
+        application, holding the locks of the statistics entities so that
+        every datastore server can add its own changes.
+
+    Args:
+      app_id: The application ID.
+      kinds: A dict of kinds to [count, bytes] lists of changes.
+    Raises:
+      ZKTransactionException: If the locks can not be acquired.
+      AppScaleDBConnectionError: If the statistics can not be read or
+        written.
+    """
+    totals = [sum(delta[0] for delta in kinds.values()),
+              sum(delta[1] for delta in kinds.values())]
+    changes = [(self.new_stat_entity(app_id, KIND_STAT_KIND, kind), delta)
+               for kind, delta in sorted(kinds.items())]
+    changes.append((self.new_stat_entity(app_id, GLOBAL_STAT_KIND,
+      GLOBAL_STAT_NAME), totals))
+    entities = [entity for entity, _ in changes]
+
+    txn_hash = {}
+    try:
+      txn_hash = self.acquire_locks_for_nontrans(app_id, entities)
+      row_keys = [self.get_entity_key(self.get_table_prefix(entity),
+                  entity.key().path()) for entity in entities]
+      current = self.datastore_batch.batch_get_entity(
+        dbconstants.APP_ENTITY_TABLE, row_keys, dbconstants.APP_ENTITY_SCHEMA)
+      current = dict((self.get_entity_key(self.get_table_prefix(entity),
+        entity.key().path()), entity)
+        for entity in self.get_existing_entities(current))
+
+      timestamp = long(time.time() * 1000000)
+      stat_entities = []
+      for row_key, (entity, (count, size)) in zip(row_keys, changes):
+        entity = current.get(row_key, entity)
+        values = dict((prop.name(), prop.value().int64value())
+                      for prop in entity.property_list())
+        self.set_stat_property(entity, 'count',
+          max(0, values.get('count', 0) + count))
+        self.set_stat_property(entity, 'bytes',
+          max(0, values.get('bytes', 0) + size))
+        self.set_stat_property(entity, 'timestamp', timestamp,
+          meaning=entity_pb.Property.GD_WHEN)
+        stat_entities.append(entity)
+
+      self.put_entities(app_id, stat_entities, txn_hash)
+      self.release_locks_for_nontrans(app_id, stat_entities, txn_hash)
+    except (ZKTransactionException,
+            dbconstants.AppScaleDBConnectionError), error:
+      for root_key in txn_hash:
+        self.zookeeper.notify_failed_transaction(app_id, txn_hash[root_key])
+      raise error
+
+  @staticmethod
+  def new_stat_entity(app_id, kind, name):
+    """ Creates an empty statistics entity, which is its own entity group.
+
+    Args:
+      app_id: The application ID.
+      kind: KIND_STAT_KIND or GLOBAL_STAT_KIND.
+      name: The key name, which is the kind counted for kind statistics.
+    Returns:
+      An entity_pb.EntityProto.
+    """
+    entity = entity_pb.EntityProto()
+    key = entity.mutable_key()
+    key.set_app(app_id)
+    element = key.mutable_path().add_element()
+    element.set_type(kind)
+    element.set_name(name)
+    entity.mutable_entity_group().add_element().CopyFrom(element)
+    if kind == KIND_STAT_KIND:
+      prop = entity.add_property()
+      prop.set_name('kind_name')
+      prop.set_multiple(False)
+      prop.mutable_value().set_stringvalue(name)
+    return entity
+
+  @staticmethod
+  def set_stat_property(entity, name, value, meaning=None):
+    """ Sets an integer property of a statistics entity, adding it if it is
+        missing.
+
+    Args:
+      entity: An entity_pb.EntityProto.
+      name: The property name.
+      value: The new value.
+      meaning: The meaning of the property, if it has one.
+    """
+    for prop in entity.property_list():
+      if prop.name() == name:
+        break
+    else:
+      prop = entity.add_property()
+      prop.set_name(name)
+      prop.set_multiple(False)
+      if meaning is not None:
+        prop.set_meaning(meaning)
+    prop.mutable_value().Clear()
+    prop.mutable_value().set_int64value(value)
+
+  def start_stats_flusher(self, interval=STATS_FLUSH_INTERVAL):
+    """ Flushes the kind statistics every interval seconds in a background
+        thread.
+
+    Args:
+      interval: The seconds between flushes.
+    """
+    def flush_periodically():
+      """ Flushes the kind statistics until the process exits. """
+      while True:
+        time.sleep(interval)
+        try:
+          self.flush_kind_stats()
+        except Exception, exception:
+          logging.exception(exception)
+
+    thread = threading.Thread(target=flush_periodically,
+      name="kind-stats-flusher")
+    thread.daemon = True
+    thread.start()
+
+  def get_existing_entities(self, entity_rows):
+    """ Parses the entities in a result from the entity table, skipping 
+        rows which are missing or tombstoned.
+
+    Args:
+      entity_rows: A database result from the APP_ENTITY_TABLE.
+    Returns:
+      A list of entity_pb.EntityProto.
+    """
+    entities = []
+    for row_key in entity_rows:
+      # Entities may not exist if this is the first put
+      if dbconstants.APP_ENTITY_SCHEMA[0] in entity_rows[row_key] and\
+           not entity_rows[row_key][dbconstants.APP_ENTITY_SCHEMA[0]].\
+           startswith(TOMBSTONE):
+        ent = entity_pb.EntityProto()
+        ent.ParseFromString(entity_rows[row_key]\
+          [dbconstants.APP_ENTITY_SCHEMA[0]])
+        entities.append(ent)
+    return entities
 
   def delete_entities(self, app_id, keys, txn_hash, soft_delete=False):
     """ Deletes the entities and the indexes associated with them.
@@ -644,6 +1606,7 @@ class DatastoreDistributed():
 
     self.register_old_entities(ret, txn_hash, app_id)
 
+    writes = []
     if soft_delete:
       row_values = {}
       for rk in row_keys:
@@ -653,28 +1616,21 @@ class DatastoreDistributed():
                           dbconstants.APP_ENTITY_SCHEMA[1]:
                                 str(txn_hash[root_key])
                          }
-      #TODO do these in ||
-      self.datastore_batch.batch_put_entity(dbconstants.APP_ENTITY_TABLE, 
-                                          row_keys, 
-                                          dbconstants.APP_ENTITY_SCHEMA, 
-                                          row_values)    
-      self.update_journal(row_keys, row_values, txn_hash)
+      writes.append((dbconstants.APP_ENTITY_TABLE,
+        self.datastore_batch.batch_put_entity,
+        (dbconstants.APP_ENTITY_TABLE, row_keys, dbconstants.APP_ENTITY_SCHEMA,
+         row_values)))
+      writes.append((dbconstants.JOURNAL_TABLE, self.update_journal,
+        (row_keys, row_values, txn_hash)))
 
-    self.datastore_batch.batch_delete(dbconstants.APP_KIND_TABLE,
-                                      kind_keys, 
-                                      column_names=dbconstants.APP_KIND_SCHEMA)
+    writes.append((dbconstants.APP_KIND_TABLE, self.datastore_batch.batch_delete,
+      (dbconstants.APP_KIND_TABLE, kind_keys, dbconstants.APP_KIND_SCHEMA)))
 
-    entities = []
-    for row_key in ret:
-      # Entities may not exist if this is the first put
-      if dbconstants.APP_ENTITY_SCHEMA[0] in ret[row_key] and\
-           not ret[row_key][dbconstants.APP_ENTITY_SCHEMA[0]].\
-           startswith(TOMBSTONE):
-        ent = entity_pb.EntityProto()
-        ent.ParseFromString(ret[row_key][dbconstants.APP_ENTITY_SCHEMA[0]])
-        entities.append(ent)
+    entities = self.get_existing_entities(ret)
 
-    self.delete_index_entries(entities)
+    # The kind and index rows are removed concurrently with the tombstones.
+    self.write_tables(writes + self.get_index_deletes(entities))
+    self.record_kind_stats(entities, [])
 
   def get_journal_key(self, row_key, version):
     """ Creates a string for a journal key.
@@ -763,21 +1719,26 @@ class DatastoreDistributed():
           uid = '1' + ''.join(['%02d' % ord(x) for x in uid])[:20]
           prop.mutable_value().mutable_uservalue().set_obfuscated_gaiaid(uid)
 
-      last_path = entity.key().path().element_list()[-1]
-      if last_path.id() == 0 and not last_path.has_name():
-        try: 
-          id_, _ = self.allocate_ids(self.get_table_prefix(entity.key()), 1,
-            num_retries=3)
-        except ZKTransactionException, zk_exception:
-          logging.error("Unable to attain a new ID for {0}"\
-            .format(str(entity.key())))
-          raise zk_exception
+    # Assign all of the missing IDs with a single allocation per prefix.
+    incomplete = [e for e in entities if self.is_incomplete_key(e.key())]
+    incomplete = sorted(((self.get_table_prefix(e.key()), e) 
+                         for e in incomplete), key=lambda x: x[0])
+    for prefix, group in itertools.groupby(incomplete, lambda x: x[0]):
+      group = [e for _, e in group]
+      try: 
+        ids = self.allocate_local_ids(prefix, len(group))
+      except ZKTransactionException, zk_exception:
+        logging.error("Unable to attain new IDs for {0}".format(prefix))
+        raise zk_exception
 
+      for entity, id_ in zip(group, ids):
+        last_path = entity.key().path().element_list()[-1]
         last_path.set_id(id_)
 
-        group = entity.mutable_entity_group()
+        group_pb = entity.mutable_entity_group()
         root = entity.key().path().element(0)
-        group.add_element().CopyFrom(root)
+        group_pb.add_element().CopyFrom(root)
+
     # This has maps transaction IDs to root keys
     txn_hash = {}
     try:
@@ -799,6 +1760,18 @@ class DatastoreDistributed():
         self.zookeeper.notify_failed_transaction(app_id, txn_hash[root_key])
       raise zkte
 
+  @staticmethod
+  def is_incomplete_key(key):
+    """ Checks if a key still needs an ID to be assigned to it.
+
+    Args:
+      key: An entity_pb.Reference.
+    Returns:
+      True if the last path element has neither an ID nor a name.
+    """
+    last_path = key.path().element_list()[-1]
+    return last_path.id() == 0 and not last_path.has_name()
+
   def get_root_key_from_entity_key(self, entity_key):
     """ Extract the root key from an entity key. We 
         remove any excess children from a string to get to
@@ -841,7 +1814,6 @@ class DatastoreDistributed():
      TypeError: If args are the wrong type.
     """
     root_keys = []
-    txn_hash = {}
     if not isinstance(entities, list):
       raise TypeError("Expected a list and got %s" % entities.__class__)
     for ent in entities:
@@ -854,12 +1826,14 @@ class DatastoreDistributed():
           "got {0}".format(ent.__class__))
 
     # Remove all duplicate root keys
-    root_keys = list(set(root_keys))
+    root_keys = sorted(set(root_keys))
+    txn_hash = dict(zip(root_keys,
+      self.setup_transactions(app_id, len(root_keys))))
     try:
-      for root_key in root_keys: 
-        txnid = self.setup_transaction(app_id, is_xg=False)
-        txn_hash[root_key] = txnid
-        self.zookeeper.acquire_lock(app_id, txnid, root_key)
+      # All groups are locked at once, so the cost does not grow with the
+      # number of groups.
+      self.zookeeper.acquire_locks(app_id,
+        [(txn_hash[root_key], root_key) for root_key in root_keys])
     except ZKTransactionException, zkte:
       logging.info("Concurrent transaction exception for app id {0} with " \
         "info {1}".format(app_id, str(zkte)))
@@ -953,10 +1927,9 @@ class DatastoreDistributed():
       root_keys.append(self.get_root_key_from_entity_key(ent))
 
     # Remove all duplicate root keys
-    root_keys = list(set(root_keys))
-    for root_key in root_keys: 
-      txnid = txn_hash[root_key]
-      self.zookeeper.release_lock(app_id, txnid)
+    root_keys = sorted(set(root_keys))
+    self.zookeeper.release_locks(app_id,
+      [txn_hash[root_key] for root_key in root_keys])
 
   def validated_result(self, app_id, db_results, current_ongoing_txn=0):
     """ Takes database results from the entity table and returns
@@ -999,13 +1972,17 @@ class DatastoreDistributed():
     """
     journal_result_map = {}
     journal_keys = []
-    # Get all the valid versions of journal entries if needed.
-    for index, dict_entry in enumerate(db_results):
+    versions = []
+    for dict_entry in db_results:
       row_key = dict_entry.keys()[0]
-      current_version = \
-          long(dict_entry[row_key][dbconstants.APP_ENTITY_SCHEMA[1]])
-      trans_id = self.zookeeper.get_valid_transaction_id(\
-                             app_id, current_version, row_key)
+      versions.append((
+        long(dict_entry[row_key][dbconstants.APP_ENTITY_SCHEMA[1]]), row_key))
+    # Validate the whole batch against the transaction blacklist at once.
+    valid_ids = self.zookeeper.get_valid_transaction_ids(app_id, versions)
+
+    # Get all the valid versions of journal entries if needed.
+    for index, (current_version, row_key) in enumerate(versions):
+      trans_id = valid_ids[row_key]
       if current_ongoing_txn != 0 and \
            current_version == current_ongoing_txn:
         # This value has been updated from within an ongoing transaction and
@@ -1017,15 +1994,14 @@ class DatastoreDistributed():
         # Index is used here for lookup when replacing back into db_results.
         journal_result_map[journal_key] = (index, row_key, trans_id)
 
+    if not journal_result_map: 
+      return db_results
+
     journal_entities = self.datastore_batch.batch_get_entity(
                             dbconstants.JOURNAL_TABLE,
                             journal_keys,
                             dbconstants.JOURNAL_SCHEMA)
 
-    if not journal_result_map: 
-      return db_results
-
-
     for journal_key in journal_result_map:
       index, row_key, trans_id = journal_result_map[journal_key]
       if dbconstants.JOURNAL_SCHEMA[0] in journal_entities[journal_key]:
@@ -1060,13 +2036,17 @@ class DatastoreDistributed():
     journal_result_map = {}
     journal_keys = []
     delete_keys = []
+    versions = []
     for row_key in db_results:
       if dbconstants.APP_ENTITY_SCHEMA[1] not in db_results[row_key]:
         continue
-      current_version = long(db_results[row_key]\
-                             [dbconstants.APP_ENTITY_SCHEMA[1]])
-      trans_id = self.zookeeper.get_valid_transaction_id(\
-                             app_id, current_version, row_key)
+      versions.append((long(db_results[row_key]\
+                             [dbconstants.APP_ENTITY_SCHEMA[1]]), row_key))
+    # Validate the whole batch against the transaction blacklist at once.
+    valid_ids = self.zookeeper.get_valid_transaction_ids(app_id, versions)
+
+    for current_version, row_key in versions:
+      trans_id = valid_ids[row_key]
       if current_ongoing_txn != 0 and \
            current_version == current_ongoing_txn:
         # This value has been updated from within an ongoing transaction and
@@ -1256,7 +2236,8 @@ class DatastoreDistributed():
       orders.pop()
     return orders
 
-  def __get_start_key(self, prefix, prop_name, order, last_result):
+  def __get_start_key(self, prefix, prop_name, order, last_result,
+                      filter_ops=None):
     """ Builds the start key for cursor query.
 
     Args: 
@@ -1264,14 +2245,29 @@ class DatastoreDistributed():
        prop_name: property name of the filter.
        order: sort order.
        last_result: last result encoded in cursor.
+       filter_ops: The (op, encoded value) filters on the property.
+    Returns:
+       The start key.
+    Raises:
+       apiproxy_errors.ApplicationError: If the value of the last result is
+         not known, so the cursor can not be resumed.
     """
     e = last_result
     if not prop_name and not order:
       return str(prefix + '/' + str(self.__encode_index_pb(e.key().path())))
-     
-    if e.property_list():
-      plist = e.property_list()
-    else:   
+
+    # The value is fixed by an equality filter, carried in the cursor, or
+    # else read from the entity, which may have been deleted since.
+    val = None
+    for op, value in filter_ops or []:
+      if op == datastore_pb.Query_Filter.EQUAL:
+        val = str(value)
+    if val is None:
+      for p in e.property_list():
+        if p.name() == prop_name:
+          val = str(self.__encode_index_pb(p.value()))
+          break
+    if val is None:
       rkey = prefix + '/' + str(self.__encode_index_pb(e.key().path()))
       ret = self.datastore_batch.batch_get_entity(dbconstants.APP_ENTITY_TABLE, 
                                              [rkey], 
@@ -1279,15 +2275,16 @@ class DatastoreDistributed():
 
       ret = self.remove_tombstoned_entities(ret)
 
-      if dbconstants.APP_ENTITY_SCHEMA[0] in ret[rkey]:
+      if dbconstants.APP_ENTITY_SCHEMA[0] in ret.get(rkey, {}):
         ent = entity_pb.EntityProto(ret[rkey][dbconstants.APP_ENTITY_SCHEMA[0]])
-        plist = ent.property_list() 
-
-    for p in plist:
-      if p.name() == prop_name:
-        break
+        for p in ent.property_list():
+          if p.name() == prop_name:
+            val = str(self.__encode_index_pb(p.value()))
+            break
+    if val is None:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+        'The cursor position is no longer valid.')
 
-    val = str(self.__encode_index_pb(p.value()))
     # remove first binary char for correct lexigraphical ordering
     val = str(val[1:])
 
@@ -1295,7 +2292,7 @@ class DatastoreDistributed():
       val = helper_functions.reverse_lex(val)        
     params = [prefix,
               self.get_entity_kind(e), 
-              p.name(), 
+              prop_name, 
               val, 
               str(self.__encode_index_pb(e.key().path()))]
 
@@ -1350,6 +2347,236 @@ class DatastoreDistributed():
 
     return results
 
+  @staticmethod
+  def get_keys_only_entity(entity):
+    """ Returns a copy of an entity with only its key.
+
+    Args:
+      entity: An entity_pb.EntityProto.
+    Returns:
+      An entity_pb.EntityProto without properties.
+    """
+    key_entity = entity_pb.EntityProto()
+    key_entity.mutable_key().CopyFrom(entity.key())
+    key_entity.mutable_entity_group().CopyFrom(entity.entity_group())
+    return key_entity
+
+  def get_entity_from_reference(self, query, prefix, reference):
+    """ Builds a keys-only entity from a reference to the entity table,
+        without reading the entity.
+
+    Args:
+      query: The query the reference was found for.
+      prefix: The table prefix of the query.
+      reference: An entity table key.
+    Returns:
+      An entity_pb.EntityProto with only a key, or None if the reference 
+      does not tell whether an element has a name or an ID.
+    """
+    entity = entity_pb.EntityProto()
+    key = entity.mutable_key()
+    key.set_app(query.app())
+    if query.name_space():
+      key.set_name_space(query.name_space())
+
+    path = str(reference)[len(prefix) + 1:]
+    for encoded_element in path.split('!')[:-1]:
+      kind, key_id = encoded_element.split(':', 1)
+      element = key.mutable_path().add_element()
+      element.set_type(kind)
+      if not key_id.isdigit() or len(key_id) < ID_KEY_LENGTH:
+        element.set_name(key_id)
+      elif len(key_id) == ID_KEY_LENGTH and key_id.startswith('0'):
+        # IDs are zero padded, and names this shape already share a row
+        # with the ID of the same value.
+        element.set_id(long(key_id))
+      else:
+        return None
+
+    entity.mutable_entity_group().add_element().CopyFrom(
+      key.path().element(0))
+    return entity
+
+  def __fetch_keys(self, query, prefix, refs):
+    """ Given the results from an index scan, get the keys of the entities
+        they reference. Entities are only read when their key can not be
+        recovered from the reference.
+
+    Args:
+      query: The query being run.
+      prefix: The table prefix of the query.
+      refs: key/value pairs where the values contain a reference to 
+            the entitiy table.
+    Returns:
+      Encoded keys-only entities.
+    """
+    entities = []
+    unresolved = {}
+    for ref in refs:
+      reference = ref.values()[0]['reference']
+      entity = self.get_entity_from_reference(query, prefix, reference)
+      if entity is None:
+        unresolved.setdefault(reference, []).append(len(entities))
+      entities.append(entity)
+
+    if unresolved:
+      result = self.datastore_batch.batch_get_entity(
+        dbconstants.APP_ENTITY_TABLE, unresolved.keys(),
+        dbconstants.APP_ENTITY_SCHEMA)
+      result = self.remove_tombstoned_entities(result)
+      for reference, positions in unresolved.items():
+        if reference in result and \
+           dbconstants.APP_ENTITY_SCHEMA[0] in result[reference]:
+          entity = self.get_keys_only_entity(entity_pb.EntityProto(
+            result[reference][dbconstants.APP_ENTITY_SCHEMA[0]]))
+          for position in positions:
+            entities[position] = entity
+
+    return [entity.Encode() for entity in entities if entity is not None]
+
+  def get_index_value_tag(self, property_name, filter_ops):
+    """ Finds the type of a property from the filters on it, which is 
+        needed to read its value back from an index key.
+
+    Args:
+      property_name: The name of the property.
+      filter_ops: A list of (op, encoded value) filters on the property.
+    Returns:
+      The tag byte of the value type, or None if it is not known.
+    """
+    tags = set(str(value)[0] for _, value in filter_ops)
+    if len(tags) != 1:
+      return None
+    tag = tags.pop()
+    field_tag = sortable_pb_encoder.Decoder(array.array('B', tag)).\
+      getVarInt32()
+    if field_tag >> 3 not in INDEX_VALUE_TAGS:
+      return None
+    return tag
+
+  def __fetch_projection(self, query, prefix, property_name, direction, tag,
+                         refs):
+    """ Builds projected entities from the values in index keys.
+
+    Args:
+      query: The query being run.
+      prefix: The table prefix of the query.
+      property_name: The projected property.
+      direction: The direction of the index table that was scanned.
+      tag: The tag byte of the property's value type.
+      refs: The index rows returned by the scan.
+    Returns:
+      Encoded entities with the projected property, or None if a row could
+      not be read back.
+    """
+    entities = []
+    for ref in refs:
+      reference = str(ref.values()[0]['reference'])
+      value = self.get_index_value(query, prefix, property_name, direction,
+                                   ref)
+      entity = self.get_entity_from_reference(query, prefix, reference)
+      if entity is None:
+        return None
+      prop = entity.add_property()
+      prop.set_name(property_name)
+      prop.set_meaning(entity_pb.Property.INDEX_VALUE)
+      prop.set_multiple(False)
+      decoder = sortable_pb_encoder.Decoder(array.array('B', tag + value))
+      try:
+        prop.mutable_value().TryMerge(decoder)
+      except ProtocolBuffer.ProtocolBufferDecodeError:
+        return None
+      entities.append(entity.Encode())
+    return entities
+
+  def get_index_value(self, query, prefix, property_name, direction, ref):
+    """ Returns the encoded property value in a property index key, without
+        the tag byte of its type.
+
+    Args:
+      query: The query being run.
+      prefix: The table prefix of the query.
+      property_name: The indexed property.
+      direction: The direction of the index table that was scanned.
+      ref: A row of the property index.
+    Returns:
+      A str holding the encoded value.
+    """
+    value_start = len(self.get_index_key_from_params(
+      [prefix, query.kind(), property_name, None]))
+    index_key = str(ref.keys()[0])
+    path = str(ref.values()[0]['reference'])[len(prefix) + 1:]
+    value = index_key[value_start:len(index_key) - len(path) - 1]
+    if direction == datastore_pb.Query_Order.DESCENDING:
+      value = helper_functions.reverse_lex(value)
+    return value
+
+  def __index_value_tag_bytes(self):
+    """ Returns the tag bytes which index keys leave out of the values they
+        can be read back from, as sortable_pb_encoder writes them.
+
+    Returns:
+      A list of one character strs.
+    """
+    int_value = entity_pb.PropertyValue()
+    int_value.set_int64value(0)
+    bool_value = entity_pb.PropertyValue()
+    bool_value.set_booleanvalue(False)
+    string_value = entity_pb.PropertyValue()
+    string_value.set_stringvalue('')
+    double_value = entity_pb.PropertyValue()
+    double_value.set_doublevalue(0.0)
+    return [str(self.__encode_index_pb(value))[0] for value in
+            [int_value, bool_value, string_value, double_value]]
+
+  def __add_index_value(self, query, prefix, property_name, direction,
+                        filter_ops, refs, encoded_entity):
+    """ Adds the value an entity has in a property index to a keys only
+        result, so that a cursor can resume after it without reading it.
+
+    Args:
+      query: The query being run.
+      prefix: The table prefix of the query.
+      property_name: The indexed property.
+      direction: The direction of the index table that was scanned.
+      filter_ops: The (op, encoded value) filters on the property.
+      refs: The index rows scanned for the results.
+      encoded_entity: The encoded keys only result.
+    Returns:
+      The encoded result, with the property if its value could be read.
+    """
+    entity = entity_pb.EntityProto(encoded_entity)
+    reference = prefix + '/' + str(self.__encode_index_pb(entity.key().path()))
+    for ref in reversed(refs):
+      if str(ref.values()[0]['reference']) != reference:
+        continue
+      value = self.get_index_value(query, prefix, property_name, direction,
+                                   ref)
+      tag = self.get_index_value_tag(property_name, filter_ops)
+      if tag:
+        tags = [tag]
+      else:
+        tags = self.__index_value_tag_bytes()
+      # A value read with the wrong type does not encode back to the same
+      # index value.
+      for tag in tags:
+        prop_value = entity_pb.PropertyValue()
+        try:
+          prop_value.TryMerge(sortable_pb_encoder.Decoder(
+            array.array('B', tag + value)))
+        except ProtocolBuffer.ProtocolBufferDecodeError:
+          continue
+        if str(self.__encode_index_pb(prop_value))[1:] != value:
+          continue
+        prop = entity.add_property()
+        prop.set_name(property_name)
+        prop.set_meaning(entity_pb.Property.INDEX_VALUE)
+        prop.set_multiple(False)
+        prop.mutable_value().CopyFrom(prop_value)
+        return entity.Encode()
+      break
+    return encoded_entity
+
   def ordered_ancestor_query(self, query, filter_info, order_info):
     """ Performs an ordered ancestor query. It grabs all entities of a 
         given ancestor and then orders in memory.
@@ -1609,6 +2836,32 @@ class DatastoreDistributed():
     key = '!'.join(tokens)[1:] + '!'
     return key
 
+  def __fill_page(self, fetch_rows, resolve, limit, rows=None):
+    """ Resolves index rows into results until there are enough of them or
+        the index range runs out. Rows of deleted entities resolve to
+        nothing, so each page of rows can give fewer results than it has.
+
+    Args:
+      fetch_rows: A function taking the key of the last row scanned (or
+        None) and a page size, which returns the next index rows.
+      resolve: A function turning a list of index rows into results.
+      limit: The number of results wanted.
+      rows: The first page of rows, if they were already fetched.
+    Returns:
+      A list of at most limit results.
+    """
+    results = []
+    size = limit
+    if rows is None:
+      rows = fetch_rows(None, size)
+    while True:
+      results.extend(resolve(rows))
+      if len(rows) < size or len(results) >= limit:
+        break
+      size = limit - len(results)
+      rows = fetch_rows(rows[-1].keys()[0], size)
+    return results
+
   def kind_query_range(self, query, filter_info, order_info):
     """ Gets start and end keys for kind queries, along with
         inclusivity of those keys.
@@ -1665,6 +2918,11 @@ class DatastoreDistributed():
     for fi in filter_info:
       if fi != "__key__":
         return None
+
+    # Sort orders on properties are served from the property indexes.
+    if query.has_kind() and not query.has_ancestor() and \
+       any(name != '__key__' for name, _ in order_info):
+      return None
     
     order = None
     prop_name = None
@@ -1689,16 +2947,28 @@ class DatastoreDistributed():
       startrow = self.get_kind_key(prefix, last_result.key().path())
       start_inclusive = self._DISABLE_INCLUSIVITY
 
-    limit = query.limit() or self._MAXIMUM_RESULTS
-    result = self.datastore_batch.range_query(dbconstants.APP_KIND_TABLE, 
+    def fetch_rows(last_key, size):
+      """ Fetches the next rows from the kind table. """
+      start_key = startrow
+      inclusive = start_inclusive
+      if last_key:
+        start_key = last_key
+        inclusive = self._DISABLE_INCLUSIVITY
+      return self.datastore_batch.range_query(dbconstants.APP_KIND_TABLE, 
                                               dbconstants.APP_KIND_SCHEMA, 
-                                              startrow, 
+                                              start_key, 
                                               endrow, 
-                                              limit, 
+                                              size, 
                                               offset=0, 
-                                              start_inclusive=start_inclusive, 
+                                              start_inclusive=inclusive, 
                                               end_inclusive=end_inclusive)
-    return self.__fetch_entities(result)
+
+    limit = query.limit() or self._MAXIMUM_RESULTS
+    if query.keys_only():
+      prefix = self.get_table_prefix(query)
+      return self.__fill_page(fetch_rows,
+        lambda rows: self.__fetch_keys(query, prefix, rows), limit)
+    return self.__fill_page(fetch_rows, self.__fetch_entities, limit)
 
   def __single_property_query(self, query, filter_info, order_info):
     """Performs queries satisfiable by the Single_Property tables.
@@ -1748,19 +3018,52 @@ class DatastoreDistributed():
       startrow = self.__get_start_key(prefix, 
                                     property_name,
                                     direction,
-                                    last_result)
+                                    last_result,
+                                    filter_ops)
     else:
       startrow = None
 
-    references = self.__apply_filters(filter_ops, 
+    def fetch_rows(last_key, size):
+      """ Fetches the next rows from the property index. """
+      return self.__apply_filters(filter_ops, 
                                order_info, 
                                property_name, 
                                query.kind(), 
                                prefix, 
-                               limit, 
+                               size, 
                                0, 
-                               startrow)
-    return self.__fetch_entities(references)
+                               last_key or startrow,
+                               force_start_key_exclusive=bool(last_key or
+                                                              startrow))
+
+    if query.keys_only():
+      scanned = []
+      def fetch_scanned_rows(last_key, size):
+        """ Fetches the next rows, keeping them to position the cursor. """
+        rows = fetch_rows(last_key, size)
+        scanned.extend(rows)
+        return rows
+      results = self.__fill_page(fetch_scanned_rows,
+        lambda rows: self.__fetch_keys(query, prefix, rows), limit)
+      # The next page resumes at the last result's value, which is read from
+      # its index key, as the entity may be gone by then.
+      if results:
+        results[-1] = self.__add_index_value(query, prefix, property_name,
+          direction, filter_ops, scanned, results[-1])
+      return results
+
+    # A projection of the scanned property is read from the index keys.
+    references = None
+    if [property_name] == query.property_name_list():
+      tag = self.get_index_value_tag(property_name, filter_ops)
+      if tag:
+        references = fetch_rows(None, limit)
+        projection = self.__fetch_projection(query, prefix, property_name,
+          direction, tag, references)
+        if projection is not None:
+          return projection
+    return self.__fill_page(fetch_rows, self.__fetch_entities, limit,
+      references)
     
   def __apply_filters(self, 
                      filter_ops, 
@@ -1986,6 +3289,319 @@ class DatastoreDistributed():
          
     return []
 
+  def get_composite_index_for_query(self, query, filter_info, order_info):
+    """ Finds a composite index which holds the results of a query in a
+        single contiguous range: equality filters on its first properties,
+        followed by the sort orders, which start with the inequality
+        filter's property if there is one.
+
+    Args:
+      query: The query to run.
+      filter_info: tuple with filter operators and values.
+      order_info: tuple with property name and the sort order.
+    Returns:
+      An entity_pb.CompositeIndex which serves queries, or None.
+    """
+    if query.has_ancestor() or not query.has_kind():
+      return None
+    if '__key__' in filter_info or \
+       any(name == '__key__' for name, _ in order_info):
+      return None
+
+    equality = set()
+    inequality = None
+    for name, filter_ops in filter_info.items():
+      ops = set(op for op, _ in filter_ops)
+      if ops == set([datastore_pb.Query_Filter.EQUAL]):
+        # Several values for the same property need it indexed twice.
+        if len(filter_ops) > 1:
+          return None
+        equality.add(name)
+      elif ops.issubset(REVERSED_OPERATORS) and inequality is None:
+        inequality = name
+      else:
+        return None
+
+    postfix = list(order_info)
+    if inequality:
+      if postfix and postfix[0][0] != inequality:
+        return None
+      if not postfix:
+        postfix = [(inequality, None)]
+    if len(equality) + len(postfix) < 2:
+      return None
+
+    for index in self.get_composite_indexes(query.app()):
+      definition = index.definition()
+      if index.state() != entity_pb.CompositeIndex.READ_WRITE or \
+         definition.ancestor() or definition.entity_type() != query.kind():
+        continue
+      props = [(prop.name(), prop.direction())
+               for prop in definition.property_list()]
+      if len(props) != len(equality) + len(postfix):
+        continue
+      if set(name for name, _ in props[:len(equality)]) != equality:
+        continue
+      if all(name == prop_name and direction in (None, prop_direction)
+             for (name, direction), (prop_name, prop_direction) in
+             zip(postfix, props[len(equality):])):
+        return index
+    return None
+
+  def get_composite_index_range(self, prefix, index, filter_info):
+    """ Gets the keys bounding the rows of a composite index which match
+        the filters of a query. Both bounds are inclusive, since bounds
+        ending with the terminating string never equal a row key.
+
+    Args:
+      prefix: The table prefix of the query.
+      index: The entity_pb.CompositeIndex the query is run on.
+      filter_info: tuple with filter operators and values.
+    Returns:
+      A tuple of the start and end keys.
+    """
+    value_prefix = self.get_composite_index_prefix(prefix, index.id())
+    props = index.definition().property_list()
+    position = 0
+    for prop in props:
+      filter_ops = filter_info.get(prop.name())
+      if not filter_ops or filter_ops[0][0] != datastore_pb.Query_Filter.EQUAL:
+        break
+      value_prefix += self.encode_composite_value(filter_ops[0][1],
+                                                  prop.direction())
+      position += 1
+
+    start_key = value_prefix
+    end_key = value_prefix + self._TERM_STRING
+    if position == len(props):
+      return start_key, end_key
+
+    prop = props[position]
+    for op, value in filter_info.get(prop.name(), []):
+      value = value_prefix + self.encode_composite_value(value, 
+                                                         prop.direction())
+      if prop.direction() == entity_pb.Index_Property.DESCENDING:
+        op = REVERSED_OPERATORS[op]
+      if op == datastore_pb.Query_Filter.GREATER_THAN:
+        start_key = max(start_key, value + self._TERM_STRING)
+      elif op == datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL:
+        start_key = max(start_key, value)
+      elif op == datastore_pb.Query_Filter.LESS_THAN:
+        end_key = min(end_key, value)
+      elif op == datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:
+        end_key = min(end_key, value + self._TERM_STRING)
+    return start_key, end_key
+
+  def __get_composite_start_key(self, prefix, index, filter_info, 
+                                last_result, start_key, end_key):
+    """ Builds the key of the composite index row a cursor stopped at.
+
+    Args: 
+      prefix: The table prefix of the query.
+      index: The entity_pb.CompositeIndex the query is run on.
+      filter_info: tuple with filter operators and values.
+      last_result: last result encoded in cursor.
+      start_key: The first key of the query's range.
+      end_key: The last key of the query's range.
+    Returns:
+      The row key, or None if the last result can not be found.
+    """
+    entity = last_result
+    names = set(prop.name() for prop in index.definition().property_list())
+    names.difference_update(filter_info)
+    if names - set(prop.name() for prop in entity.property_list()):
+      rkey = prefix + '/' + str(self.__encode_index_pb(entity.key().path()))
+      ret = self.datastore_batch.batch_get_entity(dbconstants.APP_ENTITY_TABLE,
+        [rkey], dbconstants.APP_ENTITY_SCHEMA)
+      ret = self.remove_tombstoned_entities(ret)
+      if dbconstants.APP_ENTITY_SCHEMA[0] not in ret[rkey]:
+        return None
+      entity = entity_pb.EntityProto(
+        ret[rkey][dbconstants.APP_ENTITY_SCHEMA[0]])
+
+    values = {}
+    for prop in entity.property_list():
+      values.setdefault(prop.name(), []).append(
+        str(self.__encode_index_pb(prop.value())))
+    for name, filter_ops in filter_info.items():
+      if filter_ops[0][0] == datastore_pb.Query_Filter.EQUAL:
+        values[name] = [str(filter_ops[0][1])]
+
+    # Entities with several values for a property have several rows, so the
+    # query resumes after the first one in range.
+    path = str(self.__encode_index_pb(entity.key().path()))
+    keys = [key for key in 
+            self.get_composite_index_keys(prefix, index, values, path)
+            if start_key <= key <= end_key]
+    if not keys:
+      return None
+    return min(keys)
+
+  def __composite_index_query(self, query, filter_info, index):
+    """ Performs a composite query with a single range scan of its 
+        composite index.
+
+    Args:
+      query: The query to run.
+      filter_info: tuple with filter operators and values.
+      index: The entity_pb.CompositeIndex holding the query's results.
+    Returns:
+      List of entities retrieved from the given query.
+    """
+    prefix = self.get_table_prefix(query)
+    start_key, end_key = self.get_composite_index_range(prefix, index,
+                                                        filter_info)
+    start_inclusive = self._ENABLE_INCLUSIVITY
+    if query.has_compiled_cursor() and query.compiled_cursor().position_size():
+      cursor = cassandra_stub_util.ListCursor(query)
+      last_result = cursor._GetLastResult()
+      resume_key = self.__get_composite_start_key(prefix, index, filter_info,
+        last_result, start_key, end_key)
+      if resume_key is None:
+        return []
+      start_key = resume_key
+      start_inclusive = self._DISABLE_INCLUSIVITY
+
+    if query.keys_only():
+      resolve = lambda rows: self.__fetch_keys(query, prefix, rows)
+    else:
+      resolve = self.__fetch_entities
+
+    # An entity with several values in range has several rows, but is only
+    # returned once. Rows of deleted entities give no results, so scanning
+    # goes on until there are enough.
+    limit = query.limit() or self._MAXIMUM_RESULTS
+    results = []
+    seen = set()
+    while len(results) < limit:
+      size = limit - len(results)
+      rows = self.datastore_batch.range_query(dbconstants.COMPOSITE_TABLE,
+        dbconstants.COMPOSITE_SCHEMA, start_key, end_key, size, offset=0,
+        start_inclusive=start_inclusive, end_inclusive=self._ENABLE_INCLUSIVITY)
+      references = []
+      for row in rows:
+        reference = row.values()[0][dbconstants.COMPOSITE_SCHEMA[0]]
+        if reference not in seen:
+          seen.add(reference)
+          references.append(row)
+      results.extend(resolve(references))
+      if len(rows) < size:
+        break
+      start_key = str(rows[-1].keys()[0])
+      start_inclusive = self._DISABLE_INCLUSIVITY
+    return results
+
+  def get_merge_join_prefixes(self, query, filter_info, order_info):
+    """ Finds the property index ranges of a query with only equality 
+        filters. Rows in each range differ only by entity path, which they
+        are sorted by, so the query's results are the paths found in every
+        range.
+
+    Args:
+      query: The query to run.
+      filter_info: tuple with filter operators and values.
+      order_info: tuple with property name and the sort order.
+    Returns:
+      A list of ASC_PROPERTY_TABLE key prefixes, one for each filter, or
+      None if the query can not be answered with a merge join.
+    """
+    if query.has_ancestor() or not query.has_kind() or order_info:
+      return None
+    if '__key__' in filter_info:
+      return None
+
+    prefix = self.get_table_prefix(query)
+    value_prefixes = []
+    for name, filter_ops in sorted(filter_info.items()):
+      for op, value in filter_ops:
+        if op != datastore_pb.Query_Filter.EQUAL:
+          return None
+        # Remove the first binary character, as the index keys do.
+        params = [prefix, query.kind(), name, str(value)[1:], None]
+        value_prefixes.append(self.get_index_key_from_params(params))
+    if len(value_prefixes) < 2:
+      return None
+    return value_prefixes
+
+  def __merge_join_query(self, query, value_prefixes):
+    """ Performs a query with several equality filters by intersecting the
+        paths in their property index ranges. Each range seeks forward to
+        the highest path seen in any of them, so rows which can not be in
+        the result are mostly skipped, and only matching entities are read.
+
+    Args:
+      query: The query to run.
+      value_prefixes: The ASC_PROPERTY_TABLE key prefix of each filter.
+    Returns:
+      List of entities retrieved from the given query, in key order.
+    """
+    prefix = self.get_table_prefix(query)
+    target = ''
+    inclusive = self._ENABLE_INCLUSIVITY
+    if query.has_compiled_cursor() and query.compiled_cursor().position_size():
+      cursor = cassandra_stub_util.ListCursor(query)
+      last_result = cursor._GetLastResult()
+      target = str(self.__encode_index_pb(last_result.key().path()))
+      inclusive = self._DISABLE_INCLUSIVITY
+
+    # Rows read ahead for each filter as (path, row) tuples, and whether the
+    # filter has no rows after them.
+    buffers = [[] for _ in value_prefixes]
+    exhausted = [False for _ in value_prefixes]
+
+    def seek(position, target, inclusive):
+      """ Returns the first (path, row) of a filter at or after a path, or
+          None if there is none. """
+      value_prefix = value_prefixes[position]
+      rows = buffers[position]
+      while True:
+        while rows and (rows[0][0] < target or 
+                        (not inclusive and rows[0][0] == target)):
+          rows.pop(0)
+        if rows:
+          return rows[0]
+        if exhausted[position]:
+          return None
+        page = self.datastore_batch.range_query(
+          dbconstants.ASC_PROPERTY_TABLE, dbconstants.PROPERTY_SCHEMA,
+          value_prefix + target, value_prefix + self._TERM_STRING,
+          MERGE_JOIN_BATCH_SIZE, offset=0, start_inclusive=inclusive,
+          end_inclusive=self._ENABLE_INCLUSIVITY)
+        rows.extend((str(row.keys()[0])[len(value_prefix):], row)
+                    for row in page)
+        if len(page) < MERGE_JOIN_BATCH_SIZE:
+          exhausted[position] = True
+
+    if query.keys_only():
+      resolve = lambda rows: self.__fetch_keys(query, prefix, rows)
+    else:
+      resolve = self.__fetch_entities
+
+    # Matches of deleted entities give no results, so joining goes on until
+    # there are enough.
+    limit = query.limit() or self._MAXIMUM_RESULTS
+    results = []
+    while target is not None and len(results) < limit:
+      references = []
+      while len(references) < limit - len(results):
+        heads = []
+        for position in range(len(value_prefixes)):
+          head = seek(position, target, inclusive)
+          if head is None:
+            target = None
+            break
+          heads.append(head)
+          # Later filters seek straight past paths this one does not have.
+          if head[0] != target:
+            target, inclusive = head[0], self._ENABLE_INCLUSIVITY
+        if target is None:
+          break
+        if all(path == target for path, _ in heads):
+          references.append(heads[0][1])
+          inclusive = self._DISABLE_INCLUSIVITY
+      results.extend(resolve(references))
+    return results
+
   def __composite_query(self, query, filter_info, order_info):  
     """Performs Composite queries which is a combination of 
        multiple properties to query on.
@@ -2006,6 +3622,15 @@ class DatastoreDistributed():
     if not query.has_kind():
       return None
 
+    index = self.get_composite_index_for_query(query, filter_info, order_info)
+    if index:
+      return self.__composite_index_query(query, filter_info, index)
+
+    value_prefixes = self.get_merge_join_prefixes(query, filter_info, 
+                                                  order_info)
+    if value_prefixes:
+      return self.__merge_join_query(query, value_prefixes)
+
     def set_prop_names(filt_info):
       """ Sets the property names. """
       pnames = set(filt_info.keys())
@@ -2055,7 +3680,8 @@ class DatastoreDistributed():
       startrow = self.__get_start_key(prefix, 
                                     property_name,
                                     direction,
-                                    last_result)
+                                    last_result,
+                                    filter_ops)
     else:
       startrow = None
     result = []     
@@ -2182,11 +3808,13 @@ class DatastoreDistributed():
   ]
 
 
-  def __get_query_results(self, query):
+  def __get_query_results(self, query, positioned=False):
     """Applies the strategy for the provided query.
 
     Args:    
       query: A datastore_pb.Query protocol buffer.
+      positioned: True to leave the last result of a keys only query with
+        the property values a cursor needs to resume after it.
     Returns:
       Result set.
     """
@@ -2215,12 +3843,248 @@ class DatastoreDistributed():
       if results:
         break
 
-    # TODO keys only queries. 
-    # They work but pass the entire entity back to the AppServer
-    if query.has_keys_only():
-      pass
+    # Strategies which read whole entities still only send back keys.
+    if query.keys_only() and results:
+      last_result = results[-1]
+      results = [self.get_keys_only_entity(entity_pb.EntityProto(ii)).Encode()
+                 for ii in results]
+      if positioned:
+        results[-1] = last_result
     return results
   
+  def is_streamable_query(self, query):
+    """ Checks if a query is answered by a strategy which returns results
+        in their final order and can resume after the last result, so its
+        results can be fetched a batch at a time.
+
+    Args:
+      query: A datastore_pb.Query.
+    Returns:
+      True if the query can be run in batches, False otherwise.
+    """
+    filters, orders = datastore_index.Normalize(query.filter_list(),
+                                                query.order_list(), [])
+    filter_info = self.generate_filter_info(filters)
+    order_info = self.generate_order_info(orders)
+
+    # Kind, kindless and ancestor queries without sort orders. Ancestor
+    # queries with a kind are filtered and reordered after the scan.
+    if not order_info and all(name == '__key__' for name in filter_info):
+      return not (query.has_ancestor() and query.has_kind())
+
+    # Queries with the layout of a composite index, or with only equality
+    # filters, which are merge joined in key order.
+    if self.get_composite_index_for_query(query, filter_info, order_info) or \
+       self.get_merge_join_prefixes(query, filter_info, order_info):
+      return True
+
+    # Queries on a single property, the same as __single_property_query.
+    property_names = set(filter_info.keys())
+    property_names.update(x[0] for x in order_info)
+    property_names.discard('__key__')
+    if len(property_names) != 1 or query.has_ancestor() or \
+       not query.has_kind():
+      return False
+    property_name = property_names.pop()
+    equality_filters = [1 for op, _ in filter_info.get(property_name, [])
+                        if op == datastore_pb.Query_Filter.EQUAL]
+    if len(equality_filters) > 1:
+      return False
+    if len(order_info) > 1 or (order_info and 
+                               order_info[0][0] != property_name):
+      return False
+    return True
+
+  def __fetch_query_page(self, cursor, size, keys_only=False):
+    """ Runs a query for the results after the last one a cursor returned,
+        and moves the cursor past them.
+
+    Args:
+      cursor: A QueryCursor.
+      size: The maximum number of results to fetch.
+      keys_only: True to only fetch the keys of the results.
+    Returns:
+      A list of encoded entities.
+    """
+    page_query = datastore_pb.Query()
+    page_query.CopyFrom(cursor.query)
+    page_query.clear_offset()
+    page_query.clear_count()
+    page_query.set_limit(size)
+    if keys_only:
+      page_query.set_keys_only(True)
+    if cursor.last_result:
+      page_query.clear_compiled_cursor()
+      cassandra_stub_util.QueryCursor(cursor.query, [cursor.last_result]).\
+        _EncodeCompiledCursor(page_query.mutable_compiled_cursor())
+    results = self.__get_query_results(page_query, positioned=True) or []
+    if results:
+      cursor.last_result = entity_pb.EntityProto(results[-1])
+      if page_query.keys_only():
+        results[-1] = self.get_keys_only_entity(cursor.last_result).Encode()
+    return results
+
+  def fetch_query_batch(self, cursor, count, offset, query_result):
+    """ Fetches the next batch of results for a query cursor, starting 
+        after the last result it returned.
+
+    Args:
+      cursor: A QueryCursor.
+      count: The number of results to return.
+      offset: The number of results to skip before the batch.
+      query_result: The datastore_pb.QueryResult to fill in.
+    Returns:
+      True if the query may have more results, False otherwise.
+    """
+    # Skipped results are only needed for their position, so their keys are
+    # read from the indexes rather than fetching whole entities.
+    skipped = 0
+    if offset > 0:
+      skipped = len(self.__fetch_query_page(cursor, offset, keys_only=True))
+
+    fetch_size = count
+    if cursor.remaining is not None:
+      fetch_size = min(fetch_size, cursor.remaining)
+
+    results = []
+    if skipped == offset and fetch_size > 0:
+      results = self.__fetch_query_page(cursor, fetch_size)
+
+    more_results = skipped == offset and len(results) == fetch_size
+    batch = [entity_pb.EntityProto(ii) for ii in results]
+    if cursor.remaining is not None:
+      cursor.remaining -= len(batch)
+      more_results = more_results and cursor.remaining > 0
+
+    query_result.set_skipped_results(skipped)
+    query_result.result_list().extend(batch)
+    query_result.set_keys_only(cursor.query.keys_only())
+    query_result.set_more_results(more_results)
+    if cursor.last_result:
+      cassandra_stub_util.QueryCursor(cursor.query, [cursor.last_result]).\
+        _EncodeCompiledCursor(query_result.mutable_compiled_cursor())
+    return more_results
+
+  def __count_index_rows(self, fetch_keys, maximum):
+    """ Counts rows by paging through their keys.
+
+    Args:
+      fetch_keys: A function taking the last key counted (or None) and a
+        page size, which returns the keys of the next rows.
+      maximum: Stop counting after this many rows, or None to count all.
+    Returns:
+      The number of rows counted.
+    """
+    total = 0
+    last_key = None
+    while maximum is None or total < maximum:
+      size = COUNT_BATCH_SIZE
+      if maximum is not None:
+        size = min(size, maximum - total)
+      keys = fetch_keys(last_key, size)
+      total += len(keys)
+      if len(keys) < size:
+        break
+      last_key = keys[-1]
+    return total
+
+  def count_query_results(self, query, maximum=None):
+    """ Counts the results of a query. Kind and single property queries are
+        counted from the kind and property tables without reading entities.
+
+    Args:
+      query: A datastore_pb.Query.
+      maximum: Stop counting after this many results, or None to count all.
+    Returns:
+      The number of results.
+    """
+    filters, orders = datastore_index.Normalize(query.filter_list(),
+                                                query.order_list(), [])
+    filter_info = self.generate_filter_info(filters)
+    order_info = self.generate_order_info(orders)
+    streamable = self.is_streamable_query(query)
+
+    if streamable and query.has_kind() and not query.has_ancestor() and \
+       not order_info and all(name == '__key__' for name in filter_info):
+      startrow, endrow, start_inclusive, end_inclusive = \
+        self.kind_query_range(query, filter_info, order_info)
+      if query.has_compiled_cursor() and \
+         query.compiled_cursor().position_size():
+        last_result = cassandra_stub_util.ListCursor(query)._GetLastResult()
+        startrow = self.get_kind_key(self.get_table_prefix(query),
+                                     last_result.key().path())
+        start_inclusive = self._DISABLE_INCLUSIVITY
+
+      def fetch_keys(last_key, size):
+        """ Fetches the next keys from the kind table. """
+        start_key = str(startrow)
+        inclusive = start_inclusive
+        if last_key:
+          start_key = last_key
+          inclusive = self._DISABLE_INCLUSIVITY
+        return self.datastore_batch.range_query(dbconstants.APP_KIND_TABLE,
+          dbconstants.APP_KIND_SCHEMA, start_key, str(endrow), size,
+          offset=0, start_inclusive=inclusive, end_inclusive=end_inclusive,
+          keys_only=True)
+      return self.__count_index_rows(fetch_keys, maximum)
+
+    if streamable and query.has_kind() and not query.has_ancestor():
+      property_names = set(filter_info.keys())
+      property_names.update(x[0] for x in order_info)
+      property_names.discard('__key__')
+      property_name = property_names.pop()
+      filter_ops = filter_info.get(property_name, [])
+      prefix = self.get_table_prefix(query)
+
+      # The count starts after a cursor as the query's results would.
+      startrow = None
+      if query.has_compiled_cursor() and \
+         query.compiled_cursor().position_size():
+        direction = datastore_pb.Query_Order.ASCENDING
+        if order_info:
+          direction = order_info[0][1]
+        last_result = cassandra_stub_util.ListCursor(query)._GetLastResult()
+        startrow = self.__get_start_key(prefix, property_name, direction,
+                                        last_result, filter_ops)
+
+      def fetch_keys(last_key, size):
+        """ Fetches the next keys from the property table. """
+        rows = self.__apply_filters(filter_ops, order_info, property_name,
+          query.kind(), prefix, size, 0, last_key or startrow,
+          force_start_key_exclusive=bool(last_key or startrow))
+        return [row.keys()[0] for row in rows]
+      return self.__count_index_rows(fetch_keys, maximum)
+
+    # Other queries are counted from their keys, a page at a time if the 
+    # query can resume after its last result.
+    cursor = QueryCursor(query)
+    if not streamable:
+      return len(self.__fetch_query_page(cursor,
+        maximum or self._MAXIMUM_RESULTS, keys_only=True))
+    total = 0
+    while maximum is None or total < maximum:
+      size = COUNT_BATCH_SIZE
+      if maximum is not None:
+        size = min(size, maximum - total)
+      results = self.__fetch_query_page(cursor, size, keys_only=True)
+      total += len(results)
+      if len(results) < size:
+        break
+    return total
+
+  def _dynamic_count(self, query, integer64proto):
+    """ Counts the results of a query, honouring its offset and limit.
+
+    Args:
+      query: The query to count.
+      integer64proto: The api_base_pb.Integer64Proto to set the count in.
+    """
+    maximum = None
+    if query.has_limit():
+      maximum = query.offset() + query.limit()
+    total = self.count_query_results(query, maximum)
+    integer64proto.set_value(max(0, total - query.offset()))
+
   def _dynamic_run_query(self, query, query_result):
     """Populates the query result and use that query result to 
        encode a cursor.
@@ -2229,6 +4093,17 @@ class DatastoreDistributed():
       query: The query to run.
       query_result: The response given to the application server.
     """
+    if self.is_streamable_query(query):
+      count = QUERY_BATCH_SIZE
+      if query.has_count():
+        count = query.count()
+      cursor = QueryCursor(query)
+      if self.fetch_query_batch(cursor, count, query.offset(), query_result):
+        self.query_cursors.add(cursor)
+        query_result.mutable_cursor().set_app(cursor.app)
+        query_result.mutable_cursor().set_cursor(cursor.cursor_id)
+      return
+
     result = self.__get_query_results(query)
     count = 0
     offset = query.offset()
@@ -2242,6 +4117,32 @@ class DatastoreDistributed():
     cur = cassandra_stub_util.QueryCursor(query, result)
     cur.PopulateQueryResult(count, query.offset(), query_result) 
 
+  def _dynamic_next(self, app_id, next_request, query_result):
+    """ Continues a query from where its last batch ended.
+
+    Args:
+      app_id: The application ID.
+      next_request: A datastore_pb.NextRequest.
+      query_result: The response given to the application server.
+    Raises:
+      apiproxy_errors.ApplicationError: If the cursor does not exist.
+    """
+    cursor_id = next_request.cursor().cursor()
+    cursor = self.query_cursors.get(app_id, cursor_id)
+    if not cursor:
+      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
+        'Cursor {0} not found'.format(cursor_id))
+
+    count = QUERY_BATCH_SIZE
+    if next_request.has_count():
+      count = next_request.count()
+    if self.fetch_query_batch(cursor, count, next_request.offset(), 
+                              query_result):
+      query_result.mutable_cursor().set_app(cursor.app)
+      query_result.mutable_cursor().set_cursor(cursor.cursor_id)
+    else:
+      self.query_cursors.remove(cursor_id)
+
   def setup_transaction(self, app_id, is_xg):
     """ Gets a transaction ID for a new transaction.
 
@@ -2254,6 +4155,17 @@ class DatastoreDistributed():
     """
     return self.zookeeper.get_transaction_id(app_id, is_xg)
 
+  def setup_transactions(self, app_id, count):
+    """ Gets transaction IDs for several new non-XG transactions at once.
+
+    Args:
+      app_id: The application for which we are getting new transaction IDs.
+      count: The number of transaction IDs to get.
+    Returns:
+      A list of longs representing unique transaction IDs.
+    """
+    return self.zookeeper.get_transaction_ids(app_id, count)
+
   def commit_transaction(self, app_id, http_request_data):
     """ Handles the commit phase of a transaction.
 
@@ -2341,10 +4253,61 @@ class MainHandler(tornado.web.RequestHandler):
       return
 
     if pb_type == "Request":
-      self.remote_request(app_id, http_request_data)
+      if request_pool:
+        self.submit_remote_request(app_id, http_request_data)
+        return
+      self.write(self.remote_request(app_id, http_request_data))
     else:
       self.unknown_request(app_id, http_request_data, pb_type)
     self.finish()
+
+  def submit_remote_request(self, app_id, http_request_data):
+    """ Queues a remote request on the request pool and finishes the
+        response on the IOLoop once a worker thread has run it. Requests
+        from each application wait in their own queue, so one application's
+        slow queries do not hold up the others. If too many requests are
+        pending, the request is turned away with a TIMEOUT error, which the
+        AppServer raises as a retryable datastore Timeout.
+
+    Args:
+      app_id: The application ID that is sending this request.
+      http_request_data: Encoded protocol buffer.
+    """
+    global request_pool
+    io_loop = tornado.ioloop.IOLoop.instance()
+    try:
+      pending = request_pool.submit(app_id, self.remote_request, app_id,
+        http_request_data)
+    except worker_pool.WorkerPoolFull, full_error:
+      logging.warning("Turning away request for {0}: {1}".format(app_id,
+        str(full_error)))
+      apiresponse = remote_api_pb.Response()
+      apperror_pb = apiresponse.mutable_application_error()
+      apperror_pb.set_code(datastore_pb.Error.TIMEOUT)
+      apperror_pb.set_detail("The datastore is too busy, try again later.")
+      self.write(apiresponse.Encode())
+      self.finish()
+      return
+
+    # The callback runs on the worker thread, and add_callback is the only
+    # IOLoop method which is safe to call from another thread.
+    pending.add_done_callback(
+      lambda result: io_loop.add_callback(self.finish_remote_request, result))
+
+  def finish_remote_request(self, pending):
+    """ Writes the response of a remote request run on the request pool.
+
+    Args:
+      pending: A worker_pool.PendingResult for the call to remote_request.
+    """
+    try:
+      response = pending.wait()
+    except Exception:
+      logging.exception("Remote request failed")
+      self.send_error(500)
+      return
+    self.write(response)
+    self.finish()
   
   @tornado.web.asynchronous
   def get(self):
@@ -2362,6 +4325,8 @@ class MainHandler(tornado.web.RequestHandler):
     Args:
       app_id: The application ID that is sending this request.
       http_request_data: Encoded protocol buffer.
+    Returns:
+      An encoded remote_api_pb.Response.
     """
     apirequest = remote_api_pb.Request()
     apirequest.ParseFromString(http_request_data)
@@ -2393,6 +4358,11 @@ class MainHandler(tornado.web.RequestHandler):
                                                     http_request_data)
     elif method == "RunQuery":
       response, errcode, errdetail = self.run_query(http_request_data)
+    elif method == "Next":
+      response, errcode, errdetail = self.next_request(app_id, 
+                                                       http_request_data)
+    elif method == "Count":
+      response, errcode, errdetail = self.count_request(http_request_data)
     elif method == "BeginTransaction":
       response, errcode, errdetail = self.begin_transaction_request(
                                                       app_id, http_request_data)
@@ -2409,27 +4379,16 @@ class MainHandler(tornado.web.RequestHandler):
                                                         app_id,
                                                         http_request_data)
     elif method == "CreateIndex":
-      errcode = 0
-      errdetail = ""
-      response = api_base_pb.Integer64Proto()
-      response.set_value(0)
-      response = response.Encode()
-
+      response, errcode, errdetail = self.create_index_request(app_id,
+                                                        http_request_data)
     elif method == "GetIndices":
-      response = datastore_pb.CompositeIndices().Encode()
-      errcode = 0
-      errdetail = ""
-
+      response, errcode, errdetail = self.get_indices_request(app_id)
     elif method == "UpdateIndex":
-      response = api_base_pb.VoidProto().Encode()
-      errcode = 0
-      errdetail = ""
-
+      response, errcode, errdetail = self.update_index_request(app_id,
+                                                        http_request_data)
     elif method == "DeleteIndex":
-      response = api_base_pb.VoidProto().Encode()
-      errcode = 0
-      errdetail = ""
-
+      response, errcode, errdetail = self.delete_index_request(app_id,
+                                                        http_request_data)
     else:
       errcode = datastore_pb.Error.BAD_REQUEST 
       errdetail = "Unknown datastore message" 
@@ -2440,7 +4399,7 @@ class MainHandler(tornado.web.RequestHandler):
       apperror_pb.set_code(errcode)
       apperror_pb.set_detail(errdetail)
 
-    self.write(apiresponse.Encode())
+    return apiresponse.Encode()
 
   def begin_transaction_request(self, app_id, http_request_data):
     """ Handles the intial request to start a transaction. Replies with 
@@ -2510,6 +4469,115 @@ class MainHandler(tornado.web.RequestHandler):
     datastore_access._dynamic_run_query(query, clone_qr_pb)
     return (clone_qr_pb.Encode(), 0, "")
 
+  def count_request(self, http_request_data):
+    """ High level function for counting the results of a query.
+
+    Args:
+      http_request_data: Stores the protocol buffer request from the AppServer.
+    Returns:
+      Returns an encoded count response.
+    """
+    global datastore_access
+    query = datastore_pb.Query(http_request_data)
+    count_response = api_base_pb.Integer64Proto()
+    datastore_access._dynamic_count(query, count_response)
+    return (count_response.Encode(), 0, "")
+
+  def next_request(self, app_id, http_request_data):
+    """ Gets the next batch of results for a query.
+
+    Args:
+      app_id: The application ID.
+      http_request_data: Stores the protocol buffer request from the AppServer.
+    Returns:
+      Returns an encoded query response.
+    """
+    global datastore_access
+    next_request = datastore_pb.NextRequest(http_request_data)
+    query_result = datastore_pb.QueryResult()
+    try:
+      datastore_access._dynamic_next(app_id, next_request, query_result)
+    except apiproxy_errors.ApplicationError, error:
+      logging.info("Unable to continue query: {0}".format(error.error_detail))
+      query_result = datastore_pb.QueryResult()
+      query_result.set_more_results(False)
+      return (query_result.Encode(), error.application_error, 
+              error.error_detail)
+    return (query_result.Encode(), 0, "")
+
+  def create_index_request(self, app_id, http_request_data):
+    """ High level function for creating a composite index.
+
+    Args:
+      app_id: Name of the application.
+      http_request_data: Stores the protocol buffer request from the AppServer.
+    Returns:
+      Returns an encoded response with the ID of the index.
+    """
+    global datastore_access
+    index = entity_pb.CompositeIndex(http_request_data)
+    response = api_base_pb.Integer64Proto()
+    try:
+      response.set_value(datastore_access.create_composite_index(app_id, 
+                                                                 index))
+    except ZKTransactionException, zkte:
+      logging.info("Unable to allocate an ID for a composite index of {0}, " \
+        "info {1}".format(app_id, str(zkte)))
+      return (response.Encode(), 
+              datastore_pb.Error.CONCURRENT_TRANSACTION, 
+              "Concurrent transaction exception on create index.")
+    return (response.Encode(), 0, "")
+
+  def get_indices_request(self, app_id):
+    """ High level function for listing the composite indexes of an app.
+
+    Args:
+      app_id: Name of the application.
+    Returns:
+      Returns an encoded response with the composite indexes.
+    """
+    global datastore_access
+    response = datastore_pb.CompositeIndices()
+    for index in datastore_access.get_composite_indexes(app_id, refresh=True):
+      response.add_index().CopyFrom(index)
+    return (response.Encode(), 0, "")
+
+  def update_index_request(self, app_id, http_request_data):
+    """ High level function for changing the state of a composite index.
+
+    Args:
+      app_id: Name of the application.
+      http_request_data: Stores the protocol buffer request from the AppServer.
+    Returns:
+      Returns an encoded void response.
+    """
+    global datastore_access
+    index = entity_pb.CompositeIndex(http_request_data)
+    response = api_base_pb.VoidProto()
+    try:
+      datastore_access.update_composite_index(app_id, index)
+    except apiproxy_errors.ApplicationError, error:
+      return (response.Encode(), error.application_error, error.error_detail)
+    return (response.Encode(), 0, "")
+
+  def delete_index_request(self, app_id, http_request_data):
+    """ High level function for deleting a composite index.
+
+    Args:
+      app_id: Name of the application.
+      http_request_data: Stores the protocol buffer request from the AppServer.
+    Returns:
+      Returns an encoded void response.
+    """
+    global datastore_access
+    index = entity_pb.CompositeIndex(http_request_data)
+    response = api_base_pb.VoidProto()
+    try:
+      datastore_access.delete_composite_index(app_id, index)
+    except apiproxy_errors.ApplicationError, error:
+      return (response.Encode(), error.application_error, error.error_detail)
+    return (response.Encode(), 0, "")
+
   def allocate_ids_request(self, app_id, http_request_data):
     """ High level function for getting unique identifiers for entities.
 
@@ -2597,6 +4665,20 @@ class MainHandler(tornado.web.RequestHandler):
               "Concurrent transaction exception on delete.")
     return (delresp_pb.Encode(), 0, "")
 
+class StatsHandler(tornado.web.RequestHandler):
+  """
+  Reports the counters kept by the datastore in json.
+  """
+
+  def get(self):
+    """ Handles get requests for the statistics of this datastore server. """
+    global datastore_access
+    global request_pool
+    stats = datastore_access.get_stats()
+    if request_pool:
+      stats['request_pool'] = request_pool.get_stats()
+    self.write(json.dumps(stats))
+
 def usage():
   """ Prints the usage for this web service. """
   print "AppScale Server"
@@ -2606,27 +4688,45 @@ def usage():
   print "\t--no_encryption"
   print "\t--port"
   print "\t--zoo_keeper <zk nodes>"
+  print "\t--id_block_size <number of IDs reserved at once>"
+  print "\t--write_workers <number of threads writing to tables at once>"
+  print "\t--request_workers <number of threads running requests, 0 runs " \
+    "them on the IOLoop>"
+  print "\t--max_pending_requests <number of requests allowed to wait or run>"
+  print "\t--processes <number of server processes, 0 starts one per core>"
 
 pb_application = tornado.web.Application([
+    (r"/stats", StatsHandler),
     (r"/*", MainHandler),
 ])
 
 def main(argv):
   """ Starts a web service for handing datastore requests. """
   global datastore_access
+  global request_pool
   zookeeper_locations = ""
 
   db_info = appscale_info.get_db_info()
   db_type = db_info[':table']
   port = DEFAULT_SSL_PORT
   is_encrypted = True
+  id_block_size = BLOCK_SIZE
+  write_workers = WRITE_WORKERS
+  request_workers = REQUEST_WORKERS
+  max_pending_requests = MAX_PENDING_REQUESTS
+  processes = SERVER_PROCESSES
 
   try:
-    opts, args = getopt.getopt( argv, "t:p:n:z:",
+    opts, args = getopt.getopt( argv, "t:p:n:z:b:w:r:m:f:",
                                ["type=",
                                 "port",
                                 "no_encryption",
-                                "zoo_keeper"] )
+                                "zoo_keeper",
+                                "id_block_size=",
+                                "write_workers=",
+                                "request_workers=",
+                                "max_pending_requests=",
+                                "processes="] )
   except getopt.GetoptError:
     usage()
     sys.exit(1)
@@ -2641,25 +4741,64 @@ def main(argv):
       is_encrypted = False
     elif opt in ("-z", "--zoo_keeper"):
       zookeeper_locations = arg
+    elif opt in ("-b", "--id_block_size"):
+      id_block_size = int(arg)
+    elif opt in ("-w", "--write_workers"):
+      write_workers = int(arg)
+    elif opt in ("-r", "--request_workers"):
+      request_workers = int(arg)
+    elif opt in ("-m", "--max_pending_requests"):
+      max_pending_requests = int(arg)
+    elif opt in ("-f", "--processes"):
+      processes = int(arg)
 
   if db_type not in VALID_DATASTORES:
     print "This datastore is not supported for this version of the AppScale\
           datastore API:" + db_type
     exit(1)
+
+  if port == DEFAULT_SSL_PORT and not is_encrypted:
+    port = DEFAULT_PORT
+
+  # The processes share one listening socket. Each one forks before opening
+  # its own database and ZooKeeper connections, which can not be shared.
+  sockets = None
+  task_id = None
+  if processes != 1 and not SHARED_SOCKETS:
+    logging.warning("This version of Tornado can not fork server " \
+      "processes, so only one is started.")
+  elif processes != 1:
+    sockets = tornado.netutil.bind_sockets(port)
+    task_id = tornado.process.fork_processes(processes)
  
   datastore_batch = appscale_datastore_batch.DatastoreFactory.\
                                              getDatastore(db_type)
   zookeeper = zk.ZKTransaction(host=zookeeper_locations)
   datastore_access = DatastoreDistributed(datastore_batch, 
-                                          zookeeper=zookeeper)
-  if port == DEFAULT_SSL_PORT and not is_encrypted:
-    port = DEFAULT_PORT
+                                          zookeeper=zookeeper,
+                                          id_block_size=id_block_size,
+                                          write_workers=write_workers)
+  datastore_access.start_stats_flusher()
+
+  # Requests wait for these threads, and then for the datastore's write
+  # threads, so the two must never be the same pool.
+  if request_workers > 0:
+    request_pool = worker_pool.FairWorkerPool(request_workers,
+      max_pending_requests,
+      max_pending_per_key=min(max_pending_requests,
+                              MAX_PENDING_REQUESTS_PER_APP),
+      name="datastore-request")
 
   server = tornado.httpserver.HTTPServer(pb_application)
-  server.listen(port)
-
-  ds_groomer = groomer.DatastoreGroomer(zookeeper, db_type, LOCAL_DATASTORE)
-  ds_groomer.start()
+  if sockets:
+    server.add_sockets(sockets)
+  else:
+    server.listen(port)
+
+  # One groomer per node is enough.
+  if not task_id:
+    ds_groomer = groomer.DatastoreGroomer(zookeeper, db_type, LOCAL_DATASTORE)
+    ds_groomer.start()
 
   while 1:
     try:
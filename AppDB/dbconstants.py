@@ -25,6 +25,7 @@ APP_NAMESPACE_TABLE = "APP_NAMESPACES__"
 APP_ID_TABLE = "APP_IDS__"
 APP_ENTITY_TABLE = "ENTITIES__"
 APP_KIND_TABLE = "KINDS__"
+COMPOSITE_TABLE = "COMPOSITE_INDEXES__"
 JOURNAL_TABLE = "JOURNAL__"
 
 INITIAL_TABLES = [ASC_PROPERTY_TABLE,
@@ -34,6 +35,7 @@ INITIAL_TABLES = [ASC_PROPERTY_TABLE,
                   APP_ID_TABLE,
                   APP_ENTITY_TABLE,
                   APP_KIND_TABLE,
+                  COMPOSITE_TABLE,
                   JOURNAL_TABLE]
 
 ###########################################
@@ -66,6 +68,8 @@ APP_ID_SCHEMA = [
   "next_id" ]
 APP_KIND_SCHEMA = [
   "reference" ]
+COMPOSITE_SCHEMA = [
+  "reference" ]
 
 USERS_SCHEMA = [
   "email",
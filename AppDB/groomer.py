@@ -2,7 +2,9 @@
 calculates datastore statistics. Removes tombstoned items for garbage 
 collection.
 """
+import base64
 import datetime
+import json
 import logging
 import os
 import random
@@ -36,6 +38,12 @@ class DatastoreGroomer(threading.Thread):
   # The number of entities retrieved in a datastore request.
   BATCH_SIZE = 100 
 
+  # The number of threads on each node grooming ranges of the entity table.
+  WORKERS = 4
+
+  # The most ranges a grooming pass splits the entity table into.
+  MAX_RANGES = 256
+
   # Any kind that is of __*__ is private and should not have stats.
   PRIVATE_KINDS = '__(.*)__'
 
@@ -60,6 +68,11 @@ class DatastoreGroomer(threading.Thread):
     self.datastore_path = ds_path
     self.stats = {}
     self.num_deletes = 0
+    self.journal_deletes = 0
+    self.journal_bytes = 0
+    self.blacklisted = {}
+    self.blacklist_deletes = 0
+    self.validlist_deletes = 0
 
   def stop(self):
     """ Stops the groomer thread. """
@@ -69,17 +82,7 @@ class DatastoreGroomer(threading.Thread):
     """ Starts the main loop of the groomer thread. """
     while True:
       time.sleep(random.randint(1, self.LOCK_POLL_PERIOD))
-      logging.info("Trying to get groomer lock.")
-      if self.get_groomer_lock():
-        logging.info("Got the groomer lock.")
-        self.run_groomer()
-        try:
-          self.zoo_keeper.release_datastore_groomer_lock()
-        except zk.ZKTransactionException, zk_exception:
-          logging.error("Unable to release zk lock {0}.".\
-            format(str(zk_exception)))
-      else:
-        logging.info("Did not get the groomer lock.")
+      self.run_groomer()
 
   def get_groomer_lock(self):
     """ Tries to acquire the lock to the datastore groomer. 
@@ -89,22 +92,71 @@ class DatastoreGroomer(threading.Thread):
     """
     return self.zoo_keeper.get_datastore_groomer_lock()
 
-  def get_entity_batch(self, last_key):
+  def release_groomer_lock(self):
+    """ Releases the lock to the datastore groomer. """
+    try:
+      self.zoo_keeper.release_datastore_groomer_lock()
+    except zk.ZKTransactionException, zk_exception:
+      logging.error("Unable to release zk lock {0}.".\
+        format(str(zk_exception)))
+
+  def get_entity_batch(self, last_key, end_key, start_inclusive=False):
     """ Gets a batch of entites to operate on.
 
     Args:
       last_key: The last key from a previous query.
+      end_key: The key the batch ends before.
+      start_inclusive: Whether to include the entity at last_key.
     Returns:
       A list of entities.
     """ 
     return self.db_access.range_query(dbconstants.APP_ENTITY_TABLE, 
-      dbconstants.APP_ENTITY_SCHEMA, last_key, "", self.BATCH_SIZE,
-      start_inclusive=False)
+      dbconstants.APP_ENTITY_SCHEMA, last_key, end_key, self.BATCH_SIZE,
+      start_inclusive=start_inclusive, end_inclusive=False)
+
+  def get_split_points(self):
+    """ Finds the key where each root kind of each application and namespace
+        starts in the entity table, by seeking from one to the next. Only
+        one key is read per root kind.
+
+    Returns:
+      A sorted list of keys, starting with "", which split the entity table
+      into at most MAX_RANGES ranges.
+    """
+    term_string = datastore_server.DatastoreDistributed._TERM_STRING
+    split_points = [""]
+    seek_key = ""
+    while True:
+      keys = self.db_access.range_query(dbconstants.APP_ENTITY_TABLE,
+        dbconstants.APP_ENTITY_SCHEMA, seek_key, term_string, 1,
+        keys_only=True)
+      if not keys:
+        break
+      key = str(keys[0])
+      prefix = self.get_prefix_from_entity_key(key)
+      kind = key[len(prefix) + 1:].split(':')[0]
+      kind_start = prefix + '/' + kind + ':'
+      # The first range starts at "", so it covers the first root kind.
+      if seek_key:
+        split_points.append(kind_start)
+      # ';' follows ':', so this is past every key of the root kind.
+      seek_key = prefix + '/' + kind + ';'
+
+    if len(split_points) > self.MAX_RANGES:
+      step = float(len(split_points)) / self.MAX_RANGES
+      split_points = [split_points[int(index * step)]
+        for index in range(self.MAX_RANGES)]
+    return split_points
 
   def reset_statistics(self):
     """ Reinitializes statistics. """
     self.stats = {}
     self.num_deletes = 0
+    self.journal_deletes = 0
+    self.journal_bytes = 0
+    self.blacklisted = {}
+    self.blacklist_deletes = 0
+    self.validlist_deletes = 0
 
   def hard_delete_row(self, row_key):
     """ Does a hard delete on a given row key to the entity
@@ -164,8 +216,8 @@ class DatastoreGroomer(threading.Thread):
       True if a hard delete occurred, False otherwise.
     """
     success = False
-    app_prefix = DatastoreGroomer.get_prefix_from_entity_key(key)
-    root_key = DatastoreGroomer.get_root_key_from_entity_key(key)
+    app_prefix = self.get_prefix_from_entity_key(key)
+    root_key = self.get_root_key_from_entity_key(key)
     
     if self.zoo_keeper.is_blacklisted(app_prefix, version):
       return False
@@ -245,16 +297,166 @@ class DatastoreGroomer(threading.Thread):
     self.stats[app_id][kind]['number'] += 1
     return True
 
-  def txn_blacklist_cleanup(self):
-    """ Clean up old transactions and removed unused references
-        to reap storage.
+  def compact_journal(self, entities, hard_deleted):
+    """ Deletes the journal versions of a batch of entities which are older
+        than the newest valid version of each, since neither reads nor
+        rollbacks go further back. Newer versions are kept, as they may
+        belong to transactions in progress. An entity stored at the version
+        of a transaction still in progress is skipped, since the version it
+        rolls back to is older. Every version of an entity which was hard
+        deleted is removed.
 
+    Args:
+      entities: A batch of rows from the entity table.
+      hard_deleted: A set of the keys of rows which were hard deleted.
     Returns:
       True on success, False otherwise.
     """
-    #TODO implement
+    if not entities:
+      return True
+
+    # Versions of each entity below this one can be deleted.
+    oldest_versions = {}
+    app_versions = {}
+    for entity in entities:
+      key = entity.keys()[0]
+      version = long(entity[key][dbconstants.APP_ENTITY_SCHEMA[1]])
+      app_id = key.split('/')[0]
+      app_versions.setdefault(app_id, []).append((version, key))
+
+    try:
+      for app_id, versions in app_versions.items():
+        referenced = self.blacklisted.setdefault(app_id, set())
+        valid_ids = self.zoo_keeper.get_valid_transaction_ids(app_id,
+          versions)
+        open_txids = self.zoo_keeper.get_open_transactions(app_id,
+          [version for version, key in versions
+           if key not in hard_deleted and valid_ids[key] == version])
+        for version, key in versions:
+          if key in hard_deleted:
+            oldest_versions[key] = version + 1
+            continue
+          if version in open_txids:
+            continue
+          oldest_versions[key] = valid_ids[key]
+          if valid_ids[key] != version:
+            # Reads of this entity still check the blacklist for this ID.
+            referenced.add(str(version))
+
+      if not oldest_versions:
+        return True
+      keys = sorted(oldest_versions)
+      last_key = keys[0] + '/'
+      end_key = keys[-1] + '/' + '9' * datastore_server.ID_KEY_LENGTH
+      start_inclusive = True
+      deletes = []
+      while True:
+        journal_rows = self.db_access.range_query(dbconstants.JOURNAL_TABLE,
+          dbconstants.JOURNAL_SCHEMA, last_key, end_key, self.BATCH_SIZE,
+          start_inclusive=start_inclusive)
+        if not journal_rows:
+          break
+        for journal_row in journal_rows:
+          journal_key = journal_row.keys()[0]
+          entity_key, version = journal_key.rsplit('/', 1)
+          if entity_key in oldest_versions and \
+             long(version) < oldest_versions[entity_key]:
+            deletes.append(journal_key)
+            self.journal_bytes += len(journal_key) + len(
+              journal_row[journal_key].get(dbconstants.JOURNAL_SCHEMA[0], ''))
+        last_key = journal_rows[-1].keys()[0]
+        start_inclusive = False
+
+      if deletes:
+        self.db_access.batch_delete(dbconstants.JOURNAL_TABLE, deletes,
+          dbconstants.JOURNAL_SCHEMA)
+        self.journal_deletes += len(deletes)
+    except dbconstants.AppScaleDBConnectionError, db_error:
+      logging.error("Error compacting the journal: {0}".format(db_error))
+      return False
+    except (zk.ZKTransactionException,
+            zk.ZKTimeoutException) as zk_exception:
+      logging.error("Error compacting the journal: {0}".format(zk_exception))
+      return False
     return True
 
+  def prune_valid_version(self, app_id, entity_key):
+    """ Removes the valid version recorded for an entity, unless the entity
+        is still stored at a blacklisted version. The entity's group is
+        locked meanwhile, so that no transaction records a new version for
+        it at the same time.
+
+    Args:
+      app_id: The application ID.
+      entity_key: The key of the entity in the entity table.
+    Returns:
+      True on success, False otherwise.
+    """
+    success = False
+    root_key = self.get_root_key_from_entity_key(entity_key)
+    txn_id = self.zoo_keeper.get_transaction_id(app_id)
+    try:
+      if self.zoo_keeper.acquire_lock(app_id, txn_id, root_key):
+        row = self.db_access.batch_get_entity(dbconstants.APP_ENTITY_TABLE,
+          [entity_key], dbconstants.APP_ENTITY_SCHEMA)[entity_key]
+        version = row.get(dbconstants.APP_ENTITY_SCHEMA[1])
+        if version is None or \
+           not self.zoo_keeper.is_blacklisted(app_id, version):
+          self.zoo_keeper.delete_valid_version(app_id, entity_key)
+          self.validlist_deletes += 1
+        success = True
+    except zk.ZKTransactionException, zk_exception:
+      logging.debug("Unable to prune valid version of {0}: {1}".format(
+        entity_key, zk_exception))
+    except dbconstants.AppScaleDBConnectionError, db_error:
+      logging.error("Unable to prune valid version of {0}: {1}".format(
+        entity_key, db_error))
+    finally:
+      if not success:
+        if not self.zoo_keeper.notify_failed_transaction(app_id, txn_id):
+          logging.error("Unable to invalidate txn for {0} with txnid: {1}"\
+            .format(app_id, txn_id))
+      try:
+        self.zoo_keeper.release_lock(app_id, txn_id)
+      except zk.ZKTransactionException, zk_exception:
+        pass
+    return success
+
+  def txn_blacklist_cleanup(self, referenced, started):
+    """ Clean up old transactions and removed unused references
+        to reap storage. A blacklisted transaction ID is removed once no
+        entity is stored at it, and the valid version recorded for an
+        entity is removed once the entity is no longer stored at a
+        blacklisted version.
+
+    Args:
+      referenced: A dict of application IDs to the sets of blacklisted
+        transaction IDs which entities were found at during the pass.
+      started: The time the pass started. Transactions blacklisted later
+        may have written entities the pass did not see.
+    Returns:
+      True on success, False otherwise.
+    """
+    success = True
+    for app_id, txids in referenced.items():
+      try:
+        unused = [txid for txid, blacklisted in
+          self.zoo_keeper.get_blacklist_times(app_id).items()
+          if blacklisted < started and txid not in txids]
+        if unused:
+          self.blacklist_deletes += self.zoo_keeper.delete_blacklist_entries(
+            app_id, unused)
+
+        for entity_key in self.zoo_keeper.get_valid_version_keys(app_id):
+          if not self.prune_valid_version(app_id, entity_key):
+            success = False
+      except (zk.ZKTransactionException,
+              zk.ZKTimeoutException) as zk_exception:
+        logging.error("Unable to clean up transactions of {0}: {1}".format(
+          app_id, zk_exception))
+        success = False
+    return success
+
   def process_entity(self, entity):
     """ Processes an entity by updating statistics, indexes, and removes 
         tombstones.
@@ -278,7 +480,8 @@ class DatastoreGroomer(threading.Thread):
     return True
 
   def create_kind_stat_entry(self, kind, size, number, timestamp):
-    """ Puts a kind statistic into the datastore.
+    """ Puts a kind statistic into the datastore, replacing the counts the
+        datastore servers have been adding puts and deletes to.
  
     Args:
       kind: The entity kind.
@@ -288,7 +491,8 @@ class DatastoreGroomer(threading.Thread):
     Returns: 
       True on success, False otherwise.
     """
-    kind_stat = stats.KindStat(kind_name=kind, 
+    kind_stat = stats.KindStat(key_name=kind,
+                               kind_name=kind,
                                bytes=size,
                                count=number,
                                timestamp=timestamp)
@@ -301,7 +505,8 @@ class DatastoreGroomer(threading.Thread):
     return True
 
   def create_global_stat_entry(self, size, number, timestamp):
-    """ Puts a global statistic into the datastore.
+    """ Puts a global statistic into the datastore, replacing the counts the
+        datastore servers have been adding puts and deletes to.
     
     Args:
       size: The number of bytes of all entities.
@@ -310,7 +515,8 @@ class DatastoreGroomer(threading.Thread):
     Returns: 
       True on success, False otherwise.
     """
-    global_stat = stats.GlobalStat(bytes=size,
+    global_stat = stats.GlobalStat(key_name=datastore_server.GLOBAL_STAT_NAME,
+                                   bytes=size,
                                    count=number,
                                    timestamp=timestamp)
     try:
@@ -362,7 +568,9 @@ class DatastoreGroomer(threading.Thread):
 
   def update_statistics(self):
     """ Puts the statistics into the datastore for applications
-        to access.
+        to access. The datastore servers keep them current between passes
+        by adding the changes of each put and delete, so this corrects any
+        drift, such as from rolled back transactions.
 
     Returns:
       True if there were no errors, False otherwise.
@@ -394,32 +602,264 @@ class DatastoreGroomer(threading.Thread):
 
     return True
 
-  def run_groomer(self):
-    """ Runs the grooming process. Loops on the entire dataset sequentially
-        and updates stats, indexes, and transactions.
+  @staticmethod
+  def new_range_state(start_key, end_key):
+    """ Creates the state of a range of the entity table which has not been
+        groomed yet. Keys are base64 encoded, since they are not text.
+
+    Args:
+      start_key: The first key of the range.
+      end_key: The key the range ends before.
+    Returns:
+      A dict holding the state of the range.
     """
-    logging.info("Groomer started")
-    start = time.time()
-    last_key = ""
-    self.reset_statistics()
+    return {'start': base64.b64encode(start_key),
+            'end': base64.b64encode(end_key),
+            'last_key': None,
+            'done': False,
+            'entities': 0,
+            'seconds': 0,
+            'stats': {},
+            'deletes': 0,
+            'journal_deletes': 0,
+            'journal_bytes': 0,
+            'blacklisted': {},
+            'failed': False,
+            'created': time.time()}
 
-    self.db_access = appscale_datastore_batch.DatastoreFactory.getDatastore(
-      self.table_name)
+  @staticmethod
+  def decode_stats(stats):
+    """ Converts statistics read from a range's state back to str keys, as
+        process_statistics uses.
 
-    while True:
-      entities = self.get_entity_batch(last_key)
+    Args:
+      stats: A dict of application IDs to kinds to statistics, as decoded
+        from JSON.
+    Returns:
+      The same statistics, keyed by str values.
+    """
+    return dict((app_id.encode('utf-8'),
+      dict((kind.encode('utf-8'), kind_stats)
+           for kind, kind_stats in kinds.items()))
+      for app_id, kinds in stats.items())
+
+  def start_pass(self):
+    """ Splits the entity table into ranges and stores them in ZooKeeper,
+        unless another node already has.
+
+    Returns:
+      The names of the ranges of the pass, or an empty list if no pass
+      could be started.
+    """
+    logging.info("Trying to get groomer lock.")
+    if not self.get_groomer_lock():
+      logging.info("Did not get the groomer lock.")
+      return []
+
+    try:
+      names = self.zoo_keeper.get_groomer_ranges()
+      if names:
+        return names
+      split_points = self.get_split_points()
+      end_keys = split_points[1:] + \
+        [datastore_server.DatastoreDistributed._TERM_STRING]
+      self.zoo_keeper.create_groomer_ranges(
+        [json.dumps(self.new_range_state(start_key, end_key))
+         for start_key, end_key in zip(split_points, end_keys)])
+      logging.info("Split the entity table into {0} ranges."\
+        .format(len(split_points)))
+      return self.zoo_keeper.get_groomer_ranges()
+    except zk.ZKTransactionException, zk_exception:
+      logging.error("Unable to start a groomer pass: {0}".format(
+        str(zk_exception)))
+      return []
+    finally:
+      self.release_groomer_lock()
+
+  def run_worker(self, names):
+    """ Grooms ranges of the pass which no other worker holds, until none
+        are left.
+
+    Args:
+      names: The names of the ranges of the pass.
+    """
+    # Each worker keeps the statistics of the range it grooms apart.
+    worker = DatastoreGroomer(self.zoo_keeper, self.table_name,
+      self.datastore_path)
+    worker.db_access = self.db_access
+
+    # Workers try the ranges in different orders, so that they rarely
+    # contend for the same one.
+    names = list(names)
+    random.shuffle(names)
+    for name in names:
+      if not self.zoo_keeper.claim_groomer_range(name):
+        continue
+      try:
+        worker.groom_range(name)
+      except Exception, exception:
+        logging.exception("Error grooming range {0}: {1}".format(name,
+          exception))
+      finally:
+        self.zoo_keeper.release_groomer_range(name)
+
+  def groom_range(self, name):
+    """ Grooms a range of the entity table, resuming from its last
+        checkpoint. The last key groomed and the statistics gathered so far
+        are checkpointed after each batch.
+
+    Args:
+      name: The name of a range claimed by this groomer.
+    """
+    value = self.zoo_keeper.get_groomer_range(name)
+    if value is None:
+      return
+    state = json.loads(value)
+    if state['done']:
+      return
+
+    self.stats = self.decode_stats(state['stats'])
+    self.num_deletes = state['deletes']
+    self.journal_deletes = state['journal_deletes']
+    self.journal_bytes = state['journal_bytes']
+    self.blacklisted = dict((app_id.encode('utf-8'), set(txids))
+      for app_id, txids in state['blacklisted'].items())
+    end_key = base64.b64decode(state['end'])
+    if state['last_key'] is None:
+      last_key = base64.b64decode(state['start'])
+      start_inclusive = True
+    else:
+      last_key = base64.b64decode(state['last_key'])
+      start_inclusive = False
 
+    start = time.time()
+    seconds = state['seconds']
+    while True:
+      entities = self.get_entity_batch(last_key, end_key, start_inclusive)
       if not entities:
         break
 
+      hard_deleted = set()
       for entity in entities:
-        self.process_entity(entity)
+        key = entity.keys()[0]
+        if self.process_entity(entity) and \
+           entity[key][dbconstants.APP_ENTITY_SCHEMA[0]] == \
+           datastore_server.TOMBSTONE:
+          hard_deleted.add(key)
+      if not self.compact_journal(entities, hard_deleted):
+        # The blacklisted IDs this batch refers to may not all have been
+        # recorded, so none can be removed at the end of this pass.
+        state['failed'] = True
 
       last_key = entities[-1].keys()[0]
-    if not self.update_statistics():
-      logging.error("There was an error updating the statistics")
+      start_inclusive = False
+      state['last_key'] = base64.b64encode(last_key)
+      state['entities'] += len(entities)
+      state['seconds'] = seconds + time.time() - start
+      state['stats'] = self.stats
+      state['deletes'] = self.num_deletes
+      state['journal_deletes'] = self.journal_deletes
+      state['journal_bytes'] = self.journal_bytes
+      state['blacklisted'] = dict((app_id, sorted(txids))
+        for app_id, txids in self.blacklisted.items())
+      self.zoo_keeper.update_groomer_range(name, json.dumps(state))
+
+    state['done'] = True
+    state['seconds'] = seconds + time.time() - start
+    self.zoo_keeper.update_groomer_range(name, json.dumps(state))
+    logging.info("Groomed range {0}.".format(name))
+
+  def finish_pass(self):
+    """ Ends the pass if all of its ranges have been groomed. The
+        statistics of each range are added up and updated, and transaction
+        metadata which no entity refers to any more is cleaned up.
+
+    Returns:
+      True if the pass was ended, False otherwise.
+    """
+    if not self.get_groomer_lock():
+      return False
+
+    try:
+      states = []
+      for name in self.zoo_keeper.get_groomer_ranges():
+        value = self.zoo_keeper.get_groomer_range(name)
+        if value is None:
+          return False
+        state = json.loads(value)
+        if not state['done']:
+          logging.info("Groomer range {0} is not done yet.".format(name))
+          return False
+        states.append((name, state))
+      if not states:
+        return False
+
+      self.reset_statistics()
+      referenced = {}
+      for name, state in states:
+        for app_id, kinds in self.decode_stats(state['stats']).items():
+          for kind, kind_stats in kinds.items():
+            self.initialize_kind(app_id, kind)
+            self.stats[app_id][kind]['size'] += kind_stats['size']
+            self.stats[app_id][kind]['number'] += kind_stats['number']
+        self.num_deletes += state['deletes']
+        self.journal_deletes += state['journal_deletes']
+        self.journal_bytes += state['journal_bytes']
+        for app_id, txids in state['blacklisted'].items():
+          referenced.setdefault(app_id.encode('utf-8'), set()).update(txids)
+        logging.info("Groomer range {0} had {1} entities, taking {2} " \
+          "seconds ({3} entities per second).".format(name,
+          state['entities'], round(state['seconds'], 3),
+          round(state['entities'] / max(state['seconds'], 0.001), 1)))
+
+      logging.info("Deleted {0} journal versions, reclaiming {1} bytes."\
+        .format(self.journal_deletes, self.journal_bytes))
+
+      started = min(state['created'] for _, state in states)
+      if any(state.get('failed') for _, state in states):
+        logging.warning("Not cleaning up transactions, since the journal " \
+          "of a range could not be compacted.")
+      elif not self.txn_blacklist_cleanup(referenced, started):
+        logging.error("There was an error cleaning up transactions")
+      logging.info("Removed {0} blacklisted transactions and {1} valid " \
+        "versions.".format(self.blacklist_deletes, self.validlist_deletes))
+
+      if not self.update_statistics():
+        logging.error("There was an error updating the statistics")
+      self.zoo_keeper.delete_groomer_ranges()
+      return True
+    finally:
+      self.release_groomer_lock()
 
-    del self.db_access
+  def run_groomer(self):
+    """ Runs a grooming pass, or joins the pass in progress. The entity
+        table is split into ranges, which workers on every node claim
+        through ZooKeeper and checkpoint as they go, so a pass which was
+        interrupted resumes where it stopped. The node which finds every
+        range groomed updates the statistics.
+    """
+    logging.info("Groomer started")
+    start = time.time()
+    self.reset_statistics()
+
+    self.db_access = appscale_datastore_batch.DatastoreFactory.getDatastore(
+      self.table_name)
+
+    try:
+      names = self.zoo_keeper.get_groomer_ranges()
+      if not names:
+        names = self.start_pass()
+
+      if names:
+        workers = [threading.Thread(target=self.run_worker, args=(names,))
+          for _ in range(self.WORKERS)]
+        for worker in workers:
+          worker.start()
+        for worker in workers:
+          worker.join()
+        self.finish_pass()
+    finally:
+      del self.db_access
 
     time_taken = time.time() - start
     logging.info("Groomer stopped (Took {0} seconds)".format(str(time_taken)))
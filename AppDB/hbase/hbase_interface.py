@@ -1,11 +1,12 @@
 # Author: Navraj Chohan <nlake44@gmail.com>
 
 import os
+import socket
 import sys
 import Hbase
-import threading
 import ttypes
 
+from connection_pool import ConnectionPool
 from dbinterface import *
 from thrift import Thrift
 from thrift.transport import TSocket
@@ -18,6 +19,15 @@ import file_io
 # Thrift port to connect to HBase
 THRIFT_PORT = 9090
 
+# The most Thrift connections to HBase open at once
+MAX_CONNECTIONS = 10
+
+# The number of rows to fetch from a scanner per round trip
+SCANNER_BATCH_SIZE = 100
+
+# Errors which mean a Thrift connection is broken
+TRANSPORT_ERRORS = (TTransport.TTransportException, socket.error)
+
 class DatastoreProxy(AppDBInterface):
   """ 
     The AppScale DB API class implementation for HBase
@@ -26,8 +36,9 @@ class DatastoreProxy(AppDBInterface):
     """
     Constructor.
     """
-    self.lock = threading.Lock()
-    self.connection = self.create_connection()
+    self.pool = ConnectionPool(self.create_connection, MAX_CONNECTIONS,
+      transport_errors=TRANSPORT_ERRORS,
+      close_connection=self.close_connection)
 
   def batch_get_entity(self, table_name, row_keys, column_names):
     """Allows access to multiple rows with a single call
@@ -47,13 +58,14 @@ class DatastoreProxy(AppDBInterface):
     if not isinstance(row_keys, list): raise TypeError("Expected list")
 
     result = {}
-    rows = []
     column_list = []
-    client = self.__init_connection() 
-
     for ii in column_names:
       column_list.append(ii + ":") 
-      rows = client.getRowsWithColumns(table_name, row_keys, column_list)
+
+    rows = []
+    if row_keys and column_list:
+      rows = self.pool.call(lambda client: client.getRowsWithColumns(
+        table_name, row_keys, column_list))
 
     for row in rows:
       result[row.row] = {}
@@ -64,7 +76,6 @@ class DatastoreProxy(AppDBInterface):
     for row in row_keys:
       if row not in result:
         result[row] = {}
-    self.__release_lock()
     return result  
 
   def batch_put_entity(self, table_name, row_keys, column_names, cell_values):
@@ -100,9 +111,8 @@ class DatastoreProxy(AppDBInterface):
       batch_mutation.row = row
       all_mutations.append(batch_mutation) 
 
-    client = self.__init_connection()
-    client.mutateRows(table_name, all_mutations)
-    self.__release_lock()
+    self.pool.call(lambda client: client.mutateRows(table_name,
+      all_mutations))
  
   def batch_delete(self, table_name, row_keys, column_names=[]):
     """ Remove a batch of rows.
@@ -132,9 +142,8 @@ class DatastoreProxy(AppDBInterface):
       batch_mutation.mutations = mutations
       batch_mutation.row = row
       all_mutations.append(batch_mutation) 
-    client = self.__init_connection()
-    client.mutateRows(table_name, all_mutations)
-    self.__release_lock()
+    self.pool.call(lambda client: client.mutateRows(table_name,
+      all_mutations))
  
   def delete_table(self, table_name):
     """ Drops a given table
@@ -148,13 +157,12 @@ class DatastoreProxy(AppDBInterface):
     """
     if not isinstance(table_name, str): raise TypeError("Excepted str")
 
-    client = self.__init_connection() 
-    try:
-      client.disableTable(table_name)
-      client.deleteTable(table_name)
-    except ttypes.IOError: # table not found
-      pass
-    self.__release_lock()
+    with self.pool.connection() as client:
+      try:
+        client.disableTable(table_name)
+        client.deleteTable(table_name)
+      except ttypes.IOError: # table not found
+        pass
 
   def create_table(self, table_name, column_names):
     """ Creates a table as a column family.
@@ -177,9 +185,8 @@ class DatastoreProxy(AppDBInterface):
       col.name = ii + ":"
       col.maxVersions = 1
       columnlist.append(col)
-    client = self.__init_connection()
-    client.createTable(table_name, columnlist)
-    self.__release_lock()
+    with self.pool.connection() as client:
+      client.createTable(table_name, columnlist)
 
   def range_query(self,
                   table_name,
@@ -208,7 +215,7 @@ class DatastoreProxy(AppDBInterface):
     Raises: 
       TypeError: Raised when given bad types of for args.
     Returns:
-      Dictionary of the results
+      An ordered list of dictionaries of key=>columns/values, or of keys
     """
     if not isinstance(table_name, str): raise TypeError("Expected str")
     if not isinstance(column_names, list): raise TypeError("Expected list")
@@ -233,25 +240,15 @@ class DatastoreProxy(AppDBInterface):
     for col in column_names:
       col_names.append(col + ":")
 
-    client = self.__init_connection()
-    scanner = client.scannerOpenWithStop(
-                  table_name, start_key, end_key, col_names) 
-
-    rowresult = client.scannerGetList(scanner, row_count)
-    while rowresult:
-      row_count -= len(rowresult) 
-      for row in rowresult:
-        item = {}
-        col_dict = {}
-        for c in column_names:
-          col_dict[c] = row.columns[c+":"].value
-        item[row.row] = col_dict
-        results.append(item)   
-      if row_count <= 0:
-        break
-      rowresult = client.scannerGetList(scanner, row_count)
-    client.scannerClose(scanner) 
-    self.__release_lock()
+    for row in self.pool.call(self.__scan, table_name, start_key, end_key,
+                              col_names, row_count):
+      item = {}
+      col_dict = {}
+      for c in column_names:
+        col_dict[c] = row.columns[c+":"].value
+      item[row.row] = col_dict
+      results.append(item)   
+    row_count -= len(results)
 
     # The end key is not included in the scanner. Get the last key if 
     # needed
@@ -274,6 +271,8 @@ class DatastoreProxy(AppDBInterface):
     if offset != 0 and offset <= len(results):
       results = results[offset:]
 
+    if keys_only:
+      return [item.keys()[0] for item in results]
     return results
 
   ########################
@@ -293,23 +292,43 @@ class DatastoreProxy(AppDBInterface):
     t.open()
     return c
 
-  def __init_connection(self):
+  def close_connection(self, client):
+    """ Closes the transport of a connection made by create_connection.
+
+    Args:
+      client: An HBase client object
     """
-    Provides a locking wrapper around a connection to make it threadsafe. 
-    Blocks until the lock is available.
+    client._oprot.trans.close()
+
+  def __scan(self, client, table_name, start_key, end_key, col_names,
+    row_count):
+    """ Reads up to row_count rows in [start_key, end_key) through a scanner,
+        fetching SCANNER_BATCH_SIZE rows per round trip so that large ranges
+        are not buffered by the Thrift server in one response.
+
+    Args:
+      client: An HBase client object
+      table_name: Table to access
+      start_key: String key starting the scan
+      end_key: String key ending the scan, which is not included
+      col_names: The HBase column names to return
+      row_count: The most rows to return
     Returns:
-      An HBase connection
+      A list of HBase row results
     """
-    self.lock.acquire()
-    if self.connection:
-      return self.connection
-    else:
-      self.connection = self.create_connection()
-      return self.connection
-
-  def __release_lock(self):
-    """
-    Releases the connection lock.
-    """ 
-    self.lock.release()
+    rows = []
+    if row_count <= 0:
+      return rows
 
+    scanner = client.scannerOpenWithStop(
+                  table_name, start_key, end_key, col_names) 
+    try:
+      while len(rows) < row_count:
+        batch = client.scannerGetList(scanner,
+          min(SCANNER_BATCH_SIZE, row_count - len(rows)))
+        if not batch:
+          break
+        rows.extend(batch)
+    finally:
+      client.scannerClose(scanner) 
+    return rows
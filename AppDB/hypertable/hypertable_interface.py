@@ -4,13 +4,16 @@
  Hypertable Interface for AppScale
 """
 import os
+import socket
 import time
 
 import hyperthrift.gen.ttypes as ttypes
 
+from connection_pool import ConnectionPool
 from dbinterface_batch import *
 from dbconstants import *
 from hypertable import thriftclient
+from thrift.transport import TTransport
 
 
 from xml.sax import make_parser
@@ -30,6 +33,12 @@ THRIFT_PORT = 38080
 # AppScale default namespace for Hypertable
 NS = "/appscale"
 
+# The most Thrift connections to Hypertable open at once
+MAX_CONNECTIONS = 10
+
+# Errors which mean a Thrift connection is broken
+TRANSPORT_ERRORS = (TTransport.TTransportException, socket.error)
+
 # XML tags used for parsing Hypertable results
 ROOT_TAG_BEGIN="<Schema>"
 ROOT_TAG_END="</Schema>"
@@ -75,8 +84,9 @@ class DatastoreProxy(AppDBInterface):
     """
     self.host = file_io.read(
                    constants.APPSCALE_HOME + '/.appscale/my_private_ip')
-    self.conn = thriftclient.ThriftClient(self.host, THRIFT_PORT)
-    self.ns = self.conn.namespace_open(NS)
+    self.pool = ConnectionPool(self.create_connection, MAX_CONNECTIONS,
+      transport_errors=TRANSPORT_ERRORS,
+      close_connection=self.close_connection)
 
   def batch_get_entity(self, table_name, row_keys, column_names):
     """Allows access to multiple rows with a single call
@@ -112,7 +122,11 @@ class DatastoreProxy(AppDBInterface):
                                 None,  
                                 column_names)
 
-    res = self.conn.get_cells(self.ns, table_name, scan_spec)
+    def get_cells(connection):
+      conn, ns = connection
+      return conn.get_cells(ns, table_name, scan_spec)
+
+    res = self.pool.call(get_cells)
     for cell in res:
       if self.__decode(cell.key.row) in ret:
         # update the dictionary
@@ -153,8 +167,6 @@ class DatastoreProxy(AppDBInterface):
     __INSERT = 255
     cell_list = []
 
-    mutator = self.conn.mutator_open(self.ns, table_name, 0, 0)
-
     for key in row_keys:
       for col in column_names: 
         cell = ttypes.Cell()
@@ -165,8 +177,7 @@ class DatastoreProxy(AppDBInterface):
         cell.value = cell_values[key][col]
         cell_list.append(cell)
 
-    self.conn.mutator_set_cells(mutator, cell_list)
-    self.conn.mutator_close(mutator)
+    self.pool.call(self.__set_cells, table_name, cell_list)
 
   def batch_delete(self, table_name, row_keys, column_names=[]):
     """Remove a set of keys
@@ -189,16 +200,13 @@ class DatastoreProxy(AppDBInterface):
     __DELETE_ROW = 0
     cell_list = []
 
-    mutator = self.conn.mutator_open(self.ns, table_name, 0, 0)
-
     for key in row_keys:
       cell = ttypes.Cell()
       ttypekey = ttypes.Key(row=key, flag=__DELETE_ROW)
       cell.key = ttypekey
       cell_list.append(cell)
 
-    self.conn.mutator_set_cells(mutator, cell_list)
-    self.conn.mutator_close(mutator)
+    self.pool.call(self.__set_cells, table_name, cell_list)
 
 
   def delete_table(self, table_name):
@@ -213,7 +221,8 @@ class DatastoreProxy(AppDBInterface):
     """
     if not isinstance(table_name, str): raise TypeError("Expected str")
 
-    self.conn.drop_table(self.ns, table_name, 1)
+    with self.pool.connection() as (conn, ns):
+      conn.drop_table(ns, table_name, 1)
     return 
 
 
@@ -233,7 +242,8 @@ class DatastoreProxy(AppDBInterface):
     if not isinstance(column_names, list): raise TypeError("Expected list")
 
     table_schema_xml = self.__construct_schema_xml(column_names)
-    self.conn.create_table(self.ns,table_name,table_schema_xml)
+    with self.pool.connection() as (conn, ns):
+      conn.create_table(ns, table_name, table_schema_xml)
     return 
 
   def range_query(self, 
@@ -303,7 +313,7 @@ class DatastoreProxy(AppDBInterface):
                                 0, 
                                 None, 
                                 column_names)
-    res = self.conn.get_cells(self.ns, table_name, scan_spec)
+    res = self.pool.call(self.__scan, table_name, scan_spec)
 
     results = []
     last_row = None
@@ -345,6 +355,65 @@ class DatastoreProxy(AppDBInterface):
   # private methods 
   ######################################################################
 
+  def create_connection(self):
+    """ Creates a connection to Hypertable's Thrift on the local node and
+        opens the AppScale namespace with it.
+
+    Returns:
+      A tuple of a Hypertable client and the namespace handle
+    """
+    conn = thriftclient.ThriftClient(self.host, THRIFT_PORT)
+    return conn, conn.namespace_open(NS)
+
+  def close_connection(self, connection):
+    """ Closes a connection made by create_connection.
+
+    Args:
+      connection: A tuple of a Hypertable client and the namespace handle
+    """
+    conn, ns = connection
+    conn.close()
+
+  def __set_cells(self, connection, table_name, cell_list):
+    """ Writes cells to a table with a mutator which is always closed, so
+        that a failed write does not leak it on the server.
+
+    Args:
+      connection: A tuple of a Hypertable client and the namespace handle
+      table_name: The table to mutate
+      cell_list: A list of ttypes.Cell to write
+    """
+    conn, ns = connection
+    mutator = conn.mutator_open(ns, table_name, 0, 0)
+    try:
+      conn.mutator_set_cells(mutator, cell_list)
+    finally:
+      conn.mutator_close(mutator)
+
+  def __scan(self, connection, table_name, scan_spec):
+    """ Reads the cells for a scan through a scanner, one block of cells
+        per round trip, rather than having get_cells buffer the whole
+        range in a single response.
+
+    Args:
+      connection: A tuple of a Hypertable client and the namespace handle
+      table_name: The table to access
+      scan_spec: A ttypes.ScanSpec for the cells to read
+    Returns:
+      A list of ttypes.Cell in row order
+    """
+    conn, ns = connection
+    cells = []
+    scanner = conn.scanner_open(ns, table_name, scan_spec)
+    try:
+      batch = conn.scanner_get_cells(scanner)
+      while batch:
+        cells.extend(batch)
+        batch = conn.scanner_get_cells(scanner)
+    finally:
+      conn.scanner_close(scanner)
+    return cells
+
   def __construct_schema_xml(self, column_names):
     """ For the column names of a table, this method returns
         an xml string representing the columns, which can 
@@ -0,0 +1,324 @@
+""" An in-process stand-in for a ZooKeeper server and the KazooClient that
+talks to it, so that the datastore's transaction code can run without a
+ZooKeeper ensemble, such as in benchmarks. Nothing it holds is durable, so it
+is kept out of the zkappscale package the datastore server runs with.
+"""
+import threading
+import time
+
+import kazoo.exceptions
+import kazoo.handlers.threading
+from kazoo.protocol.states import EventType
+from kazoo.protocol.states import KazooState
+from kazoo.protocol.states import WatchedEvent
+from kazoo.protocol.states import ZnodeStat
+
+# Separates the nodes of a path.
+PATH_SEPARATOR = "/"
+
+class InProcessZooKeeper():
+  """ Holds a tree of nodes in memory and serves the subset of the
+  KazooClient interface which ZKTransaction uses. Calls finish before they
+  return, in the order they were made, as calls on one ZooKeeper session
+  do. One-time watches on data and children fire as they would on a real
+  server.
+  """
+
+  def __init__(self):
+    """ Creates an empty tree. """
+    self.handler = kazoo.handlers.threading.SequentialThreadingHandler()
+    self.lock = threading.RLock()
+    # Each node's path maps to a list of its value, version and the times it
+    # was created and last changed.
+    self.nodes = {PATH_SEPARATOR: ['', 0, 0, 0]}
+    self.children = {PATH_SEPARATOR: set()}
+    self.sequences = {}
+    self.data_watches = {}
+    self.child_watches = {}
+    self.listeners = []
+    # The number of requests made, keyed by the KazooClient method name.
+    self.requests = {}
+
+  def start(self, timeout=None):
+    """ Starts the session, which needs no connection. """
+    for listener in list(self.listeners):
+      listener(KazooState.CONNECTED)
+
+  def stop(self):
+    """ Ends the session. The tree is kept, as it would be on a server. """
+    pass
+
+  def add_listener(self, listener):
+    """ Registers a function called with connection state changes.
+
+    Args:
+      listener: A function taking a KazooState.
+    """
+    self.listeners.append(listener)
+
+  def get_stats(self):
+    """ Returns the number of requests made of each kind.
+
+    Returns:
+      A dict of KazooClient method names to counts.
+    """
+    with self.lock:
+      return dict(self.requests)
+
+  def create(self, path, value='', acl=None, ephemeral=False, sequence=False,
+    makepath=False):
+    return self.create_async(path, value, acl, ephemeral, sequence,
+      makepath).get()
+
+  def create_async(self, path, value='', acl=None, ephemeral=False,
+    sequence=False, makepath=False):
+    return self.__run('create', self.__create, path, value, sequence,
+      makepath)
+
+  def get(self, path, watch=None):
+    return self.get_async(path, watch).get()
+
+  def get_async(self, path, watch=None):
+    return self.__run('get', self.__get, path, watch)
+
+  def set(self, path, value, version=-1):
+    return self.set_async(path, value, version).get()
+
+  def set_async(self, path, value, version=-1):
+    return self.__run('set', self.__set, path, value, version)
+
+  def exists(self, path, watch=None):
+    return self.exists_async(path, watch).get()
+
+  def exists_async(self, path, watch=None):
+    return self.__run('exists', self.__exists, path, watch)
+
+  def get_children(self, path, watch=None, include_data=False):
+    return self.get_children_async(path, watch, include_data).get()
+
+  def get_children_async(self, path, watch=None, include_data=False):
+    return self.__run('get_children', self.__get_children, path, watch)
+
+  def delete(self, path, version=-1, recursive=False):
+    if recursive:
+      for child in self.get_children(path):
+        self.delete(PATH_SEPARATOR.join([path.rstrip(PATH_SEPARATOR), child]),
+          recursive=True)
+    return self.delete_async(path, version).get()
+
+  def delete_async(self, path, version=-1):
+    return self.__run('delete', self.__delete, path, version)
+
+  def ensure_path(self, path, acl=None):
+    try:
+      self.create(path, makepath=True)
+    except kazoo.exceptions.NodeExistsError:
+      pass
+    return True
+
+  def transaction(self):
+    """ Starts a multi-op transaction.
+
+    Returns:
+      An InProcessTransaction.
+    """
+    return InProcessTransaction(self)
+
+  def _commit(self, operations):
+    """ Applies the operations of a transaction, all of them or none.
+
+    Args:
+      operations: A list of (method, args) tuples, where method is one of
+        the private methods applying a request.
+    Returns:
+      An IAsyncResult holding a list of the result of each operation. If one
+      failed, it holds the exception it raised and the others hold
+      RolledBackError.
+    """
+    return self.__run('transaction', self.__commit, operations)
+
+  def __run(self, name, function, *args):
+    """ Applies a request to the tree, and then fires the watches it
+    triggered.
+
+    Returns:
+      An IAsyncResult holding the value function returned, or the
+      exception it raised.
+    """
+    result = self.handler.async_result()
+    fired = []
+    with self.lock:
+      self.requests[name] = self.requests.get(name, 0) + 1
+      try:
+        result.set(function(fired, *args))
+      except kazoo.exceptions.ZookeeperError as exception:
+        result.set_exception(exception)
+    for watch, event in fired:
+      watch(event)
+    return result
+
+  @staticmethod
+  def __parent(path):
+    return path.rsplit(PATH_SEPARATOR, 1)[0] or PATH_SEPARATOR
+
+  def __trigger(self, fired, watches, path, event_type):
+    # Operations inside a transaction pass no list, and trigger their
+    # watches once the whole transaction is applied.
+    if fired is None:
+      return
+    for watch in watches.pop(path, []):
+      fired.append((watch, WatchedEvent(event_type, KazooState.CONNECTED,
+        path)))
+
+  def __create(self, fired, path, value, sequence, makepath):
+    parent = self.__parent(path)
+    if parent not in self.nodes:
+      if not makepath:
+        raise kazoo.exceptions.NoNodeError(parent)
+      self.__create(fired, parent, '', False, True)
+    if sequence:
+      count = self.sequences.get(parent, 0)
+      self.sequences[parent] = count + 1
+      path = "{0}{1:010d}".format(path, count)
+    if path in self.nodes:
+      raise kazoo.exceptions.NodeExistsError(path)
+    now = int(time.time() * 1000)
+    self.nodes[path] = [value, 0, now, now]
+    self.children[path] = set()
+    self.children[parent].add(path.rsplit(PATH_SEPARATOR, 1)[1])
+    self.__trigger(fired, self.data_watches, path, EventType.CREATED)
+    self.__trigger(fired, self.child_watches, parent, EventType.CHILD)
+    return path
+
+  def __stat(self, path):
+    value, version, ctime, mtime = self.nodes[path]
+    return ZnodeStat(0, 0, ctime, mtime, version, 0, 0, 0, len(value),
+      len(self.children[path]), 0)
+
+  def __get(self, fired, path, watch):
+    if path not in self.nodes:
+      raise kazoo.exceptions.NoNodeError(path)
+    if watch:
+      self.data_watches.setdefault(path, []).append(watch)
+    return self.nodes[path][0], self.__stat(path)
+
+  def __set(self, fired, path, value, version):
+    if path not in self.nodes:
+      raise kazoo.exceptions.NoNodeError(path)
+    node = self.nodes[path]
+    if version != -1 and version != node[1]:
+      raise kazoo.exceptions.BadVersionError(path)
+    node[0] = value
+    node[1] += 1
+    node[3] = int(time.time() * 1000)
+    self.__trigger(fired, self.data_watches, path, EventType.CHANGED)
+    return self.__stat(path)
+
+  def __exists(self, fired, path, watch):
+    if watch:
+      self.data_watches.setdefault(path, []).append(watch)
+    if path not in self.nodes:
+      return None
+    return self.__stat(path)
+
+  def __get_children(self, fired, path, watch):
+    if path not in self.nodes:
+      raise kazoo.exceptions.NoNodeError(path)
+    if watch:
+      self.child_watches.setdefault(path, []).append(watch)
+    return list(self.children[path])
+
+  def __delete(self, fired, path, version):
+    if path not in self.nodes:
+      raise kazoo.exceptions.NoNodeError(path)
+    if version != -1 and version != self.nodes[path][1]:
+      raise kazoo.exceptions.BadVersionError(path)
+    if self.children[path]:
+      raise kazoo.exceptions.NotEmptyError(path)
+    parent = self.__parent(path)
+    del self.nodes[path]
+    del self.children[path]
+    self.children[parent].discard(path.rsplit(PATH_SEPARATOR, 1)[1])
+    self.__trigger(fired, self.data_watches, path, EventType.DELETED)
+    self.__trigger(fired, self.child_watches, path, EventType.DELETED)
+    self.__trigger(fired, self.child_watches, parent, EventType.CHILD)
+    return True
+
+  def __commit(self, fired, operations):
+    # Each applied operation's undo is kept until all of them succeed.
+    undo = []
+    results = []
+    for index, (name, args) in enumerate(operations):
+      try:
+        if name == 'create':
+          path = self.__create(None, args[0], args[1], args[2], False)
+          undo.append(lambda path=path: self.__delete(None, path, -1))
+          results.append(path)
+        elif name == 'delete':
+          path = args[0]
+          if path not in self.nodes:
+            raise kazoo.exceptions.NoNodeError(path)
+          value = self.nodes[path][0]
+          self.__delete(None, path, args[1])
+          undo.append(lambda path=path, value=value:
+            self.__create(None, path, value, False, False))
+          results.append(True)
+        elif name == 'set_data':
+          old = list(self.nodes.get(args[0], []))
+          results.append(self.__set(None, args[0], args[1], args[2]))
+          undo.append(lambda path=args[0], old=old:
+            self.nodes[path].__setitem__(slice(None), old))
+        elif name == 'check':
+          if args[0] not in self.nodes or \
+             (args[1] != -1 and self.nodes[args[0]][1] != args[1]):
+            raise kazoo.exceptions.BadVersionError(args[0])
+          results.append(True)
+      except kazoo.exceptions.ZookeeperError as exception:
+        for operation in reversed(undo):
+          operation()
+        results = [kazoo.exceptions.RolledBackError()] * len(operations)
+        results[index] = exception
+        return results
+
+    # Watches only fire for a transaction which was applied.
+    for (name, args), result in zip(operations, results):
+      if name == 'create':
+        self.__trigger(fired, self.data_watches, result, EventType.CREATED)
+        self.__trigger(fired, self.child_watches, self.__parent(result),
+          EventType.CHILD)
+      elif name == 'delete':
+        self.__trigger(fired, self.data_watches, args[0], EventType.DELETED)
+        self.__trigger(fired, self.child_watches, args[0], EventType.DELETED)
+        self.__trigger(fired, self.child_watches, self.__parent(args[0]),
+          EventType.CHILD)
+      elif name == 'set_data':
+        self.__trigger(fired, self.data_watches, args[0], EventType.CHANGED)
+    return results
+
+
+class InProcessTransaction():
+  """ Collects the operations of a multi-op transaction, as a kazoo
+  TransactionRequest does.
+  """
+
+  def __init__(self, client):
+    self.client = client
+    self.operations = []
+
+  def create(self, path, value='', acl=None, ephemeral=False, sequence=False):
+    self.operations.append(('create', (path, value, sequence)))
+
+  def delete(self, path, version=-1):
+    self.operations.append(('delete', (path, version)))
+
+  def set_data(self, path, value, version=-1):
+    self.operations.append(('set_data', (path, value, version)))
+
+  def check(self, path, version):
+    self.operations.append(('check', (path, version)))
+
+  def commit_async(self):
+    return self.client._commit(self.operations)
+
+  def commit(self):
+    return self.commit_async().get()
@@ -0,0 +1,293 @@
+# See LICENSE file
+
+"""
+ SQLite Interface for AppScale. Keeps all tables in a single file on the
+ local disk, for single node deployments and for testing the datastore
+ without a database cluster.
+"""
+import os
+import sqlite3
+import threading
+
+from dbconstants import *
+from dbinterface_batch import *
+
+# The file holding all tables
+DEFAULT_DATABASE = "/opt/appscale/sqlite/appscale.db"
+
+# Seconds a write waits for another process's write to finish
+BUSY_TIMEOUT = 30
+
+# The number of keys looked up by a single select, kept under SQLite's
+# limit on the number of parameters in a statement
+MAX_GET_KEYS = 500
+
+# The first SQLite release with write-ahead logging
+WAL_VERSION = (3, 7, 0)
+
+class DatastoreProxy(AppDBInterface):
+  """
+    SQLite implementation of the AppDBInterface. Like a Cassandra column
+    family, each table holds cells of (row_key, column_name, value) and any
+    column can be stored on any row. The primary key of (row_key,
+    column_name) indexes cells in key order, so range queries are index
+    scans. Keys and values
+    are stored as blobs, which SQLite compares byte by byte.
+  """
+  def __init__(self, path=DEFAULT_DATABASE):
+    """
+    Constructor. Creates the database file and the datastore's tables if
+    they do not exist yet.
+
+    Args:
+      path: The file holding all tables.
+    """
+    self.path = path
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+
+    # SQLite connections can not be shared between threads, so each
+    # thread opens its own.
+    self.local = threading.local()
+
+    # Readers do not block the writer, or each other, in WAL mode. SQLite
+    # releases before 3.7.0 do not have it.
+    if sqlite3.sqlite_version_info >= WAL_VERSION:
+      self.get_connection().execute("PRAGMA journal_mode=WAL")
+    for table_name in INITIAL_TABLES:
+      self.create_table(table_name, [])
+
+  def get_connection(self):
+    """ Gets this thread's connection to the database, opening it if
+    needed.
+
+    Returns:
+      A sqlite3.Connection.
+    """
+    connection = getattr(self.local, "connection", None)
+    if connection is None:
+      connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+      connection.execute("PRAGMA synchronous=NORMAL")
+      self.local.connection = connection
+    return connection
+
+  def batch_get_entity(self, table_name, row_keys, column_names):
+    """
+    Takes in batches of keys and retrieves their cooresponding rows.
+
+    Args:
+      table_name: The table to access
+      row_keys: A list of keys to access
+      column_names: A list of columns to access
+    Returns:
+      A dictionary of rows and columns/values of those rows. The format
+      looks like such: {key:{column_name:value,...}}
+    """
+
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+    if not isinstance(column_names, list): raise TypeError("Expected a list")
+    if not isinstance(row_keys, list): raise TypeError("Expected a list")
+
+    ret_val = {}
+    for row in row_keys:
+      ret_val[row] = {}
+    if not column_names:
+      return ret_val
+
+    connection = self.get_connection()
+    column_filter = self.__parameters(column_names)
+    for index in range(0, len(row_keys), MAX_GET_KEYS):
+      keys = [buffer(key) for key in row_keys[index:index + MAX_GET_KEYS]]
+      cursor = connection.execute(
+        "SELECT row_key, column_name, value FROM {0} "
+        "WHERE row_key IN {1} AND column_name IN {2}".format(
+          self.__quote(table_name), self.__parameters(keys), column_filter),
+        keys + column_names)
+      for key, column, value in cursor:
+        ret_val[str(key)][str(column)] = str(value)
+    return ret_val
+
+  def batch_put_entity(self, table_name, row_keys, column_names, cell_values):
+    """
+    Allows callers to store multiple rows with a single call. A row can
+    have multiple columns and values with them. We refer to each row as
+    an entity.
+
+    Args:
+      table_name: The table to mutate
+      row_keys: A list of keys to store on
+      column_names: A list of columns to mutate
+      cell_values: A dict of key/value pairs
+    Raises:
+      TypeError: when bad arguments are given
+    """
+
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+    if not isinstance(column_names, list): raise TypeError("Expected a list")
+    if not isinstance(row_keys, list): raise TypeError("Expected a list")
+    if not isinstance(cell_values, dict): raise TypeError("Expected a dic")
+
+    cells = []
+    for key in row_keys:
+      for cname in column_names:
+        cells.append((buffer(key), cname, buffer(cell_values[key][cname])))
+
+    # Rows are written in one transaction, so a single sync covers all of
+    # them.
+    connection = self.get_connection()
+    with connection:
+      connection.executemany(
+        "INSERT OR REPLACE INTO {0} (row_key, column_name, value) "
+        "VALUES (?, ?, ?)".format(self.__quote(table_name)), cells)
+
+  def batch_delete(self, table_name, row_keys, column_names=[]):
+    """
+    Remove a set of rows cooresponding to a set of keys.
+
+    Args:
+      table_name: Table to delete rows from
+      row_keys: A list of keys to remove
+      column_names: Not used
+    Raises:
+      AppScaleDBConnectionError: when unable to execute deletes
+      TypeError: when given bad argument types
+    """
+
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+    if not isinstance(row_keys, list): raise TypeError("Expected a list")
+
+    connection = self.get_connection()
+    try:
+      with connection:
+        connection.executemany(
+          "DELETE FROM {0} WHERE row_key = ?".format(
+            self.__quote(table_name)), [(buffer(key),) for key in row_keys])
+    except sqlite3.Error, ex:
+      raise AppScaleDBConnectionError("Exception %s" % str(ex))
+
+  def delete_table(self, table_name):
+    """
+    Drops a given table.
+
+    Args:
+      table_name: A string name of the table to drop
+    Rasies:
+      TypeError: when given bad argument types
+    """
+
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+
+    connection = self.get_connection()
+    with connection:
+      connection.execute(
+        "DROP TABLE IF EXISTS {0}".format(self.__quote(table_name)))
+
+  def create_table(self, table_name, column_names):
+    """
+    Creates a table. Tables which already exist are left as they are.
+
+    Args:
+      table_name: The table name
+      column_names: Not used but here to match the interface
+    Raises:
+      TypeError: when given bad argument types
+    """
+
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+    if not isinstance(column_names, list): raise TypeError("Expected a list")
+
+    connection = self.get_connection()
+    with connection:
+      connection.execute(
+        "CREATE TABLE IF NOT EXISTS {0} (row_key BLOB NOT NULL, "
+        "column_name TEXT NOT NULL, value BLOB, "
+        "PRIMARY KEY (row_key, column_name))".format(
+        self.__quote(table_name)))
+
+  def range_query(self,
+                  table_name,
+                  column_names,
+                  start_key,
+                  end_key,
+                  limit,
+                  offset=0,
+                  start_inclusive=True,
+                  end_inclusive=True,
+                  keys_only=False):
+    """
+    Gets a dense range ordered by keys. Returns an ordered list of
+    a dictionary of [key:{column1:value1, column2:value2},...]
+    or a list of keys if keys only.
+
+    Args:
+      table_name: Name of table to access
+      column_names: Columns which get returned within the key range
+      start_key: String for which the query starts at
+      end_key: String for which the query ends at
+      limit: Maximum number of results to return
+      offset: Cuts off these many from the results [offset:]
+      start_inclusive: Boolean if results should include the start_key
+      end_inclusive: Boolean if results should include the end_key
+      keys_only: Boolean if to only keys and not values
+    Raises:
+      TypeError: when bad arguments are given
+    Returns:
+      An ordered list of dictionaries of key=>columns/values
+    """
+
+    if not isinstance(table_name, str): raise TypeError("Expected a str")
+    if not isinstance(column_names, list): raise TypeError("Expected a list")
+    if not isinstance(start_key, str): raise TypeError("Expected a str")
+    if not isinstance(end_key, str): raise TypeError("Expected a str")
+    if not isinstance(limit, int) and not isinstance(limit, long):
+      raise TypeError("Expected an int or long")
+    if not isinstance(offset, int) and not isinstance(offset, long):
+      raise TypeError("Expected an int or long")
+
+    # The bounds and limit are applied by the index scan, so no extra rows
+    # are read to make up for excluded start and end keys.
+    start_operator = ">=" if start_inclusive else ">"
+    end_operator = "<=" if end_inclusive else "<"
+    connection = self.get_connection()
+    cursor = connection.execute(
+      "SELECT DISTINCT row_key FROM {0} WHERE row_key {1} ? "
+      "AND row_key {2} ? ORDER BY row_key LIMIT ?".format(
+        self.__quote(table_name), start_operator, end_operator),
+      (buffer(start_key), buffer(end_key), limit))
+    keys = [str(row[0]) for row in cursor]
+
+    if keys_only:
+      results = keys
+    else:
+      rows = self.batch_get_entity(table_name, keys, column_names)
+      results = [{key: rows[key]} for key in keys]
+
+    if offset != 0 and offset <= len(results):
+      results = results[offset:]
+
+    return results
+
+  ######################################################################
+  # private methods
+  ######################################################################
+
+  def __quote(self, table_name):
+    """ Quotes a table name for use in a statement.
+
+    Args:
+      table_name: The table name
+    Returns:
+      The quoted table name.
+    """
+    return '"{0}"'.format(table_name.replace('"', '""'))
+
+  def __parameters(self, values):
+    """ Gets a list of placeholders for binding values in a statement.
+
+    Args:
+      values: The list of values to bind
+    Returns:
+      A string like "(?, ?)".
+    """
+    return "({0})".format(", ".join(["?"] * len(values)))
@@ -28,12 +28,25 @@ class FakePool():
   def return_conn(self, client):
     return 
 
+class FakeBatch():
+  """ Fake column family batch class for mocking """
+  def __init__(self):
+    self.mutations = []
+  def insert(self, key, columns):
+    self.mutations.append((key, columns))
+  def remove(self, key):
+    self.mutations.append((key, None))
+  def send(self):
+    return
+
 class FakeColumnFamily():
   """ Fake column family class for mocking """
   def __init__(self):
     return
-  def batch_insert(self, multi_map):
-    return
+  def batch(self, queue_size=100):
+    return FakeBatch()
+  def multiget(self, keys, columns=None, buffer_size=100):
+    return {}
   def get_range(self, start='', finish='', columns='', row_count='', 
                 read_consistency_level=''):
     return {}
@@ -64,10 +77,15 @@ class TestCassandra(unittest.TestCase):
     flexmock(pycassa).should_receive("ConnectionPool") \
         .and_return(FakePool())
 
+    flexmock(pycassa) \
+        .should_receive("ColumnFamily") \
+        .and_return(FakeColumnFamily())
+
     db = cassandra_interface.DatastoreProxy()
 
     # Make sure no exception is thrown
     assert {} == db.batch_get_entity('table', [], [])
+    assert {'a': {}} == db.batch_get_entity('table', ['a'], ['c'])
 
   def testPut(self):
     flexmock(file_io) \
@@ -110,5 +128,49 @@ class TestCassandra(unittest.TestCase):
 
     assert [] == db.range_query("table", [], "start", "end", 0)
 
+  def testPoolsAllNodes(self):
+    flexmock(file_io).should_receive('read') \
+        .and_return('192.168.0.1\n')
+    flexmock(file_io).should_receive('read') \
+        .with_args('/etc/appscale/slaves') \
+        .and_return('192.168.0.2\n192.168.0.3\n')
+
+    flexmock(pycassa).should_receive("ConnectionPool") \
+        .with_args(keyspace=cassandra_interface.KEYSPACE,
+          server_list=['192.168.0.1:9160', '192.168.0.2:9160',
+                       '192.168.0.3:9160'],
+          pool_size=6, max_retries=cassandra_interface.MAX_RETRIES,
+          timeout=cassandra_interface.CONNECTION_TIMEOUT, prefill=False) \
+        .and_return(FakePool()).once()
+
+    cassandra_interface.DatastoreProxy()
+
+  def testColumnFamilyConsistency(self):
+    flexmock(file_io) \
+        .should_receive('read') \
+        .and_return('127.0.0.1')
+
+    flexmock(pycassa).should_receive("ConnectionPool") \
+        .and_return(FakePool())
+
+    db = cassandra_interface.DatastoreProxy(
+      write_consistency={'table': cassandra_interface.CONSISTENCY_ALL})
+
+    flexmock(pycassa).should_receive("ColumnFamily") \
+        .with_args(db.pool, cassandra_interface.APP_KIND_TABLE,
+          read_consistency_level=cassandra_interface.CONSISTENCY_ONE,
+          write_consistency_level=cassandra_interface.CONSISTENCY_ONE) \
+        .and_return(FakeColumnFamily()).once()
+    flexmock(pycassa).should_receive("ColumnFamily") \
+        .with_args(db.pool, 'table',
+          read_consistency_level=cassandra_interface.CONSISTENCY_QUORUM,
+          write_consistency_level=cassandra_interface.CONSISTENCY_ALL) \
+        .and_return(FakeColumnFamily()).once()
+
+    # Handles are created once per table.
+    for _ in range(2):
+      db.range_query(cassandra_interface.APP_KIND_TABLE, [], "start", "end", 0)
+      db.batch_put_entity('table', [], [], {})
+
 if __name__ == "__main__":
   unittest.main()    
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from connection_pool import ConnectionPool
+
+
+class BrokenConnection(Exception):
+  pass
+
+
+class TestConnectionPool(unittest.TestCase):
+  """
+  A set of test cases for the database connection pool.
+  """
+  def setUp(self):
+    self.opened = []
+    self.closed = []
+
+  def create_connection(self):
+    self.opened.append("conn{0}".format(len(self.opened)))
+    return self.opened[-1]
+
+  def get_pool(self, max_size):
+    return ConnectionPool(self.create_connection, max_size,
+      transport_errors=(BrokenConnection,),
+      close_connection=self.closed.append)
+
+  def test_reuses_connections(self):
+    pool = self.get_pool(2)
+    with pool.connection() as connection:
+      self.assertEquals(connection, "conn0")
+    with pool.connection() as connection:
+      self.assertEquals(connection, "conn0")
+    self.assertEquals(self.opened, ["conn0"])
+
+  def test_bounds_open_connections(self):
+    pool = self.get_pool(1)
+    first = pool.get()
+    taken = []
+    thread = threading.Thread(target=lambda: taken.append(pool.get()))
+    thread.start()
+    thread.join(0.1)
+    self.assertEquals(taken, [])
+    pool.put(first)
+    thread.join(5)
+    self.assertEquals(taken, ["conn0"])
+
+  def test_discards_broken_connections(self):
+    pool = self.get_pool(1)
+    def use(connection):
+      raise BrokenConnection()
+    self.assertRaises(BrokenConnection, pool.call, use)
+    self.assertEquals(self.closed, ["conn0", "conn1"])
+
+    # Other errors leave the connection in the pool.
+    self.assertRaises(ValueError, pool.call, int, )
+    self.assertEquals(self.opened, ["conn0", "conn1", "conn2"])
+    with pool.connection() as connection:
+      self.assertEquals(connection, "conn2")
+
+  def test_retries_on_new_connection(self):
+    pool = self.get_pool(1)
+    def use(connection, value):
+      if connection == "conn0":
+        raise BrokenConnection()
+      return value
+    self.assertEquals(pool.call(use, "a"), "a")
+    self.assertEquals(self.closed, ["conn0"])
+
+
+if __name__ == "__main__":
+  unittest.main()
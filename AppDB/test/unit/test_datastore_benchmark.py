@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import kazoo.exceptions
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../../AppServer"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+import datastore_benchmark
+
+from inprocess_zookeeper import InProcessZooKeeper
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../sqlite/"))
+import sqlite_interface
+
+class TestInProcessZooKeeper(unittest.TestCase):
+  def testWatchesFire(self):
+    server = InProcessZooKeeper()
+    events = []
+    server.ensure_path("/a")
+    server.get_children("/a", watch=events.append)
+    server.create("/a/tx", sequence=True)
+    assert ["tx0000000000"] == server.get_children("/a")
+    assert 1 == len(events)
+
+  def testFailedTransactionRollsBack(self):
+    server = InProcessZooKeeper()
+    server.create("/a", "1")
+    transaction = server.transaction()
+    transaction.create("/b", "2")
+    transaction.delete("/missing")
+    results = transaction.commit()
+    assert isinstance(results[0], kazoo.exceptions.RolledBackError)
+    assert isinstance(results[1], kazoo.exceptions.NoNodeError)
+    assert None == server.exists("/b")
+    assert {"create": 1, "transaction": 1, "exists": 1} == server.get_stats()
+
+class TestDatastoreBenchmark(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def run_benchmark(self):
+    server = InProcessZooKeeper()
+    zookeeper = datastore_benchmark.InProcessZKTransaction(server)
+    benchmark = datastore_benchmark.DatastoreBenchmark(
+      sqlite_interface.DatastoreProxy(os.path.join(self.directory,
+        str(len(os.listdir(self.directory))))),
+      zookeeper, zookeeper_server=server, seed=1)
+    try:
+      return benchmark.run(requests=2)
+    finally:
+      benchmark.stop()
+      zookeeper.close()
+
+  def testRunsEveryWorkload(self):
+    results = self.run_benchmark()
+    assert sorted(datastore_benchmark.WORKLOADS) == sorted(results.keys())
+    for name, result in results.items():
+      assert 0 == result['errors'], name
+      assert result['latency_ms']['p50'] <= result['latency_ms']['p99']
+      assert result['datastore_calls'], name
+    assert 'acquire_locks' in results['put_batch']['zookeeper_calls']
+    assert 'transaction' in results['put_batch']['zookeeper_requests']
+
+  def testReproducible(self):
+    first = self.run_benchmark()
+    second = self.run_benchmark()
+    for name in datastore_benchmark.WORKLOADS:
+      for source in ['datastore_calls', 'zookeeper_calls']:
+        assert first[name][source] == second[name][source], name
+
+  def testPercentile(self):
+    assert 0 == datastore_benchmark.percentile([], 0.5)
+    assert 50 == datastore_benchmark.percentile(range(1, 101), 0.5)
+    assert 99 == datastore_benchmark.percentile(range(1, 101), 0.99)
+    assert 7 == datastore_benchmark.percentile([7], 0.99)
+
+if __name__ == "__main__":
+  unittest.main()
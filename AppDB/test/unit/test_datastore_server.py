@@ -12,11 +12,14 @@ from google.appengine.datastore import datastore_index
 from google.appengine.datastore import datastore_pb
 from google.appengine.api import api_base_pb
 from google.appengine.api import datastore
+from google.appengine.runtime import apiproxy_errors
 from google.appengine.ext import db
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))  
 from appscale_datastore_batch import DatastoreFactory
 from datastore_server import DatastoreDistributed
+from datastore_server import QueryCursor
+from datastore_server import QueryCursorRegistry
 from datastore_server import BLOCK_SIZE
 from datastore_server import TOMBSTONE
 from dbconstants import *
@@ -35,7 +38,11 @@ class TestDatastoreServer(unittest.TestCase):
   def get_zookeeper(self):
     zookeeper = flexmock()
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("release_locks").and_return(True)
     zookeeper.should_receive("get_transaction_id").and_return(1)
     return zookeeper
 
@@ -81,7 +88,11 @@ class TestDatastoreServer(unittest.TestCase):
     db_batch.should_receive("batch_put_entity").and_return(None)
     zookeeper = flexmock()
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("release_locks").and_return(True)
     dd = DatastoreDistributed(db_batch, zookeeper)
     self.assertEquals(dd.configure_namespace("howdy", "hello", "ns"), True)
 
@@ -90,7 +101,11 @@ class TestDatastoreServer(unittest.TestCase):
     db_batch.should_receive("batch_put_entity").and_return(None)
     zookeeper = flexmock()
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("release_locks").and_return(True)
     dd = DatastoreDistributed(db_batch, zookeeper)
     item = Item(key_name="Bob", name="Bob", _app="hello")
     key = db.model_to_protobuf(item)
@@ -112,6 +127,7 @@ class TestDatastoreServer(unittest.TestCase):
 
   def test_delete_index_entries(self):
     db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([])
     db_batch.should_receive("batch_delete").and_return(None)
     db_batch.should_receive("batch_put_entity").and_return(None)
     dd = DatastoreDistributed(db_batch, self.get_zookeeper())
@@ -133,6 +149,7 @@ class TestDatastoreServer(unittest.TestCase):
 
   def test_insert_index_entries(self):
     db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([])
     db_batch.should_receive("batch_put_entity").and_return(None)
     dd = DatastoreDistributed(db_batch, self.get_zookeeper())
     item1 = Item(key_name="Bob", name="Bob", _app="hello")
@@ -141,6 +158,40 @@ class TestDatastoreServer(unittest.TestCase):
     key2 = db.model_to_protobuf(item2)
     dd.insert_index_entries([key1,key2])
 
+  def test_write_tables(self):
+    db_batch = flexmock()
+    db_batch.should_receive("batch_put_entity").and_return(None)
+    db_batch.should_receive("batch_delete").and_raise(AppScaleDBConnectionError("down"))
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper(), write_workers=2)
+    dd.write_tables([
+      (APP_ENTITY_TABLE, db_batch.batch_put_entity, (APP_ENTITY_TABLE, [], [], {})),
+      (APP_KIND_TABLE, db_batch.batch_put_entity, (APP_KIND_TABLE, [], [], {}))])
+    stats = dd.get_stats()
+    self.assertEquals(stats['table_writes'][APP_ENTITY_TABLE]['count'], 1)
+    self.assertEquals(stats['table_writes'][APP_KIND_TABLE]['count'], 1)
+
+    # A failed write is raised once all of the writes have finished.
+    self.assertRaises(AppScaleDBConnectionError, dd.write_tables, [
+      (APP_KIND_TABLE, db_batch.batch_delete, (APP_KIND_TABLE, [], [])),
+      (APP_ENTITY_TABLE, db_batch.batch_put_entity, (APP_ENTITY_TABLE, [], [], {}))])
+    stats = dd.get_stats()
+    self.assertEquals(stats['table_writes'][APP_ENTITY_TABLE]['count'], 2)
+    self.assertEquals(stats['table_writes'][APP_KIND_TABLE]['count'], 2)
+
+  def test_get_index_puts(self):
+    db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([])
+    db_batch.should_receive("batch_put_entity").and_return(None)
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+    item1 = Item(key_name="Bob", name="Bob", _app="hello")
+    item2 = Item(key_name="Sally", name="Sally", _app="hello", namespace="ns")
+    key1 = db.model_to_protobuf(item1)
+    key2 = db.model_to_protobuf(item2)
+    writes = dd.get_index_puts([key1, key2])
+    # Index rows from every namespace are written.
+    for table, _, args in writes:
+      self.assertEquals(len(args[1]), 2)
+
   def test_acquire_next_id_from_db(self):
     PREFIX = "x"
     db_batch = flexmock()
@@ -184,6 +235,22 @@ class TestDatastoreServer(unittest.TestCase):
     except ValueError:
       pass 
 
+  def test_allocate_local_ids(self):
+    PREFIX = "x"
+    db_batch = flexmock()
+    db_batch.should_receive("batch_get_entity").and_return({PREFIX:{APP_ID_SCHEMA[0]:"1"}})
+    # Only one block is reserved from the ID table for both calls.
+    db_batch.should_receive("batch_put_entity").and_return(None).once
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper(), id_block_size=100)
+    self.assertEquals(dd.allocate_local_ids(PREFIX, 5), [1, 2, 3, 4, 5])
+    self.assertEquals(dd.allocate_local_ids(PREFIX, 2), [6, 7])
+    self.assertEquals(dd.get_stats()['id_blocks_reserved'], 1)
+    self.assertEquals(dd.get_stats()['ids_allocated_locally'], 7)
+
+    # Reserving past a max ID drops the local IDs under it.
+    dd.discard_id_blocks(PREFIX, 50)
+    self.assertEquals(dd.allocate_local_ids(PREFIX, 1), [51])
+
   def test_put_entities(self):
     item1 = Item(key_name="Bob", name="Bob", _app="hello")
     item2 = Item(key_name="Sally", name="Sally", _app="hello")
@@ -191,16 +258,22 @@ class TestDatastoreServer(unittest.TestCase):
     key2 = db.model_to_protobuf(item2)
 
     db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([])
     db_batch.should_receive("batch_delete").and_return(None)
     db_batch.should_receive("batch_put_entity").and_return(None)
     db_batch.should_receive("batch_get_entity").and_return({"key1":{},"key2":{}})
     zookeeper = flexmock()
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("release_locks").and_return(True)
     dd = DatastoreDistributed(db_batch, zookeeper)
     dd.put_entities("hello", [key1, key2], {}) 
 
     db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([])
     db_batch.should_receive("batch_delete").and_return(None)
     db_batch.should_receive("batch_put_entity").and_return(None)
     db_batch.should_receive("batch_get_entity").and_return({"key1":{"entity":key1.Encode()},"key2":{"entity":key2.Encode()}})
@@ -223,8 +296,13 @@ class TestDatastoreServer(unittest.TestCase):
 
     zookeeper = flexmock()
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     zookeeper.should_receive("release_lock").and_return(True)
-    zookeeper.should_receive("get_valid_transaction_id").and_return(2)
+    zookeeper.should_receive("release_locks").and_return(True)
+    zookeeper.should_receive("get_valid_transaction_ids").and_return(
+      {'test/blah/test_kind:bob!': 2})
     dd = DatastoreDistributed(db_batch, zookeeper)
 
     self.assertEquals(({'test/blah/test_kind:bob!': 
@@ -237,6 +315,7 @@ class TestDatastoreServer(unittest.TestCase):
     db_batch = flexmock()
     zookeeper = flexmock()
     zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("release_locks").and_return(True)
     dd = DatastoreDistributed(db_batch, zookeeper)
     commit_request = datastore_pb.Transaction()
     commit_request.set_handle(123)
@@ -249,6 +328,7 @@ class TestDatastoreServer(unittest.TestCase):
     db_batch = flexmock()
     zookeeper = flexmock()
     zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("release_locks").and_return(True)
     zookeeper.should_receive("notify_failed_transaction").and_return(True)
     dd = DatastoreDistributed(db_batch, zookeeper)
     commit_request = datastore_pb.Transaction()
@@ -286,13 +366,18 @@ class TestDatastoreServer(unittest.TestCase):
   def test_dynamic_put(self):
     PREFIX = "x!"
     db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([])
     db_batch.should_receive("batch_put_entity").and_return(None)
     db_batch.should_receive("batch_get_entity").and_return({PREFIX:{}})
     db_batch.should_receive("batch_delete").and_return(None)
 
     zookeeper = flexmock()
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("release_locks").and_return(True)
     zookeeper.should_receive("get_transaction_id").and_return(1)
 
     entity_proto1 = self.get_new_entity_proto("test", "test_kind", "bob", "prop1name", 
@@ -314,12 +399,16 @@ class TestDatastoreServer(unittest.TestCase):
   def test_put_entities(self):
     PREFIX = "x!"
     db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([])
     db_batch.should_receive("batch_put_entity").and_return(None)
     db_batch.should_receive("batch_get_entity").and_return({PREFIX:{}})
     db_batch.should_receive("batch_delete").and_return(None)
 
     zookeeper = flexmock()
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
 
     entity_proto1 = self.get_new_entity_proto("test", "test_kind", "bob", "prop1name", 
                                               "prop1val", ns="blah")
@@ -331,10 +420,49 @@ class TestDatastoreServer(unittest.TestCase):
     # Make sure it does not throw an exception
     dd.put_entities("hello", entity_list, {"test/blah/test_kind:bob!":1, "test/blah/test_kind:nancy!":1}) 
 
+  def test_put_entities_index_delta(self):
+    old_entity = self.get_new_entity_proto("test", "test_kind", "bob", "prop1name",
+                                           "prop1val", ns="blah")
+    prop = old_entity.add_property()
+    prop.set_name("prop2name")
+    prop.set_multiple(0)
+    prop.mutable_value().set_stringvalue("same")
+    new_entity = datastore_pb.EntityProto()
+    new_entity.CopyFrom(old_entity)
+    new_entity.property(0).mutable_value().set_stringvalue("newval")
+    row_key = "test/blah/test_kind:bob!"
+
+    puts = []
+    deletes = []
+    db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([])
+    db_batch.should_receive("batch_get_entity").and_return(
+      {row_key: {APP_ENTITY_SCHEMA[0]: old_entity.Encode()}}).once()
+    db_batch.should_receive("batch_put_entity").replace_with(
+      lambda table, keys, schema, values: puts.append((table, keys)))
+    db_batch.should_receive("batch_delete").replace_with(
+      lambda table, keys, schema: deletes.append((table, keys)))
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+    dd.put_entities("test", [new_entity], {row_key: 2})
+
+    # Only the index rows of the changed property are rewritten.
+    put_tables = dict(puts)
+    self.assertEquals(len(put_tables[ASC_PROPERTY_TABLE]), 1)
+    self.assertTrue("newval" in put_tables[ASC_PROPERTY_TABLE][0])
+    self.assertEquals(len(put_tables[DSC_PROPERTY_TABLE]), 1)
+    delete_tables = dict(deletes)
+    self.assertEquals(len(delete_tables[ASC_PROPERTY_TABLE]), 1)
+    self.assertTrue("prop1val" in delete_tables[ASC_PROPERTY_TABLE][0])
+    self.assertEquals(len(delete_tables[DSC_PROPERTY_TABLE]), 1)
+    self.assertFalse(APP_KIND_TABLE in delete_tables)
+
   def test_acquire_locks_for_trans(self):
     PREFIX = 'x!'
     zookeeper = flexmock()
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     db_batch = flexmock()
     db_batch.should_receive("batch_put_entity").and_return(None)
     db_batch.should_receive("batch_get_entity").and_return({PREFIX:{}})
@@ -356,6 +484,9 @@ class TestDatastoreServer(unittest.TestCase):
     PREFIX = 'x!'
     zookeeper = flexmock()
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     zookeeper.should_receive("get_transaction_id").and_return(1).and_return(2)
     db_batch = flexmock()
     db_batch.should_receive("batch_put_entity").and_return(None)
@@ -406,6 +537,7 @@ class TestDatastoreServer(unittest.TestCase):
     zookeeper.should_receive("get_valid_transaction_id").and_return(1)
     zookeeper.should_receive("register_updated_key").and_return(1)
     db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([])
     db_batch.should_receive("batch_put_entity").and_return(None)
     db_batch.should_receive("batch_get_entity").and_return(row_values)
     db_batch.should_receive("batch_delete").and_return(None)
@@ -416,11 +548,78 @@ class TestDatastoreServer(unittest.TestCase):
     txn_hash = {row_key: 2}
     dd.delete_entities('test', row_keys, txn_hash, soft_delete=True) 
      
+  def test_record_kind_stats(self):
+    old_entity = self.get_new_entity_proto("test", "test_kind", "bob",
+      "prop1name", "prop1val", ns="blah")
+    new_entity = self.get_new_entity_proto("test", "test_kind", "bob",
+      "prop1name", "a longer value", ns="blah")
+    other_entity = self.get_new_entity_proto("test", "other_kind", "nancy",
+      "prop1name", "prop1val")
+    private_entity = self.get_new_entity_proto("test", "__Stat_Kind__",
+      "test_kind", "prop1name", "prop1val")
+    dd = DatastoreDistributed(flexmock(), flexmock())
+
+    dd.record_kind_stats([old_entity], [new_entity, other_entity,
+                                        private_entity])
+    self.assertEquals({"test": {
+      "test_kind": [0, new_entity.ByteSize() - old_entity.ByteSize()],
+      "other_kind": [1, other_entity.ByteSize()]}}, dd.get_kind_stat_deltas())
+
+    dd.record_kind_stats([other_entity], [])
+    self.assertEquals([0, 0], dd.get_kind_stat_deltas()["test"]["other_kind"])
+
+  def test_flush_kind_stats(self):
+    dd = DatastoreDistributed(flexmock(), flexmock())
+    existing = dd.new_stat_entity("test", "__Stat_Kind__", "test_kind")
+    dd.set_stat_property(existing, "count", 5)
+    dd.set_stat_property(existing, "bytes", 500)
+    row_key = "test/!__Stat_Kind__:test_kind!"
+
+    db_batch = flexmock()
+    db_batch.should_receive("batch_put_entity").and_return(None)
+    db_batch.should_receive("batch_get_entity").and_return(
+      {row_key: {APP_ENTITY_SCHEMA[0]: existing.Encode()}})
+    dd = flexmock(DatastoreDistributed(db_batch, flexmock()))
+    dd.should_receive("acquire_locks_for_nontrans").and_return({})
+    dd.should_receive("release_locks_for_nontrans").once()
+    written = []
+    dd.should_receive("put_entities").replace_with(
+      lambda app_id, entities, txn_hash: written.extend(entities))
+
+    entity = self.get_new_entity_proto("test", "test_kind", "bob",
+      "prop1name", "prop1val")
+    other_entity = self.get_new_entity_proto("test", "other_kind", "nancy",
+      "prop1name", "prop1val")
+    dd.record_kind_stats([], [entity, other_entity])
+    dd.flush_kind_stats()
+    self.assertEquals({}, dd.get_kind_stat_deltas())
+
+    stats = {}
+    for stat in written:
+      values = dict((prop.name(), prop.value()) for prop in
+                    stat.property_list())
+      stats[stat.key().path().element(0).name()] = (
+        values["count"].int64value(), values["bytes"].int64value())
+    self.assertEquals({
+      "test_kind": (6, 500 + entity.ByteSize()),
+      "other_kind": (1, other_entity.ByteSize()),
+      "total_entity_usage": (2, entity.ByteSize() + other_entity.ByteSize())},
+      stats)
+
+    # Changes which could not be written are kept for the next flush.
+    dd.should_receive("apply_kind_stats").and_raise(ZKTransactionException)
+    dd.record_kind_stats([], [entity])
+    dd.flush_kind_stats()
+    dd.record_kind_stats([], [entity])
+    self.assertEquals({"test": {"test_kind": [2, 2 * entity.ByteSize()]}},
+                      dd.get_kind_stat_deltas())
+
   def test_release_put_locks_for_nontrans(self):
     zookeeper = flexmock()
     zookeeper.should_receive("get_valid_transaction_id").and_return(1)
     zookeeper.should_receive("register_updated_key").and_return(1)
     zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("release_locks").and_return(True)
     db_batch = flexmock()
     db_batch.should_receive("batch_put_entity").and_return(None)
     db_batch.should_receive("batch_get_entity").and_return(None)
@@ -460,9 +659,13 @@ class TestDatastoreServer(unittest.TestCase):
     entity_proto1 = self.get_new_entity_proto("test", "test_kind", "nancy", "prop1name", 
                                               "prop2val", ns="blah")
     zookeeper = flexmock()
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").and_return(
+      {"test/blah/test_kind:nancy!": 1})
     zookeeper.should_receive("register_updated_key").and_return(1)
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     db_batch = flexmock()
     db_batch.should_receive("batch_put_entity").and_return(None)
     db_batch.should_receive("batch_get_entity").and_return(
@@ -517,8 +720,12 @@ class TestDatastoreServer(unittest.TestCase):
                       APP_ENTITY_SCHEMA[1]: 1}}
     db_batch.should_receive("range_query").and_return([entity_proto1, tombstone1]).and_return([])
     zookeeper = flexmock()
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").and_return(
+      {'test/blah/test_kind:nancy!': 1, 'key': 1})
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     dd = DatastoreDistributed(db_batch, zookeeper) 
     dd.ancestor_query(query, filter_info, None)
     # Now with a transaction
@@ -551,14 +758,507 @@ class TestDatastoreServer(unittest.TestCase):
                       APP_ENTITY_SCHEMA[1]: 1}}
     db_batch.should_receive("range_query").and_return([entity_proto1, tombstone1]).and_return([])
     zookeeper = flexmock()
-    zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    zookeeper.should_receive("get_valid_transaction_ids").and_return(
+      {'test/blah/test_kind:nancy!': 1, 'key': 1})
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     dd = DatastoreDistributed(db_batch, zookeeper) 
     filter_info = {
       '__key__' : [[0, 0]]
     }
     dd.kindless_query(query, filter_info, None)
 
+  def test_query_batches(self):
+    entities = {}
+    for name in ["a", "b", "c"]:
+      entities["test/blah/test_kind:{0}!".format(name)] = \
+        self.get_new_entity_proto("test", "test_kind", name, "prop1name",
+                                  "prop1val", ns="blah")
+    kind_keys = sorted(entities.keys())
+
+    def range_query(table, schema, start, end, limit, offset=0,
+                    start_inclusive=True, end_inclusive=True):
+      rows = [key for key in kind_keys if key <= end and
+              (key > start or (start_inclusive and key == start))]
+      return [{key: {'reference': key}} for key in rows[:limit]]
+
+    def batch_get_entity(table, keys, schema):
+      return dict((key, {APP_ENTITY_SCHEMA[0]: entities[key].Encode(),
+                         APP_ENTITY_SCHEMA[1]: '1'}) for key in keys)
+
+    db_batch = flexmock()
+    db_batch.should_receive("batch_put_entity").and_return(None)
+    db_batch.should_receive("range_query").replace_with(range_query)
+    db_batch.should_receive("batch_get_entity").replace_with(batch_get_entity)
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+
+    query = datastore_pb.Query()
+    query.set_app("test")
+    query.set_name_space("blah")
+    query.set_kind("test_kind")
+    query.set_count(2)
+    self.assertTrue(dd.is_streamable_query(query))
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+    self.assertEquals(query_result.result_size(), 2)
+    self.assertTrue(query_result.more_results())
+    self.assertEquals(dd.get_stats()['open_query_cursors'], 1)
+
+    # The next batch starts after the last result of the first one.
+    next_request = datastore_pb.NextRequest()
+    next_request.mutable_cursor().CopyFrom(query_result.cursor())
+    next_request.set_count(2)
+    next_result = datastore_pb.QueryResult()
+    dd._dynamic_next("test", next_request, next_result)
+    self.assertEquals(next_result.result_size(), 1)
+    self.assertEquals(next_result.result(0).key().path().element(0).name(), "c")
+    self.assertFalse(next_result.more_results())
+    self.assertEquals(dd.get_stats()['open_query_cursors'], 0)
+
+    self.assertRaises(apiproxy_errors.ApplicationError, dd._dynamic_next,
+                      "test", next_request, datastore_pb.QueryResult())
+
+  def test_query_batches_skip_deleted_entities(self):
+    entities = {}
+    for name in ["a", "b", "c", "d"]:
+      entities["test/blah/test_kind:{0}!".format(name)] = \
+        self.get_new_entity_proto("test", "test_kind", name, "prop1name",
+                                  "prop1val", ns="blah").Encode()
+    kind_keys = sorted(entities.keys())
+    # The kind row of a deleted entity may outlive it for a while.
+    entities["test/blah/test_kind:b!"] = TOMBSTONE
+
+    def range_query(table, schema, start, end, limit, offset=0,
+                    start_inclusive=True, end_inclusive=True):
+      rows = [key for key in kind_keys if key <= end and
+              (key > start or (start_inclusive and key == start))]
+      return [{key: {'reference': key}} for key in rows[:limit]]
+
+    def batch_get_entity(table, keys, schema):
+      return dict((key, {APP_ENTITY_SCHEMA[0]: entities[key],
+                         APP_ENTITY_SCHEMA[1]: '1'}) for key in keys)
+
+    db_batch = flexmock()
+    db_batch.should_receive("batch_put_entity").and_return(None)
+    db_batch.should_receive("range_query").replace_with(range_query)
+    db_batch.should_receive("batch_get_entity").replace_with(batch_get_entity)
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+
+    query = datastore_pb.Query()
+    query.set_app("test")
+    query.set_name_space("blah")
+    query.set_kind("test_kind")
+    query.set_count(2)
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+    self.assertEquals(["a", "c"], [result.key().path().element(0).name()
+                                   for result in query_result.result_list()])
+    self.assertTrue(query_result.more_results())
+
+    next_request = datastore_pb.NextRequest()
+    next_request.mutable_cursor().CopyFrom(query_result.cursor())
+    next_request.set_count(2)
+    next_result = datastore_pb.QueryResult()
+    dd._dynamic_next("test", next_request, next_result)
+    self.assertEquals(["d"], [result.key().path().element(0).name()
+                              for result in next_result.result_list()])
+    self.assertFalse(next_result.more_results())
+
+  def test_index_only_queries(self):
+    entities = [self.get_new_entity_proto("test", "test_kind", name,
+                                          "prop1name", "prop1val", ns="blah")
+                for name in ["bob", "nancy"]]
+    id_entity = self.get_new_entity_proto("test", "test_kind", "x",
+                                          "prop1name", "prop1val", ns="blah")
+    id_entity.key().path().element(0).clear_name()
+    id_entity.key().path().element(0).set_id(5)
+    entities.append(id_entity)
+
+    db_batch = flexmock()
+    db_batch.should_receive("batch_put_entity").and_return(None)
+    db_batch.should_receive("batch_get_entity").never()
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+    asc_rows, _ = dd.get_index_rows(entities)
+
+    def range_query(table, schema, start, end, limit, offset=0,
+                    start_inclusive=True, end_inclusive=True):
+      keys = sorted(key for key in asc_rows if start <= key <= end)
+      return [{key: {'reference': asc_rows[key]}} for key in keys[:limit]]
+    db_batch.should_receive("range_query").replace_with(range_query)
+
+    query = datastore_pb.Query()
+    query.set_app("test")
+    query.set_name_space("blah")
+    query.set_kind("test_kind")
+    query.set_keys_only(True)
+    query_filter = query.add_filter()
+    query_filter.set_op(datastore_pb.Query_Filter.EQUAL)
+    query_filter.add_property().CopyFrom(entities[0].property(0))
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+    self.assertEquals(query_result.result_size(), 3)
+    keys = [result.key().Encode() for result in query_result.result_list()]
+    self.assertEquals(sorted(keys), sorted(e.key().Encode() for e in entities))
+    for result in query_result.result_list():
+      self.assertEquals(result.property_size(), 0)
+
+    query.set_keys_only(False)
+    query.add_property_name("prop1name")
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+    self.assertEquals(query_result.result_size(), 3)
+    for result in query_result.result_list():
+      self.assertEquals(result.property_size(), 1)
+      self.assertEquals(result.property(0).value().stringvalue(), "prop1val")
+      self.assertEquals(result.property(0).meaning(),
+                        entity_pb.Property.INDEX_VALUE)
+
+  def test_count_query(self):
+    entities = [self.get_new_entity_proto("test", "test_kind", str(index),
+                                          "prop1name", "prop1val", ns="blah")
+                for index in range(5)]
+    db_batch = flexmock()
+    db_batch.should_receive("batch_put_entity").and_return(None)
+    db_batch.should_receive("batch_get_entity").never()
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+    asc_rows, _ = dd.get_index_rows(entities)
+    kind_keys = sorted(dd.get_kind_key("test/blah", e.key().path())
+                       for e in entities)
+
+    def range_query(table, schema, start, end, limit, offset=0,
+                    start_inclusive=True, end_inclusive=True, keys_only=False):
+      keys = kind_keys
+      if table == ASC_PROPERTY_TABLE:
+        keys = sorted(asc_rows)
+      keys = [key for key in keys if key <= end and
+              (key > start or (start_inclusive and key == start))][:limit]
+      if keys_only:
+        return keys
+      return [{key: {'reference': 'ref'}} for key in keys]
+    db_batch.should_receive("range_query").replace_with(range_query)
+
+    query = datastore_pb.Query()
+    query.set_app("test")
+    query.set_name_space("blah")
+    query.set_kind("test_kind")
+    count = api_base_pb.Integer64Proto()
+    dd._dynamic_count(query, count)
+    self.assertEquals(count.value(), 5)
+
+    query.set_offset(1)
+    query.set_limit(3)
+    dd._dynamic_count(query, count)
+    self.assertEquals(count.value(), 3)
+
+    query.clear_limit()
+    query_filter = query.add_filter()
+    query_filter.set_op(datastore_pb.Query_Filter.EQUAL)
+    query_filter.add_property().CopyFrom(entities[0].property(0))
+    dd._dynamic_count(query, count)
+    self.assertEquals(count.value(), 4)
+
+  def test_count_after_cursor(self):
+    db_batch, _, _, _ = self.get_table_fake()
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+    ranks = {"a": 5, "b": 9, "c": 7, "d": 1}
+    dd.put_entities("test", [self.get_composite_entity(name, rank, "red")
+                             for name, rank in ranks.items()],
+                    dict(("test/blah/test_kind:{0}!".format(name), 1)
+                         for name in ranks))
+
+    query = datastore_pb.Query()
+    query.set_app("test")
+    query.set_name_space("blah")
+    query.set_kind("test_kind")
+    query.set_count(1)
+    for with_order in [False, True]:
+      if with_order:
+        order = query.add_order()
+        order.set_property("rank")
+        order.set_direction(datastore_pb.Query_Order.DESCENDING)
+      query_result = datastore_pb.QueryResult()
+      dd._dynamic_run_query(query, query_result)
+
+      count_query = datastore_pb.Query()
+      count_query.CopyFrom(query)
+      count_query.mutable_compiled_cursor().CopyFrom(
+        query_result.compiled_cursor())
+      count = api_base_pb.Integer64Proto()
+      dd._dynamic_count(count_query, count)
+      self.assertEquals(count.value(), 3)
+
+  def get_table_fake(self):
+    tables = {}
+    scanned = []
+    fetched = []
+
+    def batch_put_entity(table, keys, schema, values):
+      for key in keys:
+        tables.setdefault(table, {})[str(key)] = dict(values[key])
+
+    def batch_get_entity(table, keys, schema):
+      fetched.extend(keys)
+      return dict((key, dict(tables.get(table, {}).get(str(key), {})))
+                  for key in keys)
+
+    def batch_delete(table, keys, schema):
+      for key in keys:
+        tables.get(table, {}).pop(str(key), None)
+
+    def range_query(table, schema, start, end, limit, offset=0,
+                    start_inclusive=True, end_inclusive=True, keys_only=False):
+      scanned.append(table)
+      rows = tables.get(table, {})
+      keys = [key for key in sorted(rows) if
+              (key > start or (start_inclusive and key == start)) and
+              (key < end or (end_inclusive and key == end))][:limit]
+      if keys_only:
+        return keys
+      return [{key: rows[key]} for key in keys]
+
+    db_batch = flexmock()
+    db_batch.should_receive("batch_put_entity").replace_with(batch_put_entity)
+    db_batch.should_receive("batch_get_entity").replace_with(batch_get_entity)
+    db_batch.should_receive("batch_delete").replace_with(batch_delete)
+    db_batch.should_receive("range_query").replace_with(range_query)
+    return db_batch, tables, scanned, fetched
+
+  def get_composite_entity(self, name, rank, tag):
+    entity = self.get_new_entity_proto("test", "test_kind", name, "tag", tag,
+                                       ns="blah")
+    prop = entity.add_property()
+    prop.set_name("rank")
+    prop.set_multiple(0)
+    prop.mutable_value().set_int64value(rank)
+    return entity
+
+  def get_composite_query(self, tag):
+    query = datastore_pb.Query()
+    query.set_app("test")
+    query.set_name_space("blah")
+    query.set_kind("test_kind")
+    query_filter = query.add_filter()
+    query_filter.set_op(datastore_pb.Query_Filter.EQUAL)
+    prop = query_filter.add_property()
+    prop.set_name("tag")
+    prop.set_multiple(0)
+    prop.mutable_value().set_stringvalue(tag)
+    order = query.add_order()
+    order.set_property("rank")
+    order.set_direction(datastore_pb.Query_Order.DESCENDING)
+    return query
+
+  def test_composite_index_query(self):
+    db_batch, tables, scanned, _ = self.get_table_fake()
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+    index = entity_pb.CompositeIndex()
+    index.set_app_id("test")
+    index.set_id(1)
+    index.set_state(entity_pb.CompositeIndex.READ_WRITE)
+    definition = index.mutable_definition()
+    definition.set_entity_type("test_kind")
+    definition.set_ancestor(False)
+    for name, direction in [("tag", entity_pb.Index_Property.ASCENDING),
+                            ("rank", entity_pb.Index_Property.DESCENDING)]:
+      prop = definition.add_property()
+      prop.set_name(name)
+      prop.set_direction(direction)
+    dd.put_composite_index(index)
+
+    entities = [self.get_composite_entity("a", 5, "red"),
+                self.get_composite_entity("b", 9, "red"),
+                self.get_composite_entity("c", 7, "blue"),
+                self.get_composite_entity("d", -1, "red")]
+    txn_hash = dict(("test/blah/test_kind:{0}!".format(name), 1)
+                    for name in "abcd")
+    dd.put_entities("test", entities, txn_hash)
+    self.assertEquals(len(tables[COMPOSITE_TABLE]), 4)
+
+    # The matching rows are read with one scan, in the index's order.
+    query = self.get_composite_query("red")
+    query.set_count(2)
+    self.assertTrue(dd.is_streamable_query(query))
+    query_result = datastore_pb.QueryResult()
+    del scanned[:]
+    dd._dynamic_run_query(query, query_result)
+    self.assertEquals(scanned, [COMPOSITE_TABLE])
+    self.assertEquals([e.key().path().element(0).name() for e in
+                       query_result.result_list()], ["b", "a"])
+    self.assertTrue(query_result.more_results())
+    next_request = datastore_pb.NextRequest()
+    next_request.mutable_cursor().CopyFrom(query_result.cursor())
+    next_result = datastore_pb.QueryResult()
+    dd._dynamic_next("test", next_request, next_result)
+    self.assertEquals([e.key().path().element(0).name() for e in
+                       next_result.result_list()], ["d"])
+
+    # Inequality filters bound the range on the property after the
+    # equality filters.
+    query = self.get_composite_query("red")
+    query_filter = query.add_filter()
+    query_filter.set_op(datastore_pb.Query_Filter.LESS_THAN)
+    prop = query_filter.add_property()
+    prop.set_name("rank")
+    prop.set_multiple(0)
+    prop.mutable_value().set_int64value(9)
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+    self.assertEquals([e.key().path().element(0).name() for e in
+                       query_result.result_list()], ["a", "d"])
+
+    # Changing an indexed value moves the entity's row.
+    dd.zookeeper.should_receive("get_valid_transaction_id").and_return(1)
+    dd.zookeeper.should_receive("register_updated_key").and_return(True)
+    dd.put_entities("test", [self.get_composite_entity("b", 9, "blue")],
+                    {"test/blah/test_kind:b!": 2})
+    self.assertEquals(len(tables[COMPOSITE_TABLE]), 4)
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(self.get_composite_query("blue"), query_result)
+    self.assertEquals([e.key().path().element(0).name() for e in
+                       query_result.result_list()], ["b", "c"])
+
+  def test_composite_index_lifecycle(self):
+    db_batch, tables, _, _ = self.get_table_fake()
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+    dd.put_entities("test", [self.get_composite_entity("a", 5, "red"),
+                             self.get_composite_entity("b", 9, "red")],
+                    {"test/blah/test_kind:a!": 1, "test/blah/test_kind:b!": 1})
+    self.assertFalse(tables.get(COMPOSITE_TABLE))
+
+    index = entity_pb.CompositeIndex()
+    index.set_app_id("test")
+    index.set_id(0)
+    index.set_state(entity_pb.CompositeIndex.WRITE_ONLY)
+    index.mutable_definition().CopyFrom(datastore_index.IndexDefinitionToProto(
+      "test", datastore_index.ParseIndexDefinitions(
+        "indexes:\n- kind: test_kind\n  properties:\n  - name: tag\n"
+        "  - name: rank\n    direction: desc\n").indexes[0]).definition())
+    jobs = []
+    flexmock(dd).should_receive("start_index_job").replace_with(
+      lambda function, job_index: jobs.append(job_index))
+    index_id = dd.create_composite_index("test", index)
+    self.assertEquals(dd.create_composite_index("test", index), index_id)
+    self.assertEquals(len(jobs), 1)
+    self.assertEquals(dd.get_composite_indexes("test")[0].state(),
+                      entity_pb.CompositeIndex.WRITE_ONLY)
+
+    # Queries are only served from the index once it is backfilled.
+    self.assertFalse(dd.is_streamable_query(self.get_composite_query("red")))
+    dd.backfill_composite_index(jobs[0], wait=0)
+    self.assertEquals(len(tables[COMPOSITE_TABLE]), 2)
+    self.assertEquals(dd.get_composite_indexes("test")[0].state(),
+                      entity_pb.CompositeIndex.READ_WRITE)
+    self.assertTrue(dd.is_streamable_query(self.get_composite_query("red")))
+
+    dd.delete_composite_index("test", jobs[0])
+    self.assertEquals(dd.get_composite_indexes("test")[0].state(),
+                      entity_pb.CompositeIndex.DELETED)
+    dd.remove_composite_index(jobs[1], wait=0)
+    self.assertFalse(tables[COMPOSITE_TABLE])
+    self.assertEquals(dd.get_composite_indexes("test"), [])
+    self.assertRaises(apiproxy_errors.ApplicationError,
+                      dd.update_composite_index, "test", jobs[0])
+
+  def test_merge_join_query(self):
+    db_batch, tables, scanned, fetched = self.get_table_fake()
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+    entities = [self.get_composite_entity(str(index), index % 3, 
+                                          ["red", "blue"][index % 2])
+                for index in range(12)]
+    # A second value for a property is matched by its own filter.
+    prop = entities[7].add_property()
+    prop.set_name("tag")
+    prop.set_multiple(1)
+    prop.mutable_value().set_stringvalue("green")
+    dd.put_entities("test", entities, dict(
+      ("test/blah/test_kind:{0}!".format(index), 1) for index in range(12)))
+
+    query = self.get_composite_query("blue")
+    query.clear_order()
+    query_filter = query.add_filter()
+    query_filter.set_op(datastore_pb.Query_Filter.EQUAL)
+    prop = query_filter.add_property()
+    prop.set_name("rank")
+    prop.set_multiple(0)
+    prop.mutable_value().set_int64value(1)
+    query.set_count(2)
+    self.assertTrue(dd.is_streamable_query(query))
+    del scanned[:]
+    del fetched[:]
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+    self.assertEquals([e.key().path().element(0).name() for e in
+                       query_result.result_list()], ["1", "7"])
+    self.assertEquals(set(scanned), set([ASC_PROPERTY_TABLE]))
+    self.assertEquals(len(fetched), 2)
+
+    next_request = datastore_pb.NextRequest()
+    next_request.mutable_cursor().CopyFrom(query_result.cursor())
+    next_result = datastore_pb.QueryResult()
+    dd._dynamic_next("test", next_request, next_result)
+    self.assertEquals([e.key().path().element(0).name() for e in
+                       next_result.result_list()], [])
+
+    query = self.get_composite_query("blue")
+    query.clear_order()
+    query_filter = query.add_filter()
+    query_filter.set_op(datastore_pb.Query_Filter.EQUAL)
+    prop = query_filter.add_property()
+    prop.set_name("tag")
+    prop.set_multiple(0)
+    prop.mutable_value().set_stringvalue("green")
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+    self.assertEquals([e.key().path().element(0).name() for e in
+                       query_result.result_list()], ["7"])
+
+  def test_keys_only_cursor_after_delete(self):
+    db_batch, tables, _, _ = self.get_table_fake()
+    dd = DatastoreDistributed(db_batch, self.get_zookeeper())
+    ranks = {"a": 5, "b": 9, "c": 7, "d": 1}
+    dd.put_entities("test", [self.get_composite_entity(name, rank, "red")
+                             for name, rank in ranks.items()],
+                    dict(("test/blah/test_kind:{0}!".format(name), 1)
+                         for name in ranks))
+
+    query = datastore_pb.Query()
+    query.set_app("test")
+    query.set_name_space("blah")
+    query.set_kind("test_kind")
+    query.set_keys_only(True)
+    order = query.add_order()
+    order.set_property("rank")
+    order.set_direction(datastore_pb.Query_Order.DESCENDING)
+    query.set_count(2)
+    query_result = datastore_pb.QueryResult()
+    dd._dynamic_run_query(query, query_result)
+    self.assertEquals([e.key().path().element(0).name() for e in
+                       query_result.result_list()], ["b", "c"])
+    for result in query_result.result_list():
+      self.assertEquals(result.property_size(), 0)
+
+    # The cursor keeps its position once the last result is deleted.
+    del tables[APP_ENTITY_TABLE]["test/blah/test_kind:c!"]
+    next_request = datastore_pb.NextRequest()
+    next_request.mutable_cursor().CopyFrom(query_result.cursor())
+    next_result = datastore_pb.QueryResult()
+    dd._dynamic_next("test", next_request, next_result)
+    self.assertEquals([e.key().path().element(0).name() for e in
+                       next_result.result_list()], ["a", "d"])
+
+  def test_query_cursor_registry(self):
+    query = datastore_pb.Query()
+    query.set_app("test")
+    registry = QueryCursorRegistry()
+    cursor_id = registry.add(QueryCursor(query))
+    self.assertEquals(registry.get("test", cursor_id).query, query)
+    self.assertEquals(registry.get("other", cursor_id), None)
+    registry.ttl = -1
+    self.assertEquals(registry.evict_idle(), 1)
+    self.assertEquals(registry.get("test", cursor_id), None)
+
   def test_dynamic_delete(self):
     entity_proto1 = self.get_new_entity_proto("test", "test_kind", "nancy", "prop1name", 
                                               "prop2val", ns="blah")
@@ -567,8 +1267,13 @@ class TestDatastoreServer(unittest.TestCase):
     zookeeper.should_receive("get_valid_transaction_id").and_return(1)
     zookeeper.should_receive("register_updated_key").and_return(1)
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("release_locks").and_return(True)
     db_batch = flexmock()
+    db_batch.should_receive("range_query").and_return([])
     db_batch.should_receive("batch_delete").and_return(None)
     db_batch.should_receive("batch_put_entity").and_return(None)
     db_batch.should_receive("batch_get_entity").and_return(
@@ -600,7 +1305,11 @@ class TestDatastoreServer(unittest.TestCase):
     zookeeper.should_receive("get_valid_transaction_id").and_return(1)
     zookeeper.should_receive("register_updated_key").and_return(1)
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("release_locks").and_return(True)
     db_batch = flexmock()
     db_batch.should_receive("batch_delete").and_return(None)
     db_batch.should_receive("batch_put_entity").and_return(None)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # Programmer: Navraj Chohan <nlake44@gmail.com>
 
+import json
 import os
 import sys
 import unittest
@@ -34,6 +35,27 @@ class FakeDatastore():
   def batch_delete(self, table, row_keys):
     raise dbconstants.AppScaleDBConnectionError("Bad connection")
 
+class FakeKeyDatastore():
+  """ Serves keys only range queries over a sorted list of keys. """
+  def __init__(self, keys):
+    self.keys = sorted(keys)
+  def range_query(self, table, schema, start_key, end_key, limit,
+    keys_only=False):
+    return [key for key in self.keys if start_key <= key <= end_key][:limit]
+
+class FakeJournal():
+  """ Serves range queries and deletes over a dict of journal rows. """
+  def __init__(self, rows):
+    self.rows = rows
+    self.deleted = []
+  def range_query(self, table, schema, start_key, end_key, limit,
+    start_inclusive=True):
+    return [{key: self.rows[key]} for key in sorted(self.rows)
+            if (start_key <= key if start_inclusive else start_key < key)
+            and key <= end_key][:limit]
+  def batch_delete(self, table, row_keys, column_names=[]):
+    self.deleted.extend(row_keys)
+
 class FakeDistributedDB():
   def __init__(self):
     pass
@@ -97,16 +119,117 @@ class TestGroomer(unittest.TestCase):
       get_prefix_from_entity_key("hi//some/other/stuff"))
 
   def test_run_groomer(self):
+    state = groomer.DatastoreGroomer.new_range_state("", "\xff")
+    state['done'] = True
     zookeeper = flexmock()
+    zookeeper.should_receive("get_groomer_ranges").and_return(["0000000000"])
+    zookeeper.should_receive("get_groomer_range").and_return(
+      json.dumps(state))
+    zookeeper.should_receive("claim_groomer_range").and_return(False)
+    zookeeper.should_receive("get_datastore_groomer_lock").and_return(True)
+    zookeeper.should_receive("release_datastore_groomer_lock").once()
     dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
     dsg = flexmock(dsg)
-    dsg.should_receive("get_entity_batch").and_return([])
-    dsg.should_receive("process_entity")
     dsg.should_receive("update_statistics").and_raise(Exception)
     ds_factory = flexmock(appscale_datastore_batch.DatastoreFactory)
     ds_factory.should_receive("getDatastore").and_return(FakeDatastore())
     self.assertRaises(Exception, dsg.run_groomer)
 
+  def test_get_split_points(self):
+    zookeeper = flexmock()
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg.db_access = FakeKeyDatastore(["a//A:1!", "a//A:2!B:1!", "a//B:1!",
+      "a/ns/A:1!", "b//A:1!"])
+    self.assertEquals(["", "a//B:", "a/ns/A:", "b//A:"],
+      dsg.get_split_points())
+
+    dsg.MAX_RANGES = 2
+    self.assertEquals(["", "a/ns/A:"], dsg.get_split_points())
+
+  def test_groom_range(self):
+    state = groomer.DatastoreGroomer.new_range_state("a", "c")
+    state['last_key'] = "YQ=="
+    state['stats'] = {'app_id': {'kind': {'size': 3, 'number': 1}}}
+    checkpoints = []
+    zookeeper = flexmock()
+    zookeeper.should_receive("get_groomer_range").and_return(
+      json.dumps(state))
+    zookeeper.should_receive("update_groomer_range").replace_with(
+      lambda name, value: checkpoints.append(json.loads(value)))
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg = flexmock(dsg)
+    # Grooming resumes after the checkpointed key.
+    dsg.should_receive("get_entity_batch").with_args("a", "c", False)\
+      .and_return([{'b': {}}]).once()
+    dsg.should_receive("get_entity_batch").with_args("b", "c", False)\
+      .and_return([]).once()
+    dsg.should_receive("process_entity").once()
+    dsg.should_receive("compact_journal").with_args([{'b': {}}], set())\
+      .and_return(False).once()
+    dsg.groom_range("0000000000")
+    self.assertEquals(2, len(checkpoints))
+    self.assertEquals("Yg==", checkpoints[0]['last_key'])
+    self.assertEquals(False, checkpoints[0]['done'])
+    self.assertEquals(True, checkpoints[0]['failed'])
+    self.assertEquals(True, checkpoints[1]['done'])
+    self.assertEquals(1, checkpoints[1]['entities'])
+    self.assertEquals({'app_id': {'kind': {'size': 3, 'number': 1}}},
+      checkpoints[1]['stats'])
+
+  def test_finish_pass(self):
+    states = []
+    for size in [1, 2]:
+      state = groomer.DatastoreGroomer.new_range_state("", "")
+      state['stats'] = {'app_id': {'kind': {'size': size, 'number': 1}}}
+      state['deletes'] = 1
+      states.append(state)
+    zookeeper = flexmock()
+    zookeeper.should_receive("get_datastore_groomer_lock").and_return(True)
+    zookeeper.should_receive("release_datastore_groomer_lock")
+    zookeeper.should_receive("get_groomer_ranges").and_return(["0", "1"])
+    zookeeper.should_receive("get_groomer_range").with_args("0")\
+      .and_return(json.dumps(states[0]))
+    zookeeper.should_receive("get_groomer_range").with_args("1")\
+      .and_return(json.dumps(states[1]))
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg = flexmock(dsg)
+    dsg.should_receive("update_statistics").and_return(True)
+    dsg.should_receive("txn_blacklist_cleanup").and_return(True)
+
+    # The pass is not over until every range is done.
+    zookeeper.should_receive("delete_groomer_ranges").never()
+    self.assertEquals(False, dsg.finish_pass())
+
+    for state in states:
+      state['done'] = True
+    zookeeper.should_receive("get_groomer_range").with_args("0")\
+      .and_return(json.dumps(states[0]))
+    zookeeper.should_receive("get_groomer_range").with_args("1")\
+      .and_return(json.dumps(states[1]))
+    zookeeper.should_receive("delete_groomer_ranges").once()
+    self.assertEquals(True, dsg.finish_pass())
+    self.assertEquals({'app_id': {'kind': {'size': 3, 'number': 2}}},
+      dsg.stats)
+    self.assertEquals(2, dsg.num_deletes)
+
+  def test_finish_pass_after_failed_compaction(self):
+    state = groomer.DatastoreGroomer.new_range_state("", "")
+    state['done'] = True
+    state['failed'] = True
+    zookeeper = flexmock()
+    zookeeper.should_receive("get_datastore_groomer_lock").and_return(True)
+    zookeeper.should_receive("release_datastore_groomer_lock")
+    zookeeper.should_receive("get_groomer_ranges").and_return(["0"])
+    zookeeper.should_receive("get_groomer_range").with_args("0")\
+      .and_return(json.dumps(state))
+    zookeeper.should_receive("delete_groomer_ranges").once()
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg = flexmock(dsg)
+    dsg.should_receive("update_statistics").and_return(True)
+    # Blacklisted IDs are kept until a pass records all of their references.
+    dsg.should_receive("txn_blacklist_cleanup").never()
+    self.assertEquals(True, dsg.finish_pass())
+
   def test_process_entity(self):
     zookeeper = flexmock()
     flexmock(entity_pb).should_receive('EntityProto').and_return(FakeEntity())
@@ -142,15 +265,81 @@ class TestGroomer(unittest.TestCase):
     dsg.initialize_kind('app_id', 'kind')
     self.assertEquals(dsg.stats, {'app_id': {'kind': {'size': 0, 'number': 0}}}) 
  
+  def test_compact_journal(self):
+    zookeeper = flexmock()
+    # Version 3 of the first entity is blacklisted, and 2 is valid.
+    zookeeper.should_receive("get_valid_transaction_ids").and_return(
+      {'app//A:1!': 2, 'app//A:2!': 5, 'app//A:3!': 1, 'app//A:4!': 7})
+    # The fourth entity was written by a transaction still in progress, which
+    # may roll it back to version 6.
+    zookeeper.should_receive("get_open_transactions").and_return(set([7]))
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg.BATCH_SIZE = 2
+    dsg.db_access = FakeJournal(dict((key, {'Encoded_Entity': 'e'}) for key in
+      ['app//A:1!/0000000001', 'app//A:1!/0000000002',
+       'app//A:1!/0000000003', 'app//A:1!B:1!/0000000001',
+       'app//A:2!/0000000004', 'app//A:2!/0000000005',
+       'app//A:2!/0000000006', 'app//A:3!/0000000001',
+       'app//A:4!/0000000006', 'app//A:4!/0000000007']))
+    entities = [{'app//A:1!': {'entity': 'e', 'txnID': '3'}},
+                {'app//A:2!': {'entity': 'e', 'txnID': '5'}},
+                {'app//A:3!': {'entity': 'e', 'txnID': '1'}},
+                {'app//A:4!': {'entity': 'e', 'txnID': '7'}}]
+    self.assertEquals(True, dsg.compact_journal(entities, set(['app//A:3!'])))
+    self.assertEquals(['app//A:1!/0000000001', 'app//A:2!/0000000004',
+      'app//A:3!/0000000001'], dsg.db_access.deleted)
+    self.assertEquals(3, dsg.journal_deletes)
+    self.assertEquals(3 * len('app//A:1!/0000000001e'), dsg.journal_bytes)
+    self.assertEquals({'app': set(['3'])}, dsg.blacklisted)
+
   def test_txn_blacklist_cleanup(self):
-    #TODO 
-    pass
+    zookeeper = flexmock()
+    zookeeper.should_receive("get_blacklist_times").and_return(
+      {'1': 10.0, '2': 10.0, '3': 30.0})
+    # Only IDs which are unreferenced and older than the pass are removed.
+    zookeeper.should_receive("delete_blacklist_entries").with_args('app',
+      ['1']).and_return(1).once()
+    zookeeper.should_receive("get_valid_version_keys").and_return(
+      ['app//A:1!', 'app//A:2!'])
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg = flexmock(dsg)
+    dsg.should_receive("prune_valid_version").and_return(True).twice()
+    self.assertEquals(True, dsg.txn_blacklist_cleanup({'app': set(['2'])},
+      20.0))
+    self.assertEquals(1, dsg.blacklist_deletes)
+
+  def test_prune_valid_version(self):
+    zookeeper = flexmock()
+    zookeeper.should_receive("get_transaction_id").and_return(1)
+    zookeeper.should_receive("acquire_lock").with_args('app', 1, 'app//A:1!')\
+      .and_return(True)
+    zookeeper.should_receive("release_lock")
+    zookeeper.should_receive("is_blacklisted").with_args('app', '3')\
+      .and_return(True).and_return(False)
+    zookeeper.should_receive("delete_valid_version").with_args('app',
+      'app//A:1!B:1!').once()
+    dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
+    dsg = flexmock(dsg)
+    dsg.should_receive("get_root_key_from_entity_key").and_return("app//A:1!")
+    dsg.db_access = flexmock()
+    dsg.db_access.should_receive("batch_get_entity").and_return(
+      {'app//A:1!B:1!': {'entity': 'e', 'txnID': '3'}})
+
+    # The entity is still stored at a blacklisted version.
+    self.assertEquals(True, dsg.prune_valid_version('app', 'app//A:1!B:1!'))
+    self.assertEquals(0, dsg.validlist_deletes)
+    self.assertEquals(True, dsg.prune_valid_version('app', 'app//A:1!B:1!'))
+    self.assertEquals(1, dsg.validlist_deletes)
   
   def test_process_tombstone(self):
     zookeeper = flexmock()
     zookeeper.should_receive("get_transaction_id").and_return(1)
     zookeeper.should_receive("acquire_lock").and_return(True)
+    zookeeper.should_receive("acquire_locks").and_return(True)
+    zookeeper.should_receive("get_transaction_ids").replace_with(
+      lambda app_id, count: range(1, count + 1))
     zookeeper.should_receive("release_lock").and_return(True)
+    zookeeper.should_receive("release_locks").and_return(True)
     zookeeper.should_receive("is_blacklisted").and_return(False)
     zookeeper.should_receive("notify_failed_transaction").and_return(True)
 
@@ -161,9 +350,9 @@ class TestGroomer(unittest.TestCase):
     dsg = groomer.DatastoreGroomer(zookeeper, "cassandra", "localhost:8888")
     dsg = flexmock(dsg)
     dsg.should_receive("hard_delete_row").and_return(True)
-    flexmock(groomer.DatastoreGroomer).should_receive(
+    dsg.should_receive(
       "get_root_key_from_entity_key").and_return("key")
-    flexmock(groomer.DatastoreGroomer).should_receive(
+    dsg.should_receive(
       "get_prefix_from_entity_key").and_return("app/ns")
     dsg.db_access = FakeDatastore()
 
@@ -33,6 +33,28 @@ class FakeHBaseClient():
     return []
   def scannerClose(self, scanner):
     return
+
+class FakeScannerClient(FakeHBaseClient):
+  """ Fake hbase client which serves rows from a scanner """
+  def __init__(self, rows):
+    self.rows = rows
+    self.batch_sizes = []
+    self.closed = []
+  def scannerOpenWithStop(self, table_name, start_key, end_key, col_names):
+    return "scanner"
+  def scannerGetList(self, scanner, rowcount):
+    self.batch_sizes.append(rowcount)
+    batch = self.rows[:rowcount]
+    self.rows = self.rows[rowcount:]
+    return batch
+  def scannerClose(self, scanner):
+    self.closed.append(scanner)
+
+class FakeRow():
+  """ Fake hbase row result """
+  def __init__(self, key, value):
+    self.row = key
+    self.columns = {"c:": flexmock(value=value)}
  
 class TestHBase(unittest.TestCase):
   def testConstructor(self):
@@ -108,5 +130,43 @@ class TestHBase(unittest.TestCase):
     db = hbase_interface.DatastoreProxy()
     assert [] == db.range_query("table", [], "start", "end", 0)
 
+  def testRangeQueryPages(self):
+    flexmock(hbase_interface, SCANNER_BATCH_SIZE=2)
+    rows = [FakeRow("a" + str(index), str(index)) for index in range(5)]
+    client = FakeScannerClient(rows)
+    flexmock(hbase_interface.DatastoreProxy).should_receive("create_connection") \
+        .and_return(client)
+
+    db = hbase_interface.DatastoreProxy()
+    results = db.range_query("table", ["c"], "a", "b", 4,
+                             end_inclusive=False)
+    assert [{"a0": {"c": "0"}}, {"a1": {"c": "1"}}, {"a2": {"c": "2"}},
+            {"a3": {"c": "3"}}] == results
+    assert [2, 2, 1] == client.batch_sizes
+    assert ["scanner"] == client.closed
+
+  def testRangeQueryKeysOnly(self):
+    rows = [FakeRow("a" + str(index), str(index)) for index in range(3)]
+    flexmock(hbase_interface.DatastoreProxy).should_receive("create_connection") \
+        .and_return(FakeScannerClient(rows))
+
+    db = hbase_interface.DatastoreProxy()
+    assert ["a1", "a2"] == db.range_query("table", ["c"], "a0", "b", 2,
+                                          start_inclusive=False,
+                                          end_inclusive=False, keys_only=True)
+
+  def testReconnectsOnTransportError(self):
+    broken = FakeHBaseClient()
+    flexmock(broken).should_receive("mutateRows") \
+        .and_raise(hbase_interface.TTransport.TTransportException)
+    broken._oprot = flexmock(trans=flexmock())
+    flexmock(broken._oprot.trans).should_receive("close").once()
+    flexmock(hbase_interface.DatastoreProxy).should_receive("create_connection") \
+        .and_return(broken) \
+        .and_return(FakeHBaseClient())
+
+    db = hbase_interface.DatastoreProxy()
+    assert None == db.batch_put_entity('table', [], [], {})
+
 if __name__ == "__main__":
   unittest.main()    
@@ -30,6 +30,14 @@ class FakeHypertableClient():
     return None
   def mutator_close(self, mutator):
     return None
+  def scanner_open(self, ns, table_name, scan_spec):
+    return None
+  def scanner_get_cells(self, scanner):
+    return []
+  def scanner_close(self, scanner):
+    return None
+  def close(self):
+    return None
  
 class TestHypertable(unittest.TestCase):
   def testConstructor(self):
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from dbconstants import *
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../sqlite/"))
+import sqlite_interface
+
+class TestSQLite(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.db = sqlite_interface.DatastoreProxy(
+      os.path.join(self.directory, "appscale.db"))
+    keys = ["a\x00", "a\x01", "b", "b\x00c", "c"]
+    self.db.batch_put_entity(APP_ENTITY_TABLE, keys, ["entity", "txnID"],
+      dict((key, {"entity": key + "\xff", "txnID": "1"}) for key in keys))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testConstructor(self):
+    db = sqlite_interface.DatastoreProxy(
+      os.path.join(self.directory, "new", "appscale.db"))
+    for table_name in INITIAL_TABLES:
+      assert [] == db.range_query(table_name, [], "", "\xff", 10)
+
+  def testGet(self):
+    assert {"a\x00": {"entity": "a\x00\xff"}, "d": {}} == \
+      self.db.batch_get_entity(APP_ENTITY_TABLE, ["a\x00", "d"], ["entity"])
+    assert {} == self.db.batch_get_entity(APP_ENTITY_TABLE, [], ["entity"])
+
+  def testPutMergesColumns(self):
+    self.db.batch_put_entity(APP_ENTITY_TABLE, ["b"], ["txnID"],
+      {"b": {"txnID": "2"}})
+    assert {"b": {"entity": "b\xff", "txnID": "2"}} == \
+      self.db.batch_get_entity(APP_ENTITY_TABLE, ["b"], ["entity", "txnID"])
+
+  def testDelete(self):
+    self.db.batch_delete(APP_ENTITY_TABLE, ["b", "c"])
+    assert ["a\x00", "a\x01", "b\x00c"] == self.db.range_query(
+      APP_ENTITY_TABLE, [], "", "\xff", 10, keys_only=True)
+
+  def testCreateAndDeleteTable(self):
+    self.db.create_table("new_table", ["column"])
+    self.db.batch_put_entity("new_table", ["a"], ["column"],
+      {"a": {"column": "1"}})
+    self.db.delete_table("new_table")
+    self.db.create_table("new_table", ["column"])
+    assert [] == self.db.range_query("new_table", ["column"], "", "\xff", 10)
+
+  def testRangeQuery(self):
+    assert [{"a\x01": {"txnID": "1"}}, {"b": {"txnID": "1"}}] == \
+      self.db.range_query(APP_ENTITY_TABLE, ["txnID"], "a\x01", "b", 10)
+    assert ["b", "b\x00c"] == self.db.range_query(APP_ENTITY_TABLE, [],
+      "a\x01", "c", 10, start_inclusive=False, end_inclusive=False,
+      keys_only=True)
+    assert ["a\x00", "a\x01"] == self.db.range_query(APP_ENTITY_TABLE, [],
+      "a", "c", 2, keys_only=True)
+    assert ["a\x01", "b"] == self.db.range_query(APP_ENTITY_TABLE, [],
+      "a", "c", 3, offset=1, keys_only=True)
+
+  def testConnectionPerThread(self):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+      self.db.batch_get_entity(APP_ENTITY_TABLE, ["c"], ["txnID"])))
+    thread.start()
+    thread.join()
+    assert [{"c": {"txnID": "1"}}] == results
+
+if __name__ == "__main__":
+  unittest.main()
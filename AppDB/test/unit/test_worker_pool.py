@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from worker_pool import FairWorkerPool
+from worker_pool import PendingResult
+from worker_pool import WorkerPoolFull
+
+
+class TestFairWorkerPool(unittest.TestCase):
+  """
+  A set of test cases for the fair worker pool.
+  """
+  def test_add_done_callback(self):
+    results = []
+    pending = PendingResult()
+    pending.add_done_callback(lambda done: results.append(done.wait()))
+    self.assertEquals(results, [])
+    pending.set_result("a")
+    self.assertEquals(results, ["a"])
+
+    # Callbacks added after the call finished run right away.
+    pending.add_done_callback(lambda done: results.append(done.wait()))
+    self.assertEquals(results, ["a", "a"])
+
+  def test_takes_turns_between_keys(self):
+    pool = FairWorkerPool(1, 10)
+    started = threading.Event()
+    release = threading.Event()
+    def block():
+      started.set()
+      release.wait()
+
+    order = []
+    first = pool.submit("busy", block)
+    started.wait()
+    pending = [pool.submit("busy", order.append, "busy1"),
+               pool.submit("busy", order.append, "busy2"),
+               pool.submit("quiet", order.append, "quiet1")]
+    release.set()
+    first.wait(5)
+    for item in pending:
+      item.wait(5)
+    self.assertEquals(order, ["busy1", "quiet1", "busy2"])
+    pool.stop()
+
+  def test_bounds_pending_calls(self):
+    pool = FairWorkerPool(1, 3, max_pending_per_key=2)
+    release = threading.Event()
+    pending = [pool.submit("app1", release.wait),
+               pool.submit("app1", release.wait)]
+    self.assertRaises(WorkerPoolFull, pool.submit, "app1", release.wait)
+    pending.append(pool.submit("app2", release.wait))
+    self.assertRaises(WorkerPoolFull, pool.submit, "app3", release.wait)
+
+    stats = pool.get_stats()
+    self.assertEquals(stats['pending'], 3)
+    self.assertEquals(stats['pending_by_key'], {"app1": 2, "app2": 1})
+    self.assertEquals(stats['rejected'], 2)
+
+    release.set()
+    for item in pending:
+      item.wait(5)
+    pool.stop()
+
+  def test_raises_call_exceptions(self):
+    pool = FairWorkerPool(2, 10)
+    pending = pool.submit("app", int, "not a number")
+    self.assertRaises(ValueError, pending.wait, 5)
+    pool.stop()
+
+
+if __name__ == "__main__":
+  unittest.main()
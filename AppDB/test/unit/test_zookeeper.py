@@ -3,12 +3,15 @@
 
 import os
 import sys
+import threading
 import time
 import unittest
+from multiprocessing.pool import ThreadPool
 
 from flexmock import flexmock
 import kazoo.client
 import kazoo.exceptions
+import kazoo.handlers.threading
 import kazoo.protocol
 import kazoo.protocol.states
 
@@ -19,6 +22,152 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
 from zkappscale import zktransaction as zk
 from zkappscale.zktransaction import ZKTransactionException
 
+class FakeTransaction():
+  """ An in-process stand-in for a kazoo TransactionRequest. """
+  def __init__(self, zookeeper):
+    self.zookeeper = zookeeper
+    self.operations = []
+
+  def create(self, path, value='', acl=None):
+    self.operations.append(lambda: self.zookeeper._create(path, value, False,
+      False))
+
+  def delete(self, path, version=-1):
+    self.operations.append(lambda: self.zookeeper._delete(path))
+
+  def commit_async(self):
+    return self.zookeeper._run(None, self._commit)
+
+  def _commit(self, _):
+    nodes = dict(self.zookeeper.nodes)
+    results = []
+    for index, operation in enumerate(self.operations):
+      try:
+        results.append(operation())
+      except kazoo.exceptions.ZookeeperError as exception:
+        self.zookeeper.nodes.clear()
+        self.zookeeper.nodes.update(nodes)
+        results = [kazoo.exceptions.RolledBackError()] * len(self.operations)
+        results[index] = exception
+        return results
+    return results
+
+
+class FakeZooKeeper():
+  """ An in-process stand-in for a KazooClient and the ZooKeeper server it
+  talks to. Calls on paths in stalled never finish, and the first failures
+  calls raise ConnectionLoss.
+  """
+  def __init__(self, nodes=None, failures=0):
+    self.handler = kazoo.handlers.threading.SequentialThreadingHandler()
+    self.nodes = nodes if nodes is not None else {'/': ''}
+    self.sequences = {}
+    self.stalled = set()
+    self.failures = failures
+    self.lock = threading.Lock()
+
+  def start(self):
+    pass
+
+  def stop(self):
+    pass
+
+  def add_listener(self, listener):
+    pass
+
+  def _run(self, path, function, *args):
+    result = self.handler.async_result()
+    if path in self.stalled:
+      return result
+    try:
+      with self.lock:
+        if self.failures:
+          self.failures -= 1
+          raise kazoo.exceptions.ConnectionLoss()
+        result.set(function(path, *args))
+    except Exception as exception:
+      result.set_exception(exception)
+    return result
+
+  @staticmethod
+  def _parent(path):
+    return path.rsplit('/', 1)[0] or '/'
+
+  def _create(self, path, value, makepath, sequence):
+    parent = self._parent(path)
+    if parent not in self.nodes:
+      if not makepath:
+        raise kazoo.exceptions.NoNodeError()
+      self._create(parent, '', True, False)
+    if sequence:
+      count = self.sequences.get(parent, 0)
+      self.sequences[parent] = count + 1
+      path = "{0}{1:010d}".format(path, count)
+    if path in self.nodes:
+      raise kazoo.exceptions.NodeExistsError()
+    self.nodes[path] = value
+    return path
+
+  def _get(self, path):
+    if path not in self.nodes:
+      raise kazoo.exceptions.NoNodeError()
+    return self.nodes[path], None
+
+  def _set(self, path, value):
+    self._get(path)
+    self.nodes[path] = value
+
+  def _children(self, path):
+    self._get(path)
+    return [node.rsplit('/', 1)[1] for node in self.nodes
+            if node != '/' and self._parent(node) == path]
+
+  def _delete(self, path):
+    if self._children(path):
+      raise kazoo.exceptions.NotEmptyError()
+    del self.nodes[path]
+
+  def create_async(self, path, value='', acl=None, ephemeral=False,
+    sequence=False, makepath=False):
+    return self._run(path, self._create, value, makepath, sequence)
+
+  def get_async(self, path, watch=None):
+    return self._run(path, self._get)
+
+  def set_async(self, path, value, version=-1):
+    return self._run(path, self._set, value)
+
+  def exists_async(self, path, watch=None):
+    return self._run(path, lambda path: path in self.nodes or None)
+
+  def get_children_async(self, path, watch=None, include_data=False):
+    return self._run(path, self._children)
+
+  def delete_async(self, path, version=-1):
+    return self._run(path, self._delete)
+
+  def transaction(self):
+    return FakeTransaction(self)
+
+  def create(self, *args, **kwargs):
+    return self.create_async(*args, **kwargs).get()
+
+  def get(self, *args, **kwargs):
+    return self.get_async(*args, **kwargs).get()
+
+  def set(self, *args, **kwargs):
+    return self.set_async(*args, **kwargs).get()
+
+  def exists(self, *args, **kwargs):
+    return self.exists_async(*args, **kwargs).get()
+
+  def get_children(self, *args, **kwargs):
+    return self.get_children_async(*args, **kwargs).get()
+
+  def delete(self, *args, **kwargs):
+    return self.delete_async(*args, **kwargs).get()
+
+
 class TestZookeeperTransaction(unittest.TestCase):
   """
   """
@@ -344,6 +493,7 @@ class TestZookeeperTransaction(unittest.TestCase):
     fake_zookeeper.should_receive('delete_async')
     fake_zookeeper.should_receive('delete')
     fake_zookeeper.should_receive('get_children').and_return(['1','2'])
+    fake_zookeeper.should_receive('add_listener')
 
     flexmock(kazoo.client)
     kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
@@ -373,6 +523,7 @@ class TestZookeeperTransaction(unittest.TestCase):
     fake_zookeeper.should_receive('create').and_return()
     fake_zookeeper.should_receive('exists').and_return(True)
     fake_zookeeper.should_receive('get_children').and_return(['1','2'])
+    fake_zookeeper.should_receive('add_listener')
 
     flexmock(kazoo.client)
     kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
@@ -380,6 +531,39 @@ class TestZookeeperTransaction(unittest.TestCase):
     transaction = zk.ZKTransaction(host="something", start_gc=False)
     self.assertEquals(True, transaction.is_blacklisted(self.appid, 1))
 
+  def test_get_valid_transaction_ids(self):
+    flexmock(zk.ZKTransaction)
+    zk.ZKTransaction.should_receive('get_blacklist_root_path').\
+      and_return("bl_root_path")
+    zk.ZKTransaction.should_receive('get_valid_transaction_path').\
+      and_return("vl_path")
+
+    # The blacklist and valid list are only read once, and then served
+    # from the local cache until a watch fires.
+    fake_zookeeper = flexmock(name='fake_zoo')
+    fake_zookeeper.should_receive('start')
+    fake_zookeeper.should_receive('add_listener').once
+    fake_zookeeper.should_receive('exists').and_return(True)
+    fake_zookeeper.should_receive('get_children').and_return(['2']).once
+    fake_zookeeper.should_receive('get').and_return(['1']).once
+
+    flexmock(kazoo.client)
+    kazoo.client.should_receive('KazooClient').and_return(fake_zookeeper)
+
+    transaction = zk.ZKTransaction(host="something", start_gc=False)
+    versions = [(1, 'key1'), (2, 'key2'), (3, 'key3')]
+    expected = {'key1': 1, 'key2': 1, 'key3': 3}
+    self.assertEquals(expected,
+      transaction.get_valid_transaction_ids(self.appid, versions))
+    self.assertEquals(expected,
+      transaction.get_valid_transaction_ids(self.appid, versions))
+    self.assertEquals(1,
+      transaction.get_valid_transaction_id(self.appid, 2, 'key2'))
+
+    # A watch firing drops the cached blacklist.
+    transaction.invalidate_caches()
+    self.assertEquals({}, transaction.blacklist_cache)
+
   def test_register_updated_key(self):
     # mock out getTransactionRootPath
     flexmock(zk.ZKTransaction)
@@ -525,6 +709,159 @@ class TestZookeeperTransaction(unittest.TestCase):
       raise kazoo.exceptions.NoNodeError()
     self.assertRaises(kazoo.exceptions.NoNodeError, transaction.run_with_timeout,
       1, 1, my_zk_exception_function, "1")
-     
+
+
+class TestZookeeperConcurrency(unittest.TestCase):
+  """ Runs ZKTransaction calls from many threads at once against an
+  in-process ZooKeeper.
+  """
+
+  # The number of threads making calls at once.
+  THREADS = 10
+
+  def setUp(self):
+    self.pool = ThreadPool(self.THREADS)
+
+  def tearDown(self):
+    self.pool.close()
+    self.pool.join()
+
+  def get_transaction(self, *fakes):
+    expectation = flexmock(kazoo.client).should_receive('KazooClient')
+    for fake in fakes:
+      expectation.and_return(fake)
+    return zk.ZKTransaction(host="something", start_gc=False)
+
+  def test_concurrent_transaction_ids(self):
+    transaction = self.get_transaction(FakeZooKeeper())
+    txids = self.pool.map(lambda _: transaction.get_transaction_id('appid'),
+      range(200))
+    self.assertEquals(len(set(txids)), 200)
+    self.assertNotIn(0, txids)
+
+  def test_concurrent_timeouts(self):
+    fake_zookeeper = FakeZooKeeper()
+    fake_zookeeper.nodes['/stuck'] = 'value'
+    fake_zookeeper.stalled.add('/stuck')
+    transaction = self.get_transaction(fake_zookeeper)
+
+    def get_stuck_node(_):
+      start = time.time()
+      try:
+        transaction.run_with_timeout(0.1, 3, transaction.handle.get, '/stuck')
+      except ZKTransactionException:
+        return time.time() - start
+
+    waits = self.pool.map(get_stuck_node, range(self.THREADS * 2))
+    self.assertNotIn(None, waits)
+    self.assertTrue(max(waits) < 1)
+
+  def test_reconnects_once(self):
+    nodes = {'/': '', '/node': 'value'}
+    broken_zookeeper = FakeZooKeeper(nodes, failures=1000)
+    working_zookeeper = FakeZooKeeper(nodes)
+    transaction = self.get_transaction(broken_zookeeper, working_zookeeper)
+    flexmock(broken_zookeeper).should_receive('stop').once()
+    flexmock(working_zookeeper).should_receive('stop').never()
+
+    values = self.pool.map(lambda _: transaction.run_with_timeout(1, 5,
+      transaction.handle.get, '/node')[0], range(self.THREADS * 5))
+    self.assertEquals(set(values), set(['value']))
+    self.assertEquals(transaction.handle, working_zookeeper)
+
+  def test_acquire_and_release_locks(self):
+    fake_zookeeper = FakeZooKeeper()
+    transaction = self.get_transaction(fake_zookeeper)
+    txids = transaction.get_transaction_ids('appid', 3)
+    self.assertEquals(len(set(txids)), 3)
+    self.assertTrue(transaction.acquire_locks('appid',
+      zip(txids, ['key1', 'key2', 'key3'])))
+    lock_path = transaction.get_lock_root_path('appid', 'key2')
+    self.assertEquals(fake_zookeeper.nodes[lock_path],
+      transaction.get_transaction_path('appid', txids[1]))
+
+    # Locks are taken all at once or not at all.
+    other_txids = transaction.get_transaction_ids('appid', 2)
+    self.assertRaises(ZKTransactionException, transaction.acquire_locks,
+      'appid', zip(other_txids, ['key0', 'key3']))
+    self.assertNotIn(transaction.get_lock_root_path('appid', 'key0'),
+      fake_zookeeper.nodes)
+
+    self.assertTrue(transaction.release_locks('appid', txids))
+    for txid, key in zip(txids, ['key1', 'key2', 'key3']):
+      self.assertNotIn(transaction.get_lock_root_path('appid', key),
+        fake_zookeeper.nodes)
+      self.assertNotIn(transaction.get_transaction_path('appid', txid),
+        fake_zookeeper.nodes)
+    self.assertTrue(transaction.acquire_locks('appid',
+      zip(other_txids, ['key0', 'key3'])))
+
+  def test_concurrent_locks(self):
+    transaction = self.get_transaction(FakeZooKeeper())
+
+    def lock_groups(index):
+      txids = transaction.get_transaction_ids('appid', 5)
+      keys = ['shared'] + ['key{0}-{1}'.format(index, group)
+        for group in range(4)]
+      try:
+        return transaction.acquire_locks('appid', zip(txids, keys))
+      except ZKTransactionException:
+        return False
+
+    self.assertEquals(self.pool.map(lock_groups, range(20)).count(True), 1)
+
+  def test_groomer_ranges(self):
+    fake_zookeeper = FakeZooKeeper()
+    transaction = self.get_transaction(fake_zookeeper)
+    self.assertEquals([], transaction.get_groomer_ranges())
+    transaction.create_groomer_ranges(['a', 'b'])
+    names = transaction.get_groomer_ranges()
+    self.assertEquals(['0000000000', '0000000001'], names)
+
+    # A range can only be held by one groomer at a time.
+    self.assertTrue(transaction.claim_groomer_range(names[1]))
+    self.assertFalse(transaction.claim_groomer_range(names[1]))
+    transaction.update_groomer_range(names[1], 'c')
+    self.assertEquals('c', transaction.get_groomer_range(names[1]))
+    transaction.release_groomer_range(names[1])
+    self.assertTrue(transaction.claim_groomer_range(names[1]))
+
+    # Another pass can not start until this one is deleted.
+    self.assertRaises(ZKTransactionException,
+      transaction.create_groomer_ranges, ['d'])
+    transaction.delete_groomer_ranges()
+    self.assertEquals([], transaction.get_groomer_ranges())
+    self.assertEquals(None, transaction.get_groomer_range(names[0]))
+    self.assertFalse(transaction.claim_groomer_range(names[0]))
+
+  def test_prune_transaction_metadata(self):
+    fake_zookeeper = FakeZooKeeper()
+    transaction = self.get_transaction(fake_zookeeper)
+    blacklist_root = transaction.get_blacklist_root_path('appid')
+    fake_zookeeper.create(blacklist_root, makepath=True)
+    fake_zookeeper.create(blacklist_root + '/5', '10.5')
+    fake_zookeeper.create(blacklist_root + '/6', 'default')
+    self.assertEquals({'5': 10.5}, transaction.get_blacklist_times('appid'))
+    self.assertTrue(transaction.is_blacklisted('appid', 5))
+    self.assertEquals(1, transaction.delete_blacklist_entries('appid',
+      ['5', '7']))
+    self.assertFalse(transaction.is_blacklisted('appid', 5))
+
+    self.assertEquals([], transaction.get_valid_version_keys('appid'))
+    fake_zookeeper.create(transaction.get_valid_transaction_path('appid',
+      'app//A:1!'), '4', makepath=True)
+    self.assertEquals(['app//A:1!'],
+      transaction.get_valid_version_keys('appid'))
+    transaction.delete_valid_version('appid', 'app//A:1!')
+    self.assertEquals([], transaction.get_valid_version_keys('appid'))
+
+  def test_get_open_transactions(self):
+    fake_zookeeper = FakeZooKeeper()
+    transaction = self.get_transaction(fake_zookeeper)
+    txids = transaction.get_transaction_ids('appid', 2)
+    fake_zookeeper.delete(transaction.get_transaction_path('appid', txids[1]))
+    self.assertEquals(set([txids[0]]), transaction.get_open_transactions(
+      'appid', txids + [txids[1] + 100]))
+
 if __name__ == "__main__":
-  unittest.main()    
+  unittest.main()
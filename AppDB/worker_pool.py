@@ -0,0 +1,341 @@
+# See LICENSE file
+"""
+A bounded pool of worker threads used to run independent datastore
+operations concurrently.
+"""
+import collections
+import Queue
+import sys
+import threading
+
+class PendingResult():
+  """ The result of a call submitted to a WorkerPool, which callers wait on.
+  """
+  def __init__(self):
+    """ Constructor. """
+    self.__done = threading.Event()
+    self.__result = None
+    self.__exc_info = None
+    self.__callbacks = []
+    self.__lock = threading.Lock()
+
+  def __finish(self):
+    """ Wakes up waiters and runs the callbacks added so far. """
+    with self.__lock:
+      self.__done.set()
+      callbacks, self.__callbacks = self.__callbacks, []
+    for callback in callbacks:
+      callback(self)
+
+  def set_result(self, result):
+    """ Stores the return value of the call and wakes up waiters.
+
+    Args:
+      result: The value returned by the call.
+    """
+    self.__result = result
+    self.__finish()
+
+  def set_exception(self, exc_info):
+    """ Stores the exception raised by the call and wakes up waiters.
+
+    Args:
+      exc_info: The tuple returned by sys.exc_info().
+    """
+    self.__exc_info = exc_info
+    self.__finish()
+
+  def add_done_callback(self, callback):
+    """ Calls a function with this PendingResult once the call finishes. If
+        it already has, the function is called right away. Otherwise it is
+        called on the thread which ran the call.
+
+    Args:
+      callback: A function taking the PendingResult.
+    """
+    with self.__lock:
+      if not self.__done.is_set():
+        self.__callbacks.append(callback)
+        return
+    callback(self)
+
+  def done(self):
+    """ Returns True if the call has finished. """
+    return self.__done.is_set()
+
+  def wait(self, timeout=None):
+    """ Waits for the call to finish.
+
+    Args:
+      timeout: The maximum number of seconds to wait, or None to wait forever.
+    Returns:
+      The value returned by the call.
+    Raises:
+      WorkerPoolTimeout: If the call did not finish in time.
+      Any exception raised by the call itself.
+    """
+    if not self.__done.wait(timeout):
+      raise WorkerPoolTimeout("Call did not finish in {0} seconds".\
+        format(timeout))
+    if self.__exc_info:
+      raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+    return self.__result
+
+class WorkerPoolTimeout(Exception):
+  """ Raised when waiting on a PendingResult takes too long. """
+  pass
+
+class WorkerPoolFull(Exception):
+  """ Raised when a call is submitted to a FairWorkerPool which already
+      holds as many calls as it allows.
+  """
+  pass
+
+class WorkerPool():
+  """ A fixed number of threads which run calls from a bounded queue. Threads
+      are started on first use. Submitting blocks once the queue is full,
+      which pushes back on callers instead of buffering without bound.
+  """
+
+  # The number of queued calls allowed per worker before submit blocks.
+  QUEUE_SIZE_PER_WORKER = 100
+
+  def __init__(self, num_workers, name="worker"):
+    """ Constructor.
+
+    Args:
+      num_workers: The number of threads running calls.
+      name: A prefix for the thread names.
+    """
+    self.num_workers = num_workers
+    self.name = name
+    self.__queue = Queue.Queue(num_workers * self.QUEUE_SIZE_PER_WORKER)
+    self.__threads = []
+    self.__lock = threading.Lock()
+
+  def __start(self):
+    """ Starts the worker threads if they are not running yet. """
+    with self.__lock:
+      if self.__threads:
+        return
+      for index in range(self.num_workers):
+        thread = threading.Thread(target=self.__run,
+          name="{0}-{1}".format(self.name, index))
+        thread.daemon = True
+        thread.start()
+        self.__threads.append(thread)
+
+  def __run(self):
+    """ The loop each worker thread runs. """
+    while True:
+      item = self.__queue.get()
+      if item is None:
+        return
+      pending, function, args, kwargs = item
+      try:
+        pending.set_result(function(*args, **kwargs))
+      except Exception:
+        pending.set_exception(sys.exc_info())
+
+  def submit(self, function, *args, **kwargs):
+    """ Queues a call to be run by a worker thread.
+
+    Args:
+      function: The function to call.
+      args: Positional arguments for the function.
+      kwargs: Keyword arguments for the function.
+    Returns:
+      A PendingResult for the call.
+    """
+    self.__start()
+    pending = PendingResult()
+    self.__queue.put((pending, function, args, kwargs))
+    return pending
+
+  def map(self, calls):
+    """ Runs a list of calls concurrently and waits for all of them. The
+        last call runs on the calling thread, so a single call never pays
+        for a thread hand-off.
+
+    Args:
+      calls: A list of (function, args) tuples.
+    Returns:
+      A list of the values returned by each call, in order.
+    Raises:
+      The first exception raised by any of the calls, once all have finished.
+    """
+    if not calls:
+      return []
+    pending = [self.submit(function, *args) for function, args in calls[:-1]]
+    last = PendingResult()
+    function, args = calls[-1]
+    try:
+      last.set_result(function(*args))
+    except Exception:
+      last.set_exception(sys.exc_info())
+    pending.append(last)
+
+    results = []
+    first_error = None
+    for item in pending:
+      try:
+        results.append(item.wait())
+      except Exception:
+        if not first_error:
+          first_error = sys.exc_info()
+        results.append(None)
+    if first_error:
+      raise first_error[0], first_error[1], first_error[2]
+    return results
+
+  def stop(self):
+    """ Stops the worker threads once the queued calls have run. """
+    with self.__lock:
+      for _ in self.__threads:
+        self.__queue.put(None)
+      self.__threads = []
+
+class FairWorkerPool():
+  """ Worker threads which take calls from a separate queue per key, one key
+      at a time in turn, so a key with many slow calls cannot hold up the
+      calls of the other keys. The number of calls queued or running is
+      bounded overall and per key. Submitting beyond a bound raises
+      WorkerPoolFull instead of blocking, since the caller may be an event
+      loop which must never block.
+  """
+
+  def __init__(self, num_workers, max_pending, max_pending_per_key=None,
+    name="fair-worker"):
+    """ Constructor.
+
+    Args:
+      num_workers: The number of threads running calls.
+      max_pending: The number of calls allowed to be queued or running.
+      max_pending_per_key: The number of calls allowed to be queued or
+        running for a single key. Defaults to max_pending.
+      name: A prefix for the thread names.
+    """
+    self.num_workers = num_workers
+    self.max_pending = max_pending
+    self.max_pending_per_key = max_pending_per_key or max_pending
+    self.name = name
+
+    # Calls waiting for a worker, keyed by the key they were submitted with.
+    self.__queues = {}
+
+    # The keys with waiting calls, in the order they get a turn.
+    self.__turns = collections.deque()
+
+    # The number of calls queued or running for each key.
+    self.__pending = collections.defaultdict(int)
+    self.__total_pending = 0
+
+    self.__stats = {'completed': 0, 'rejected': 0}
+    self.__condition = threading.Condition()
+    self.__threads = []
+    self.__stopped = False
+
+  def __start(self):
+    """ Starts the worker threads if they are not running yet. Must be called
+        with the condition held.
+    """
+    if self.__threads:
+      return
+    for index in range(self.num_workers):
+      thread = threading.Thread(target=self.__run,
+        name="{0}-{1}".format(self.name, index))
+      thread.daemon = True
+      thread.start()
+      self.__threads.append(thread)
+
+  def __next_call(self):
+    """ Takes the next call from the key whose turn it is. Must be called
+        with the condition held and at least one call queued.
+
+    Returns:
+      A tuple of the key and the queued call.
+    """
+    key = self.__turns.popleft()
+    queue = self.__queues[key]
+    item = queue.popleft()
+    if queue:
+      self.__turns.append(key)
+    else:
+      del self.__queues[key]
+    return key, item
+
+  def __run(self):
+    """ The loop each worker thread runs. """
+    while True:
+      with self.__condition:
+        while not self.__turns and not self.__stopped:
+          self.__condition.wait()
+        if not self.__turns:
+          return
+        key, (pending, function, args, kwargs) = self.__next_call()
+
+      try:
+        pending.set_result(function(*args, **kwargs))
+      except Exception:
+        pending.set_exception(sys.exc_info())
+
+      with self.__condition:
+        self.__total_pending -= 1
+        self.__pending[key] -= 1
+        if not self.__pending[key]:
+          del self.__pending[key]
+        self.__stats['completed'] += 1
+
+  def submit(self, key, function, *args, **kwargs):
+    """ Queues a call to be run by a worker thread on the key's turn.
+
+    Args:
+      key: The key whose queue the call waits in, such as an application ID.
+      function: The function to call.
+      args: Positional arguments for the function.
+      kwargs: Keyword arguments for the function.
+    Returns:
+      A PendingResult for the call.
+    Raises:
+      WorkerPoolFull: If the pool or the key already has as many calls
+        queued or running as it allows.
+    """
+    with self.__condition:
+      if self.__total_pending >= self.max_pending or \
+         self.__pending[key] >= self.max_pending_per_key:
+        self.__stats['rejected'] += 1
+        if not self.__pending[key]:
+          del self.__pending[key]
+        raise WorkerPoolFull("{0} calls are pending, {1} of them for {2}".\
+          format(self.__total_pending, self.__pending.get(key, 0), key))
+
+      self.__start()
+      pending = PendingResult()
+      if key not in self.__queues:
+        self.__queues[key] = collections.deque()
+        self.__turns.append(key)
+      self.__queues[key].append((pending, function, args, kwargs))
+      self.__pending[key] += 1
+      self.__total_pending += 1
+      self.__condition.notify()
+    return pending
+
+  def get_stats(self):
+    """ Returns counters for the calls this pool has handled.
+
+    Returns:
+      A dictionary with the number of calls completed and rejected, and the
+      number of calls queued or running overall and per key.
+    """
+    with self.__condition:
+      stats = dict(self.__stats)
+      stats['pending'] = self.__total_pending
+      stats['pending_by_key'] = dict(self.__pending)
+    return stats
+
+  def stop(self):
+    """ Stops the worker threads once the queued calls have run. """
+    with self.__condition:
+      self.__stopped = True
+      self.__threads = []
+      self.__condition.notify_all()
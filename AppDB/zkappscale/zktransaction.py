@@ -4,8 +4,8 @@ Distributed id and lock service for transaction support.
 Rewritten by Navraj Chohan and Chris Bunch (raj, chris@appscale.com)
 """
 import logging
+import random
 import re
-import signal
 import threading
 import time
 import urllib
@@ -77,6 +77,13 @@ GC_TIME_PATH = "gclast_time"
 # Lock path for the datastore groomer.
 DS_GROOM_LOCK_PATH = "/appscale_datastore_groomer"
 
+# The parent of the nodes holding the state of each range of the entity table
+# in a datastore groomer pass.
+DS_GROOM_RANGES_PATH = "/appscale_datastore_groomer_ranges"
+
+# The name of the ephemeral node a groomer creates under a range it works on.
+DS_GROOM_CLAIM_PATH = "claim"
+
 # A unique prefix for cross group transactions.
 XG_PREFIX = "xg"
 
@@ -86,6 +93,10 @@ MAX_GROUPS_FOR_XG = 5
 # The separator value for the lock list when using XG transactions.
 LOCK_LIST_SEPARATOR = "!XG_LIST!"
 
+# The maximum number of valid transaction IDs we cache locally per
+# application before the cache is flushed.
+MAX_VALIDLIST_CACHE_SIZE = 10000
+
 class ZKTransactionException(Exception):
   """ ZKTransactionException defines a custom exception class that should be
   thrown whenever there was a problem involving a transaction (e.g., the
@@ -105,6 +116,13 @@ class ZKTransaction:
   # The number of seconds to wait before we consider a zk call a failure.
   DEFAULT_ZK_TIMEOUT = 3
 
+  # The longest time, in seconds, to wait before the first retry of a failed
+  # zk call. It doubles for each further retry, up to MAX_RETRY_DELAY.
+  RETRY_DELAY = 0.1
+
+  # The longest time, in seconds, to wait before retrying a failed zk call.
+  MAX_RETRY_DELAY = 2
+
   def __init__(self, host=DEFAULT_HOST, start_gc=True):
     """ Creates a new ZKTransaction, which will communicate with Zookeeper
     on the given host.
@@ -120,8 +138,24 @@ class ZKTransaction:
 
     # Connection instance variables.
     self.host = host
-    self.handle = kazoo.client.KazooClient(hosts=host)
-    self.handle.start()
+    self.handle = self.connect()
+    # Held while the connection is replaced, since calls from many threads
+    # can fail on the same connection at once.
+    self.handle_lock = threading.Lock()
+
+    # Local caches of each application's blacklisted transaction IDs and the
+    # valid transaction ID of entities updated by those transactions. They are
+    # filled on first use and kept up to date with ZooKeeper watches.
+    self.cache_lock = threading.Lock()
+    self.blacklist_cache = {}
+    self.validlist_cache = {}
+    # Bumped whenever a watch invalidates an application's blacklist, so that
+    # a concurrent reader does not store a stale copy.
+    self.blacklist_generation = {}
+    self.watching_connection = False
+
+    # Applications whose lock root node is known to exist.
+    self.lock_roots = set()
 
     # for gc
     self.gc_running = False
@@ -130,6 +164,16 @@ class ZKTransaction:
       self.start_gc()
 
 
+  def connect(self):
+    """ Opens a new connection to the ZooKeeper service on self.host.
+
+    Returns:
+      A started KazooClient.
+    """
+    handle = kazoo.client.KazooClient(hosts=self.host)
+    handle.start()
+    return handle
+
   def start_gc(self):
     """ Starts a new thread that cleans up failed transactions.
 
@@ -715,6 +759,275 @@ class ZKTransaction:
 
     return True
 
+  def get_transaction_ids(self, app_id, count):
+    """ Acquires IDs for several new transactions at once. The sequence nodes
+    are created with pipelined calls, so this takes about one round trip no
+    matter how many IDs are needed.
+
+    Args:
+      app_id: A str representing the application we want to perform
+        transactions on.
+      count: The number of transaction IDs to acquire.
+    Returns:
+      A list of longs that represent the new transaction IDs.
+    Raises:
+      ZKTransactionException: If the sequence nodes couldn't be created.
+    """
+    timestamp = str(time.time())
+    app_path = self.get_txn_path_before_getting_id(app_id)
+    txids = []
+    retries_left = self.DEFAULT_NUM_RETRIES
+    while len(txids) < count and retries_left > 0:
+      retries_left -= 1
+      calls = [('create', (app_path, timestamp, ZOO_ACL_OPEN, False, True,
+        True))] * (count - len(txids))
+      for txn_id_path in self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+          self.DEFAULT_NUM_RETRIES, self.run_pipeline, calls):
+        if isinstance(txn_id_path, Exception):
+          continue
+        txn_id = long(txn_id_path.split(PATH_SEPARATOR)[-1].lstrip(
+          APP_TX_PREFIX))
+        if txn_id == 0:
+          logging.warning("Created sequence ID 0 - deleting it.")
+          self.handle.delete_async(txn_id_path)
+        else:
+          txids.append(txn_id)
+
+    if len(txids) < count:
+      raise ZKTransactionException("Unable to create {0} transaction IDs " \
+        "for app id {1}".format(count, app_id))
+    return txids
+
+  def acquire_locks(self, app_id, locks):
+    """ Acquires the locks of several new transactions at once, where each
+    transaction locks a single entity group, as non-transactional writes do.
+    All of the locks are created in one multi-op transaction, so either all
+    of them are acquired or none are.
+
+    Args:
+      app_id: The application ID to acquire locks for.
+      locks: A list of (txid, entity_key) tuples, where each txid was just
+        returned by get_transaction_ids.
+    Returns:
+      True on success.
+    Raises:
+      ZKTransactionException: If another transaction already holds one of the
+        locks.
+    """
+    if not locks:
+      return True
+
+    # Nodes can not be created with their parents in a multi-op transaction.
+    if app_id not in self.lock_roots:
+      try:
+        self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+          self.DEFAULT_NUM_RETRIES, self.handle.create,
+          PATH_SEPARATOR.join([self.get_app_root_path(app_id), APP_LOCK_PATH]),
+          '', ZOO_ACL_OPEN, False, False, True)
+      except kazoo.exceptions.NodeExistsError:
+        pass
+      self.lock_roots.add(app_id)
+
+    operations = []
+    for txid, entity_key in locks:
+      txpath = self.get_transaction_path(app_id, txid)
+      lockrootpath = self.get_lock_root_path(app_id, entity_key)
+      operations.append(('create', (lockrootpath, str(txpath))))
+      operations.append(('create', (
+        self.get_transaction_lock_list_path(app_id, txid), str(lockrootpath))))
+
+    results = self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+      self.DEFAULT_NUM_RETRIES, self.run_transaction, operations)
+    for (_, args), result in zip(operations, results):
+      if isinstance(result, kazoo.exceptions.NodeExistsError):
+        raise ZKTransactionException("acquire_locks: There is already " \
+          "another transaction using {0} lock".format(args[0]))
+      if isinstance(result, Exception) and \
+         not isinstance(result, kazoo.exceptions.RolledBackError):
+        raise ZKTransactionException("acquire_locks: Unable to create {0}: " \
+          "{1}".format(args[0], str(result)))
+    return True
+
+  def release_locks(self, app_id, txids):
+    """ Releases all locks acquired by several transactions, as release_lock
+    does for one. The transactions are read and deleted with pipelined calls,
+    so this takes a few round trips no matter how many there are. Upon
+    calling release_locks, the given transaction IDs are no longer valid.
+
+    Args:
+      app_id: The application ID we are releasing locks for.
+      txids: A list of the transaction IDs we are releasing locks for.
+    Returns:
+      True if the locks were released.
+    Raises:
+      ZKTransactionException: If any of the transactions timed out. The
+        locks of the other transactions are still released.
+    """
+    logging.debug("Releasing locks for app {0}, with transaction ids {1}" \
+      .format(app_id, txids))
+    calls = []
+    for txid in txids:
+      calls.append(('get',
+        (self.get_transaction_lock_list_path(app_id, txid),)))
+      calls.append(('get_children', (self.get_transaction_path(app_id, txid),)))
+    results = self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+      self.DEFAULT_NUM_RETRIES, self.run_pipeline, calls)
+
+    timed_out = []
+    deletes = []
+    for index, txid in enumerate(txids):
+      lock_list, children = results[2 * index], results[2 * index + 1]
+      if isinstance(children, Exception) or self.is_blacklisted(app_id, txid):
+        timed_out.append(txid)
+        continue
+      if not isinstance(lock_list, Exception):
+        for lock_path in lock_list[0].split(LOCK_LIST_SEPARATOR):
+          deletes.append(('delete', (lock_path,)))
+      # Children are deleted before their parent. ZooKeeper applies the calls
+      # of a session in the order they were sent.
+      txpath = self.get_transaction_path(app_id, txid)
+      for child in children:
+        deletes.append(('delete', (PATH_SEPARATOR.join([txpath, child]),)))
+      deletes.append(('delete', (txpath,)))
+
+    if deletes:
+      self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+        self.DEFAULT_NUM_RETRIES, self.run_pipeline, deletes)
+
+    if timed_out:
+      raise ZKTransactionException("release_locks: Transactions {0} for " \
+        "app id {1} have timed out.".format(timed_out, app_id))
+    return True
+
+  def run_pipeline(self, calls):
+    """ Sends several ZooKeeper calls without waiting for each reply, and then
+    waits for all of them.
+
+    Args:
+      calls: A list of tuples of a KazooClient method name and its arguments.
+    Returns:
+      A list with the result of each call. Calls which failed because of the
+      state of their node hold the exception they raised instead.
+    Raises:
+      ZKTimeoutException: If the replies did not arrive in time.
+    """
+    handle = self.handle
+    async_results = [getattr(handle, name + '_async')(*args)
+      for name, args in calls]
+    deadline = time.time() + self.DEFAULT_ZK_TIMEOUT
+    results = []
+    for async_result in async_results:
+      try:
+        results.append(async_result.get(
+          timeout=max(deadline - time.time(), 0)))
+      except handle.handler.timeout_exception:
+        raise ZKTimeoutException("{0} calls did not finish in {1} seconds"\
+          .format(len(calls), self.DEFAULT_ZK_TIMEOUT))
+      except (kazoo.exceptions.NoNodeError, kazoo.exceptions.NodeExistsError,
+              kazoo.exceptions.NotEmptyError) as node_exception:
+        results.append(node_exception)
+    return results
+
+  def run_transaction(self, operations):
+    """ Applies several ZooKeeper operations atomically, in one multi-op
+    transaction.
+
+    Args:
+      operations: A list of tuples of a kazoo TransactionRequest method name,
+        such as 'create' or 'delete', and its arguments.
+    Returns:
+      A list with the result of each operation. If one failed, none were
+      applied, and it holds the exception it raised.
+    Raises:
+      ZKTimeoutException: If the transaction did not finish in time.
+    """
+    handle = self.handle
+    transaction = handle.transaction()
+    for name, args in operations:
+      getattr(transaction, name)(*args)
+    try:
+      return transaction.commit_async().get(timeout=self.DEFAULT_ZK_TIMEOUT)
+    except handle.handler.timeout_exception:
+      raise ZKTimeoutException("Transaction of {0} operations did not finish " \
+        "in {1} seconds".format(len(operations), self.DEFAULT_ZK_TIMEOUT))
+
+  def invalidate_caches(self):
+    """ Drops all locally cached blacklists and valid transaction IDs. They
+    are fetched again from ZooKeeper (with new watches) on their next use.
+    """
+    with self.cache_lock:
+      for app_id in self.blacklist_cache:
+        self.blacklist_generation[app_id] = \
+          self.blacklist_generation.get(app_id, 0) + 1
+      self.blacklist_cache = {}
+      self.validlist_cache = {}
+
+  def connection_state_listener(self, state):
+    """ Invalidates the local caches whenever the ZooKeeper connection is
+    suspended or lost, since watches may be dropped along with it.
+
+    Args:
+      state: A kazoo.protocol.states.KazooState.
+    """
+    if state != kazoo.protocol.states.KazooState.CONNECTED:
+      logging.warning("ZooKeeper connection is {0}, invalidating "\
+        "transaction caches".format(state))
+      self.invalidate_caches()
+
+  def watch_connection_state(self):
+    """ Registers the listener that keeps the local caches coherent across
+    connection problems, if it has not been registered yet.
+    """
+    if not self.watching_connection:
+      self.handle.add_listener(self.connection_state_listener)
+      self.watching_connection = True
+
+  def get_blacklist(self, app_id):
+    """ Returns the set of blacklisted transaction IDs for an application.
+
+    The set is served from a local cache which a ZooKeeper child watch on the
+    blacklist node invalidates, so repeated calls do not go to ZooKeeper
+    unless the blacklist has changed.
+
+    Args:
+      app_id: The application ID whose blacklist we want.
+    Returns:
+      A set of strs, each being a blacklisted transaction ID.
+    """
+    with self.cache_lock:
+      if app_id in self.blacklist_cache:
+        return self.blacklist_cache[app_id]
+      generation = self.blacklist_generation.get(app_id, 0)
+
+    self.watch_connection_state()
+
+    def blacklist_watch(_):
+      """ Drops the cached blacklist once it changes in ZooKeeper. """
+      with self.cache_lock:
+        self.blacklist_generation[app_id] = \
+          self.blacklist_generation.get(app_id, 0) + 1
+        self.blacklist_cache.pop(app_id, None)
+
+    blacklist_root = self.get_blacklist_root_path(app_id)
+    if not self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+        self.DEFAULT_NUM_RETRIES, self.handle.exists, blacklist_root):
+      try:
+        self.handle.create(blacklist_root, DEFAULT_VAL, ZOO_ACL_OPEN,
+          ephemeral=False, sequence=False, makepath=True)
+      except kazoo.exceptions.NodeExistsError:
+        pass
+    try:
+      blacklist = set(self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+        self.DEFAULT_NUM_RETRIES, self.handle.get_children, blacklist_root,
+        blacklist_watch))
+    except kazoo.exceptions.NoNodeError:  # there is no blacklist
+      return set()
+
+    with self.cache_lock:
+      if self.blacklist_generation.get(app_id, 0) == generation:
+        self.blacklist_cache[app_id] = blacklist
+    return blacklist
+
   def is_blacklisted(self, app_id, txid):
     """ Checks to see if the given transaction ID has been blacklisted (that is,
     if it is no longer considered to be a valid transaction).
@@ -725,19 +1038,53 @@ class ZKTransaction:
     Returns:
       True if the transaction is blacklisted, False otherwise.
     """
-    # TODO(cgb): Investigate the performance impacts of not using a blacklist
-    # cache.
-    blacklist_root = self.get_blacklist_root_path(app_id)
-    if not self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
-        self.DEFAULT_NUM_RETRIES, self.handle.exists, blacklist_root):
-      self.handle.create(blacklist_root, DEFAULT_VAL, ZOO_ACL_OPEN,
-        ephemeral=False, sequence=False, makepath=True)
+    return str(txid) in self.get_blacklist(app_id)
+
+  def get_valid_version(self, app_id, entity_key):
+    """ Returns the last valid transaction ID recorded for an entity which
+    was updated by a blacklisted transaction.
+
+    Results are cached locally and invalidated by a ZooKeeper data (or
+    existence) watch on the entity's valid list node.
+
+    Args:
+      app_id: The application ID.
+      entity_key: The entity key whose valid version we want.
+    Returns:
+      A long, the valid transaction ID, or 0 if there is none.
+    """
+    with self.cache_lock:
+      app_cache = self.validlist_cache.get(app_id, {})
+      if entity_key in app_cache:
+        return app_cache[entity_key]
+
+    self.watch_connection_state()
+
+    def validlist_watch(_):
+      """ Drops the cached version once it changes in ZooKeeper. """
+      with self.cache_lock:
+        self.validlist_cache.get(app_id, {}).pop(entity_key, None)
+
+    vtxpath = self.get_valid_transaction_path(app_id, entity_key)
     try:
-      blacklist = self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
-        self.DEFAULT_NUM_RETRIES, self.handle.get_children, blacklist_root)
-      return str(txid) in blacklist
-    except kazoo.exceptions.NoNodeError:  # there is no blacklist
-      return False
+      vid = long(self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+          self.DEFAULT_NUM_RETRIES, self.handle.get, vtxpath,
+          validlist_watch)[0])
+    except kazoo.exceptions.NoNodeError:
+      # The transaction is blacklisted, but there is no valid id. Watch for
+      # one being created before trusting the negative result.
+      if self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+          self.DEFAULT_NUM_RETRIES, self.handle.exists, vtxpath,
+          validlist_watch):
+        return self.get_valid_version(app_id, entity_key)
+      vid = long(0)
+
+    with self.cache_lock:
+      app_cache = self.validlist_cache.setdefault(app_id, {})
+      if len(app_cache) >= MAX_VALIDLIST_CACHE_SIZE:
+        app_cache.clear()
+      app_cache[entity_key] = vid
+    return vid
 
   def get_valid_transaction_id(self, app_id, target_txid, entity_key):
     """ This returns valid transaction id for the entity key.
@@ -746,17 +1093,134 @@ class ZKTransaction:
     this returns latest valid transaction id.
     If there is no valid transaction id, this returns 0.
     """
-    if not self.is_blacklisted(app_id, target_txid):
-      return target_txid
-    # get the valid id
-    vtxpath = self.get_valid_transaction_path(app_id, entity_key)
+    return self.get_valid_transaction_ids(app_id,
+      [(target_txid, entity_key)])[entity_key]
+
+  def get_valid_transaction_ids(self, app_id, versions):
+    """ Returns the valid transaction ID for each of a batch of entities.
+
+    This consults the blacklist once for the whole batch, so validating a
+    query result costs a constant amount of ZooKeeper traffic rather than
+    one round trip per row.
+
+    Args:
+      app_id: The application ID the entities belong to.
+      versions: A list of (transaction ID, entity key) tuples, where the
+        transaction ID is the version currently stored for that entity.
+    Returns:
+      A dict mapping each entity key to its valid transaction ID. This is
+      the given ID unless it is blacklisted, in which case it is the last
+      valid ID, or 0 if there is none.
+    """
+    blacklist = self.get_blacklist(app_id)
+    valid_ids = {}
+    for txid, entity_key in versions:
+      if str(txid) not in blacklist:
+        valid_ids[entity_key] = txid
+      else:
+        valid_ids[entity_key] = self.get_valid_version(app_id, entity_key)
+    return valid_ids
+
+  def get_open_transactions(self, app_id, txids):
+    """ Returns which of the given transactions are still in progress, that
+    is, whose transaction node still exists.
+
+    Args:
+      app_id: The application ID the transactions belong to.
+      txids: A list of transaction IDs.
+    Returns:
+      A set of the given transaction IDs which are still in progress.
+    Raises:
+      ZKTimeoutException: If ZooKeeper did not reply in time.
+    """
+    txids = list(set(txids))
+    results = self.run_pipeline([('exists',
+      (self.get_transaction_path(app_id, long(txid)),)) for txid in txids])
+    return set(txid for txid, result in zip(txids, results)
+               if result and not isinstance(result, Exception))
+
+  def get_blacklist_times(self, app_id):
+    """ Returns when each blacklisted transaction ID of an application was
+    blacklisted.
+
+    Args:
+      app_id: The application ID whose blacklist we want.
+    Returns:
+      A dict of blacklisted transaction IDs, as strs, to the time they were
+      blacklisted. IDs without a readable time are left out.
+    """
+    blacklist_root = self.get_blacklist_root_path(app_id)
+    try:
+      txids = self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+        self.DEFAULT_NUM_RETRIES, self.handle.get_children, blacklist_root)
+    except kazoo.exceptions.NoNodeError:
+      return {}
+
+    results = self.run_pipeline([('get',
+      (PATH_SEPARATOR.join([blacklist_root, txid]),)) for txid in txids])
+    times = {}
+    for txid, result in zip(txids, results):
+      if isinstance(result, Exception):
+        continue
+      try:
+        times[txid] = float(result[0])
+      except ValueError:
+        pass
+    return times
+
+  def delete_blacklist_entries(self, app_id, txids):
+    """ Removes transaction IDs from an application's blacklist. Callers must
+    make sure no entity is still stored at one of these versions.
+
+    Args:
+      app_id: The application ID whose blacklist we are pruning.
+      txids: A list of strs, the transaction IDs to remove.
+    Returns:
+      The number of IDs removed.
+    """
+    blacklist_root = self.get_blacklist_root_path(app_id)
+    results = self.run_pipeline([('delete',
+      (PATH_SEPARATOR.join([blacklist_root, str(txid)]),)) for txid in txids])
+    with self.cache_lock:
+      if app_id in self.blacklist_cache:
+        self.blacklist_cache[app_id].difference_update(
+          str(txid) for txid in txids)
+    return len([result for result in results
+                if not isinstance(result, Exception)])
+
+  def get_valid_version_keys(self, app_id):
+    """ Returns the entity keys which have a valid version recorded.
+
+    Args:
+      app_id: The application ID.
+    Returns:
+      A list of entity keys.
+    """
+    try:
+      children = self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+        self.DEFAULT_NUM_RETRIES, self.handle.get_children,
+        self.get_valid_transaction_root_path(app_id))
+    except kazoo.exceptions.NoNodeError:
+      return []
+    return [urllib.unquote_plus(child) for child in children]
+
+  def delete_valid_version(self, app_id, entity_key):
+    """ Removes the valid version recorded for an entity. Callers must hold
+    the lock on the entity's group, so that no transaction is recording a
+    version for it at the same time.
+
+    Args:
+      app_id: The application ID.
+      entity_key: The entity key whose valid version we are removing.
+    """
     try:
-      vid = self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
-          self.DEFAULT_NUM_RETRIES, self.handle.get, vtxpath)[0]
-      return long(vid)
+      self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT, self.DEFAULT_NUM_RETRIES,
+        self.handle.delete, self.get_valid_transaction_path(app_id,
+        entity_key))
     except kazoo.exceptions.NoNodeError:
-      # The transaction is blacklisted, but there is no valid id.
-      return long(0)
+      pass
+    with self.cache_lock:
+      self.validlist_cache.get(app_id, {}).pop(entity_key, None)
 
   def register_updated_key(self, app_id, current_txid, target_txid, entity_key):
     """ Registers a key which is a part of a transaction. This is to know
@@ -839,6 +1303,10 @@ class ZKTransaction:
 
         self.handle.create_async(PATH_SEPARATOR.join([blacklist_root,
           str(txid)]), now, ZOO_ACL_OPEN)
+        # Make the blacklisting visible locally without waiting on the watch.
+        with self.cache_lock:
+          if app_id in self.blacklist_cache:
+            self.blacklist_cache[app_id].add(str(txid))
 
         # Copy valid transaction ID for each updated key into valid list.
         for child in self.handle.get_children(txpath):
@@ -854,6 +1322,8 @@ class ZKTransaction:
                 ephemeral=False, sequence=False, makepath=True)
             vtxpath = self.get_valid_transaction_path(app_id, key)
             self.handle.create_async(vtxpath, str(vid), ZOO_ACL_OPEN)
+            with self.cache_lock:
+              self.validlist_cache.get(app_id, {}).pop(key, None)
 
       # Release the locks.
       for lock in lock_list:
@@ -871,21 +1341,65 @@ class ZKTransaction:
       
     return True
 
-  def reestablish_connection(self):
-    """ Checks the connection and resets it as needed. """
-    try:
-      self.handle.stop()
-    except kazoo.exceptions.ZookeeperError as close_exception:
-      logging.error("Exception when closing ZK connection {0}".\
-        format(close_exception))
+  def reestablish_connection(self, failed_handle=None):
+    """ Checks the connection and resets it as needed.
 
-    self.handle = kazoo.client.KazooClient(hosts=self.host)
-    self.handle.start()
+    Args:
+      failed_handle: The KazooClient a call failed on. If another thread has
+        already replaced it, the connection is left as it is.
+    """
+    with self.handle_lock:
+      if failed_handle is not None and failed_handle is not self.handle:
+        return
+      try:
+        self.handle.stop()
+      except kazoo.exceptions.ZookeeperError as close_exception:
+        logging.error("Exception when closing ZK connection {0}".\
+          format(close_exception))
+
+      self.handle = self.connect()
+      # Watches do not survive a new connection.
+      self.watching_connection = False
+    self.invalidate_caches()
+
+  def call_with_deadline(self, handle, timeout_time, function, *args):
+    """ Calls the given function. Methods of a KazooClient are run through
+    their asynchronous version on the given client, waiting at most
+    timeout_time seconds for the result. Methods that are already
+    asynchronous return their IAsyncResult without waiting. Other functions
+    are called as they are.
+
+    Args:
+      handle: The KazooClient to run ZooKeeper calls on.
+      timeout_time: The number of seconds to wait for a ZooKeeper call.
+      function: The function that should be executed.
+      *args: The arguments that will be passed to function.
+    Returns:
+      Whatever function(*args) returns.
+    Raises:
+      ZKTimeoutException: If a ZooKeeper call did not finish in time.
+    """
+    client = getattr(function, 'im_self', None)
+    if not hasattr(client, 'handler'):
+      return function(*args)
+
+    # The method is looked up again on the given client, since the one it
+    # was bound to may have been replaced by a retry.
+    name = function.__name__
+    if name.endswith('_async'):
+      return getattr(handle, name)(*args)
+    async_result = getattr(handle, name + '_async')(*args)
+    try:
+      return async_result.get(timeout=timeout_time)
+    except handle.handler.timeout_exception:
+      raise ZKTimeoutException("{0} did not finish in {1} seconds".format(
+        name, timeout_time))
 
   def run_with_timeout(self, timeout_time, num_retries, function,
     *args):
     """Runs the given function, aborting it if it runs too long. Make sure
-       the function does not have side effects.
+       the function does not have side effects. Unlike a signal based timer,
+       this is safe to call from any thread.
 
     Args:
       timeout_time: The number of seconds that we should allow function to
@@ -900,90 +1414,51 @@ class ZKTransaction:
       kazoo.exceptions.ZookeeperError: For non connection related zookeeper
         exceptions and if the function runs out of retries.
     """
-    def timeout_handler(_, __):
-      """Raises a TimeoutException if the function we want to execute takes
-      too long to run.
-
-      Raises:
-        TimeoutException: If a SIGALRM is raised.
-      """
-      raise ZKTimeoutException()
-  
-    def reset_timer_and_connection():
-      """ Resets the timer and establishes a new connection. """
-      self.reestablish_connection()
-      logging.warning("Retrying with new connection")
-      signal.alarm(0)  # turn off the alarm
-
-    if num_retries <= 0:
-      raise ZKTransactionException("Failed to run {0}, no more retries"\
-        .format(str(function)))
-
-    signal.signal(signal.SIGALRM, timeout_handler)
-    signal.alarm(timeout_time)  # trigger alarm in timeout_time seconds
-    try:
-      retval = function(*args)
-      signal.alarm(0)
-    except ZKTimeoutException:
-      logging.warning("Call timed out to function {0} with args {1}".\
-        format(str(function), str(args)))
-      raise ZKTransactionException("Failed to run {0}, timed out"\
-        .format(str(function)))
-      
-    # ZK expected exceptions:
-    except kazoo.exceptions.NoNodeError as no_node:
-      signal.alarm(0)  # turn off the alarm
-      raise no_node
-    except kazoo.exceptions.NodeExistsError as node_exist:
-      signal.alarm(0)  # turn off the alarm
-      raise node_exist
-    # Exception we retry on:
-    except kazoo.exceptions.ConnectionLoss as conn_loss:
-      logging.warning("ZK connection was lost: {0}".format(str((conn_loss))))
-      reset_timer_and_connection()
-      return self.run_with_timeout(timeout_time, num_retries - 1, 
-        function, *args)
-    except kazoo.exceptions.ConnectionClosedError as conn_loss:
-      logging.warning("ZK connection was closed: {0}".format(str((conn_loss))))
-      reset_timer_and_connection()
-      return self.run_with_timeout(timeout_time, num_retries - 1, 
-        function, *args)
-    except kazoo.exceptions.OperationTimeoutError as op_timeout:
-      logging.warning("ZK had an operation timeout: {0}".\
-        format(str((op_timeout))))
-      reset_timer_and_connection()
-      return self.run_with_timeout(timeout_time, num_retries - 1, 
-        function)
-    except kazoo.exceptions.SessionExpiredError as ses_expired:
-      logging.warning("System exception: {0}".format(ses_expired))
-      reset_timer_and_connection()
-      return self.run_with_timeout(timeout_time, num_retries - 1, 
-        function, *args)
-    # Serious exception we raise:
-    except kazoo.exceptions.DataInconsistency as data_exception:
-      signal.alarm(0)  # turn off the alarm before we retry
-      raise data_exception
-    except kazoo.exceptions.BadArgumentsError as bad_args:
-      logging.error("Bad args exception: {0}".format(str((bad_args))))
-      signal.alarm(0)  # turn off the alarm before we retry
-      raise bad_args
-    except kazoo.exceptions.SystemZookeeperError as sys_exception:
-      logging.error("System exception: {0}".format(sys_exception))
-      signal.alarm(0)  # turn off the alarm before we retry
-      raise sys_exception
-    # Retry any exception we did not foresee:
-    except kazoo.exceptions.ZookeeperError as zk_exception:
-      logging.error("ZK Exception: {0}".format(zk_exception))
-      signal.alarm(0)  # turn off the alarm before we retry
-      return self.run_with_timeout(timeout_time, num_retries - 1, 
-        function, *args)
-    except Exception, general_exception:
-      logging.warning("General exception: {0}".format(general_exception))
-      signal.alarm(0)  # turn off the alarm before we retry
-      return self.run_with_timeout(timeout_time, num_retries - 1,
-        function, *args)
+    retry_delay = self.RETRY_DELAY
+    while True:
+      if num_retries <= 0:
+        raise ZKTransactionException("Failed to run {0}, no more retries"\
+          .format(str(function)))
+      num_retries -= 1
+
+      handle = self.handle
+      try:
+        return self.call_with_deadline(handle, timeout_time, function, *args)
+      except ZKTimeoutException:
+        logging.warning("Call timed out to function {0} with args {1}".\
+          format(str(function), str(args)))
+        raise ZKTransactionException("Failed to run {0}, timed out"\
+          .format(str(function)))
+      # ZK expected exceptions:
+      except (kazoo.exceptions.NoNodeError, kazoo.exceptions.NodeExistsError):
+        raise
+      # Exceptions we retry on with a new connection:
+      except (kazoo.exceptions.ConnectionLoss,
+              kazoo.exceptions.ConnectionClosedError,
+              kazoo.exceptions.OperationTimeoutError,
+              kazoo.exceptions.SessionExpiredError) as conn_error:
+        logging.warning("ZK connection problem: {0}".format(
+          conn_error.__class__.__name__))
+        self.reestablish_connection(handle)
+        logging.warning("Retrying with new connection")
+      # Serious exceptions we raise:
+      except (kazoo.exceptions.DataInconsistency,
+              kazoo.exceptions.BadArgumentsError,
+              kazoo.exceptions.SystemZookeeperError) as serious_exception:
+        logging.error("ZK exception: {0}".format(
+          serious_exception.__class__.__name__))
+        raise
+      # Retry any exception we did not foresee:
+      except kazoo.exceptions.ZookeeperError as zk_exception:
+        logging.error("ZK Exception: {0}".format(zk_exception))
+      except Exception, general_exception:
+        logging.warning("General exception: {0}".format(general_exception))
 
-    return retval
+      # Back off before retrying, so that many threads seeing the same
+      # failure do not retry in lockstep.
+      if num_retries > 0:
+        time.sleep(random.uniform(0, retry_delay))
+        retry_delay = min(retry_delay * 2, self.MAX_RETRY_DELAY)
 
   def gc_runner(self):
     """ Transaction ID garbage collection (GC) runner.
@@ -1123,6 +1598,117 @@ class ZKTransaction:
       return False
     return True
 
+  def create_groomer_ranges(self, values):
+    """ Starts a datastore groomer pass by storing the state of each range
+    it is split into. The ranges are created atomically, so that a pass is
+    never seen partly created.
+
+    Args:
+      values: A list of strs, the state of each range.
+    Raises:
+      ZKTransactionException: If the ranges could not be created.
+    """
+    operations = [('create', (DS_GROOM_RANGES_PATH, '', ZOO_ACL_OPEN))]
+    for index, value in enumerate(values):
+      # Names are zero padded like sequence nodes, so they sort in order.
+      path = PATH_SEPARATOR.join([DS_GROOM_RANGES_PATH,
+        "{0:010d}".format(index)])
+      operations.append(('create', (path, value, ZOO_ACL_OPEN)))
+    try:
+      results = self.run_transaction(operations)
+    except (ZKTimeoutException,
+            kazoo.exceptions.ZookeeperError) as zk_exception:
+      raise ZKTransactionException("Unable to create groomer ranges: {0}"\
+        .format(zk_exception))
+    for result in results:
+      if isinstance(result, Exception) and \
+         not isinstance(result, kazoo.exceptions.RolledBackError):
+        raise ZKTransactionException("Unable to create groomer ranges: {0}"\
+          .format(result.__class__.__name__))
+
+  def get_groomer_ranges(self):
+    """ Gets the ranges of the datastore groomer pass in progress.
+
+    Returns:
+      A sorted list of range names, which is empty if no pass is in progress.
+    """
+    try:
+      return sorted(self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+        self.DEFAULT_NUM_RETRIES, self.handle.get_children,
+        DS_GROOM_RANGES_PATH))
+    except kazoo.exceptions.NoNodeError:
+      return []
+
+  def get_groomer_range(self, name):
+    """ Gets the state of a range of the datastore groomer pass.
+
+    Args:
+      name: The name of the range.
+    Returns:
+      The str state of the range, or None if the pass has finished.
+    """
+    path = PATH_SEPARATOR.join([DS_GROOM_RANGES_PATH, name])
+    try:
+      return self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT,
+        self.DEFAULT_NUM_RETRIES, self.handle.get, path)[0]
+    except kazoo.exceptions.NoNodeError:
+      return None
+
+  def update_groomer_range(self, name, value):
+    """ Checkpoints the state of a range of the datastore groomer pass.
+
+    Args:
+      name: The name of the range.
+      value: The str state of the range.
+    Raises:
+      ZKTransactionException: If the range no longer exists.
+    """
+    path = PATH_SEPARATOR.join([DS_GROOM_RANGES_PATH, name])
+    try:
+      self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT, self.DEFAULT_NUM_RETRIES,
+        self.handle.set, path, value)
+    except kazoo.exceptions.NoNodeError:
+      raise ZKTransactionException("Groomer range {0} does not exist."\
+        .format(name))
+
+  def claim_groomer_range(self, name):
+    """ Tries to claim a range of the datastore groomer pass. The claim is
+    dropped along with this connection's session, so that a range claimed by
+    a groomer which died can be claimed by another.
+
+    Args:
+      name: The name of the range.
+    Returns:
+      True if the range was claimed, False if another groomer holds it or
+      the pass has finished.
+    """
+    path = PATH_SEPARATOR.join([DS_GROOM_RANGES_PATH, name,
+      DS_GROOM_CLAIM_PATH])
+    try:
+      self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT, self.DEFAULT_NUM_RETRIES,
+        self.handle.create, path, str(time.time()), ZOO_ACL_OPEN, True)
+    except (kazoo.exceptions.NoNodeError, kazoo.exceptions.NodeExistsError):
+      return False
+    return True
+
+  def release_groomer_range(self, name):
+    """ Releases a claim on a range of the datastore groomer pass.
+
+    Args:
+      name: The name of the range.
+    """
+    path = PATH_SEPARATOR.join([DS_GROOM_RANGES_PATH, name,
+      DS_GROOM_CLAIM_PATH])
+    try:
+      self.run_with_timeout(self.DEFAULT_ZK_TIMEOUT, self.DEFAULT_NUM_RETRIES,
+        self.handle.delete, path)
+    except kazoo.exceptions.NoNodeError:
+      pass
+
+  def delete_groomer_ranges(self):
+    """ Ends the datastore groomer pass by deleting its ranges. """
+    self.delete_recursive(DS_GROOM_RANGES_PATH)
+
   def execute_garbage_collection(self, app_id, app_path):
     """ Execute garbage collection for an application.
     
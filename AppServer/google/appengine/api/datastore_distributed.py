@@ -24,6 +24,7 @@ index functions, transaction functions.
 
 import datetime
 import logging
+import os
 import sys
 import threading
 import warnings
@@ -79,6 +80,71 @@ _MAX_ACTIONS_PER_TXN = 5
 
 
 
+class RemoteCursor(datastore_stub_util.BaseCursor):
+  """ A cursor over query results which are kept by the datastore server 
+      and fetched a batch at a time.
+  """
+
+  def __init__(self, query):
+    """Constructor.
+
+    Args:
+      query: the query request proto
+    """
+    super(RemoteCursor, self).__init__(query.app())
+    self.query = query
+    # The cursor handed out by the datastore server.
+    self.remote_cursor = datastore_pb.Cursor()
+    # The position after the last result, used to resume the query if the
+    # datastore server no longer has the cursor.
+    self.compiled_cursor = None
+    self.remaining = None
+    if query.has_limit():
+      self.remaining = query.limit()
+
+  def PopulateQueryResult(self, remote_result, query_result, compile):
+    """ Copies a batch of results from the datastore server.
+
+    Args:
+      remote_result: the datastore_pb.QueryResult from the datastore server
+      query_result: out: the datastore_pb.QueryResult for the application
+      compile: if a compiled cursor should be returned
+    """
+    query_result.result_list().extend(remote_result.result_list())
+    query_result.set_skipped_results(remote_result.skipped_results())
+    query_result.set_keys_only(self.query.keys_only())
+    query_result.set_more_results(remote_result.more_results())
+    if self.remaining is not None:
+      self.remaining -= remote_result.result_size()
+    if remote_result.has_cursor():
+      self.remote_cursor.CopyFrom(remote_result.cursor())
+    if remote_result.has_compiled_cursor():
+      self.compiled_cursor = datastore_pb.CompiledCursor()
+      self.compiled_cursor.CopyFrom(remote_result.compiled_cursor())
+      if compile:
+        query_result.mutable_compiled_cursor().CopyFrom(self.compiled_cursor)
+    self.PopulateCursor(query_result)
+
+  def ResumeQuery(self, count, offset):
+    """ Builds a query which continues after the last result returned.
+
+    Args:
+      count: the number of results wanted
+      offset: the number of results to skip
+    Returns:
+      A datastore_pb.Query.
+    """
+    query = datastore_pb.Query()
+    query.CopyFrom(self.query)
+    query.set_count(count)
+    query.set_offset(offset)
+    if self.remaining is not None:
+      query.set_limit(self.remaining)
+    if self.compiled_cursor:
+      query.mutable_compiled_cursor().CopyFrom(self.compiled_cursor)
+    return query
+
+
 class DatastoreDistributed(apiproxy_stub.APIProxyStub):
   """ A central server hooks up to a db and communicates via protocol 
       buffers.
@@ -354,9 +420,31 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
     datastore_stub_util.FillUsersInQuery(filters)
 
 
+    if query.has_count():
+      count = query.count()
+    elif query.has_limit():
+      count = query.limit()
+    else:
+      count = _BATCH_SIZE
+
     query_response = datastore_pb.QueryResult()
     query.set_app(self.__app_id)
-    self._RemoteSend(query, query_response, "RunQuery")
+    remote_query = datastore_pb.Query()
+    remote_query.CopyFrom(query)
+    remote_query.set_count(count)
+    self._RemoteSend(remote_query, query_response, "RunQuery")
+
+    # The datastore server keeps a cursor for queries it returns in order 
+    # a batch at a time, and the remaining batches are fetched with Next.
+    if query_response.has_cursor():
+      cursor = RemoteCursor(query)
+      self.__queries = cursor
+      cursor.PopulateQueryResult(query_response, query_result, query.compile())
+      if query.compile():
+        compiled_query = query_result.mutable_compiled_query()
+        compiled_query.set_keys_only(query.keys_only())
+        compiled_query.mutable_primaryscan().set_index_name(query.Encode())
+      return
 
     skipped_results = 0
     if query_response.has_skipped_results():
@@ -457,13 +545,6 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
                                             order_compare_entities_pb)
     self.__queries = cursor
 
-    if query.has_count():
-      count = query.count()
-    elif query.has_limit():
-      count = query.limit()
-    else:
-      count = _BATCH_SIZE
-
     cursor.PopulateQueryResult(query_result, count,
                                query.offset(), compile=query.compile())
   
@@ -489,16 +570,39 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
     count = _BATCH_SIZE
     if next_request.has_count():
       count = next_request.count()
+
+    if isinstance(cursor, RemoteCursor):
+      remote_request = datastore_pb.NextRequest()
+      remote_request.CopyFrom(next_request)
+      remote_request.mutable_cursor().CopyFrom(cursor.remote_cursor)
+      remote_request.set_count(count)
+      remote_result = datastore_pb.QueryResult()
+      try:
+        self._RemoteSend(remote_request, remote_result, "Next")
+      except apiproxy_errors.ApplicationError, error:
+        if error.application_error != datastore_pb.Error.BAD_REQUEST:
+          raise
+        # The cursor expired or lives on another datastore server, so the
+        # query is run again from the last position.
+        remote_result = datastore_pb.QueryResult()
+        self._RemoteSend(cursor.ResumeQuery(count, next_request.offset()),
+                         remote_result, "RunQuery")
+      cursor.PopulateQueryResult(remote_result, query_result,
+                                 next_request.compile())
+      return
+
     cursor.PopulateQueryResult(query_result, count,
                                next_request.offset(),
                                next_request.compile())
 
   def _Dynamic_Count(self, query, integer64proto):
     """Get the number of entities for a query. """
-    query_result = datastore_pb.QueryResult()
-    self._Dynamic_RunQuery(query, query_result)
-    count = query_result.result_size()
-    integer64proto.set_value(count)
+    if query.has_transaction() and not query.has_ancestor():
+      raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.BAD_REQUEST,
+        'Only ancestor queries are allowed inside transactions.')
+    query.set_app(self.__app_id)
+    self._RemoteSend(query, integer64proto, "Count")
 
   def _Dynamic_BeginTransaction(self, request, transaction):
     """Send a begin transaction request from the datastore server. """
@@ -643,22 +747,65 @@ class DatastoreDistributed(apiproxy_stub.APIProxyStub):
     return  allocate_ids_response
 
   def _Dynamic_CreateIndex(self, index, id_response):
-    """ Create a new index. Currently stubbed out."""
+    """ Sends a request to create a composite index to the datastore 
+    server. """
     self.__ValidateAppId(index.app_id())
     if index.id() != 0:
       raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
                                              'New index id must be 0.')
-    id_response.set_value(0)
+    self._RemoteSend(index, id_response, "CreateIndex")
     return id_response
 
   def _Dynamic_GetIndices(self, app_str, composite_indices):
-    """ Gets the indices of the current app. Currently stubbed out. """
-    return 
+    """ Gets the composite indexes of the current app from the datastore
+    server. """
+    self.__ValidateAppId(app_str.value())
+    self._RemoteSend(app_str, composite_indices, "GetIndices")
+    return composite_indices
 
   def _Dynamic_UpdateIndex(self, index, void):
-    """ Updates the indices of the current app. Currently stubbed out. """
-    return 
+    """ Sends a request to change the state of a composite index to the 
+    datastore server. """
+    self.__ValidateAppId(index.app_id())
+    self._RemoteSend(index, void, "UpdateIndex")
+    return void
     
   def _Dynamic_DeleteIndex(self, index, void):
-    """ Deletes an index of the current app. Currently stubbed out. """
+    """ Sends a request to delete a composite index to the datastore 
+    server. """
+    self.__ValidateAppId(index.app_id())
+    self._RemoteSend(index, void, "DeleteIndex")
     return void
+
+  def _SetupIndexes(self, root_path, _open=open):
+    """ Creates the composite indexes in the app's index.yaml which the 
+    datastore server does not have yet. Indexes missing from index.yaml are
+    left alone.
+
+    Args:
+      root_path: The directory of the application.
+      _open: Function used to open index.yaml, for testing.
+    """
+    index_yaml = os.path.join(root_path, 'index.yaml')
+    if not os.path.exists(index_yaml):
+      return
+    index_file = _open(index_yaml, 'r')
+    try:
+      index_defs = datastore_index.ParseIndexDefinitions(index_file)
+    finally:
+      index_file.close()
+    if index_defs is None or not index_defs.indexes:
+      return
+
+    app_str = api_base_pb.StringProto()
+    app_str.set_value(self.__app_id)
+    existing = datastore_pb.CompositeIndices()
+    self._Dynamic_GetIndices(app_str, existing)
+    existing_keys = set(index.definition().Encode()
+                        for index in existing.index_list()
+                        if index.state() != entity_pb.CompositeIndex.DELETED)
+
+    for index in datastore_index.IndexDefinitionsToProtos(self.__app_id,
+                                                          index_defs.indexes):
+      if index.definition().Encode() not in existing_keys:
+        self._Dynamic_CreateIndex(index, api_base_pb.Integer64Proto())
@@ -22,6 +22,13 @@ import memcache
 import time
 import os
 import base64
+import bisect
+import collections
+import hashlib
+import logging
+import socket
+import struct
+import threading
 
 from google.appengine.api import apiproxy_stub
 from google.appengine.api.memcache import memcache_service_pb
@@ -31,6 +38,278 @@ MemcacheSetRequest = memcache_service_pb.MemcacheSetRequest
 MemcacheIncrementRequest = memcache_service_pb.MemcacheIncrementRequest
 MemcacheDeleteResponse = memcache_service_pb.MemcacheDeleteResponse
 
+# Lists the memcached servers, one per line, as an IP with an optional port
+# and weight, such as "10.0.0.1", "10.0.0.1:11211" or "10.0.0.1 2".
+MEMCACHE_IPS_FILE = "/etc/appscale/memcache_ips"
+
+# The port of servers listed without one.
+DEFAULT_PORT = 11211
+
+# The number of points a server of weight 1 is placed at on the hash ring.
+POINTS_PER_WEIGHT = 160
+
+# Seconds between checks of the server list for changes.
+MEMBERSHIP_CHECK_INTERVAL = 5
+
+# Environment variables, set in an app's app.yaml, which keep the values an
+# app server reads in a NearCache. The size is the number of values kept, and
+# no cache is used unless it is set. Values are kept for the TTL in seconds,
+# which can be set for each namespace as a list such as "config:60,:5".
+# Reads may return a value up to the TTL old which another server replaced.
+NEAR_CACHE_SIZE_VAR = 'MEMCACHE_NEAR_CACHE_SIZE'
+NEAR_CACHE_TTL_VAR = 'MEMCACHE_NEAR_CACHE_TTL'
+NEAR_CACHE_NAMESPACE_TTLS_VAR = 'MEMCACHE_NEAR_CACHE_NAMESPACE_TTLS'
+
+# Seconds values are kept in the near cache when no TTL is set.
+DEFAULT_NEAR_CACHE_TTL = 5
+
+
+def ReadServers(path):
+  """Reads a list of memcached servers.
+
+  Args:
+    path: The file listing the servers, in the format of MEMCACHE_IPS_FILE.
+
+  Returns:
+    A dict of server addresses, as "ip:port", to their weights.
+  """
+  servers = {}
+  with open(path) as servers_file:
+    for line in servers_file:
+      fields = line.split()
+      if not fields:
+        continue
+      address = fields[0]
+      if ':' not in address:
+        address = '%s:%d' % (address, DEFAULT_PORT)
+      weight = 1
+      if len(fields) > 1:
+        weight = float(fields[1])
+      servers[address] = weight
+  return servers
+
+
+class HashRing(object):
+  """A ketama consistent hash ring.
+
+  Each node is placed at points on the ring in proportion to its weight, and
+  a key belongs to the node at the first point after the key's hash. Adding
+  or removing a node only moves the keys next to its points, about 1/N of
+  them, rather than remapping nearly every key as modulo hashing does.
+  """
+
+  def __init__(self, weights, points_per_weight=POINTS_PER_WEIGHT):
+    """Initializer.
+
+    Args:
+      weights: A dict of node names to weights.
+      points_per_weight: The number of points of a node of weight 1.
+    """
+    self.weights = dict(weights)
+    points = []
+    for node, weight in self.weights.items():
+      # Each digest gives four points, as in libketama.
+      for index in range(max(1, int(round(points_per_weight * weight / 4)))):
+        digest = hashlib.md5('%s-%d' % (node, index)).digest()
+        for offset in range(0, 16, 4):
+          points.append((struct.unpack('<I', digest[offset:offset + 4])[0],
+                         node))
+    points.sort()
+    self._hashes = [point for point, _ in points]
+    self._nodes = [node for _, node in points]
+
+  @staticmethod
+  def _Hash(key):
+    """Returns the position of a key on the ring."""
+    return struct.unpack('<I', hashlib.md5(key).digest()[:4])[0]
+
+  def GetNode(self, key):
+    """Returns the node a key belongs to, or None if there are no nodes."""
+    for node in self.IterNodes(key):
+      return node
+    return None
+
+  def IterNodes(self, key):
+    """Yields each node once, starting with the one a key belongs to and
+    continuing around the ring, which is the order to fail over in.
+
+    Args:
+      key: The key to find the nodes of.
+    """
+    if not self._hashes:
+      return
+    start = bisect.bisect(self._hashes, self._Hash(key))
+    seen = set()
+    for index in xrange(len(self._nodes)):
+      node = self._nodes[(start + index) % len(self._nodes)]
+      if node in seen:
+        continue
+      seen.add(node)
+      yield node
+      if len(seen) == len(self.weights):
+        return
+
+
+class NearCache(object):
+  """A size bounded cache of recently read values, evicting the least
+  recently used, which saves a round trip to memcached for values read
+  often."""
+
+  def __init__(self, max_items, gettime=time.time):
+    """Initializer.
+
+    Args:
+      max_items: The number of values kept.
+      gettime: time.time()-like function used for testing.
+    """
+    self.max_items = max_items
+    self._gettime = gettime
+    self._items = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.byte_hits = 0
+
+  def Get(self, key):
+    """Returns a cached value.
+
+    Args:
+      key: The internal key of the value.
+
+    Returns:
+      A tuple of the value and its flags, or None if it is not cached or has
+      expired.
+    """
+    with self._lock:
+      entry = self._items.pop(key, None)
+      if entry is None or entry[2] <= self._gettime():
+        self.misses += 1
+        return None
+      self._items[key] = entry
+      self.hits += 1
+      self.byte_hits += len(entry[0])
+      return entry[:2]
+
+  def Put(self, key, value, flags, ttl):
+    """Caches a value.
+
+    Args:
+      key: The internal key of the value.
+      value: The value read from memcached.
+      flags: The flags of the value.
+      ttl: Seconds to keep the value for.
+    """
+    with self._lock:
+      self._items.pop(key, None)
+      self._items[key] = (value, flags, self._gettime() + ttl)
+      while len(self._items) > self.max_items:
+        self._items.popitem(last=False)
+
+  def Invalidate(self, keys):
+    """Removes values which were changed.
+
+    Args:
+      keys: A list of internal keys.
+    """
+    with self._lock:
+      for key in keys:
+        self._items.pop(key, None)
+
+  def Clear(self):
+    """Removes every value and resets the counters."""
+    with self._lock:
+      self._items.clear()
+      self.hits = 0
+      self.misses = 0
+      self.byte_hits = 0
+
+
+class RingClient(memcache.Client):
+  """A memcache.Client which places keys on servers with a HashRing.
+
+  The server list is read from a file, which is checked for changes every
+  MEMBERSHIP_CHECK_INTERVAL seconds. When servers are added or removed the
+  ring is rebuilt in place, keeping the connections to the other servers.
+  """
+
+  def __init__(self, path=MEMCACHE_IPS_FILE,
+               check_interval=MEMBERSHIP_CHECK_INTERVAL):
+    """Initializer.
+
+    Args:
+      path: The file listing the servers.
+      check_interval: Seconds between checks of the file for changes.
+    """
+    memcache.Client.__init__(self, [], debug=0)
+    self._path = path
+    self._check_interval = check_interval
+    self._last_check = 0
+    self._mtime = None
+    self._hosts = {}
+    self._ring = HashRing({})
+    self._CheckMembership()
+
+  def _CheckMembership(self):
+    """Rebuilds the ring if the server list changed since the last check."""
+    now = time.time()
+    if now - self._last_check < self._check_interval:
+      return
+    self._last_check = now
+
+    try:
+      mtime = os.stat(self._path).st_mtime
+      if mtime == self._mtime:
+        return
+      weights = ReadServers(self._path)
+    except (IOError, OSError, ValueError), error:
+      logging.warning('Unable to read the memcache servers from %s: %s',
+                      self._path, error)
+      return
+    self._mtime = mtime
+
+    # The file is rewritten when membership changes, so an empty read is
+    # taken to be one caught part way through.
+    if weights and weights != self._ring.weights:
+      logging.info('Memcache servers are now %s', weights)
+      self.SetServerWeights(weights)
+
+  def SetServerWeights(self, weights):
+    """Replaces the servers keys are placed on.
+
+    Args:
+      weights: A dict of server addresses to weights.
+    """
+    addresses = sorted(weights)
+    self.set_servers(addresses)
+    hosts = {}
+    for address, host in zip(addresses, self.servers):
+      hosts[address] = self._hosts.get(address, host)
+    for address, host in self._hosts.items():
+      if address not in hosts:
+        host.close_socket()
+    self.servers = [hosts[address] for address in addresses]
+    self._hosts = hosts
+    self._ring = HashRing(weights)
+
+  def _get_server(self, key):
+    """Finds the server a key belongs to, failing over to the next servers
+    on the ring when it is down.
+
+    Args:
+      key: The key, or a tuple of a hash and the key.
+
+    Returns:
+      A tuple of the server and the key, or (None, None) if no server is up.
+    """
+    if isinstance(key, tuple):
+      key = key[1]
+    self._CheckMembership()
+    for address in self._ring.IterNodes(key):
+      server = self._hosts[address]
+      if server.connect():
+        return server, key
+    return None, None
+
 class CacheEntry(object):
   """An entry in the cache."""
 
@@ -95,25 +374,40 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
   """Python only memcache service.
 
   This service keeps all data in any external servers running memcached.
+  Requests for several keys are sent to each server in one exchange.
   """
 
-  def __init__(self, gettime=time.time, service_name='memcache'):
+  # The memcached storage command for each set policy.
+  _STORE_COMMANDS = {
+    MemcacheSetRequest.SET: 'set',
+    MemcacheSetRequest.ADD: 'add',
+    MemcacheSetRequest.REPLACE: 'replace',
+    MemcacheSetRequest.CAS: 'cas',
+  }
+
+  # The set status for each memcached storage response. A CAS for a key
+  # which is missing is answered with NOT_FOUND.
+  _SET_STATUSES = {
+    'STORED': MemcacheSetResponse.STORED,
+    'NOT_STORED': MemcacheSetResponse.NOT_STORED,
+    'EXISTS': MemcacheSetResponse.EXISTS,
+    'NOT_FOUND': MemcacheSetResponse.NOT_STORED,
+  }
+
+  def __init__(self, gettime=time.time, service_name='memcache',
+               client=None):
     """Initializer.
 
     Args:
       gettime: time.time()-like function used for testing.
       service_name: Service name expected for all calls.
+      client: The memcache.Client to use, or None for a RingClient.
     """
     super(MemcacheService, self).__init__(service_name)
     self._gettime = gettime
 
-    f = open("/etc/appscale/memcache_ips")
-    all_ips = f.read().split("\n")
-    f.close()
-
-    memcaches = [ip + ":11211" for ip in all_ips if ip != '']
-
-    self._memcache = memcache.Client(memcaches, debug=0)
+    self._memcache = client or RingClient()
+    self._near_cache = None
     self._hits = 0
     self._misses = 0
     self._byte_hits = 0
@@ -127,26 +421,137 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
     self._byte_hits = 0
     self._cache_creation_time = self._gettime()
 
-  def _GetKey(self, namespace, key):
-    """Retrieves a CacheEntry from the cache if it hasn't expired.
+  def _GetNearCache(self):
+    """Returns the NearCache if the app enabled it, or None."""
+    try:
+      size = int(os.environ.get(NEAR_CACHE_SIZE_VAR, 0))
+    except ValueError:
+      size = 0
+    if size <= 0:
+      return None
+    if self._near_cache is None or self._near_cache.max_items != size:
+      self._near_cache = NearCache(size, self._gettime)
+    return self._near_cache
+
+  def _GetNearCacheTTL(self, namespace):
+    """Returns the seconds values of a namespace are kept in the NearCache.
+
+    Args:
+      namespace: The namespace the values are stored under.
+    """
+    try:
+      for entry in os.environ.get(NEAR_CACHE_NAMESPACE_TTLS_VAR, '').split(','):
+        name, _, ttl = entry.rpartition(':')
+        if ttl and name == namespace:
+          return float(ttl)
+      return float(os.environ.get(NEAR_CACHE_TTL_VAR, DEFAULT_NEAR_CACHE_TTL))
+    except ValueError:
+      return DEFAULT_NEAR_CACHE_TTL
 
-    Does not take deletion timeout into account.
+  def _InvalidateNearCache(self, internal_keys):
+    """Removes keys changed by this app server from the NearCache.
 
     Args:
-      namespace: The namespace that keys are stored under.
-      key: The key to retrieve from the cache.
+      internal_keys: A list of internal keys.
+    """
+    if self._near_cache is not None:
+      self._near_cache.Invalidate(internal_keys)
+
+  def _Pipeline(self, requests):
+    """Sends commands to the memcached servers holding their keys, with one
+    exchange per server, and reads the one line response to each.
+
+    Args:
+      requests: A list of (internal_key, command) tuples, where command is the
+        full text of a storage or delete command.
 
     Returns:
-      The corresponding CacheEntry instance, or None if it was not found or
-      has already expired.
+      A list of the response lines in the order of requests, with None for
+      commands whose key is invalid or whose server could not be reached.
     """
-    internal_key = self._Get_Internal_Key(namespace, key)
+    responses = [None] * len(requests)
+    server_commands = {}
+    for index, (internal_key, command) in enumerate(requests):
+      if not self._IsValidKey(internal_key):
+        continue
+      server, _ = self._memcache._get_server(internal_key)
+      if server is None:
+        continue
+      server_commands.setdefault(server, []).append((index, command))
+
+    for server, commands in server_commands.items():
+      try:
+        server.send_cmds(''.join(command for _, command in commands))
+        for index, _ in commands:
+          # A server that closes the connection is marked dead by readline,
+          # which drops its socket, so nothing more can be read from it.
+          line = server.readline()
+          if not line:
+            break
+          responses[index] = line
+      except socket.error, error:
+        server.mark_dead(error)
+    return responses
+
+  def _IsValidKey(self, internal_key):
+    """Checks that memcached accepts a key. A command with a key it rejects
+    gets two error lines back, which would answer the next command sent in
+    the same exchange.
 
-    entry = self._memcache.get(internal_key)
-    if entry is None:
-      return None
-    else:
-      return entry
+    Args:
+      internal_key: An internal key.
+
+    Returns:
+      True if the key can be sent to memcached, False otherwise.
+    """
+    try:
+      self._memcache.check_key(internal_key)
+    except memcache.Client.MemcachedKeyError:
+      return False
+    return True
+
+  def _GetMulti(self, internal_keys, for_cas=False):
+    """Fetches keys with one exchange per memcached server.
+
+    Args:
+      internal_keys: A list of internal keys.
+      for_cas: True to also fetch the CAS IDs of the values.
+
+    Returns:
+      A dict of the internal keys found to (value, flags, cas_id) tuples.
+      cas_id is None unless for_cas is True.
+    """
+    server_keys = {}
+    for internal_key in internal_keys:
+      if not self._IsValidKey(internal_key):
+        continue
+      server, _ = self._memcache._get_server(internal_key)
+      if server is None:
+        continue
+      server_keys.setdefault(server, []).append(internal_key)
+
+    command = 'get'
+    if for_cas:
+      command = 'gets'
+
+    found = {}
+    for server, keys in server_keys.items():
+      try:
+        server.send_cmd('%s %s' % (command, ' '.join(keys)))
+        line = server.readline()
+        while line and line != 'END':
+          fields = line.split()
+          if fields[0] != 'VALUE':
+            break
+          cas_id = None
+          if for_cas:
+            cas_id = long(fields[4])
+          value = server.recv(int(fields[3]) + 2)[:-2]
+          found[fields[1]] = (value, int(fields[2]), cas_id)
+          line = server.readline()
+      except socket.error, error:
+        server.mark_dead(error)
+    return found
 
   def _Dynamic_Get(self, request, response):
     """Implementation of MemcacheService::Get().
@@ -156,41 +561,76 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       response: A MemcacheGetResponse.
     """
     namespace = request.name_space()
-    keys = set(request.key_list())
-    for key in keys:
-      value = self._GetKey(namespace, key)
-      if value is None: 
-        continue
+    keys = dict((self._Get_Internal_Key(namespace, key), key)
+                for key in set(request.key_list()))
+
+    # Reads for CAS need the current CAS ID from the server.
+    near_cache = None
+    if not request.for_cas():
+      near_cache = self._GetNearCache()
+
+    found = {}
+    if near_cache:
+      for internal_key in keys:
+        entry = near_cache.Get(internal_key)
+        if entry is not None:
+          found[internal_key] = entry + (None,)
+
+    fetched = self._GetMulti([internal_key for internal_key in keys
+                              if internal_key not in found],
+                             request.for_cas())
+    if near_cache:
+      ttl = self._GetNearCacheTTL(namespace)
+      if ttl > 0:
+        for internal_key, (value, flags, _) in fetched.items():
+          near_cache.Put(internal_key, value, flags, ttl)
+    found.update(fetched)
+
+    for internal_key, (value, flags, cas_id) in found.items():
       item = response.add_item()
-      item.set_key(key)
+      item.set_key(keys[internal_key])
       item.set_value(value)
+      item.set_flags(flags)
+      if cas_id is not None:
+        item.set_cas_id(cas_id)
 
   def _Dynamic_Set(self, request, response):
     """Implementation of MemcacheService::Set().
 
+    Each set policy maps onto the memcached command with the same meaning,
+    so that servers decide atomically whether to store each item.
+
     Args:
       request: A MemcacheSetRequest.
       response: A MemcacheSetResponse.
     """
     namespace = request.name_space()
+    statuses = []
+    requests = []
     for item in request.item_list():
-      key = item.key()
+      statuses.append(MemcacheSetResponse.NOT_STORED)
       set_policy = item.set_policy()
-      old_entry = self._GetKey(namespace, key)
-
-      set_status = MemcacheSetResponse.NOT_STORED
-      if ((set_policy == MemcacheSetRequest.SET) or
-          (set_policy == MemcacheSetRequest.ADD and old_entry is None) or
-          (set_policy == MemcacheSetRequest.REPLACE and old_entry is not None)):
-
-        if (old_entry is None or
-            set_policy == MemcacheSetRequest.SET
-            or not old_entry.CheckLocked()):
-          internal_key = self._Get_Internal_Key(namespace, key)
-          if self._memcache.set(internal_key, item.value(), item.expiration_time()):
-            set_status = MemcacheSetResponse.STORED
-
-      response.add_set_status(set_status)
+      cas_id = ''
+      if set_policy == MemcacheSetRequest.CAS:
+        if not item.has_cas_id():
+          continue
+        cas_id = ' %d' % item.cas_id()
+      internal_key = self._Get_Internal_Key(namespace, item.key())
+      command = '%s %s %d %d %d%s\r\n%s\r\n' % (
+        self._STORE_COMMANDS[set_policy], internal_key, item.flags(),
+        item.expiration_time(), len(item.value()), cas_id, item.value())
+      requests.append((len(statuses) - 1, internal_key, command))
+
+    self._InvalidateNearCache([internal_key
+                               for _, internal_key, _ in requests])
+    lines = self._Pipeline([(internal_key, command)
+                            for _, internal_key, command in requests])
+    for (index, _, _), line in zip(requests, lines):
+      statuses[index] = self._SET_STATUSES.get(line,
+                                               MemcacheSetResponse.ERROR)
+
+    for status in statuses:
+      response.add_set_status(status)
 
   def _Dynamic_Delete(self, request, response):
     """Implementation of MemcacheService::Delete().
@@ -200,18 +640,17 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       response: A MemcacheDeleteResponse.
     """
     namespace = request.name_space()
+    requests = []
     for item in request.item_list():
-      key = item.key()
-      entry = self._GetKey(namespace, key)
+      internal_key = self._Get_Internal_Key(namespace, item.key())
+      requests.append((internal_key, 'delete %s\r\n' % internal_key))
 
-      delete_status = MemcacheDeleteResponse.DELETED
-      if entry is None:
-        delete_status = MemcacheDeleteResponse.NOT_FOUND
+    self._InvalidateNearCache([internal_key for internal_key, _ in requests])
+    for line in self._Pipeline(requests):
+      if line == 'DELETED':
+        response.add_delete_status(MemcacheDeleteResponse.DELETED)
       else:
-        internal_key = self._Get_Internal_Key(namespace, key)
-        self._memcache.delete(internal_key)
-
-      response.add_delete_status(delete_status)
+        response.add_delete_status(MemcacheDeleteResponse.NOT_FOUND)
 
   def _Dynamic_Increment(self, request, response):
     """Implementation of MemcacheService::Increment().
@@ -227,13 +666,14 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
     new_value = 0
     try:
       internal_key = self._Get_Internal_Key(namespace, key)
+      self._InvalidateNearCache([internal_key])
       if request.direction() == MemcacheIncrementRequest.INCREMENT:
         new_value = self._memcache.incr(internal_key, delta)
       elif request.direction() == MemcacheIncrementRequest.DECREMENT:
         new_value = self._memcache.decr(internal_key, delta)
       else:
         raise ValueError
-    except ValueError:
+    except (ValueError, memcache.Client.MemcachedKeyError):
       return
 
     response.set_new_value(new_value)
@@ -246,6 +686,8 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       response: A MemcacheFlushResponse.
     """
     self._memcache.flush_all()
+    if self._near_cache is not None:
+      self._near_cache.Clear()
 
   def _Dynamic_Stats(self, request, response):
     """Implementation of MemcacheService::Stats().
@@ -260,6 +702,10 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
     2) time of oldest item in cache returns the age of the cache, not the
        time of the oldest item. Resolved to just return zero for now.
 
+    Reads answered by the NearCache of this app server never reach memcached,
+    so its hits are added to the hits of the servers. Its misses are not, as
+    they are counted by the servers they are read from.
+
     Args:
       request: A MemcacheStatsRequest.
       response: A MemcacheStatsResponse.
@@ -279,6 +725,10 @@ class MemcacheService(apiproxy_stub.APIProxyStub):
       bytes_written += int(memcache_stats['bytes_written'])
       bytes += int(memcache_stats['bytes'])
 
+    if self._near_cache is not None:
+      hits += self._near_cache.hits
+      bytes_written += self._near_cache.byte_hits
+
     stats = response.mutable_stats()
     stats.set_hits(hits)
     stats.set_misses(misses)
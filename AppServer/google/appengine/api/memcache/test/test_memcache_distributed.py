@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import memcache
+
+memcache_path = "{0}/../../../../..".format(os.path.dirname(__file__))
+sys.path.append(memcache_path)
+from google.appengine.api.memcache import memcache_distributed
+from google.appengine.api.memcache import memcache_service_pb
+
+MemcacheSetRequest = memcache_service_pb.MemcacheSetRequest
+MemcacheSetResponse = memcache_service_pb.MemcacheSetResponse
+MemcacheDeleteResponse = memcache_service_pb.MemcacheDeleteResponse
+
+
+class FakeServer():
+  """ Answers the parts of the memcached text protocol the service uses. """
+
+  def __init__(self):
+    self.items = {}
+    self.next_cas_id = 1
+    self.exchanges = 0
+    self.output = ''
+
+  def send_cmd(self, cmd):
+    self.send_cmds(cmd + '\r\n')
+
+  def send_cmds(self, cmds):
+    self.exchanges += 1
+    while cmds:
+      line, cmds = cmds.split('\r\n', 1)
+      fields = line.split()
+      if fields[0] in ('get', 'gets'):
+        for key in fields[1:]:
+          if key in self.items:
+            value, flags, cas_id = self.items[key]
+            cas = ''
+            if fields[0] == 'gets':
+              cas = ' %d' % cas_id
+            self.output += 'VALUE %s %d %d%s\r\n%s\r\n' % (key, flags,
+              len(value), cas, value)
+        self.output += 'END\r\n'
+      elif fields[0] == 'delete':
+        if self.items.pop(fields[1], None):
+          self.output += 'DELETED\r\n'
+        else:
+          self.output += 'NOT_FOUND\r\n'
+      else:
+        length = int(fields[4])
+        value, cmds = cmds[:length], cmds[length + 2:]
+        self.output += self.store(fields, value) + '\r\n'
+
+  def store(self, fields, value):
+    command, key, flags = fields[0], fields[1], int(fields[2])
+    exists = key in self.items
+    if command == 'add' and exists:
+      return 'NOT_STORED'
+    if command == 'replace' and not exists:
+      return 'NOT_STORED'
+    if command == 'cas':
+      if not exists:
+        return 'NOT_FOUND'
+      if self.items[key][2] != long(fields[5]):
+        return 'EXISTS'
+    self.items[key] = (value, flags, self.next_cas_id)
+    self.next_cas_id += 1
+    return 'STORED'
+
+  def readline(self):
+    line, self.output = self.output.split('\r\n', 1)
+    return line
+
+  def recv(self, length):
+    data, self.output = self.output[:length], self.output[length:]
+    return data
+
+
+class ClosingServer(FakeServer):
+  """ Closes the connection after answering the first command, as
+  memcache._Host does by dropping its socket. """
+
+  def __init__(self):
+    FakeServer.__init__(self)
+    self.socket = True
+
+  def send_cmds(self, cmds):
+    FakeServer.send_cmds(self, cmds)
+    self.output = self.output.split('\r\n', 1)[0] + '\r\n'
+
+  def readline(self):
+    if not self.socket:
+      raise AttributeError("'NoneType' object has no attribute 'recv'")
+    if not self.output:
+      self.socket = None
+      return ''
+    return FakeServer.readline(self)
+
+
+class FakeClient():
+  """ Spreads keys over fake servers, as memcache.Client does. """
+
+  def __init__(self, servers):
+    self.servers = servers
+
+  def check_key(self, key):
+    if len(key) > memcache.SERVER_MAX_KEY_LENGTH:
+      raise memcache.Client.MemcachedKeyLengthError(key)
+
+  def _get_server(self, key):
+    return self.servers[sum(ord(char) for char in key) % len(self.servers)], \
+      key
+
+
+class TestMemcacheDistributed(unittest.TestCase):
+
+  def setUp(self):
+    os.environ['APPNAME'] = 'my-app'
+    self.servers = [FakeServer(), FakeServer()]
+    self.service = memcache_distributed.MemcacheService(
+      client=FakeClient(self.servers))
+
+  def tearDown(self):
+    os.environ['APPNAME'] = ''
+    for name in [memcache_distributed.NEAR_CACHE_SIZE_VAR,
+                 memcache_distributed.NEAR_CACHE_NAMESPACE_TTLS_VAR]:
+      os.environ.pop(name, None)
+
+  def set(self, items, set_policy=MemcacheSetRequest.SET, cas_ids=None):
+    request = MemcacheSetRequest()
+    for key, value in items:
+      item = request.add_item()
+      item.set_key(key)
+      item.set_value(value)
+      item.set_flags(3)
+      item.set_set_policy(set_policy)
+      if cas_ids:
+        item.set_cas_id(cas_ids[key])
+    response = MemcacheSetResponse()
+    self.service._Dynamic_Set(request, response)
+    return response.set_status_list()
+
+  def get(self, keys, for_cas=False):
+    request = memcache_service_pb.MemcacheGetRequest()
+    for key in keys:
+      request.add_key(key)
+    request.set_for_cas(for_cas)
+    response = memcache_service_pb.MemcacheGetResponse()
+    self.service._Dynamic_Get(request, response)
+    return dict((item.key(), item) for item in response.item_list())
+
+  def test_set_and_get(self):
+    keys = ['key{0}'.format(index) for index in range(10)]
+    self.assertEquals([MemcacheSetResponse.STORED] * 10,
+                      self.set([(key, key + 'value') for key in keys]))
+    items = self.get(keys + ['missing'])
+    self.assertEquals(sorted(keys), sorted(items.keys()))
+    self.assertEquals('key1value', items['key1'].value())
+    self.assertEquals(3, items['key1'].flags())
+
+    # Every request is one exchange with each server.
+    self.assertEquals([2, 2], [server.exchanges for server in self.servers])
+
+  def test_add_and_replace(self):
+    self.set([('a', '1')])
+    self.assertEquals([MemcacheSetResponse.NOT_STORED,
+                       MemcacheSetResponse.STORED],
+                      self.set([('a', '2'), ('b', '2')],
+                               MemcacheSetRequest.ADD))
+    self.assertEquals([MemcacheSetResponse.STORED,
+                       MemcacheSetResponse.NOT_STORED],
+                      self.set([('a', '3'), ('c', '3')],
+                               MemcacheSetRequest.REPLACE))
+    items = self.get(['a', 'b', 'c'])
+    self.assertEquals({'a': '3', 'b': '2'},
+                      dict((key, item.value()) for key, item in items.items()))
+
+  def test_cas(self):
+    self.set([('a', '1')])
+    cas_id = self.get(['a'], for_cas=True)['a'].cas_id()
+    self.assertEquals([MemcacheSetResponse.STORED],
+      self.set([('a', '2')], MemcacheSetRequest.CAS, {'a': cas_id}))
+    self.assertEquals([MemcacheSetResponse.EXISTS],
+      self.set([('a', '3')], MemcacheSetRequest.CAS, {'a': cas_id}))
+    self.assertEquals([MemcacheSetResponse.NOT_STORED],
+      self.set([('b', '3')], MemcacheSetRequest.CAS, {'b': cas_id}))
+    self.assertEquals([MemcacheSetResponse.NOT_STORED],
+      self.set([('a', '3')], MemcacheSetRequest.CAS))
+    self.assertEquals('2', self.get(['a'])['a'].value())
+
+  def test_near_cache(self):
+    os.environ[memcache_distributed.NEAR_CACHE_SIZE_VAR] = '2'
+    os.environ[memcache_distributed.NEAR_CACHE_NAMESPACE_TTLS_VAR] = 'other:0'
+    self.set([('a', '1'), ('b', '2'), ('c', '3')])
+    exchanges = sum(server.exchanges for server in self.servers)
+    self.get(['a'])
+    self.assertEquals('1', self.get(['a'])['a'].value())
+    self.assertEquals(3, self.get(['a'])['a'].flags())
+    self.assertEquals(exchanges + 1,
+                      sum(server.exchanges for server in self.servers))
+
+    # Local changes and reads for CAS go to the servers.
+    self.set([('a', '4')])
+    self.assertEquals('4', self.get(['a'])['a'].value())
+    self.assertTrue(self.get(['a'], for_cas=True)['a'].has_cas_id())
+
+    stats = memcache_service_pb.MemcacheStatsResponse()
+    self.service._memcache.get_stats = lambda: []
+    self.service._Dynamic_Stats(memcache_service_pb.MemcacheStatsRequest(),
+                                stats)
+    self.assertEquals(2, stats.stats().hits())
+
+  def test_near_cache_lru(self):
+    now = [0]
+    cache = memcache_distributed.NearCache(2, gettime=lambda: now[0])
+    cache.Put('a', '1', 0, 10)
+    cache.Put('b', '2', 0, 10)
+    cache.Get('a')
+    cache.Put('c', '3', 0, 10)
+    self.assertEquals(None, cache.Get('b'))
+    self.assertEquals(('1', 0), cache.Get('a'))
+    now[0] = 10
+    self.assertEquals(None, cache.Get('a'))
+    self.assertEquals((2, 2), (cache.hits, cache.misses))
+
+  def test_delete(self):
+    self.set([('a', '1')])
+    request = memcache_service_pb.MemcacheDeleteRequest()
+    request.add_item().set_key('a')
+    request.add_item().set_key('b')
+    response = MemcacheDeleteResponse()
+    self.service._Dynamic_Delete(request, response)
+    self.assertEquals([MemcacheDeleteResponse.DELETED,
+                       MemcacheDeleteResponse.NOT_FOUND],
+                      response.delete_status_list())
+    self.assertEquals({}, self.get(['a']))
+
+  def test_long_key_in_batch(self):
+    long_key = 'k' * 200
+    self.assertEquals([MemcacheSetResponse.STORED, MemcacheSetResponse.ERROR,
+                       MemcacheSetResponse.STORED],
+                      self.set([('a', '1'), (long_key, '2'), ('c', '3')]))
+    items = self.get(['a', long_key, 'c'])
+    self.assertEquals(['a', 'c'], sorted(items.keys()))
+    self.assertEquals('3', items['c'].value())
+
+    # Nothing is left unread on the connections for the next request.
+    self.assertEquals(['', ''], [server.output for server in self.servers])
+
+  def test_set_after_server_closes(self):
+    self.servers[:] = [ClosingServer()]
+    self.assertEquals([MemcacheSetResponse.STORED, MemcacheSetResponse.ERROR,
+                       MemcacheSetResponse.ERROR],
+                      self.set([('a', '1'), ('b', '2'), ('c', '3')]))
+
+
+class TestHashRing(unittest.TestCase):
+
+  def setUp(self):
+    self.keys = ['key{0}'.format(index) for index in range(10000)]
+
+  def test_weights(self):
+    ring = memcache_distributed.HashRing({'a': 1, 'b': 1, 'c': 2})
+    counts = {}
+    for key in self.keys:
+      node = ring.GetNode(key)
+      counts[node] = counts.get(node, 0) + 1
+    self.assertTrue(0.4 < counts['c'] / float(len(self.keys)) < 0.6)
+    self.assertTrue(0.18 < counts['a'] / float(len(self.keys)) < 0.32)
+
+  def test_membership_change_moves_few_keys(self):
+    before = memcache_distributed.HashRing({'a': 1, 'b': 1, 'c': 1, 'd': 1})
+    after = memcache_distributed.HashRing({'a': 1, 'b': 1, 'c': 1, 'd': 1,
+                                           'e': 1})
+    moved = [key for key in self.keys
+             if before.GetNode(key) != after.GetNode(key)]
+    # Only keys taken by the new node move, about 1/5 of them.
+    self.assertTrue(all(after.GetNode(key) == 'e' for key in moved))
+    self.assertTrue(0.14 < len(moved) / float(len(self.keys)) < 0.26)
+
+  def test_iter_nodes(self):
+    ring = memcache_distributed.HashRing({'a': 1, 'b': 1, 'c': 1})
+    nodes = list(ring.IterNodes('key'))
+    self.assertEquals(['a', 'b', 'c'], sorted(nodes))
+    self.assertEquals(ring.GetNode('key'), nodes[0])
+    self.assertEquals(None, memcache_distributed.HashRing({}).GetNode('key'))
+
+
+class TestRingClient(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'memcache_ips')
+    self.write_servers('10.0.0.1\n10.0.0.2:11212 2\n\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write_servers(self, contents):
+    with open(self.path, 'w') as servers_file:
+      servers_file.write(contents)
+
+  def test_read_servers(self):
+    self.assertEquals({'10.0.0.1:11211': 1, '10.0.0.2:11212': 2},
+                      memcache_distributed.ReadServers(self.path))
+
+  def test_membership_reload(self):
+    client = memcache_distributed.RingClient(self.path, check_interval=0)
+    self.assertEquals(['10.0.0.1:11211', '10.0.0.2:11212'],
+                      sorted(client._hosts.keys()))
+    kept = client._hosts['10.0.0.1:11211']
+
+    self.write_servers('10.0.0.1\n10.0.0.3\n')
+    os.utime(self.path, (0, 0))
+    client._CheckMembership()
+    self.assertEquals(['10.0.0.1:11211', '10.0.0.3:11211'],
+                      sorted(client._hosts.keys()))
+    self.assertTrue(kept is client._hosts['10.0.0.1:11211'])
+    self.assertEquals(2, len(client.servers))
+
+    # A list caught part way through being rewritten is ignored.
+    self.write_servers('')
+    os.utime(self.path, (1, 1))
+    client._CheckMembership()
+    self.assertEquals(2, len(client._hosts))
+
+
+if __name__ == "__main__":
+  unittest.main()
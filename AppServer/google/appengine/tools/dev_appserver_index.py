@@ -29,5 +29,5 @@
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.datastore.datastore_stub_index import *
 
-def SetupIndexes(unused_app_id, unused_root_path):
-  apiproxy_stub_map.apiproxy.GetStub('datastore_v3')._SetupIndexes()
+def SetupIndexes(unused_app_id, root_path):
+  apiproxy_stub_map.apiproxy.GetStub('datastore_v3')._SetupIndexes(root_path)
@@ -165,6 +165,7 @@ from google.appengine.api import yaml_errors
 from google.appengine.tools import appcfg
 from google.appengine.tools import appengine_rpc
 from google.appengine.tools import dev_appserver
+from google.appengine.tools import dev_appserver_index
 #from google.appengine.tools import dev_appserver_multiprocess as multiprocess
 
 
@@ -741,6 +742,14 @@ def main(argv):
           exc_type, exc_value, exc_traceback)))
     return 1
 
+  try:
+    dev_appserver_index.SetupIndexes(appinfo.application, root_path)
+  except:
+    # Queries fall back to the property indexes without composite indexes.
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    logging.warning('Unable to set up composite indexes: ' + str(exc_type) +
+                    ': ' + str(exc_value))
+
   #frontend_port = option_dict.get(ARG_MULTIPROCESS_FRONTEND_PORT, None)
   #if frontend_port is not None:
   #  frontend_port = int(frontend_port)
@@ -20,18 +20,161 @@
 
 import array
 import httplib
+import os
 import re
+import select
+import socket
 import struct
+import threading
+import time
 
 __all__ = ['ProtocolMessage', 'Encoder', 'Decoder',
            'ExtendableProtocolMessage',
            'ProtocolBufferDecodeError',
            'ProtocolBufferEncodeError',
-           'ProtocolBufferReturnError']
+           'ProtocolBufferReturnError',
+           'ConnectionPool']
 
 
 URL_RE = re.compile('^(https?)://([^/]+)(/.*)$')
 
+
+class ConnectionPool(object):
+  """Keeps connections to RPC servers open between requests.
+
+  AppScale: Idle connections are kept per (server, secure, keyfile,
+  certfile) endpoint, so that a request to the datastore or taskqueue
+  server costs a round trip instead of a new TCP connection and TLS
+  handshake. Connections are checked before reuse and dropped if the
+  server closed them or they were idle for too long.
+  """
+
+  MAX_IDLE_CONNECTIONS = 8
+
+  MAX_IDLE_SECONDS = 60
+
+  def __init__(self, max_idle_connections=MAX_IDLE_CONNECTIONS,
+               max_idle_seconds=MAX_IDLE_SECONDS):
+    """Constructor.
+
+    Args:
+      max_idle_connections: The number of idle connections kept for each
+        endpoint.
+      max_idle_seconds: Idle connections older than this are not reused.
+    """
+    self.max_idle_connections = max_idle_connections
+    self.max_idle_seconds = max_idle_seconds
+    self._lock = threading.Lock()
+    self._idle = {}
+    self._pid = os.getpid()
+    self._stats = {'hits': 0, 'misses': 0, 'handshakes': 0, 'discarded': 0,
+                   'reconnects': 0}
+
+  def _Count(self, name):
+    """Increments a counter reported by GetStats."""
+    with self._lock:
+      self._stats[name] += 1
+
+  def _Connect(self, endpoint):
+    """Opens a new connection to an endpoint."""
+    server, secure, keyfile, certfile = endpoint
+    if secure:
+      if keyfile and certfile:
+        conn = httplib.HTTPSConnection(server, key_file=keyfile,
+                                       cert_file=certfile)
+      else:
+        conn = httplib.HTTPSConnection(server)
+    else:
+      conn = httplib.HTTPConnection(server)
+    conn.connect()
+    self._Count('handshakes')
+    return conn
+
+  @staticmethod
+  def _IsHealthy(conn):
+    """Checks that an idle connection is still open.
+
+    An idle connection has nothing to read, unless the server closed it or
+    sent something unexpected, so it is only reused if its socket is not
+    readable.
+    """
+    if conn.sock is None:
+      return False
+    try:
+      readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+      return False
+    return not readable
+
+  def Get(self, endpoint):
+    """Returns a connection to an endpoint.
+
+    Args:
+      endpoint: A (server, secure, keyfile, certfile) tuple.
+
+    Returns:
+      A tuple of an open httplib connection and whether it was reused.
+    """
+    now = time.time()
+    with self._lock:
+      if self._pid != os.getpid():
+        # Connections inherited from the parent process are not ours to use.
+        self._idle = {}
+        self._pid = os.getpid()
+      idle = self._idle.get(endpoint, [])
+      while idle:
+        conn, last_used = idle.pop()
+        if now - last_used <= self.max_idle_seconds and self._IsHealthy(conn):
+          self._stats['hits'] += 1
+          return conn, True
+        self._stats['discarded'] += 1
+        conn.close()
+      self._stats['misses'] += 1
+    return self._Connect(endpoint), False
+
+  def Reconnect(self, endpoint):
+    """Returns a new connection to replace one which failed."""
+    self._Count('reconnects')
+    return self._Connect(endpoint)
+
+  def Put(self, endpoint, conn):
+    """Returns a connection to the pool after its response was read.
+
+    Args:
+      endpoint: A (server, secure, keyfile, certfile) tuple.
+      conn: The httplib connection.
+    """
+    with self._lock:
+      if self._pid == os.getpid():
+        idle = self._idle.setdefault(endpoint, [])
+        if len(idle) < self.max_idle_connections:
+          idle.append((conn, time.time()))
+          return
+    conn.close()
+
+  def Clear(self):
+    """Closes all idle connections."""
+    with self._lock:
+      idle, self._idle = self._idle, {}
+    for connections in idle.values():
+      for conn, _ in connections:
+        conn.close()
+
+  def GetStats(self):
+    """Returns the pool's counters.
+
+    Returns:
+      A dictionary with the number of hits, misses, handshakes, discarded
+      idle connections, reconnects and currently idle connections.
+    """
+    with self._lock:
+      stats = dict(self._stats)
+      stats['idle'] = sum(len(idle) for idle in self._idle.values())
+    return stats
+
+
+connection_pool = ConnectionPool()
+
 class ProtocolMessage:
 
 
@@ -109,26 +252,47 @@ class ProtocolMessage:
   def sendCommand(self, server, url, response, follow_redirects=1,
                   secure=0, keyfile=None, certfile=None):
     data = self.Encode()
+    # AppScale
+    # Connections are kept open and reused for later requests to the same
+    # server, see ConnectionPool.
     if secure:
-      if keyfile and certfile:
-        conn = httplib.HTTPSConnection(server, key_file=keyfile,
-                                       cert_file=certfile)
-      else:
-        conn = httplib.HTTPSConnection(server)
+      endpoint = (server, True, keyfile, certfile)
     else:
-      conn = httplib.HTTPConnection(server)
-    conn.putrequest("POST", "/")
-    # AppScale
-    # We add additional headers for the datastore server to reason 
-    # about what request it is getting
-    pb_type = str(self.__class__).split('.')[-1]
-    conn.putheader("ProtocolBufferType" , pb_type)
-    conn.putheader("AppData", url) # app id, user email, nick name, auth domain
+      endpoint = (server, False, None, None)
+    conn, reused = connection_pool.Get(endpoint)
+    while True:
+      written = False
+      try:
+        self._writeRequest(conn, url, data)
+        written = True
+        resp = conn.getresponse()
+        break
+      except (httplib.BadStatusLine, socket.error), e:
+        conn.close()
+        # Commands such as Put are not idempotent, so a request is only sent
+        # again if the server never read it. A server which closed the idle
+        # connection makes the write fail, or sends back an empty status
+        # line.
+        closed_idle = not written or (
+          isinstance(e, httplib.BadStatusLine) and e.line in ("", "''"))
+        if not reused or not closed_idle:
+          raise
+        conn = connection_pool.Reconnect(endpoint)
+        reused = False
+      except:
+        conn.close()
+        raise
+
+    try:
+      body = resp.read()
+    except:
+      conn.close()
+      raise
+    if resp.will_close:
+      conn.close()
+    else:
+      connection_pool.Put(endpoint, conn)
 
-    conn.putheader("Content-Length", "%d" %len(data))
-    conn.endheaders()
-    conn.send(data)
-    resp = conn.getresponse()
     if follow_redirects > 0 and resp.status == 302:
       m = URL_RE.match(resp.getheader('Location'))
       if m:
@@ -141,9 +305,23 @@ class ProtocolMessage:
     if resp.status != 200:
       raise ProtocolBufferReturnError(resp.status)
     if response is not None:
-      response.ParseFromString(resp.read())
+      response.ParseFromString(body)
     return response
 
+  def _writeRequest(self, conn, url, data):
+    """Writes the encoded message to a connection as a POST request."""
+    conn.putrequest("POST", "/")
+    # AppScale
+    # We add additional headers for the datastore server to reason 
+    # about what request it is getting
+    pb_type = str(self.__class__).split('.')[-1]
+    conn.putheader("ProtocolBufferType" , pb_type)
+    conn.putheader("AppData", url) # app id, user email, nick name, auth domain
+
+    conn.putheader("Content-Length", "%d" %len(data))
+    conn.endheaders()
+    conn.send(data)
+
   def sendSecureCommand(self, server, keyfile, certfile, url, response,
                         follow_redirects=1):
     return self.sendCommand(server, url, response,
@@ -0,0 +1,128 @@
+import BaseHTTPServer
+import httplib
+import os
+import select
+import SocketServer
+import sys
+import threading
+import unittest
+from flexmock import flexmock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../../.."))
+from google.appengine.api import api_base_pb
+from google.net.proto import ProtocolBuffer
+from google.net.proto.ProtocolBuffer import ConnectionPool
+
+
+class EchoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  # Set to make the server close each connection after responding.
+  close_after_response = False
+
+  # Set to make the server send an invalid status line in response.
+  garble_response = False
+
+  # The number of requests the server has read.
+  requests = 0
+
+  def do_POST(self):
+    request = api_base_pb.StringProto(
+      self.rfile.read(int(self.headers["Content-Length"])))
+    EchoHandler.requests += 1
+    if EchoHandler.garble_response:
+      self.wfile.write("HTTP/1.1 garbage\r\n")
+      self.close_connection = 1
+      return
+    response = api_base_pb.StringProto()
+    response.set_value(request.value() + ":" + self.headers["AppData"])
+    body = response.Encode()
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    self.close_connection = int(EchoHandler.close_after_response)
+
+  def log_message(self, *args):
+    pass
+
+
+class EchoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class TestConnectionPool(unittest.TestCase):
+  def setUp(self):
+    EchoHandler.close_after_response = False
+    EchoHandler.garble_response = False
+    EchoHandler.requests = 0
+    self.server = EchoServer(("localhost", 0), EchoHandler)
+    self.address = "localhost:{0}".format(self.server.server_port)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.pool = ConnectionPool()
+    self.original_pool = ProtocolBuffer.connection_pool
+    ProtocolBuffer.connection_pool = self.pool
+
+  def tearDown(self):
+    ProtocolBuffer.connection_pool = self.original_pool
+    self.pool.Clear()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def send(self, value):
+    request = api_base_pb.StringProto()
+    request.set_value(value)
+    response = api_base_pb.StringProto()
+    request.sendCommand(self.address, "app", response)
+    return response.value()
+
+  def test_reuses_connections(self):
+    for index in range(3):
+      self.assertEquals(self.send(str(index)), "{0}:app".format(index))
+    stats = self.pool.GetStats()
+    self.assertEquals(stats["handshakes"], 1)
+    self.assertEquals(stats["misses"], 1)
+    self.assertEquals(stats["hits"], 2)
+    self.assertEquals(stats["idle"], 1)
+
+  def test_discards_closed_connections(self):
+    EchoHandler.close_after_response = True
+    self.assertEquals(self.send("a"), "a:app")
+    # A request sent before the close arrives is not resent, so the test
+    # waits for it.
+    for connections in self.pool._idle.values():
+      for conn, _ in connections:
+        select.select([conn.sock], [], [], 5)
+    self.assertEquals(self.send("b"), "b:app")
+    stats = self.pool.GetStats()
+    self.assertEquals(stats["handshakes"], 2)
+    self.assertEquals(stats["discarded"], 1)
+    self.assertEquals(stats["hits"], 0)
+
+  def test_reconnects_on_error(self):
+    self.assertEquals(self.send("a"), "a:app")
+    # The closed connection is handed out, and replaced when it fails.
+    for connections in self.pool._idle.values():
+      for conn, _ in connections:
+        conn.sock.close()
+    flexmock(self.pool).should_receive("_IsHealthy").and_return(True)
+    self.assertEquals(self.send("b"), "b:app")
+    stats = self.pool.GetStats()
+    self.assertEquals(stats["hits"], 1)
+    self.assertEquals(stats["reconnects"], 1)
+    self.assertEquals(stats["handshakes"], 2)
+    self.assertEquals(EchoHandler.requests, 2)
+
+  def test_does_not_resend_read_requests(self):
+    self.assertEquals(self.send("a"), "a:app")
+    # The server read the request, so it may have acted on it.
+    EchoHandler.garble_response = True
+    self.assertRaises(httplib.BadStatusLine, self.send, "b")
+    self.assertEquals(EchoHandler.requests, 2)
+    self.assertEquals(self.pool.GetStats()["reconnects"], 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,7 +1,9 @@
 """ Constants and helper functions for the RabbitMQ broker. """
 
 import os
+import socket
 import sys
+import time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../lib"))
 import file_io
@@ -12,6 +14,9 @@ RABBITMQ_LOCATION_FILE = '/etc/appscale/rabbitmq_ip'
 # The port required to connect to RabbitMQ
 RABBITMQ_PORT = 5672
 
+# The seconds to wait for RabbitMQ to confirm a batch of published messages.
+CONFIRM_TIMEOUT = 10
+
 def get_connection_string():
   """ Reads from the local FS to get the RabbitMQ location to 
       connect to.
@@ -24,3 +29,48 @@ def get_connection_string():
   return 'amqp://guest:guest@' + rabbitmq_ip + ':' + \
          str(RABBITMQ_PORT) + '//'
 
+def publish_confirmed(connection, channel, publishes,
+                      timeout=CONFIRM_TIMEOUT):
+  """ Publishes a batch of messages with publisher confirms. The channel is
+      put in confirm mode, every message is sent without waiting for the
+      broker, and then the confirms of the whole batch are awaited.
+
+  Args:
+    connection: The kombu.Connection which the channel belongs to.
+    channel: A channel on which nothing has been published yet, so that
+             its delivery tags count the messages of this batch.
+    publishes: A list of functions which each publish a message on the
+               channel.
+    timeout: The seconds to wait for the confirms.
+  Returns:
+    A list of whether RabbitMQ confirmed each message.
+  """
+  # Transports without confirms, such as librabbitmq, only publish.
+  if not hasattr(channel, 'confirm_select'):
+    for publish in publishes:
+      publish()
+    return [True] * len(publishes)
+
+  confirms = {}
+  def on_confirm(confirmed):
+    def callback(delivery_tag, multiple):
+      tags = [delivery_tag]
+      if multiple:
+        tags = range(1, delivery_tag + 1)
+      for tag in tags:
+        confirms.setdefault(tag, confirmed)
+    return callback
+  channel.events['basic_ack'].add(on_confirm(True))
+  channel.events['basic_nack'].add(on_confirm(False))
+  channel.confirm_select()
+
+  for publish in publishes:
+    publish()
+
+  deadline = time.time() + timeout
+  try:
+    while len(confirms) < len(publishes):
+      connection.drain_events(timeout=max(deadline - time.time(), 0))
+  except socket.timeout:
+    pass
+  return [confirms.get(tag, False) for tag in range(1, len(publishes) + 1)]
@@ -10,26 +10,30 @@ import hashlib
 import json
 import logging
 import os
+import random
 import socket
 import sys
 import time
 import urllib2
  
+import pull_queue
 import taskqueue_server
 import tq_lib
 
+from brokers import rabbitmq
 from tq_config import TaskQueueConfig
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../lib"))
 import appscale_info
+import constants
 import file_io
 import god_app_configuration
 import god_interface
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../AppServer"))
 from google.appengine.runtime import apiproxy_errors
-#from google.appengine.api import datastore_distributed
-#from google.appengine.api import datastore
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_distributed
 
 from google.appengine.api.taskqueue import taskqueue_service_pb
 
@@ -85,6 +89,11 @@ class DistributedTaskQueue():
     file_io.mkdir(self.LOG_DIR)
     file_io.mkdir(TaskQueueConfig.CELERY_WORKER_DIR)
     file_io.mkdir(TaskQueueConfig.CELERY_CONFIG_DIR)
+    self.__pull_queues = None
+    # Celery worker modules and the hashes authenticating task requests,
+    # keyed by application ID.
+    self.__worker_modules = {}
+    self.__secret_hashes = {}
 
   def __parse_json_and_validate_tags(self, json_request, tags):
     """ Parses JSON and validates that it contains the 
@@ -132,6 +141,7 @@ class DistributedTaskQueue():
         stop_command = self.get_worker_stop_command(app_id)
         os.system(stop_command) 
         TaskQueueConfig.remove_config_files(app_id)
+        self.__forget_worker_module(app_id)
         result = {'error': False}
       else:
         result = {'error': True, 'reason': "Unable to stop watch %s" % watch}
@@ -180,6 +190,7 @@ class DistributedTaskQueue():
       config.load_queues_from_file(app_id)
       config.create_celery_file(TaskQueueConfig.QUEUE_INFO_FILE) 
       config.create_celery_worker_scripts(TaskQueueConfig.QUEUE_INFO_FILE)
+      self.__forget_worker_module(app_id)
     except ValueError, value_error:
       return json.dumps({"error": True, "reason": str(value_error)}) 
     except NameError, name_error:
@@ -246,7 +257,7 @@ class DistributedTaskQueue():
     return (response.Encode(), 0, "")
 
   def delete(self, app_id, http_data):
-    """ 
+    """ Deletes tasks of a pull queue by name.
 
     Args:
       app_id: The application ID.
@@ -254,13 +265,18 @@ class DistributedTaskQueue():
     Returns:
       A tuple of a encoded response, error code, and error detail.
     """
-    # TODO implement.
     request = taskqueue_service_pb.TaskQueueDeleteRequest(http_data)
     response = taskqueue_service_pb.TaskQueueDeleteResponse()
+    try:
+      # Push tasks are held by celery, and cannot be deleted by name.
+      if self.__is_pull_queue(app_id, request.queue_name()):
+        self.__get_pull_queues().delete_tasks(app_id, request, response)
+    except apiproxy_errors.ApplicationError, error:
+      return (response.Encode(), error.application_error, error.error_detail)
     return (response.Encode(), 0, "")
 
   def query_and_own_tasks(self, app_id, http_data):
-    """ 
+    """ Leases the tasks of a pull queue which are due.
 
     Args:
       app_id: The application ID.
@@ -268,9 +284,13 @@ class DistributedTaskQueue():
     Returns:
       A tuple of a encoded response, error code, and error detail.
     """
-    # TODO implement.
     request = taskqueue_service_pb.TaskQueueQueryAndOwnTasksRequest(http_data)
     response = taskqueue_service_pb.TaskQueueQueryAndOwnTasksResponse()
+    try:
+      self.__validate_pull_queue(app_id, request.queue_name())
+      self.__get_pull_queues().lease_tasks(app_id, request, response)
+    except apiproxy_errors.ApplicationError, error:
+      return (response.Encode(), error.application_error, error.error_detail)
     return (response.Encode(), 0, "")
 
   def add(self, app_id, http_data):
@@ -359,18 +379,37 @@ class DistributedTaskQueue():
     if error_found:
       return
 
+    # Pull tasks are stored together, a transaction per task, and push
+    # tasks are published together.
+    pull_requests = []
+    pull_results = []
+    push_requests = []
+    push_results = []
     for add_request, task_result in zip(request.add_request_list(),
                                         response.taskresult_list()):
       # TODO make sure transactional tasks are handled first at the AppServer
       # level, and not at the taskqueue server level
       # if add_request.has_transaction() is true.
-      
-      try:  
-        self.__enqueue_push_task(add_request)
-      except apiproxy_errors.ApplicationError, e:
-        task_result.set_result(e.application_error)
-      else:
-        task_result.set_result(taskqueue_service_pb.TaskQueueServiceError.OK)
+      if add_request.mode() == taskqueue_service_pb.TaskQueueMode.PULL:
+        try:
+          self.__validate_pull_queue(add_request.app_id(),
+                                     add_request.queue_name())
+        except apiproxy_errors.ApplicationError, e:
+          task_result.set_result(e.application_error)
+        else:
+          pull_requests.append(add_request)
+          pull_results.append(task_result)
+        continue
+      push_requests.append(add_request)
+      push_results.append(task_result)
+
+    if push_requests:
+      self.__enqueue_push_tasks(push_requests, push_results)
+
+    if pull_requests:
+      results = self.__get_pull_queues().add_tasks(pull_requests)
+      for task_result, result in zip(pull_results, results):
+        task_result.set_result(result)
 
   def __method_mapping(self, method):
     """ Maps an int index to a string. 
@@ -391,29 +430,71 @@ class DistributedTaskQueue():
     elif method == taskqueue_service_pb.TaskQueueQueryTasksResponse_Task.DELETE:
       return 'DELETE'
 
-  def __enqueue_push_task(self, request):
-    """ Enqueues a batch of push tasks.
+  def __enqueue_push_tasks(self, requests, task_results):
+    """ Enqueues a batch of push tasks. The tasks of each application are
+        published over a single channel, and confirmed by RabbitMQ together.
   
     Args:
-      request: A taskqueue_service_pb.TaskQueueAddRequest.
+      requests: A list of taskqueue_service_pb.TaskQueueAddRequest.
+      task_results: A list of 
+        taskqueue_service_pb.TaskQueueBulkAddResponse_TaskResult to set
+        the result of each task in.
     """
-    self.__validate_push_task(request)
-
-    args = self.get_task_args(request)
+    publishes_by_app = {}
+    for request, task_result in zip(requests, task_results):
+      try:  
+        self.__validate_push_task(request)
+        task_func = self.__get_task_function(request)
+      except apiproxy_errors.ApplicationError, e:
+        task_result.set_result(e.application_error)
+        continue
+
+      args = self.get_task_args(request)
+      headers = self.get_task_headers(request)
+      countdown = int(headers['X-AppEngine-TaskETA']) - \
+            int(datetime.datetime.now().strftime("%s"))
+      celery_queue_name = TaskQueueConfig.get_celery_queue_name(
+                            request.app_id(), request.queue_name())
+      options = {'kwargs': {'headers': headers, 'args': args},
+                 'expires': args['expires'],
+                 'acks_late': True,
+                 'countdown': countdown,
+                 'queue': celery_queue_name,
+                 'routing_key': celery_queue_name}
+      publishes_by_app.setdefault(request.app_id(), []).append(
+        (task_func, options, task_result))
+
+    for app_id, publishes in publishes_by_app.iteritems():
+      celery = self.__get_worker_module(app_id).celery
+      with celery.pool.acquire(block=True) as connection:
+        channel = connection.channel()
+        try:
+          producer = celery.amqp.TaskProducer(channel)
+          confirmed = rabbitmq.publish_confirmed(connection, channel,
+            [self.__task_publisher(task_func, options, producer)
+             for task_func, options, _ in publishes])
+        finally:
+          channel.close()
+
+      for (_, _, task_result), was_confirmed in zip(publishes, confirmed):
+        if was_confirmed:
+          task_result.set_result(
+            taskqueue_service_pb.TaskQueueServiceError.OK)
+        else:
+          task_result.set_result(
+            taskqueue_service_pb.TaskQueueServiceError.TRANSIENT_ERROR)
+
+  def __task_publisher(self, task_func, options, producer):
+    """ Returns a function which publishes a task with the given producer.
 
-    headers = self.get_task_headers(request)
-    countdown = int(headers['X-AppEngine-TaskETA']) - \
-          int(datetime.datetime.now().strftime("%s"))
-    task_func = self.__get_task_function(request)
-    result = task_func.apply_async(kwargs={'headers':headers,
-                    'args':args},
-                    expires=args['expires'],
-                    acks_late=True,
-                    countdown=countdown,
-                    queue=TaskQueueConfig.get_celery_queue_name(
-                              request.app_id(), request.queue_name()),
-                    routing_key=TaskQueueConfig.get_celery_queue_name(
-                              request.app_id(), request.queue_name()))
+    Args:
+      task_func: The celery task of the queue.
+      options: A dictionary of keyword arguments for apply_async.
+      producer: The celery TaskProducer to publish with.
+    Returns:
+      A function taking no arguments.
+    """
+    return lambda: task_func.apply_async(producer=producer, **options)
 
   def __get_task_function(self, request):
     """ Returns a function pointer to a celery task.
@@ -426,16 +507,92 @@ class DistributedTaskQueue():
     Raises:
       taskqueue_service_pb.TaskQueueServiceError
     """
+    task_module = self.__get_worker_module(request.app_id())
+    if request.queue_name() in getattr(task_module, 'PULL_QUEUES', []):
+      raise apiproxy_errors.ApplicationError(
+              taskqueue_service_pb.TaskQueueServiceError.INVALID_QUEUE_MODE)
     try:
-      task_module = __import__(TaskQueueConfig.\
-                  get_celery_worker_module_name(request.app_id()))
-      task_func = getattr(task_module, 
+      return getattr(task_module, 
         TaskQueueConfig.get_queue_function_name(request.queue_name()))
-      return task_func
-    except ImportError, import_error:
+    except AttributeError:
       raise apiproxy_errors.ApplicationError(
               taskqueue_service_pb.TaskQueueServiceError.UNKNOWN_QUEUE)
-     
+
+  def __get_worker_module(self, app_id):
+    """ Loads the celery worker module of an application, once until its
+        workers are restarted.
+
+    Args:
+      app_id: The application ID.
+    Returns:
+      The worker module.
+    Raises:
+      apiproxy_errors.ApplicationError: If the application has no workers.
+    """
+    if app_id not in self.__worker_modules:
+      try:
+        self.__worker_modules[app_id] = __import__(
+          TaskQueueConfig.get_celery_worker_module_name(app_id))
+      except ImportError:
+        raise apiproxy_errors.ApplicationError(
+                taskqueue_service_pb.TaskQueueServiceError.UNKNOWN_QUEUE)
+    return self.__worker_modules[app_id]
+
+  def __forget_worker_module(self, app_id):
+    """ Drops the loaded worker module of an application, so that a
+        rewritten worker script is imported again.
+
+    Args:
+      app_id: The application ID.
+    """
+    self.__worker_modules.pop(app_id, None)
+    sys.modules.pop(TaskQueueConfig.get_celery_worker_module_name(app_id),
+                    None)
+
+  def __is_pull_queue(self, app_id, queue_name):
+    """ Checks whether a queue of an application is a pull queue.
+
+    Args:
+      app_id: The application ID.
+      queue_name: The name of the queue.
+    Returns:
+      True if the queue is a pull queue, False otherwise.
+    Raises:
+      apiproxy_errors.ApplicationError: If the application has no workers.
+    """
+    # Worker modules written before pull queues existed do not list them.
+    task_module = self.__get_worker_module(app_id)
+    return queue_name in getattr(task_module, 'PULL_QUEUES', [])
+
+  def __validate_pull_queue(self, app_id, queue_name):
+    """ Checks that tasks can be added to or leased from a queue.
+
+    Args:
+      app_id: The application ID.
+      queue_name: The name of the queue.
+    Raises:
+      apiproxy_errors.ApplicationError: If the queue is not a pull queue.
+    """
+    if not self.__is_pull_queue(app_id, queue_name):
+      raise apiproxy_errors.ApplicationError(
+              taskqueue_service_pb.TaskQueueServiceError.INVALID_QUEUE_MODE)
+
+  def __get_pull_queues(self):
+    """ Returns the store of pull queue tasks. The datastore API is pointed
+        at a datastore server the first time it is needed.
+
+    Returns:
+      A pull_queue.PullQueues.
+    """
+    if self.__pull_queues is None:
+      datastore_path = "%s:%d" % (random.choice(appscale_info.get_db_ips()),
+                                  constants.DB_SERVER_PORT)
+      apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+        datastore_distributed.DatastoreDistributed(
+          TaskQueueConfig.APPSCALE_QUEUES, datastore_path, trusted=True))
+      os.environ['APPLICATION_ID'] = TaskQueueConfig.APPSCALE_QUEUES
+      self.__pull_queues = pull_queue.PullQueues()
+    return self.__pull_queues
 
   def get_task_args(self, request):
     """ Gets the task args used when making a task web request.
@@ -494,10 +651,12 @@ class DistributedTaskQueue():
     eta = self.__when_to_run(request)
     
     # This header is how we authenticate that it's an internal request
-    secret = appscale_info.get_secret() 
-    secret_hash = hashlib.sha1(request.app_id() + '/' + \
-                      secret).hexdigest()
-    headers['X-AppEngine-Fake-Is-Admin'] = secret_hash
+    if request.app_id() not in self.__secret_hashes:
+      secret = appscale_info.get_secret() 
+      self.__secret_hashes[request.app_id()] = hashlib.sha1(
+        request.app_id() + '/' + secret).hexdigest()
+    headers['X-AppEngine-Fake-Is-Admin'] = \
+      self.__secret_hashes[request.app_id()]
     #headers['X-AppEngine-Development-Payload'] = secret_hash
     headers['X-AppEngine-QueueName'] = request.queue_name()
     headers['X-AppEngine-TaskName'] = request.task_name()
@@ -565,7 +724,7 @@ class DistributedTaskQueue():
               taskqueue_service_pb.TaskQueueServiceError.INVALID_QUEUE_MODE)
      
   def modify_task_lease(self, app_id, http_data):
-    """ 
+    """ Extends or shortens the lease of a task of a pull queue.
 
     Args:
       app_id: The application ID.
@@ -573,9 +732,13 @@ class DistributedTaskQueue():
     Returns:
       A tuple of a encoded response, error code, and error detail.
     """
-    # TODO implement.
     request = taskqueue_service_pb.TaskQueueModifyTaskLeaseRequest(http_data)
     response = taskqueue_service_pb.TaskQueueModifyTaskLeaseResponse()
+    try:
+      self.__validate_pull_queue(app_id, request.queue_name())
+      self.__get_pull_queues().modify_task_lease(app_id, request, response)
+    except apiproxy_errors.ApplicationError, error:
+      return (response.Encode(), error.application_error, error.error_detail)
     return (response.Encode(), 0, "")
 
   def update_queue(self, app_id, http_data):
@@ -607,7 +770,7 @@ class DistributedTaskQueue():
     return (response.Encode(), 0, "")
 
   def query_tasks(self, app_id, http_data):
-    """ 
+    """ Lists the tasks of a pull queue in ETA order.
 
     Args:
       app_id: The application ID.
@@ -615,13 +778,17 @@ class DistributedTaskQueue():
     Returns:
       A tuple of a encoded response, error code, and error detail.
     """
-    # TODO implement.
     request = taskqueue_service_pb.TaskQueueQueryTasksRequest(http_data)
     response = taskqueue_service_pb.TaskQueueQueryTasksResponse()
+    try:
+      if self.__is_pull_queue(app_id, request.queue_name()):
+        self.__get_pull_queues().query_tasks(app_id, request, response)
+    except apiproxy_errors.ApplicationError, error:
+      return (response.Encode(), error.application_error, error.error_detail)
     return (response.Encode(), 0, "")
 
   def fetch_task(self, app_id, http_data):
-    """ 
+    """ Looks up a task of a pull queue by name.
 
     Args:
       app_id: The application ID.
@@ -629,9 +796,13 @@ class DistributedTaskQueue():
     Returns:
       A tuple of a encoded response, error code, and error detail.
     """
-    # TODO implement.
     request = taskqueue_service_pb.TaskQueueFetchTaskRequest(http_data)
     response = taskqueue_service_pb.TaskQueueFetchTaskResponse()
+    try:
+      if self.__is_pull_queue(app_id, request.queue_name()):
+        self.__get_pull_queues().fetch_task(app_id, request, response)
+    except apiproxy_errors.ApplicationError, error:
+      return (response.Encode(), error.application_error, error.error_detail)
     return (response.Encode(), 0, "")
 
   def force_run(self, app_id, http_data):
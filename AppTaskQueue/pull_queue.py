@@ -0,0 +1,498 @@
+"""
+Keeps the tasks of pull queues in the datastore, where workers lease them.
+
+Each task is an entity group of its own, holding the task and an index
+entity keyed by the queue, ETA and name of the task. The index entities of
+all queues are of one kind, so the tasks of a queue which are due are read
+in ETA order with a key range scan of that kind, which reads neither task
+bodies nor the rows of tasks not yet due. Tasks are then leased one
+transaction each, so workers leasing from the same queue only conflict over
+the same task. Leasing a task moves its ETA to when the lease expires, which
+makes the task available again if the lease is neither extended nor the task
+deleted.
+"""
+
+import os
+import sys
+import time
+
+import tq_lib
+
+from tq_config import TaskQueueConfig
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../AppServer"))
+from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
+from google.appengine.api import datastore_types
+from google.appengine.api.taskqueue import taskqueue_service_pb
+from google.appengine.runtime import apiproxy_errors
+
+# The kind of the entities holding tasks, keyed by queue and task name.
+TASK_KIND = "__pull_task__"
+
+# The kind of the entities ordering the tasks of a queue, keyed by the queue,
+# ETA and name of a task. Each is a child of its task.
+TASK_ETA_KIND = "__pull_task_eta__"
+
+# Task properties.
+TASK_NAME = "name"
+ETA = "eta_usec"
+BODY = "body"
+TAG = "tag"
+RETRY_COUNT = "retry_count"
+CREATED = "creation_time_usec"
+
+# The most tasks which can be leased with one request.
+MAX_TASKS_PER_LEASE = 1000
+
+# The longest lease in seconds, which is one week.
+MAX_LEASE_SECONDS = 7 * 24 * 60 * 60
+
+# The number of index entities read at a time while looking for tasks.
+QUERY_BATCH_SIZE = 100
+
+class PullQueues():
+  """ Stores, leases and deletes the tasks of the pull queues of all
+      applications.
+  """
+
+  def __init__(self, gettime=time.time):
+    """ PullQueues Constructor.
+
+    Args:
+      gettime: A function returning the current time in seconds.
+    """
+    self.__gettime = gettime
+
+  def add_tasks(self, add_requests):
+    """ Stores new tasks, each in a transaction of its own.
+
+    Args:
+      add_requests: A list of taskqueue_service_pb.TaskQueueAddRequest,
+                    with task names chosen.
+    Returns:
+      A list of taskqueue_service_pb.TaskQueueServiceError codes, one for
+      each request.
+    """
+    now = self.__now_usec()
+    results = []
+    added = set()
+    for request in add_requests:
+      queue_name = self.__queue_name(request.app_id(), request.queue_name())
+      if (queue_name, request.task_name()) in added:
+        results.append(
+          taskqueue_service_pb.TaskQueueServiceError.DUPLICATE_TASK_NAME)
+        continue
+      try:
+        code = self.__run_in_transaction(self.__add_task, queue_name,
+                                         request, now)
+      except apiproxy_errors.ApplicationError, error:
+        code = error.application_error
+      if code == taskqueue_service_pb.TaskQueueServiceError.OK:
+        added.add((queue_name, request.task_name()))
+      results.append(code)
+    return results
+
+  def lease_tasks(self, app_id, request, response):
+    """ Leases the tasks of a queue whose ETA has passed, oldest first.
+
+    Args:
+      app_id: The application ID.
+      request: A taskqueue_service_pb.TaskQueueQueryAndOwnTasksRequest.
+      response: A taskqueue_service_pb.TaskQueueQueryAndOwnTasksResponse.
+    Raises:
+      apiproxy_errors.ApplicationError
+    """
+    self.__validate_lease_seconds(request.lease_seconds())
+    if request.max_tasks() <= 0 or request.max_tasks() > MAX_TASKS_PER_LEASE:
+      raise apiproxy_errors.ApplicationError(
+              taskqueue_service_pb.TaskQueueServiceError.INVALID_REQUEST)
+    if request.has_tag() and not request.group_by_tag():
+      raise apiproxy_errors.ApplicationError(
+              taskqueue_service_pb.TaskQueueServiceError.INVALID_REQUEST)
+
+    queue_name = self.__queue_name(app_id, request.queue_name())
+    for task in self.__lease_tasks(queue_name, request):
+      leased_task = response.add_task()
+      leased_task.set_task_name(task[TASK_NAME])
+      leased_task.set_eta_usec(task[ETA])
+      leased_task.set_retry_count(task[RETRY_COUNT])
+      leased_task.set_body(task[BODY])
+      if task.get(TAG) is not None:
+        leased_task.set_tag(task[TAG])
+
+  def modify_task_lease(self, app_id, request, response):
+    """ Extends or shortens the lease of a task which has not expired.
+
+    Args:
+      app_id: The application ID.
+      request: A taskqueue_service_pb.TaskQueueModifyTaskLeaseRequest.
+      response: A taskqueue_service_pb.TaskQueueModifyTaskLeaseResponse.
+    Raises:
+      apiproxy_errors.ApplicationError
+    """
+    self.__validate_lease_seconds(request.lease_seconds())
+    queue_name = self.__queue_name(app_id, request.queue_name())
+    updated_eta = self.__run_in_transaction(self.__modify_task_lease,
+                                            queue_name, request)
+    response.set_updated_eta_usec(updated_eta)
+
+  def delete_tasks(self, app_id, request, response):
+    """ Deletes tasks of a queue by name, each in a transaction of its own.
+
+    Args:
+      app_id: The application ID.
+      request: A taskqueue_service_pb.TaskQueueDeleteRequest.
+      response: A taskqueue_service_pb.TaskQueueDeleteResponse.
+    Raises:
+      apiproxy_errors.ApplicationError
+    """
+    queue_name = self.__queue_name(app_id, request.queue_name())
+    deleted_names = set()
+    for task_name in request.task_name_list():
+      if task_name in deleted_names:
+        response.add_result(
+          taskqueue_service_pb.TaskQueueServiceError.UNKNOWN_TASK)
+        continue
+      code = self.__run_in_transaction(self.__delete_task, queue_name,
+                                       task_name)
+      if code == taskqueue_service_pb.TaskQueueServiceError.OK:
+        deleted_names.add(task_name)
+      response.add_result(code)
+
+  def query_tasks(self, app_id, request, response):
+    """ Lists the tasks of a queue in ETA order, whether or not they are
+        leased.
+
+    Args:
+      app_id: The application ID.
+      request: A taskqueue_service_pb.TaskQueueQueryTasksRequest.
+      response: A taskqueue_service_pb.TaskQueueQueryTasksResponse.
+    Raises:
+      apiproxy_errors.ApplicationError
+    """
+    queue_name = self.__queue_name(app_id, request.queue_name())
+    query = self.__eta_query(
+      self.__eta_bound(queue_name, request.start_eta_usec(),
+                       request.start_task_name()),
+      self.__queue_end_bound(queue_name))
+    try:
+      index_entities = query.Get(request.max_rows())
+      tasks = datastore.Get([entity.key().parent()
+                             for entity in index_entities])
+    except datastore_errors.Error, error:
+      raise apiproxy_errors.ApplicationError(
+              taskqueue_service_pb.TaskQueueServiceError.TRANSIENT_ERROR,
+              str(error))
+    for task in tasks:
+      if task is not None:
+        self.__fill_task(response.add_task(), task)
+
+  def fetch_task(self, app_id, request, response):
+    """ Looks up a task of a queue by name.
+
+    Args:
+      app_id: The application ID.
+      request: A taskqueue_service_pb.TaskQueueFetchTaskRequest.
+      response: A taskqueue_service_pb.TaskQueueFetchTaskResponse.
+    Raises:
+      apiproxy_errors.ApplicationError
+    """
+    queue_name = self.__queue_name(app_id, request.queue_name())
+    try:
+      task = datastore.Get([self.__task_key(queue_name,
+                                            request.task_name())])[0]
+    except datastore_errors.Error, error:
+      raise apiproxy_errors.ApplicationError(
+              taskqueue_service_pb.TaskQueueServiceError.TRANSIENT_ERROR,
+              str(error))
+    if task is None:
+      raise apiproxy_errors.ApplicationError(
+              taskqueue_service_pb.TaskQueueServiceError.UNKNOWN_TASK)
+    self.__fill_task(response.mutable_task().add_task(), task)
+
+  def __add_task(self, queue_name, request, now):
+    """ Stores a new task. Runs in a transaction.
+
+    Args:
+      queue_name: The celery name of the queue.
+      request: A taskqueue_service_pb.TaskQueueAddRequest.
+      now: The current time in microseconds.
+    Returns:
+      A taskqueue_service_pb.TaskQueueServiceError code.
+    """
+    task_key = self.__task_key(queue_name, request.task_name())
+    if datastore.Get([task_key])[0] is not None:
+      return taskqueue_service_pb.TaskQueueServiceError.TASK_ALREADY_EXISTS
+
+    task = datastore.Entity(TASK_KIND, name=task_key.name(),
+                            _app=TaskQueueConfig.APPSCALE_QUEUES)
+    task[TASK_NAME] = request.task_name()
+    task[ETA] = now
+    if request.has_eta_usec():
+      task[ETA] = request.eta_usec()
+    task[BODY] = datastore_types.Blob(request.body())
+    task[TAG] = None
+    if request.has_tag():
+      task[TAG] = datastore_types.ByteString(request.tag())
+    task[RETRY_COUNT] = 0
+    task[CREATED] = now
+    datastore.Put([task, self.__new_index_entity(queue_name, task)])
+    return taskqueue_service_pb.TaskQueueServiceError.OK
+
+  def __lease_tasks(self, queue_name, request):
+    """ Leases the tasks of a queue which are due.
+
+    Args:
+      queue_name: The celery name of the queue.
+      request: A taskqueue_service_pb.TaskQueueQueryAndOwnTasksRequest.
+    Returns:
+      A list of the leased task entities.
+    Raises:
+      apiproxy_errors.ApplicationError: If the datastore could not be read.
+    """
+    now = self.__now_usec()
+    lease_eta = now + tq_lib._sec_to_usec(request.lease_seconds())
+    tag = None
+    tag_chosen = False
+    if request.has_tag():
+      tag = request.tag()
+      tag_chosen = True
+
+    # Index entities are keyed by queue and then ETA, so the scan only
+    # reaches the index entities of this queue's tasks which are due.
+    query = self.__eta_query(self.__eta_bound(queue_name, 0, ""),
+                             self.__eta_bound(queue_name, now + 1, ""))
+    tasks = []
+    try:
+      for index_entity in query.Run(batch_size=QUERY_BATCH_SIZE):
+        # Without a tag given, the tag of the oldest task is leased.
+        if request.group_by_tag() and tag_chosen and \
+           index_entity.get(TAG) != tag:
+          continue
+        task = self.__lease_task(queue_name, index_entity, lease_eta)
+        if task is None:
+          continue
+        if request.group_by_tag() and not tag_chosen:
+          tag = index_entity.get(TAG)
+          tag_chosen = True
+        tasks.append(task)
+        if len(tasks) == request.max_tasks():
+          break
+    except datastore_errors.Error, error:
+      raise apiproxy_errors.ApplicationError(
+              taskqueue_service_pb.TaskQueueServiceError.TRANSIENT_ERROR,
+              str(error))
+    return tasks
+
+  def __lease_task(self, queue_name, index_entity, lease_eta):
+    """ Leases a task found to be due, unless another worker got to it.
+
+    Args:
+      queue_name: The celery name of the queue.
+      index_entity: The index entity of the task.
+      lease_eta: When the lease expires, in microseconds.
+    Returns:
+      The leased task entity, or None if it was no longer due.
+    """
+    try:
+      return datastore.RunInTransaction(self.__lease_due_task, queue_name,
+                                        index_entity.key(),
+                                        index_entity[ETA], lease_eta)
+    except datastore_errors.TransactionFailedError:
+      return None
+
+  def __lease_due_task(self, queue_name, index_key, eta_usec, lease_eta):
+    """ Moves the ETA of a task to when its lease expires. Runs in a
+        transaction.
+
+    Args:
+      queue_name: The celery name of the queue.
+      index_key: The key of the index entity the task was found with.
+      eta_usec: The ETA of the task when it was found.
+      lease_eta: When the lease expires, in microseconds.
+    Returns:
+      The leased task entity, or None if the task has since been deleted or
+      leased.
+    """
+    task = datastore.Get([index_key.parent()])[0]
+    if task is None or task[ETA] != eta_usec:
+      return None
+
+    task[ETA] = lease_eta
+    task[RETRY_COUNT] += 1
+    index_entity = self.__new_index_entity(queue_name, task)
+    if index_entity.key() != index_key:
+      datastore.Delete(index_key)
+    datastore.Put([task, index_entity])
+    return task
+
+  def __modify_task_lease(self, queue_name, request):
+    """ Moves the ETA of a leased task. Runs in a transaction.
+
+    Args:
+      queue_name: The celery name of the queue.
+      request: A taskqueue_service_pb.TaskQueueModifyTaskLeaseRequest.
+    Returns:
+      The new ETA of the task in microseconds.
+    Raises:
+      apiproxy_errors.ApplicationError
+    """
+    task = datastore.Get([self.__task_key(queue_name,
+                                          request.task_name())])[0]
+    if task is None:
+      raise apiproxy_errors.ApplicationError(
+              taskqueue_service_pb.TaskQueueServiceError.UNKNOWN_TASK)
+
+    # The ETA of a leased task is when its lease expires, and the caller
+    # holds the lease only if it knows the current one.
+    now = self.__now_usec()
+    if task[ETA] != request.eta_usec() or task[ETA] < now:
+      raise apiproxy_errors.ApplicationError(
+              taskqueue_service_pb.TaskQueueServiceError.TASK_LEASE_EXPIRED)
+
+    old_key = self.__eta_key(queue_name, task[ETA], task[TASK_NAME])
+    task[ETA] = now + tq_lib._sec_to_usec(request.lease_seconds())
+    index_entity = self.__new_index_entity(queue_name, task)
+    if index_entity.key() != old_key:
+      datastore.Delete(old_key)
+    datastore.Put([task, index_entity])
+    return task[ETA]
+
+  def __delete_task(self, queue_name, task_name):
+    """ Deletes a task of a queue by name. Runs in a transaction.
+
+    Args:
+      queue_name: The celery name of the queue.
+      task_name: The name of the task.
+    Returns:
+      A taskqueue_service_pb.TaskQueueServiceError code.
+    """
+    task = datastore.Get([self.__task_key(queue_name, task_name)])[0]
+    if task is None:
+      return taskqueue_service_pb.TaskQueueServiceError.UNKNOWN_TASK
+    datastore.Delete([task.key(),
+                      self.__eta_key(queue_name, task[ETA], task[TASK_NAME])])
+    return taskqueue_service_pb.TaskQueueServiceError.OK
+
+  def __run_in_transaction(self, function, *args):
+    """ Runs a function in a datastore transaction.
+
+    Args:
+      function: The function to run.
+      args: The arguments to the function.
+    Returns:
+      What the function returned.
+    Raises:
+      apiproxy_errors.ApplicationError: If the function raised it, or with
+        TRANSIENT_ERROR if the transaction failed.
+    """
+    try:
+      return datastore.RunInTransaction(function, *args)
+    except datastore_errors.Error, error:
+      raise apiproxy_errors.ApplicationError(
+              taskqueue_service_pb.TaskQueueServiceError.TRANSIENT_ERROR,
+              str(error))
+
+  def __validate_lease_seconds(self, lease_seconds):
+    """ Checks the length of a lease.
+
+    Args:
+      lease_seconds: The length of the lease in seconds.
+    Raises:
+      apiproxy_errors.ApplicationError: If the lease is negative or too long.
+    """
+    if lease_seconds < 0 or lease_seconds > MAX_LEASE_SECONDS:
+      raise apiproxy_errors.ApplicationError(
+              taskqueue_service_pb.TaskQueueServiceError.INVALID_REQUEST)
+
+  def __fill_task(self, task_pb, task):
+    """ Copies a task entity into a task of a query response.
+
+    Args:
+      task_pb: A taskqueue_service_pb.TaskQueueQueryTasksResponse_Task.
+      task: The task entity.
+    """
+    task_pb.set_task_name(task[TASK_NAME])
+    task_pb.set_eta_usec(task[ETA])
+    task_pb.set_creation_time_usec(task[CREATED])
+    task_pb.set_retry_count(task[RETRY_COUNT])
+    task_pb.set_body(task[BODY])
+    task_pb.set_body_size(len(task[BODY]))
+    if task.get(TAG) is not None:
+      task_pb.set_tag(task[TAG])
+
+  def __now_usec(self):
+    """ Returns the current time in microseconds. """
+    return tq_lib._sec_to_usec(self.__gettime())
+
+  def __new_index_entity(self, queue_name, task):
+    """ Creates the entity placing a task in ETA order.
+
+    Args:
+      queue_name: The celery name of the queue.
+      task: The task entity.
+    Returns:
+      A datastore.Entity.
+    """
+    entity = datastore.Entity(TASK_ETA_KIND, parent=task.key(),
+               name=self.__eta_key_name(queue_name, task[ETA],
+                                        task[TASK_NAME]),
+               _app=TaskQueueConfig.APPSCALE_QUEUES)
+    entity[TASK_NAME] = task[TASK_NAME]
+    entity[ETA] = task[ETA]
+    entity[TAG] = task.get(TAG)
+    return entity
+
+  def __eta_query(self, start_key, end_key):
+    """ Returns a query for the index entities in a range of keys.
+
+    Args:
+      start_key: The first key in the range.
+      end_key: The key after the last one in the range.
+    Returns:
+      A datastore.Query.
+    """
+    return datastore.Query(TASK_ETA_KIND,
+             {datastore_types.KEY_SPECIAL_PROPERTY + " >=": start_key,
+              datastore_types.KEY_SPECIAL_PROPERTY + " <": end_key},
+             _app=TaskQueueConfig.APPSCALE_QUEUES)
+
+  def __queue_name(self, app_id, queue_name):
+    """ Returns the name of a queue which is unique across applications. """
+    return TaskQueueConfig.get_celery_queue_name(app_id, queue_name)
+
+  def __task_key(self, queue_name, task_name):
+    """ Returns the key of a task entity. """
+    return datastore.Key.from_path(TASK_KIND,
+             "%s.%s" % (queue_name, task_name),
+             _app=TaskQueueConfig.APPSCALE_QUEUES)
+
+  def __eta_key_name(self, queue_name, eta_usec, task_name):
+    """ Returns a key name which sorts by queue, then by ETA, and then by
+        task name. Celery queue names end in the queue's own name, which can
+        not hold '.' or '/', so no other queue's key names fall between
+        those of a queue.
+    """
+    return "%s.%020d.%s" % (queue_name, eta_usec, task_name)
+
+  def __eta_key(self, queue_name, eta_usec, task_name):
+    """ Returns the key of the index entity of a task. """
+    return datastore.Key.from_path(TASK_ETA_KIND,
+             self.__eta_key_name(queue_name, eta_usec, task_name),
+             parent=self.__task_key(queue_name, task_name),
+             _app=TaskQueueConfig.APPSCALE_QUEUES)
+
+  def __eta_bound(self, queue_name, eta_usec, task_name):
+    """ Returns a key which sorts with the index entities of a queue, for
+        bounding a range of them. Index entities are ordered by their own
+        key name ahead of their task's.
+    """
+    return datastore.Key.from_path(TASK_ETA_KIND,
+             self.__eta_key_name(queue_name, eta_usec, task_name),
+             _app=TaskQueueConfig.APPSCALE_QUEUES)
+
+  def __queue_end_bound(self, queue_name):
+    """ Returns a key which sorts after all index entities of a queue. """
+    return datastore.Key.from_path(TASK_ETA_KIND, queue_name + "/",
+             _app=TaskQueueConfig.APPSCALE_QUEUES)
@@ -42,6 +42,10 @@ celery = Celery(module_name, broker=config.get_broker_string(), backend='amqp')
 
 celery.config_from_object('CELERY_CONFIGURATION')
 
+# The queues whose tasks are leased by the application instead of being run
+# by these workers.
+PULL_QUEUES = getattr(__import__('CELERY_CONFIGURATION'), 'PULL_QUEUES', [])
+
 logger = get_task_logger(__name__)
 
 # This template header and tasks can be found in appscale/AppTaskQueue/templates
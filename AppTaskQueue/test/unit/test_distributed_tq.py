@@ -3,6 +3,7 @@
 import json
 import os
 import sys
+import types
 import unittest
 import urllib2
 
@@ -13,12 +14,14 @@ from distributed_tq import DistributedTaskQueue
 from tq_config import TaskQueueConfig
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../../lib"))
+import appscale_info
 import file_io
 import god_app_configuration
 import god_interface
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../../AppServer"))  
 from google.appengine.api import api_base_pb
+from google.appengine.api.taskqueue import taskqueue_service_pb
 
 sample_queue_yaml = \
 """
@@ -58,8 +61,50 @@ class FakeConnection():
   def urlopen(self, request, values):
     return FakeResponse()
 
+class FakeCeleryTask():
+  def __init__(self):
+    self.published = []
+  def apply_async(self, producer=None, **options):
+    self.published.append((producer, options))
+
+class FakeCeleryConnection():
+  def __init__(self):
+    self.channels = 0
+  def __enter__(self):
+    return self
+  def __exit__(self, *args):
+    pass
+  def channel(self):
+    self.channels += 1
+    return flexmock(close=lambda: None)
+
+# The names of the fake worker modules put in sys.modules.
+fake_worker_modules = []
+
+def new_worker_module(app_id):
+  """ Puts a worker module for an application with a default queue in
+      place of the one celery workers load. TestDistributedTaskQueue
+      removes it again after each test.
+  """
+  connection = FakeCeleryConnection()
+  celery = flexmock(pool=flexmock(acquire=lambda block: connection),
+                    amqp=flexmock(TaskProducer=lambda channel: "producer"))
+  module = types.ModuleType(
+    TaskQueueConfig.get_celery_worker_module_name(app_id))
+  module.celery = celery
+  module.PULL_QUEUES = []
+  module.queue___default = FakeCeleryTask()
+  sys.modules[module.__name__] = module
+  fake_worker_modules.append(module.__name__)
+  return module, connection
+
 class TestDistributedTaskQueue(unittest.TestCase):
 
+  def tearDown(self):
+    # Fake worker modules would otherwise be loaded by later tests.
+    while fake_worker_modules:
+      sys.modules.pop(fake_worker_modules.pop(), None)
+
   def test_start_worker(self):
     flexmock(file_io).should_receive("mkdir").and_return(None)
     flexmock(file_io) \
@@ -135,6 +180,60 @@ class TestDistributedTaskQueue(unittest.TestCase):
 
     dtq = DistributedTaskQueue()
 
+  def test_bulk_add_publishes_batch(self):
+    flexmock(file_io).should_receive("mkdir").and_return(None)
+    flexmock(appscale_info).should_receive("get_secret").and_return("secret")\
+      .once()
+    module, connection = new_worker_module('batchapp')
+
+    request = taskqueue_service_pb.TaskQueueBulkAddRequest()
+    for index in range(100):
+      add_request = request.add_add_request()
+      add_request.set_app_id('batchapp')
+      add_request.set_queue_name('default')
+      add_request.set_task_name('task%d' % index)
+      add_request.set_url('/worker')
+      add_request.set_eta_usec(0)
+      add_request.set_method(
+        taskqueue_service_pb.TaskQueueAddRequest.POST)
+
+    dtq = DistributedTaskQueue()
+    response = taskqueue_service_pb.TaskQueueBulkAddResponse(
+      dtq.bulk_add('batchapp', request.Encode())[0])
+    self.assertEquals([result.result() for result in
+                       response.taskresult_list()],
+                      [taskqueue_service_pb.TaskQueueServiceError.OK] * 100)
+    self.assertEquals(connection.channels, 1)
+    published = module.queue___default.published
+    self.assertEquals(len(published), 100)
+    self.assertEquals(set([producer for producer, _ in published]),
+                      set(["producer"]))
+    self.assertEquals(published[0][1]['routing_key'], 'batchapp___default')
+
+  def test_bulk_add_without_pull_queues(self):
+    flexmock(file_io).should_receive("mkdir").and_return(None)
+    flexmock(appscale_info).should_receive("get_secret").and_return("secret")
+    # Worker modules written before pull queues existed do not list them.
+    module, _ = new_worker_module('oldapp')
+    del module.PULL_QUEUES
+
+    request = taskqueue_service_pb.TaskQueueBulkAddRequest()
+    add_request = request.add_add_request()
+    add_request.set_app_id('oldapp')
+    add_request.set_queue_name('default')
+    add_request.set_task_name('task')
+    add_request.set_url('/worker')
+    add_request.set_eta_usec(0)
+    add_request.set_method(taskqueue_service_pb.TaskQueueAddRequest.POST)
+
+    dtq = DistributedTaskQueue()
+    response = taskqueue_service_pb.TaskQueueBulkAddResponse(
+      dtq.bulk_add('oldapp', request.Encode())[0])
+    self.assertEquals([result.result() for result in
+                       response.taskresult_list()],
+                      [taskqueue_service_pb.TaskQueueServiceError.OK])
+    self.assertEquals(len(module.queue___default.published), 1)
+
   def test_modify_task_lease(self):
     flexmock(file_io).should_receive("mkdir").and_return(None)
     flexmock(file_io) \
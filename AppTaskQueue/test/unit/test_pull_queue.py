@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+from flexmock import flexmock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+import pull_queue
+from pull_queue import PullQueues
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../../AppServer"))
+from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
+from google.appengine.api.taskqueue import taskqueue_service_pb
+from google.appengine.runtime import apiproxy_errors
+
+def kind_row(key):
+  """ Orders keys as the kind table does, by their own name first. """
+  row = ""
+  while key is not None:
+    row += "%s:%s!" % (key.kind(), key.name())
+    key = key.parent()
+  return row
+
+class FakeQuery():
+  def __init__(self, store, scanned, kind, filters={}, _app=None):
+    self.store = store
+    self.scanned = scanned
+    self.kind = kind
+    self.filters = filters
+  def Run(self, **kwargs):
+    tests = {">=": lambda row, bound: row >= bound,
+             "<": lambda row, bound: row < bound}
+    keys = [key for key in self.store if key.kind() == self.kind and \
+            all(tests[name.split()[1]](kind_row(key), kind_row(bound))
+                for name, bound in self.filters.items())]
+    entities = [self.store[key] for key in sorted(keys, key=kind_row)]
+    self.scanned.extend(entities)
+    return entities
+  def Get(self, limit):
+    return self.Run()[:limit]
+
+class FakeDatastore():
+  """ Keeps entities in a dict, and runs transactions right away. """
+  def __init__(self):
+    self.store = {}
+    self.scanned = []
+    flexmock(datastore).should_receive("RunInTransaction").replace_with(
+      lambda function, *args: function(*args))
+    flexmock(datastore).should_receive("Get").replace_with(
+      lambda keys: [self.store.get(key) for key in keys])
+    flexmock(datastore).should_receive("Put").replace_with(self.put)
+    flexmock(datastore).should_receive("Delete").replace_with(self.delete)
+    flexmock(datastore).should_receive("Query").replace_with(
+      lambda *args, **kwargs: FakeQuery(self.store, self.scanned, *args,
+                                        **kwargs))
+  def put(self, entities):
+    for entity in entities:
+      self.store[entity.key()] = entity
+  def delete(self, keys):
+    if not isinstance(keys, list):
+      keys = [keys]
+    for key in keys:
+      del self.store[key]
+
+def new_add_request(name, eta_usec, tag=None, queue_name="pullq"):
+  request = taskqueue_service_pb.TaskQueueAddRequest()
+  request.set_app_id("myapp")
+  request.set_queue_name(queue_name)
+  request.set_task_name(name)
+  request.set_eta_usec(eta_usec)
+  request.set_body("body of " + name)
+  request.set_mode(taskqueue_service_pb.TaskQueueMode.PULL)
+  if tag is not None:
+    request.set_tag(tag)
+  return request
+
+def new_lease_request(max_tasks, lease_seconds=10, group_by_tag=False,
+                      tag=None):
+  request = taskqueue_service_pb.TaskQueueQueryAndOwnTasksRequest()
+  request.set_queue_name("pullq")
+  request.set_lease_seconds(lease_seconds)
+  request.set_max_tasks(max_tasks)
+  request.set_group_by_tag(group_by_tag)
+  if tag is not None:
+    request.set_tag(tag)
+  return request
+
+class TestPullQueues(unittest.TestCase):
+  def setUp(self):
+    self.fake_datastore = FakeDatastore()
+    self.now = 100.0
+    self.queues = PullQueues(gettime=lambda: self.now)
+
+  def lease(self, request):
+    response = taskqueue_service_pb.TaskQueueQueryAndOwnTasksResponse()
+    self.queues.lease_tasks("myapp", request, response)
+    return [task.task_name() for task in response.task_list()]
+
+  def test_add_tasks(self):
+    codes = self.queues.add_tasks([new_add_request("a", 1),
+                                   new_add_request("b", 2),
+                                   new_add_request("a", 3)])
+    self.assertEquals(codes, [taskqueue_service_pb.TaskQueueServiceError.OK,
+      taskqueue_service_pb.TaskQueueServiceError.OK,
+      taskqueue_service_pb.TaskQueueServiceError.DUPLICATE_TASK_NAME])
+    self.assertEquals(len(self.fake_datastore.store), 4)
+
+    codes = self.queues.add_tasks([new_add_request("b", 5)])
+    self.assertEquals(codes,
+      [taskqueue_service_pb.TaskQueueServiceError.TASK_ALREADY_EXISTS])
+
+  def test_lease_tasks(self):
+    self.queues.add_tasks([new_add_request("late", 200000000),
+                           new_add_request("second", 20000000),
+                           new_add_request("first", 10000000),
+                           new_add_request("third", 30000000)])
+    self.assertEquals(self.lease(new_lease_request(2)), ["first", "second"])
+    self.assertEquals(self.lease(new_lease_request(5)), ["third"])
+    self.assertEquals(self.lease(new_lease_request(5)), [])
+
+    # Leases which are not extended expire.
+    self.now = 115.0
+    response = taskqueue_service_pb.TaskQueueQueryAndOwnTasksResponse()
+    self.queues.lease_tasks("myapp", new_lease_request(5), response)
+    self.assertEquals([task.task_name() for task in response.task_list()],
+                      ["first", "second", "third"])
+    self.assertEquals(response.task(0).retry_count(), 2)
+    self.assertEquals(response.task(0).eta_usec(), 125000000)
+    self.assertEquals(response.task(0).body(), "body of first")
+
+  def test_lease_reads_only_due_tasks(self):
+    self.queues.add_tasks([new_add_request("first", 10000000),
+                           new_add_request("late", 200000000),
+                           new_add_request("other", 1, queue_name="pullq2"),
+                           new_add_request("second", 20000000)])
+    self.assertEquals(self.lease(new_lease_request(5)), ["first", "second"])
+    self.assertEquals([entity.kind() for entity in
+                       self.fake_datastore.scanned],
+                      [pull_queue.TASK_ETA_KIND] * 2)
+
+  def test_lease_skips_tasks_taken_by_other_workers(self):
+    self.queues.add_tasks([new_add_request("a", 1), new_add_request("b", 2),
+                           new_add_request("c", 3)])
+    def run_in_transaction(function, queue_name, index_key, *args):
+      if index_key.parent().name() == "myapp___pullq.a":
+        raise datastore_errors.TransactionFailedError()
+      return function(queue_name, index_key, *args)
+    flexmock(datastore).should_receive("RunInTransaction").replace_with(
+      run_in_transaction)
+    self.assertEquals(self.lease(new_lease_request(2)), ["b", "c"])
+
+  def test_lease_tasks_by_tag(self):
+    self.queues.add_tasks([new_add_request("a1", 1, tag="a"),
+                           new_add_request("b1", 2, tag="b"),
+                           new_add_request("a2", 3, tag="a"),
+                           new_add_request("b2", 4, tag="b")])
+    self.assertEquals(self.lease(new_lease_request(5, tag="b",
+                                   group_by_tag=True)), ["b1", "b2"])
+    self.assertEquals(self.lease(new_lease_request(5, group_by_tag=True)),
+                      ["a1", "a2"])
+
+    self.assertRaises(apiproxy_errors.ApplicationError, self.lease,
+                      new_lease_request(5, tag="a"))
+    self.assertRaises(apiproxy_errors.ApplicationError, self.lease,
+                      new_lease_request(pull_queue.MAX_TASKS_PER_LEASE + 1))
+
+  def test_modify_task_lease(self):
+    self.queues.add_tasks([new_add_request("a", 1)])
+    self.lease(new_lease_request(1, lease_seconds=10))
+
+    request = taskqueue_service_pb.TaskQueueModifyTaskLeaseRequest()
+    request.set_queue_name("pullq")
+    request.set_task_name("a")
+    request.set_eta_usec(110000000)
+    request.set_lease_seconds(60)
+    response = taskqueue_service_pb.TaskQueueModifyTaskLeaseResponse()
+    self.queues.modify_task_lease("myapp", request, response)
+    self.assertEquals(response.updated_eta_usec(), 160000000)
+
+    # The old lease is no longer held.
+    try:
+      self.queues.modify_task_lease("myapp", request, response)
+      raise
+    except apiproxy_errors.ApplicationError, error:
+      self.assertEquals(error.application_error,
+        taskqueue_service_pb.TaskQueueServiceError.TASK_LEASE_EXPIRED)
+
+    self.now = 150.0
+    self.assertEquals(self.lease(new_lease_request(1)), [])
+
+  def test_delete_tasks(self):
+    self.queues.add_tasks([new_add_request("a", 1), new_add_request("b", 2)])
+    request = taskqueue_service_pb.TaskQueueDeleteRequest()
+    request.set_queue_name("pullq")
+    request.add_task_name("a")
+    request.add_task_name("missing")
+    response = taskqueue_service_pb.TaskQueueDeleteResponse()
+    self.queues.delete_tasks("myapp", request, response)
+    self.assertEquals(response.result_list(),
+      [taskqueue_service_pb.TaskQueueServiceError.OK,
+       taskqueue_service_pb.TaskQueueServiceError.UNKNOWN_TASK])
+    self.assertEquals(self.lease(new_lease_request(5)), ["b"])
+
+  def test_query_and_fetch_tasks(self):
+    self.queues.add_tasks([new_add_request("a", 1), new_add_request("b", 2),
+                           new_add_request("c", 3)])
+    request = taskqueue_service_pb.TaskQueueQueryTasksRequest()
+    request.set_queue_name("pullq")
+    request.set_start_eta_usec(2)
+    request.set_max_rows(5)
+    response = taskqueue_service_pb.TaskQueueQueryTasksResponse()
+    self.queues.query_tasks("myapp", request, response)
+    self.assertEquals([task.task_name() for task in response.task_list()],
+                      ["b", "c"])
+
+    request = taskqueue_service_pb.TaskQueueFetchTaskRequest()
+    request.set_queue_name("pullq")
+    request.set_task_name("c")
+    response = taskqueue_service_pb.TaskQueueFetchTaskResponse()
+    self.queues.fetch_task("myapp", request, response)
+    self.assertEquals(response.task().task(0).body(), "body of c")
+    self.assertEquals(response.task().task(0).creation_time_usec(), 100000000)
+
+    request.set_task_name("missing")
+    self.assertRaises(apiproxy_errors.ApplicationError,
+      self.queues.fetch_task, "myapp", request, response)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -34,6 +34,15 @@ queue:
   rate: 10/m
 """
 
+sample_queue_yaml3 = \
+"""
+queue:
+- name: foo
+  rate: 10/m
+- name: pullq
+  mode: pull
+"""
+
 sample_queue_xml = \
 """<?xml version="1.0" encoding="utf-8"?>
 <queue-entries>
@@ -216,6 +225,21 @@ class TestTaskQueueConfig(unittest.TestCase):
     self.assertEquals(tqc.create_celery_file(TaskQueueConfig.QUEUE_INFO_FILE),
                       TaskQueueConfig.CELERY_CONFIG_DIR + "myapp" + ".py")
  
+  def test_create_celery_file_with_pull_queue(self):
+    flexmock(file_io).should_receive("read").and_return(sample_queue_yaml3)
+    flexmock(file_io).should_receive("exists").and_return(True)
+    flexmock(file_io).should_receive("mkdir").and_return(None)
+    written = {}
+    flexmock(file_io).should_receive("write").replace_with(
+      lambda path, contents: written.update({path: contents}))
+    tqc = TaskQueueConfig(TaskQueueConfig.RABBITMQ, 'myapp')
+    tqc.load_queues_from_file('app_id')
+
+    config_file = tqc.create_celery_file(TaskQueueConfig.QUEUE_INFO_FILE)
+    assert 'myapp___pullq' not in written[config_file]
+    assert 'myapp___foo' in written[config_file]
+    assert 'PULL_QUEUES = ["pullq"]' in written[config_file]
+
   def test_create_celery_worker_scripts(self):
     flexmock(file_io).should_receive("read").and_return(sample_queue_yaml2)
     flexmock(file_io).should_receive("write").and_return(None)
@@ -270,6 +270,8 @@ queue:
     script = header_template.replace("CELERY_CONFIGURATION", 
                                      self._app_id) + '\n'
     for queue in queue_info['queue']:
+      if 'mode' in queue and queue['mode'] == "pull":
+        continue # pull tasks are leased from the datastore, not run by celery
       queue_name = queue['name']  
       # The queue name is used as a function name so replace invalid chars
       queue_name = queue_name.replace('-', '_')
@@ -375,9 +377,13 @@ queue:
  
     celery_queues = []
     celery_annotations = []
+    pull_queues = []
     for queue in queue_info['queue']:
       if 'mode' in queue and queue['mode'] == "pull":
-        continue # celery does not handle pull queues
+        # Celery does not handle pull queues, but the taskqueue server
+        # needs to know which queues they are.
+        pull_queues.append(str(queue['name']))
+        continue
       celery_queue_name = \
         TaskQueueConfig.get_celery_queue_name(self._app_id, queue['name'])
       celery_queues.append("Queue('" + celery_queue_name + \
@@ -417,6 +423,7 @@ CELERY_ANNOTATIONS = {
 CELERY_IGNORE_RESULT = True
 CELERY_STORE_ERRORS_EVEN_IF_IGNORED = True
 """
+    config += "PULL_QUEUES = " + json.dumps(pull_queues) + "\n"
     config_file = self._app_id + ".py" 
     file_io.write(self.CELERY_CONFIG_DIR + config_file, config)
     return self.CELERY_CONFIG_DIR + config_file
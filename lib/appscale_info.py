@@ -64,6 +64,37 @@ def get_taskqueue_nodes():
     nodes = nodes[:-1]
   return nodes
 
+def get_db_master_ip():
+  """ Returns the private IP of the database master node.
+
+  Returns:
+    A string containing the IP of the database master.
+  """
+  return file_io.read(constants.DB_MASTER_FILE).rstrip()
+
+def get_db_slave_ips():
+  """ Returns the private IPs of the database slave nodes. Strips off any
+      empty lines.
+
+  Returns:
+    A list of database slave IPs.
+  """
+  nodes = file_io.read(constants.DB_SLAVES_FILE).split('\n')
+  return [node.strip() for node in nodes if node.strip()]
+
+def get_db_ips():
+  """ Returns the private IPs of all database nodes, the master first and
+      without duplicates.
+
+  Returns:
+    A list of database node IPs.
+  """
+  ips = [get_db_master_ip()]
+  for ip in get_db_slave_ips():
+    if ip not in ips:
+      ips.append(ip)
+  return ips
+
 def get_app_path(app_id):
   """ Returns the application path.
   
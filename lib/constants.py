@@ -34,6 +34,12 @@ DB_INFO_LOC = '/etc/appscale/database_info.yaml'
 # The file location which has all taskqueue nodes listed.
 TASKQUEUE_NODE_FILE = "/etc/appscale/taskqueue_nodes"
 
+# The file location which has the database master node.
+DB_MASTER_FILE = "/etc/appscale/masters"
+
+# The file location which has all database slave nodes listed.
+DB_SLAVES_FILE = "/etc/appscale/slaves"
+
 # The port of the datastore server
 DB_SERVER_PORT = 8888
 
@@ -43,6 +43,17 @@ class TestAppScaleInfo(unittest.TestCase):
        .should_receive("read").and_return("")
     self.assertEquals(appscale_info.get_taskqueue_nodes(), [])
 
-      
+  def test_get_db_ips(self):
+    flexmock(file_io).should_receive("read") \
+      .with_args("/etc/appscale/masters").and_return("192.168.0.1\n")
+    flexmock(file_io).should_receive("read") \
+      .with_args("/etc/appscale/slaves") \
+      .and_return("192.168.0.2\n192.168.0.1\n\n192.168.0.3\n")
+    self.assertEquals(appscale_info.get_db_master_ip(), "192.168.0.1")
+    self.assertEquals(appscale_info.get_db_slave_ips(),
+      ["192.168.0.2", "192.168.0.1", "192.168.0.3"])
+    self.assertEquals(appscale_info.get_db_ips(),
+      ["192.168.0.1", "192.168.0.2", "192.168.0.3"])
+
 if __name__ == "__main__":
   unittest.main()